@@ -6,6 +6,16 @@ import sys
 import socket
 import time
 import traceback
+import sqlite3
+import getopt
+import multiprocessing
+from hashlib import sha1
+from itertools import izip
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 sys.path.append("../../")
 from TorCtl.TorUtil import plog
@@ -56,6 +66,26 @@ MAX_AGE = 2*GUARD_SAMPLE_RATE
 # If the resultant scan file is older than 1.5 days, something is wrong
 MAX_SCAN_AGE = 60*60*24*1.5
 
+# Catalog of already-parsed slice files, relative to the data dir.
+# It is only a cache: deleting it just forces a full re-read.
+SCAN_CATALOG = "aggregate-catalog.sqlite"
+
+# A slice file whose mtime was this long before the last run looked at
+# its scan dir is taken to be complete, and is served from the catalog
+# without a stat. Newer ones may still have been in the middle of being
+# written, and are checked again.
+CATALOG_SETTLE = 60*10
+
+# Number of processes reading scanner directories in parallel, one
+# scanner per process at a time. 0 means one per CPU.
+# Overridden by --workers on the command line.
+INGEST_WORKERS = 0
+
+# Use the NumPy-backed VectorPID engine (--numpy-pid) when numpy is
+# installed. Its votes must be identical to those of the pure Python
+# ScalarPID engine; test/test_pid.py checks this on recorded slice files.
+USE_NUMPY_PID = False
+
 # path to git repos (.git)
 PATH_TO_TORFLOW_REPO = '../../.git/'
 PATH_TO_TORCTL_REPO = '../../.git/modules/TorCtl/'
@@ -174,26 +204,276 @@ class Node:
       self.strm_fail_rate = line.strm_fail_rate
       self.scanner = line.filename
 
+# Split a "key=value key=value ..." result line into a dict in one pass.
+# Like the per-field regexps it replaces, the first occurrence of a key
+# wins and keys with empty values are treated as absent.
+def parse_fields(line):
+  fields = {}
+  for tok in line.split():
+    (key, sep, val) = tok.partition("=")
+    if sep and val and key not in fields:
+      fields[key] = val
+  return fields
+
+def get_field(fields, key):
+  try:
+    return fields[key]
+  except KeyError:
+    # AttributeError is what a failed re.search().group() used to raise,
+    # and is what callers treat as a slice file format error.
+    raise AttributeError("Missing field "+key)
+
 class Line:
   def __init__(self, line, slice_file, timestamp, filename):
-    self.idhex = re.search("[\s]*node_id=([\S]+)[\s]*", line).group(1)
-    self.nick = re.search("[\s]*nick=([\S]+)[\s]*", line).group(1)
-    self.strm_bw = int(re.search("[\s]*strm_bw=([\S]+)[\s]*", line).group(1))
-    self.filt_bw = int(re.search("[\s]*filt_bw=([\S]+)[\s]*", line).group(1))
-    self.ns_bw = int(re.search("[\s]*ns_bw=([\S]+)[\s]*", line).group(1))
-    self.desc_bw = int(re.search("[\s]*desc_bw=([\S]+)[\s]*", line).group(1))
+    fields = parse_fields(line)
+    self.idhex = get_field(fields, "node_id")
+    self.nick = get_field(fields, "nick")
+    self.strm_bw = int(get_field(fields, "strm_bw"))
+    self.filt_bw = int(get_field(fields, "filt_bw"))
+    self.ns_bw = int(get_field(fields, "ns_bw"))
+    self.desc_bw = int(get_field(fields, "desc_bw"))
     self.slice_file = slice_file
     self.filename = filename
     self.measured_at = timestamp
     try:
-      self.circ_fail_rate = float(re.search("[\s]*circ_fail_rate=([\S]+)[\s]*", line).group(1))
-    except:
+      self.circ_fail_rate = float(fields["circ_fail_rate"])
+    except (KeyError, ValueError):
       self.circ_fail_rate = 0
     try:
-      self.strm_fail_rate = float(re.search("[\s]*strm_fail_rate=([\S]+)[\s]*", line).group(1))
-    except:
+      self.strm_fail_rate = float(fields["strm_fail_rate"])
+    except (KeyError, ValueError):
       self.strm_fail_rate = 0
 
+  # The parsed fields, as stored in the ScanCatalog
+  def row(self):
+    return (self.idhex, self.nick, self.strm_bw, self.filt_bw, self.ns_bw,
+            self.desc_bw, self.circ_fail_rate, self.strm_fail_rate)
+
+# Yield a Line for each well-formed node line of an open bws-* slice
+# file, streaming from fp. Malformed lines are logged and skipped.
+def read_slice_lines(fp, slice_file, timestamp, filename):
+  fp.readline() # slicenum
+  fp.readline() # timestamp
+  for l in fp:
+    try:
+      line = Line(l, slice_file, timestamp, filename)
+    except ValueError,e:
+      plog("NOTICE", "Conversion error "+str(e)+" at "+l)
+      continue
+    except AttributeError, e:
+      plog("NOTICE", "Slice file format error "+str(e)+" at "+l)
+      continue
+    except Exception, e:
+      plog("WARN", "Unknown slice parse error "+str(e)+" at "+l)
+      traceback.print_exc()
+      continue
+    yield line
+
+# A slice file line restored from the ScanCatalog rather than parsed
+class CatalogLine(Line):
+  def __init__(self, row, slice_file, timestamp, filename):
+    (self.idhex, self.nick, self.strm_bw, self.filt_bw, self.ns_bw,
+     self.desc_bw, self.circ_fail_rate, self.strm_fail_rate) = row
+    self.slice_file = slice_file
+    self.filename = filename
+    self.measured_at = timestamp
+
+# On-disk index of bws-*-done-* files keyed by path, mtime and size,
+# holding the parsed node lines of each. Files that have not changed
+# since the last run are served from here instead of being re-read.
+# It also remembers the mtime of each scan dir and when it was last
+# listed, so that unchanged dirs need not be listed again.
+class ScanCatalog:
+  SCHEMA_VERSION = 2
+
+  def __init__(self, db_file):
+    try:
+      self.db = self._open(db_file)
+    except sqlite3.DatabaseError, e:
+      plog("WARN", "Scan catalog "+db_file+" unusable ("+str(e)+"). Rebuilding.")
+      os.remove(db_file)
+      self.db = self._open(db_file)
+
+  def _open(self, db_file):
+    db = sqlite3.connect(db_file)
+    db.text_factory = str
+    if db.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+      db.execute("DROP TABLE IF EXISTS files")
+      db.execute("DROP TABLE IF EXISTS lines")
+      db.execute("DROP TABLE IF EXISTS dirs")
+      db.execute("""CREATE TABLE files (path TEXT PRIMARY KEY, dir TEXT,
+                      mtime REAL, size INTEGER, slicenum TEXT,
+                      timestamp REAL)""")
+      db.execute("""CREATE TABLE dirs (path TEXT PRIMARY KEY, mtime REAL,
+                      listed REAL)""")
+      # The fail rate columns are untyped so that a missing (0) rate
+      # reads back as 0 and not 0.0, keeping the vote file unchanged.
+      db.execute("""CREATE TABLE lines (path TEXT, idhex TEXT, nick TEXT,
+                      strm_bw INTEGER, filt_bw INTEGER, ns_bw INTEGER,
+                      desc_bw INTEGER, circ_fail_rate, strm_fail_rate)""")
+      db.execute("CREATE INDEX lines_path ON lines (path)")
+      db.execute("CREATE INDEX files_timestamp ON files (timestamp)")
+      db.execute("CREATE INDEX files_dir ON files (dir)")
+      db.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+      db.commit()
+    return db
+
+  # Look up the header of a slice file. Returns (slicenum, timestamp, st)
+  # where st is None if the catalog is current for path, and otherwise
+  # the os.stat() result to pass to store_file() once it is parsed.
+  def check_file(self, path):
+    st = os.stat(path)
+    row = self.db.execute("SELECT mtime, size, slicenum, timestamp FROM files WHERE path = ?",
+                          (path,)).fetchone()
+    if row and row[0] == st.st_mtime and row[1] == st.st_size:
+      return (row[2], row[3], None)
+
+    fp = file(path, "r")
+    slicenum = fp.readline()
+    timestamp = float(fp.readline())
+    fp.close()
+    return (slicenum, timestamp, st)
+
+  def store_file(self, path, st, slicenum, timestamp, rows):
+    self.remove_file(path)
+    self.db.executemany("INSERT INTO lines VALUES (?,?,?,?,?,?,?,?,?)",
+                        map(lambda r: (path,)+r, rows))
+    self.db.execute("INSERT INTO files VALUES (?,?,?,?,?,?)",
+                    (path, os.path.dirname(path), st.st_mtime, st.st_size,
+                     slicenum, timestamp))
+
+  # The cataloged files of a scan dir, as {path: (mtime, slicenum, timestamp)}
+  def dir_files(self, dirpath):
+    files = {}
+    for (path, mtime, slicenum, timestamp) in self.db.execute(
+        "SELECT path, mtime, slicenum, timestamp FROM files WHERE dir = ?",
+        (dirpath,)):
+      files[path] = (mtime, slicenum, timestamp)
+    return files
+
+  # (mtime, listed) of a scan dir as of the last run, or None
+  def dir_listing(self, dirpath):
+    return self.db.execute("SELECT mtime, listed FROM dirs WHERE path = ?",
+                           (dirpath,)).fetchone()
+
+  def store_dir(self, dirpath, mtime, listed):
+    self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?,?,?)",
+                    (dirpath, mtime, listed))
+
+  def read_rows(self, path):
+    return self.db.execute("""SELECT idhex, nick, strm_bw, filt_bw, ns_bw,
+                              desc_bw, circ_fail_rate, strm_fail_rate
+                              FROM lines WHERE path = ?""", (path,)).fetchall()
+
+  def expired_files(self, cutoff):
+    return map(lambda r: r[0],
+               self.db.execute("SELECT path FROM files WHERE timestamp < ?",
+                               (cutoff,)).fetchall())
+
+  def remove_file(self, path):
+    self.db.execute("DELETE FROM lines WHERE path = ?", (path,))
+    self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+  # Forget about files and dirs that have disappeared from the scan dirs
+  def prune(self, seen_paths, seen_dirs):
+    for (path,) in self.db.execute("SELECT path FROM files").fetchall():
+      if path not in seen_paths:
+        self.remove_file(path)
+    for (path,) in self.db.execute("SELECT path FROM dirs").fetchall():
+      if path not in seen_dirs:
+        self.db.execute("DELETE FROM dirs WHERE path = ?", (path,))
+
+  def commit(self):
+    self.db.commit()
+
+  def close(self):
+    self.db.close()
+
+# Fold the slice files of one scanner into one partial record per node,
+# the way Node.add_line would: the newest measurement (the first one on
+# ties) and the nick of the last line seen. Runs in a worker process.
+#
+# job is (catalog_file, datadir, files), with files a list of
+# (slice_file, timestamp, path, st) as from ScanCatalog.check_file().
+# Files the catalog does not have yet are parsed here, and their rows
+# returned so the parent can store them.
+#
+# Returns (partials, new_rows). partials maps idhex to
+# (nick, row, slice_file, timestamp, filename).
+def ingest_scanner(job):
+  (catalog_file, datadir, files) = job
+  catalog = None
+  partials = {}
+  new_rows = {}
+  for (slice_file, timestamp, path, st) in files:
+    if st is None:
+      if not catalog:
+        catalog = ScanCatalog(catalog_file)
+      rows = catalog.read_rows(path)
+    else:
+      fp = file(path, "r")
+      rows = map(lambda l: l.row(),
+                 read_slice_lines(fp, slice_file, timestamp, path))
+      fp.close()
+      new_rows[path] = rows
+    filename = path.replace(datadir, "")
+    for row in rows:
+      p = partials.get(row[0])
+      if p is None or timestamp > p[3]:
+        partials[row[0]] = (row[1], row, slice_file, timestamp, filename)
+      else:
+        partials[row[0]] = (row[1],)+p[1:]
+  if catalog:
+    catalog.close()
+  return (partials, new_rows)
+
+# The bws-*-done-* files of a scanner's scan-data dir, sorted, as
+# (path, slicenum, timestamp, st) with st as from ScanCatalog.check_file().
+#
+# The scanner writes its slice files straight into scan-data, once each,
+# and only aggregate removes them. So the dir is listed again only if its
+# mtime moved since the last run, or moved within CATALOG_SETTLE of that
+# run's listing (a file may have come in within the mtime granularity).
+# Of the files listed, only those the catalog does not have or that were
+# not yet settled last time are stat()ed; the rest, the bulk of the 28
+# days of slices, come from the catalog alone.
+def list_scan_dir(catalog, scan_dir):
+  now = time.time()
+  try:
+    dir_mtime = os.stat(scan_dir).st_mtime
+  except OSError:
+    return []
+  known = catalog.dir_files(scan_dir)
+  listing = catalog.dir_listing(scan_dir)
+  settled = 0
+  if listing:
+    settled = listing[1] - CATALOG_SETTLE
+  if listing and listing[0] == dir_mtime and dir_mtime < settled:
+    paths = known.keys()
+  else:
+    paths = [scan_dir+"/"+f for f in os.listdir(scan_dir)
+             if re.search("^bws-[\S]+-done-", f)]
+  catalog.store_dir(scan_dir, dir_mtime, now)
+  ret = []
+  for path in sorted(paths):
+    if path in known and known[path][0] < settled:
+      (mtime, slicenum, timestamp) = known[path]
+      ret.append((path, slicenum, timestamp, None))
+    else:
+      ret.append((path,)+catalog.check_file(path))
+  return ret
+
+def remove_scan_file(path):
+  sqlf = path.replace("bws-", "sql-")
+  plog("INFO", "Removing old file "+path+" and "+sqlf)
+  try:
+    os.remove(path)
+  except OSError:
+    pass # Already gone
+  try:
+    os.remove(sqlf)
+  except:
+    pass # In some cases the sql file may not exist
 
 class Vote:
   def __init__(self, line):
@@ -322,6 +602,758 @@ class ConsensusJunk:
       self.bw_weights["Wgd"] = 0
       self.bw_weights["Wgg"] = 1.0
 
+# Pure Python PID feedback engine, operating on the nodes dict.
+# VectorPID below is a drop-in, NumPy-backed replacement.
+class ScalarPID:
+  def class_avgs(self, cs_junk):
+    true_filt_avg = {}
+    pid_tgt_avg = {}
+    true_strm_avg = {}
+    true_circ_avg = {}
+
+    if cs_junk.bwauth_pid_control:
+      # Penalize nodes for circuit failure: it indicates CPU pressure
+      # TODO: Potentially penalize for stream failure, if we run into
+      # socket exhaustion issues..
+      plog("INFO", "PID control enabled")
+
+      # TODO: Please forgive me for this, I wanted to see
+      # these loglines, so we go aead and run this code regardless of
+      # the group_by_class setting, and just reset the values if it is not set.
+
+      for cl in ["Guard+Exit", "Guard", "Exit", "Middle"]:
+        c_nodes = filter(lambda n: n.node_class() == cl, nodes.itervalues())
+        if len(c_nodes) > 0:
+          true_filt_avg[cl] = sum(map(lambda n: n.filt_bw, c_nodes))/float(len(c_nodes))
+          true_strm_avg[cl] = sum(map(lambda n: n.strm_bw, c_nodes))/float(len(c_nodes))
+          true_circ_avg[cl] = sum(map(lambda n: (1.0-n.circ_fail_rate),
+                               c_nodes))/float(len(c_nodes))
+        else:
+          true_filt_avg[cl] = 0.0
+          true_strm_avg[cl] = 0.0
+          true_circ_avg[cl] = 0.0
+
+        # FIXME: This may be expensive
+        pid_tgt_avg[cl] = true_filt_avg[cl]
+        prev_pid_avg = 2*pid_tgt_avg[cl]
+
+        while prev_pid_avg > pid_tgt_avg[cl]:
+          f_nodes = filter(lambda n: n.desc_bw >= pid_tgt_avg[cl], c_nodes)
+          prev_pid_avg = pid_tgt_avg[cl]
+          if len(f_nodes) > 0:
+            pid_tgt_avg[cl] = sum(map(lambda n: n.filt_bw, f_nodes))/float(len(f_nodes))
+          else:
+            pid_tgt_avg[cl] = 0.0
+
+        plog("INFO", "Network true_filt_avg["+cl+"]: "+str(true_filt_avg[cl]))
+        plog("INFO", "Network pid_tgt_avg["+cl+"]: "+str(pid_tgt_avg[cl]))
+        plog("INFO", "Network true_circ_avg["+cl+"]: "+str(true_circ_avg[cl]))
+
+      filt_avg = sum(map(lambda n: n.filt_bw, nodes.itervalues()))/float(len(nodes))
+      strm_avg = sum(map(lambda n: n.strm_bw, nodes.itervalues()))/float(len(nodes))
+      circ_avg = sum(map(lambda n: (1.0-n.circ_fail_rate),
+                         nodes.itervalues()))/float(len(nodes))
+      plog("INFO", "Network filt_avg: "+str(filt_avg))
+      plog("INFO", "Network circ_avg: "+str(circ_avg))
+
+      if not cs_junk.group_by_class:
+        # FIXME: This may be expensive
+        pid_avg = filt_avg
+        prev_pid_avg = 2*pid_avg
+        f_nodes = nodes.values()
+
+        while prev_pid_avg > pid_avg:
+          f_nodes = filter(lambda n: n.desc_bw >= pid_avg, f_nodes)
+          prev_pid_avg = pid_avg
+          pid_avg = sum(map(lambda n: n.filt_bw, f_nodes))/float(len(f_nodes))
+
+        for cl in ["Guard+Exit", "Guard", "Exit", "Middle"]:
+          true_filt_avg[cl] = filt_avg
+          true_strm_avg[cl] = strm_avg
+          true_circ_avg[cl] = circ_avg
+          pid_tgt_avg[cl] = pid_avg
+
+        plog("INFO", "Network pid_avg: "+str(pid_avg))
+
+    else:
+      plog("INFO", "PID control disabled")
+      filt_avg = sum(map(lambda n: n.filt_bw, nodes.itervalues()))/float(len(nodes))
+      strm_avg = sum(map(lambda n: n.strm_bw, nodes.itervalues()))/float(len(nodes))
+      for cl in ["Guard+Exit", "Guard", "Exit", "Middle"]:
+        true_filt_avg[cl] = filt_avg
+        true_strm_avg[cl] = strm_avg
+    return (true_filt_avg, pid_tgt_avg, true_strm_avg, true_circ_avg)
+
+  def update_bws(self, cs_junk, prev_votes, true_filt_avg, pid_tgt_avg,
+                 true_strm_avg, true_circ_avg):
+    tot_net_bw = 0
+    for n in nodes.itervalues():
+      n.fbw_ratio = n.filt_bw/true_filt_avg[n.node_class()]
+      n.sbw_ratio = n.strm_bw/true_strm_avg[n.node_class()]
+
+      if cs_junk.bwauth_pid_control:
+        if cs_junk.use_desc_bw:
+          n.use_bw = n.desc_bw
+        else:
+          n.use_bw = n.ns_bw
+
+        if cs_junk.use_pid_tgt:
+            n.pid_error = (n.strm_bw - pid_tgt_avg[n.node_class()]) \
+                             / pid_tgt_avg[n.node_class()]
+            # use filt_bw for pid_error < 0
+            if cs_junk.use_mercy:
+              if cs_junk.use_desc_bw:
+                if n.pid_error_sum < 0 and n.pid_error < 0:
+                  n.pid_error = (n.filt_bw - pid_tgt_avg[n.node_class()]) \
+                             / pid_tgt_avg[n.node_class()]
+              else:
+                if n.desc_bw > n.ns_bw and n.pid_error < 0:
+                  n.pid_error = (n.filt_bw - pid_tgt_avg[n.node_class()]) \
+                             / pid_tgt_avg[n.node_class()]
+        else:
+          if cs_junk.use_best_ratio and n.sbw_ratio > n.fbw_ratio:
+            n.pid_error = (n.strm_bw - true_strm_avg[n.node_class()]) \
+                             / true_strm_avg[n.node_class()]
+          else:
+            n.pid_error = (n.filt_bw - true_filt_avg[n.node_class()]) \
+                             / true_filt_avg[n.node_class()]
+
+        # XXX: Refactor the following 3 clauses out into it's own function, so we can log
+        # only in the event of update?
+        # Penalize nodes for circ failure rate
+        if cs_junk.use_circ_fails:
+          # Compute circ_error relative to 1.0 (full success), but only
+          # apply it if it is both below the network avg and worse than
+          # the pid_error
+          if (1.0-n.circ_fail_rate) < true_circ_avg[n.node_class()]:
+            circ_error = -n.circ_fail_rate # ((1.0-fail) - 1.0)/1.0
+            if circ_error < 0 and circ_error < n.pid_error:
+              plog("INFO",
+                "CPU overload for %s node %s=%s desc=%d ns=%d pid_error=%f circ_error=%f circ_fail=%f" %
+                (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw,
+                 n.pid_error, circ_error, n.circ_fail_rate))
+              n.pid_error = min(circ_error,n.pid_error)
+
+        # Don't accumulate too much amplification for fast nodes
+        if cs_junk.use_desc_bw:
+          if n.pid_error_sum > cs_junk.pid_max and n.pid_error > 0:
+            plog("INFO", "Capping feedback for %s node %s=%s desc=%d ns=%d pid_error_sum=%f" %
+                (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, n.pid_error_sum))
+            n.pid_error_sum = cs_junk.pid_max
+        else:
+          if float(n.ns_bw)/n.desc_bw > cs_junk.pid_max and n.pid_error > 0:
+            plog("INFO", "Capping feedback for %s node %s=%s desc=%d ns=%d pid_error=%f" %
+                (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, n.pid_error))
+            n.pid_error = 0
+            n.pid_error_sum = 0
+
+        # Don't punish gimpy nodes too hard.
+        if cs_junk.use_mercy:
+          if not cs_junk.use_desc_bw:
+            # If node was demoted in the past and we plan to demote it again,
+            # let's just not and say we did.
+            if n.desc_bw > n.ns_bw and n.pid_error < 0:
+              plog("DEBUG", "Showing mercy for %s node %s=%s desc=%d ns=%d pid_error=%f" %
+                   (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, n.pid_error))
+              n.use_bw = n.desc_bw
+          if n.pid_error_sum < 0 and n.pid_error < 0:
+            plog("DEBUG", "Showing mercy for %s node %s=%s desc=%d ns=%d pid_error_sum=%f" %
+                (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, n.pid_error_sum))
+            n.pid_error_sum = 0
+
+        if n.idhex in prev_votes.vote_map:
+          # If there is a new sample, let's use it for all but guards
+          if n.measured_at > prev_votes.vote_map[n.idhex].measured_at:
+
+            # Nodes with the Guard flag will respond slowly to feedback,
+            # so they should be sampled less often, and in proportion to
+            # the appropriate Wgx weight.
+            if n.idhex in prev_consensus and \
+              ("Guard" in prev_consensus[n.idhex].flags \
+               and "Exit" not in prev_consensus[n.idhex].flags):
+              # Do full feedback if our previous vote > 2.5 weeks old
+              if n.idhex not in prev_votes.vote_map or \
+                  n.measured_at - prev_votes.vote_map[n.idhex].measured_at \
+                      > cs_junk.guard_sample_rate:
+                n.new_bw = n.get_pid_bw(prev_votes.vote_map[n.idhex],
+                                        cs_junk.K_p,
+                                        cs_junk.K_i,
+                                        cs_junk.K_d,
+                                        cs_junk.K_i_decay)
+              else:
+                # Don't use feedback here, but we might as well use our
+                # new measurement against the previous vote.
+                n.copy_vote(prev_votes.vote_map[n.idhex])
+
+                if cs_junk.use_desc_bw:
+                  n.new_bw = n.get_pid_bw(prev_votes.vote_map[n.idhex],
+                                      cs_junk.K_p,
+                                      cs_junk.K_i,
+                                      cs_junk.K_d,
+                                      0.0, False)
+                else:
+                  # Use previous vote's feedback bw
+                  # FIXME: compare to ns_bw or prev_vote bw?
+                  if cs_junk.use_mercy and n.desc_bw > n.ns_bw and n.pid_error < 0:
+                    n.use_bw = n.desc_bw
+                  else:
+                    n.use_bw = prev_votes.vote_map[n.idhex].pid_bw
+                  n.new_bw = n.get_pid_bw(prev_votes.vote_map[n.idhex],
+                                      cs_junk.K_p,
+                                      0.0,
+                                      0.0,
+                                      0.0, False)
+
+                # Reset the remaining vote data..
+                n.measured_at = prev_votes.vote_map[n.idhex].measured_at
+                n.pid_error = prev_votes.vote_map[n.idhex].pid_error
+            else:
+              # Everyone else should be pretty instantenous to respond.
+              # Full feedback should be fine for them (we hope),
+              # except for Guard+Exits, we want to dampen just a little
+              # bit for them. Wgd seems a good choice, but might not be exact.
+              # We really want to magically combine Wgd and something that
+              # represents the client migration rate for Guards.. But who
+              # knows how to represent that and still KISS?
+              if n.idhex in prev_consensus and \
+                ("Guard" in prev_consensus[n.idhex].flags \
+                 and "Exit" in prev_consensus[n.idhex].flags):
+                # For section2-equivalent mode and/or use_mercy, we should
+                # not use Wgd
+                if n.use_bw == n.desc_bw:
+                  weight = 1.0
+                else:
+                  weight = (1.0-cs_junk.bw_weights["Wgd"])
+                n.new_bw = n.get_pid_bw(prev_votes.vote_map[n.idhex],
+                                cs_junk.K_p*weight,
+                                cs_junk.K_i*weight,
+                                cs_junk.K_d*weight,
+                                cs_junk.K_i_decay)
+              else:
+                n.new_bw = n.get_pid_bw(prev_votes.vote_map[n.idhex],
+                                cs_junk.K_p,
+                                cs_junk.K_i,
+                                cs_junk.K_d,
+                                cs_junk.K_i_decay)
+          else:
+            # Reset values. Don't vote/sample this measurement round.
+            n.revert_to_vote(prev_votes.vote_map[n.idhex])
+        else: # No prev vote, pure consensus feedback this round
+          n.new_bw = n.use_bw + cs_junk.K_p*n.use_bw*n.pid_error
+          n.pid_error_sum = n.pid_error
+          n.pid_bw = n.new_bw
+          plog("DEBUG", "No prev vote for node "+n.nick+": Consensus feedback")
+      else: # No PID feedback
+        # Choose the larger between sbw and fbw
+        if n.sbw_ratio > n.fbw_ratio:
+          n.ratio = n.sbw_ratio
+        else:
+          n.ratio = n.fbw_ratio
+
+        n.pid_error = 0
+        n.pid_error_sum = 0
+        n.new_bw = n.desc_bw*n.ratio
+        n.pid_bw = n.new_bw # for transition between pid/no-pid
+
+      n.change = n.new_bw - n.desc_bw
+
+      if n.idhex in prev_consensus:
+        if prev_consensus[n.idhex].bandwidth != None:
+          prev_consensus[n.idhex].measured = True
+          tot_net_bw += n.new_bw
+        if IGNORE_GUARDS \
+             and ("Guard" in prev_consensus[n.idhex].flags and not "Exit" in \
+                    prev_consensus[n.idhex].flags):
+          plog("INFO", "Skipping voting for guard "+n.nick)
+          n.ignore = True
+        elif "Authority" in prev_consensus[n.idhex].flags:
+          plog("DEBUG", "Skipping voting for authority "+n.nick)
+          n.ignore = True
+
+    return tot_net_bw
+
+  def cap_bws(self, cs_junk, tot_net_bw):
+    # Go through the list and cap them to NODE_CAP
+    for n in nodes.itervalues():
+      if n.new_bw >= 0x7fffffff:
+        plog("WARN", "Bandwidth of "+n.node_class()+" node "+n.nick+"="+n.idhex+" exceeded maxint32: "+str(n.new_bw))
+        n.new_bw = 0x7fffffff
+      if cs_junk.T_i > 0 and cs_junk.T_i_decay > 0 \
+         and math.fabs(n.pid_error_sum) > \
+             math.fabs(2*cs_junk.T_i*n.pid_error/cs_junk.T_i_decay):
+        plog("NOTICE", "Large pid_error_sum for node "+n.idhex+"="+n.nick+": "+
+                     str(n.pid_error_sum)+" vs "+str(n.pid_error))
+      if n.new_bw > tot_net_bw*NODE_CAP:
+        plog("INFO", "Clipping extremely fast "+n.node_class()+" node "+n.idhex+"="+n.nick+
+             " at "+str(100*NODE_CAP)+"% of network capacity ("+
+             str(n.new_bw)+"->"+str(int(tot_net_bw*NODE_CAP))+") "+
+             " pid_error="+str(n.pid_error)+
+             " pid_error_sum="+str(n.pid_error_sum))
+        n.new_bw = int(tot_net_bw*NODE_CAP)
+        n.pid_error_sum = 0 # Don't let unused error accumulate...
+      if n.new_bw <= 0:
+        if n.idhex in prev_consensus:
+          plog("INFO", n.node_class()+" node "+n.idhex+"="+n.nick+" has bandwidth <= 0: "+str(n.new_bw))
+        else:
+          plog("INFO", "New node "+n.idhex+"="+n.nick+" has bandwidth < 0: "+str(n.new_bw))
+        n.new_bw = 1
+
+# NumPy-backed PID feedback engine. Holds the measurements of all nodes
+# in columnar arrays and computes class averages, PID error terms, new
+# bandwidths and the NODE_CAP clip as array operations, writing the
+# results back to the Node objects at the end of each step.
+#
+# The results must be bit-for-bit identical to ScalarPID, so:
+#  - float sums are taken left to right (cumsum) rather than pairwise,
+#  - integer sums are exact and only then divided, like the scalar code,
+#  - pid_error, pid_error_sum and pid_delta carry an "is int" mask, as
+#    ScalarPID leaves a literal int 0 in them on some paths and str()
+#    writes 0 and 0.0 differently into the vote file.
+class VectorPID:
+  CLASSES = ["Guard+Exit", "Guard", "Exit", "Middle"]
+
+  def __init__(self, node_list):
+    self.node_list = node_list
+    cols = []
+    for n in node_list:
+      r = prev_consensus.get(n.idhex)
+      if r is None:
+        (in_cons, cons_bw, guard, exit) = (False, False, False, False)
+      else:
+        (in_cons, cons_bw, guard, exit) = \
+            (True, r.bandwidth != None, "Guard" in r.flags, "Exit" in r.flags)
+      cols.append((n.strm_bw, n.filt_bw, n.ns_bw, n.desc_bw,
+                   n.circ_fail_rate, n.measured_at,
+                   self.CLASSES.index(n.node_class()),
+                   in_cons, cons_bw, guard and not exit, guard and exit))
+    cols = izip(*cols)
+    self.strm_bw = numpy.array(cols.next(), dtype=numpy.int64)
+    self.filt_bw = numpy.array(cols.next(), dtype=numpy.int64)
+    self.ns_bw = numpy.array(cols.next(), dtype=numpy.int64)
+    self.desc_bw = numpy.array(cols.next(), dtype=numpy.int64)
+    self.circ_fail_rate = numpy.array(cols.next(), dtype=numpy.float64)
+    self.measured_at = numpy.array(cols.next(), dtype=numpy.float64)
+    self.node_class = numpy.array(cols.next())
+    self.in_cons = numpy.array(cols.next(), dtype=bool)
+    self.cons_bw = numpy.array(cols.next(), dtype=bool)
+    self.guard_only = numpy.array(cols.next(), dtype=bool)
+    self.guard_exit = numpy.array(cols.next(), dtype=bool)
+
+  # Python's sum() adds left to right. numpy.sum() adds pairwise, which
+  # can differ in the last bits, but cumsum() is sequential.
+  def _seq_sum(self, a):
+    if len(a) == 0:
+      return 0
+    return float(numpy.cumsum(a)[-1])
+
+  # numpy would hand back inf/nan. Fail the way the scalar code does.
+  def _div(self, num, den):
+    if (den == 0).any():
+      raise ZeroDivisionError("float division by zero")
+    return num/den
+
+  def _by_class(self, cl_dict):
+    return numpy.array(map(lambda cl: cl_dict.get(cl, 0.0), self.CLASSES),
+                       dtype=numpy.float64)[self.node_class]
+
+  def _avg(self, vals):
+    return int(vals.sum())/float(len(vals))
+
+  # Write result columns back to the Node objects. Takes a list of
+  # (attr, values, is_int) with is_int either None or an "is int 0" mask.
+  def _store(self, cols):
+    attrs = []
+    vals = []
+    for (attr, v, is_int) in cols:
+      attrs.append(attr)
+      if is_int is None:
+        vals.append(v.tolist())
+      else:
+        vals.append(map(lambda x, i: 0 if i else x, v.tolist(),
+                        is_int.tolist()))
+    for (n, row) in izip(self.node_list, izip(*vals)):
+      n.__dict__.update(izip(attrs, row))
+
+  def _nodes(self, mask):
+    for i in numpy.nonzero(mask)[0]:
+      yield (i, self.node_list[i])
+
+  def class_avgs(self, cs_junk):
+    true_filt_avg = {}
+    pid_tgt_avg = {}
+    true_strm_avg = {}
+    true_circ_avg = {}
+
+    filt_avg = self._avg(self.filt_bw)
+    strm_avg = self._avg(self.strm_bw)
+
+    if cs_junk.bwauth_pid_control:
+      plog("INFO", "PID control enabled")
+
+      for c in xrange(len(self.CLASSES)):
+        cl = self.CLASSES[c]
+        in_cl = self.node_class == c
+        c_filt = self.filt_bw[in_cl]
+        c_desc = self.desc_bw[in_cl]
+        if len(c_filt) > 0:
+          true_filt_avg[cl] = self._avg(c_filt)
+          true_strm_avg[cl] = self._avg(self.strm_bw[in_cl])
+          true_circ_avg[cl] = self._seq_sum(1.0-self.circ_fail_rate[in_cl]) \
+                                 /float(len(c_filt))
+        else:
+          true_filt_avg[cl] = 0.0
+          true_strm_avg[cl] = 0.0
+          true_circ_avg[cl] = 0.0
+
+        pid_tgt_avg[cl] = true_filt_avg[cl]
+        prev_pid_avg = 2*pid_tgt_avg[cl]
+
+        while prev_pid_avg > pid_tgt_avg[cl]:
+          f_filt = c_filt[c_desc >= pid_tgt_avg[cl]]
+          prev_pid_avg = pid_tgt_avg[cl]
+          if len(f_filt) > 0:
+            pid_tgt_avg[cl] = self._avg(f_filt)
+          else:
+            pid_tgt_avg[cl] = 0.0
+
+        plog("INFO", "Network true_filt_avg["+cl+"]: "+str(true_filt_avg[cl]))
+        plog("INFO", "Network pid_tgt_avg["+cl+"]: "+str(pid_tgt_avg[cl]))
+        plog("INFO", "Network true_circ_avg["+cl+"]: "+str(true_circ_avg[cl]))
+
+      circ_avg = self._seq_sum(1.0-self.circ_fail_rate)/float(len(self.node_list))
+      plog("INFO", "Network filt_avg: "+str(filt_avg))
+      plog("INFO", "Network circ_avg: "+str(circ_avg))
+
+      if not cs_junk.group_by_class:
+        pid_avg = filt_avg
+        prev_pid_avg = 2*pid_avg
+        f_nodes = numpy.ones(len(self.node_list), dtype=bool)
+
+        while prev_pid_avg > pid_avg:
+          f_nodes &= self.desc_bw >= pid_avg
+          prev_pid_avg = pid_avg
+          pid_avg = int(self.filt_bw[f_nodes].sum())/float(f_nodes.sum())
+
+        for cl in self.CLASSES:
+          true_filt_avg[cl] = filt_avg
+          true_strm_avg[cl] = strm_avg
+          true_circ_avg[cl] = circ_avg
+          pid_tgt_avg[cl] = pid_avg
+
+        plog("INFO", "Network pid_avg: "+str(pid_avg))
+    else:
+      plog("INFO", "PID control disabled")
+      for cl in self.CLASSES:
+        true_filt_avg[cl] = filt_avg
+        true_strm_avg[cl] = strm_avg
+
+    return (true_filt_avg, pid_tgt_avg, true_strm_avg, true_circ_avg)
+
+  def update_bws(self, cs_junk, prev_votes, true_filt_avg, pid_tgt_avg,
+                 true_strm_avg, true_circ_avg):
+    N = len(self.node_list)
+    strm_bw = self.strm_bw
+    filt_bw = self.filt_bw
+    ns_bw = self.ns_bw
+    desc_bw = self.desc_bw
+
+    tfa = self._by_class(true_filt_avg)
+    tsa = self._by_class(true_strm_avg)
+    fbw_ratio = self._div(filt_bw, tfa)
+    sbw_ratio = self._div(strm_bw, tsa)
+    out = [("fbw_ratio", fbw_ratio, None), ("sbw_ratio", sbw_ratio, None)]
+
+    # Node defaults
+    pid_error_sum = numpy.zeros(N)
+    pes_int = numpy.ones(N, dtype=bool)
+    pid_delta = numpy.zeros(N)
+    pd_int = numpy.ones(N, dtype=bool)
+
+    if not cs_junk.bwauth_pid_control:
+      # Choose the larger between sbw and fbw
+      ratio = numpy.where(sbw_ratio > fbw_ratio, sbw_ratio, fbw_ratio)
+      out.append(("ratio", ratio, None))
+      pid_error = numpy.zeros(N)
+      pe_int = numpy.ones(N, dtype=bool)
+      new_bw = desc_bw*ratio
+      pid_bw = new_bw
+    else:
+      if cs_junk.use_desc_bw:
+        use_bw = desc_bw.astype(numpy.float64)
+      else:
+        use_bw = ns_bw.astype(numpy.float64)
+
+      pe_int = numpy.zeros(N, dtype=bool)
+      if cs_junk.use_pid_tgt:
+        pta = self._by_class(pid_tgt_avg)
+        pid_error = self._div(strm_bw - pta, pta)
+        # use filt_bw for pid_error < 0
+        if cs_junk.use_mercy:
+          if cs_junk.use_desc_bw:
+            mercy = (pid_error_sum < 0) & (pid_error < 0)
+          else:
+            mercy = (desc_bw > ns_bw) & (pid_error < 0)
+          pid_error = numpy.where(mercy, (filt_bw - pta)/pta, pid_error)
+      else:
+        if cs_junk.use_best_ratio:
+          best_sbw = sbw_ratio > fbw_ratio
+        else:
+          best_sbw = numpy.zeros(N, dtype=bool)
+        pid_error = numpy.where(best_sbw, (strm_bw - tsa)/tsa,
+                                (filt_bw - tfa)/tfa)
+
+      # Penalize nodes for circ failure rate
+      if cs_junk.use_circ_fails:
+        circ_error = -self.circ_fail_rate
+        overload = ((1.0-self.circ_fail_rate) < self._by_class(true_circ_avg)) \
+                     & (circ_error < 0) & (circ_error < pid_error)
+        for (i, n) in self._nodes(overload):
+          plog("INFO",
+            "CPU overload for %s node %s=%s desc=%d ns=%d pid_error=%f circ_error=%f circ_fail=%f" %
+            (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw,
+             pid_error[i], circ_error[i], n.circ_fail_rate))
+        pid_error = numpy.where(overload,
+                                numpy.minimum(circ_error, pid_error), pid_error)
+
+      # Don't accumulate too much amplification for fast nodes
+      if cs_junk.use_desc_bw:
+        capped = (pid_error_sum > cs_junk.pid_max) & (pid_error > 0)
+        for (i, n) in self._nodes(capped):
+          plog("INFO", "Capping feedback for %s node %s=%s desc=%d ns=%d pid_error_sum=%f" %
+              (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, pid_error_sum[i]))
+        pid_error_sum[capped] = cs_junk.pid_max
+        pes_int &= ~capped
+      else:
+        capped = (self._div(ns_bw.astype(numpy.float64), desc_bw) > cs_junk.pid_max) \
+                    & (pid_error > 0)
+        for (i, n) in self._nodes(capped):
+          plog("INFO", "Capping feedback for %s node %s=%s desc=%d ns=%d pid_error=%f" %
+              (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, pid_error[i]))
+        pid_error[capped] = 0
+        pe_int |= capped
+        pid_error_sum[capped] = 0
+        pes_int |= capped
+
+      # Don't punish gimpy nodes too hard.
+      if cs_junk.use_mercy:
+        if not cs_junk.use_desc_bw:
+          mercy = (desc_bw > ns_bw) & (pid_error < 0)
+          for (i, n) in self._nodes(mercy):
+            plog("DEBUG", "Showing mercy for %s node %s=%s desc=%d ns=%d pid_error=%f" %
+                 (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, pid_error[i]))
+          use_bw = numpy.where(mercy, desc_bw, use_bw)
+        mercy = (pid_error_sum < 0) & (pid_error < 0)
+        for (i, n) in self._nodes(mercy):
+          plog("DEBUG", "Showing mercy for %s node %s=%s desc=%d ns=%d pid_error_sum=%f" %
+              (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, pid_error_sum[i]))
+        pid_error_sum[mercy] = 0
+        pes_int |= mercy
+
+      # Previous vote columns. Nodes without a vote get zeros they never
+      # use. The *_int columns flag literal int 0s, as for pid_error.
+      cols = []
+      no_vote_row = (False, 0, 0, 0, 0, True, 0, True, 0, True)
+      for n in self.node_list:
+        v = prev_votes.vote_map.get(n.idhex)
+        if v is None:
+          cols.append(no_vote_row)
+        else:
+          cols.append((True, v.bw*1000, v.pid_bw, v.measured_at,
+                       v.pid_error, isinstance(v.pid_error, (int, long)),
+                       v.pid_error_sum, isinstance(v.pid_error_sum, (int, long)),
+                       v.pid_delta, isinstance(v.pid_delta, (int, long))))
+      cols = izip(*cols)
+      has_vote = numpy.array(cols.next(), dtype=bool)
+      v_bw = numpy.array(cols.next(), dtype=numpy.float64)
+      v_pid_bw = numpy.array(cols.next(), dtype=numpy.float64)
+      v_measured_at = numpy.array(cols.next(), dtype=numpy.float64)
+      v_pe = numpy.array(cols.next(), dtype=numpy.float64)
+      v_pe_int = numpy.array(cols.next(), dtype=bool)
+      v_pes = numpy.array(cols.next(), dtype=numpy.float64)
+      v_pes_int = numpy.array(cols.next(), dtype=bool)
+      v_pd = numpy.array(cols.next(), dtype=numpy.float64)
+      v_pd_int = numpy.array(cols.next(), dtype=bool)
+
+      # If there is a new sample, let's use it for all but guards
+      newer = has_vote & (self.measured_at > v_measured_at)
+      # Nodes with the Guard flag will respond slowly to feedback
+      guard = newer & self.guard_only
+      # Do full feedback if our previous vote > 2.5 weeks old
+      guard_full = guard & (self.measured_at - v_measured_at \
+                               > cs_junk.guard_sample_rate)
+      guard_vote = guard & ~guard_full
+      other = newer & ~guard
+      full = guard_full | other
+      revert = has_vote & ~newer
+      no_vote = ~has_vote
+
+      # Guard+Exits are dampened by Wgd, except in section2-equivalent
+      # mode and/or use_mercy
+      weight = numpy.where(use_bw == desc_bw, 1.0,
+                           1.0-cs_junk.bw_weights["Wgd"])
+      damp = other & self.guard_exit
+      kp = numpy.where(damp, cs_junk.K_p*weight, cs_junk.K_p)
+      ki = numpy.where(damp, cs_junk.K_i*weight, cs_junk.K_i)
+      kd = numpy.where(damp, cs_junk.K_d*weight, cs_junk.K_d)
+
+      # Node.get_pid_bw() with update=True
+      no_prev_error = v_pe == 0
+      integral = numpy.where(no_prev_error, 0.0, pid_error_sum)
+      full_delta = numpy.where(no_prev_error, 0.0, pid_error - v_pe)
+      full_bw = use_bw + kp*use_bw*pid_error + ki*use_bw*integral \
+                  + kd*use_bw*full_delta
+      full_sum = v_pes*cs_junk.K_i_decay + pid_error
+      full_sum_int = v_pes_int & pe_int & \
+                       isinstance(cs_junk.K_i_decay, (int, long))
+
+      # Guards between full feedback rounds: use the new measurement
+      # against the previous vote.
+      if cs_junk.use_desc_bw:
+        guard_bw = use_bw + cs_junk.K_p*use_bw*pid_error \
+                     + cs_junk.K_i*use_bw*v_pes + cs_junk.K_d*use_bw*v_pd
+      else:
+        # Use previous vote's feedback bw
+        if cs_junk.use_mercy:
+          guard_use_bw = numpy.where((desc_bw > ns_bw) & (pid_error < 0),
+                                     desc_bw, v_pid_bw)
+        else:
+          guard_use_bw = v_pid_bw
+        guard_bw = guard_use_bw + cs_junk.K_p*guard_use_bw*pid_error \
+                     + 0.0*guard_use_bw*v_pes + 0.0*guard_use_bw*v_pd
+        use_bw = numpy.where(guard_vote, guard_use_bw, use_bw)
+
+      # No prev vote, pure consensus feedback this round
+      cons_bw = use_bw + cs_junk.K_p*use_bw*pid_error
+
+      from_vote = guard_vote | revert
+      new_bw = numpy.select([full, guard_vote, revert, no_vote],
+                            [full_bw, guard_bw, v_bw, cons_bw])
+      pid_bw = numpy.select([full, from_vote, no_vote],
+                            [full_bw, v_pid_bw, cons_bw])
+      pid_error_sum = numpy.select([full, from_vote, no_vote],
+                                   [full_sum, v_pes, pid_error])
+      pes_int = numpy.select([full, from_vote, no_vote],
+                             [full_sum_int, v_pes_int, pe_int])
+      pid_delta = numpy.where(full, full_delta,
+                              numpy.where(from_vote, v_pd, pid_delta))
+      pd_int = numpy.where(full, no_prev_error,
+                           numpy.where(from_vote, v_pd_int, pd_int))
+      pid_error = numpy.where(from_vote, v_pe, pid_error)
+      pe_int = numpy.where(from_vote, v_pe_int, pe_int)
+      self.measured_at = numpy.where(from_vote, v_measured_at,
+                                     self.measured_at)
+
+      for (i, n) in self._nodes(full):
+        n.prev_error = v_pe[i]
+      for (i, n) in self._nodes(no_vote):
+        plog("DEBUG", "No prev vote for node "+n.nick+": Consensus feedback")
+      out.append(("use_bw", use_bw, None))
+      out.append(("measured_at", self.measured_at, None))
+
+    self.new_bw = new_bw
+    self.pid_error = pid_error
+    self.pe_int = pe_int
+    self.pid_error_sum = pid_error_sum
+    self.pes_int = pes_int
+    out.extend([("new_bw", new_bw, None), ("pid_bw", pid_bw, None),
+                ("pid_error", pid_error, pe_int),
+                ("pid_error_sum", pid_error_sum, pes_int),
+                ("pid_delta", pid_delta, pd_int),
+                ("change", new_bw - desc_bw, None)])
+    self._store(out)
+
+    for (i, n) in self._nodes(self.in_cons):
+      if self.cons_bw[i]:
+        prev_consensus[n.idhex].measured = True
+      if IGNORE_GUARDS and self.guard_only[i]:
+        plog("INFO", "Skipping voting for guard "+n.nick)
+        n.ignore = True
+      elif "Authority" in prev_consensus[n.idhex].flags:
+        plog("DEBUG", "Skipping voting for authority "+n.nick)
+        n.ignore = True
+
+    return self._seq_sum(new_bw[self.cons_bw])
+
+  def cap_bws(self, cs_junk, tot_net_bw):
+    new_bw = self.new_bw.copy()
+    pid_error_sum = self.pid_error_sum.copy()
+    pes_int = self.pes_int.copy()
+
+    huge = new_bw >= 0x7fffffff
+    for (i, n) in self._nodes(huge):
+      plog("WARN", "Bandwidth of "+n.node_class()+" node "+n.nick+"="+n.idhex+" exceeded maxint32: "+str(new_bw[i]))
+    new_bw[huge] = 0x7fffffff
+
+    if cs_junk.T_i > 0 and cs_junk.T_i_decay > 0:
+      large = numpy.fabs(pid_error_sum) > \
+                numpy.fabs(2*cs_junk.T_i*self.pid_error/cs_junk.T_i_decay)
+      for (i, n) in self._nodes(large):
+        plog("NOTICE", "Large pid_error_sum for node "+n.idhex+"="+n.nick+": "+
+                     str(n.pid_error_sum)+" vs "+str(n.pid_error))
+
+    clip = new_bw > tot_net_bw*NODE_CAP
+    for (i, n) in self._nodes(clip):
+      plog("INFO", "Clipping extremely fast "+n.node_class()+" node "+n.idhex+"="+n.nick+
+           " at "+str(100*NODE_CAP)+"% of network capacity ("+
+           str(new_bw[i])+"->"+str(int(tot_net_bw*NODE_CAP))+") "+
+           " pid_error="+str(n.pid_error)+
+           " pid_error_sum="+str(n.pid_error_sum))
+    new_bw[clip] = int(tot_net_bw*NODE_CAP)
+    pid_error_sum[clip] = 0 # Don't let unused error accumulate...
+    pes_int |= clip
+
+    nonpos = new_bw <= 0
+    for (i, n) in self._nodes(nonpos):
+      if self.in_cons[i]:
+        plog("INFO", n.node_class()+" node "+n.idhex+"="+n.nick+" has bandwidth <= 0: "+str(new_bw[i]))
+      else:
+        plog("INFO", "New node "+n.idhex+"="+n.nick+" has bandwidth < 0: "+str(new_bw[i]))
+    new_bw[nonpos] = 1
+
+    self._store([("new_bw", new_bw, None),
+                 ("pid_error_sum", pid_error_sum, pes_int)])
+
+# The line of the vote file for node n
+# FIXME: Split out debugging data
+def vote_line(n):
+  # Turns out str() is more accurate than %lf
+  return "node_id="+n.idhex+" bw="+str(base10_round(n.new_bw))+" nick="+n.nick+ " measured_at="+str(int(n.measured_at))+" updated_at="+str(int(n.updated_at))+" pid_error="+str(n.pid_error)+" pid_error_sum="+str(n.pid_error_sum)+" pid_bw="+str(int(n.pid_bw))+" pid_delta="+str(n.pid_delta)+" circ_fail="+str(n.circ_fail_rate)+" scanner="+str(n.scanner)+"\n"
+
+# Fetch every recent descriptor with a single GETINFO and index them by
+# digest, which is what a network status entry refers to (ns.orhash).
+# This saves a control port round trip per unmeasured router.
+def get_recent_descs(c):
+  try:
+    descs = c.sendAndRecv("GETINFO desc/all-recent\r\n")[0][2]
+  except TorCtl.ErrorReply, e:
+    plog("NOTICE", "Can't fetch all descriptors at once: "+str(e))
+    return {}
+  desc_map = {}
+  start = descs.find("router ")
+  while start >= 0:
+    end = descs.find("\nrouter ", start)
+    if end < 0:
+      desc = descs[start:]
+    else:
+      desc = descs[start:end+1]
+      end += 1
+    sig_start = desc.find("\nrouter-signature\n")
+    if sig_start >= 0:
+      sig_start += len("\nrouter-signature\n")
+      desc_map[sha1(desc[:sig_start]).digest().encode("base64")[:-2]] = desc
+    start = end
+  plog("DEBUG", "Got "+str(len(desc_map))+" descriptors in bulk")
+  return desc_map
+
+# Like c.get_router(ns), but served from the get_recent_descs() map.
+# Routers whose current descriptor is missing from it are fetched
+# individually.
+def get_router(c, ns, desc_map):
+  desc = desc_map.get(ns.orhash)
+  if desc is None:
+    return c.get_router(ns)
+  return TorCtl.Router.build_from_desc(desc.split("\n"), ns)
+
 def write_file_list(datadir):
   files = {64*1024:"64M", 32*1024:"32M", 16*1024:"16M", 8*1024:"8M",
                 4*1024:"4M", 2*1024:"2M", 1024:"1M", 512:"512k",
@@ -362,6 +1394,95 @@ def write_file_list(datadir):
   # atomic on POSIX
   os.rename(datadir+"/bwfiles.new", datadir+"/bwfiles")
 
+# Load the measurements of every scanner under the data dirs in argv into
+# the nodes dict. Returns the newest slice timestamp of each scanner.
+def read_scan_data(argv):
+  catalog_file = argv[1]+"/"+SCAN_CATALOG
+  catalog = ScanCatalog(catalog_file)
+
+  # old measurements are probably better than no measurements. We may not
+  # measure hibernating routers for days. This filter is just to remove
+  # REALLY old files, and works off the catalog rather than the scan dirs.
+  for path in catalog.expired_files(time.time() - MAX_AGE):
+    remove_scan_file(path)
+    catalog.remove_file(path)
+
+  # Take the most recent timestamp from each scanner 
+  # and use the oldest for the timestamp of the result.
+  # That way we can ensure all the scanners continue running.
+  scanner_timestamps = {}
+  seen_files = set()
+  seen_dirs = set()
+  uncataloged = {}
+  jobs = []
+  for da in argv[1:-1]:
+    # First, create a list of the most recent files in the
+    # scan dirs that are recent enough
+    for ds in os.listdir(da):
+      if re.match("^scanner.[\d+]$", ds):
+        newest_timestamp = 0
+        scanner_files = []
+        sd = da+"/"+ds+"/scan-data"
+        seen_dirs.add(sd)
+        for (path, slicenum, timestamp, st) in list_scan_dir(catalog, sd):
+          if time.time() - timestamp > MAX_AGE:
+            remove_scan_file(path)
+            catalog.remove_file(path)
+            continue
+          seen_files.add(path)
+          if timestamp > newest_timestamp:
+            newest_timestamp = timestamp
+          if st is not None:
+            uncataloged[path] = (st, slicenum, timestamp)
+          bw_files.append((sd+"/"+slicenum, timestamp, path))
+          scanner_files.append((sd+"/"+slicenum, timestamp, path, st))
+        scanner_timestamps[ds] = newest_timestamp
+        jobs.append((catalog_file, argv[1], scanner_files))
+  catalog.prune(seen_files, seen_dirs)
+  catalog.commit()
+  # Don't hand an open sqlite connection across fork()
+  catalog.close()
+
+  # The scanners are independent, so read each one in its own process
+  workers = INGEST_WORKERS or multiprocessing.cpu_count()
+  workers = min(workers, len(jobs))
+  if not uncataloged:
+    # Reading from the catalog alone is quicker than starting a pool
+    workers = 1
+  if workers > 1:
+    plog("INFO", "Reading "+str(len(jobs))+" scanners with "+str(workers)+" workers")
+    pool = multiprocessing.Pool(workers)
+    results = pool.map(ingest_scanner, jobs)
+    pool.close()
+    pool.join()
+  else:
+    results = map(ingest_scanner, jobs)
+
+  # Merge in scanner order so that ties are broken the same way
+  # no matter how many workers there were.
+  # Need to only use most recent slice-file for each node..
+  catalog = ScanCatalog(catalog_file)
+  for (partials, new_rows) in results:
+    for (path, rows) in new_rows.iteritems():
+      (st, slicenum, timestamp) = uncataloged[path]
+      catalog.store_file(path, st, slicenum, timestamp, rows)
+    for (nick, row, slice_file, timestamp, filename) in partials.itervalues():
+      try:
+        line = CatalogLine(row, slice_file, timestamp, filename)
+        if line.idhex not in nodes:
+          n = Node()
+          nodes[line.idhex] = n
+        else:
+          n = nodes[line.idhex]
+        n.add_line(line)
+        n.nick = nick
+      except Exception, e:
+        plog("WARN", "Unknown slice parse error "+str(e)+" for "+row[0])
+        traceback.print_exc()
+  catalog.commit()
+  catalog.close()
+  return scanner_timestamps
+
 def main(argv):
   TorUtil.read_config(argv[1]+"/scanner.1/bwauthority.cfg")
   TorUtil.logfile = "data/aggregate-debug.log"
@@ -407,64 +1528,7 @@ def main(argv):
     plog("ERROR", "Your Tor is not providing NS w bandwidths!")
     sys.exit(0)
 
-  # Take the most recent timestamp from each scanner 
-  # and use the oldest for the timestamp of the result.
-  # That way we can ensure all the scanners continue running.
-  scanner_timestamps = {}
-  for da in argv[1:-1]:
-    # First, create a list of the most recent files in the
-    # scan dirs that are recent enough
-    for root, dirs, f in os.walk(da):
-      for ds in dirs:
-        if re.match("^scanner.[\d+]$", ds):
-          newest_timestamp = 0
-          for sr, sd, files in os.walk(da+"/"+ds+"/scan-data"):
-            for f in files:
-              if re.search("^bws-[\S]+-done-", f):
-                fp = file(sr+"/"+f, "r")
-                slicenum = sr+"/"+fp.readline()
-                timestamp = float(fp.readline())
-                fp.close()
-                # old measurements are probably
-                # better than no measurements. We may not
-                # measure hibernating routers for days.
-                # This filter is just to remove REALLY old files
-                if time.time() - timestamp > MAX_AGE:
-                  sqlf = f.replace("bws-", "sql-")
-                  plog("INFO", "Removing old file "+f+" and "+sqlf)
-                  os.remove(sr+"/"+f)
-                  try:
-                    os.remove(sr+"/"+sqlf)
-                  except:
-                    pass # In some cases the sql file may not exist
-                  continue
-                if timestamp > newest_timestamp:
-                  newest_timestamp = timestamp
-                bw_files.append((slicenum, timestamp, sr+"/"+f))
-          scanner_timestamps[ds] = newest_timestamp
-
-  # Need to only use most recent slice-file for each node..
-  for (s,t,f) in bw_files:
-    fp = file(f, "r")
-    fp.readline() # slicenum
-    fp.readline() # timestamp
-    for l in fp.readlines():
-      try:
-        line = Line(l,s,t,f.replace(argv[1], ""))
-        if line.idhex not in nodes:
-          n = Node()
-          nodes[line.idhex] = n
-        else:
-          n = nodes[line.idhex]
-        n.add_line(line)
-      except ValueError,e:
-        plog("NOTICE", "Conversion error "+str(e)+" at "+l)
-      except AttributeError, e:
-        plog("NOTICE", "Slice file format error "+str(e)+" at "+l)
-      except Exception, e:
-        plog("WARN", "Unknown slice parse error "+str(e)+" at "+l)
-        traceback.print_exc()
-    fp.close()
+  scanner_timestamps = read_scan_data(argv)
 
   if len(nodes) == 0:
     plog("NOTICE", "No scan results yet.")
@@ -474,83 +1538,14 @@ def main(argv):
     if idhex in prev_consensus:
       nodes[idhex].flags = prev_consensus[idhex].flags
 
-  true_filt_avg = {}
-  pid_tgt_avg = {}
-  true_strm_avg = {}
-  true_circ_avg = {}
-
-  if cs_junk.bwauth_pid_control:
-    # Penalize nodes for circuit failure: it indicates CPU pressure
-    # TODO: Potentially penalize for stream failure, if we run into
-    # socket exhaustion issues..
-    plog("INFO", "PID control enabled")
-
-    # TODO: Please forgive me for this, I wanted to see
-    # these loglines, so we go aead and run this code regardless of
-    # the group_by_class setting, and just reset the values if it is not set.
-
-    for cl in ["Guard+Exit", "Guard", "Exit", "Middle"]:
-      c_nodes = filter(lambda n: n.node_class() == cl, nodes.itervalues())
-      if len(c_nodes) > 0:
-        true_filt_avg[cl] = sum(map(lambda n: n.filt_bw, c_nodes))/float(len(c_nodes))
-        true_strm_avg[cl] = sum(map(lambda n: n.strm_bw, c_nodes))/float(len(c_nodes))
-        true_circ_avg[cl] = sum(map(lambda n: (1.0-n.circ_fail_rate),
-                             c_nodes))/float(len(c_nodes))
-      else:
-        true_filt_avg[cl] = 0.0
-        true_strm_avg[cl] = 0.0
-        true_circ_avg[cl] = 0.0
-
-      # FIXME: This may be expensive
-      pid_tgt_avg[cl] = true_filt_avg[cl]
-      prev_pid_avg = 2*pid_tgt_avg[cl]
-
-      while prev_pid_avg > pid_tgt_avg[cl]:
-        f_nodes = filter(lambda n: n.desc_bw >= pid_tgt_avg[cl], c_nodes)
-        prev_pid_avg = pid_tgt_avg[cl]
-        if len(f_nodes) > 0:
-          pid_tgt_avg[cl] = sum(map(lambda n: n.filt_bw, f_nodes))/float(len(f_nodes))
-        else:
-          pid_tgt_avg[cl] = 0.0
-
-      plog("INFO", "Network true_filt_avg["+cl+"]: "+str(true_filt_avg[cl]))
-      plog("INFO", "Network pid_tgt_avg["+cl+"]: "+str(pid_tgt_avg[cl]))
-      plog("INFO", "Network true_circ_avg["+cl+"]: "+str(true_circ_avg[cl]))
-
-    filt_avg = sum(map(lambda n: n.filt_bw, nodes.itervalues()))/float(len(nodes))
-    strm_avg = sum(map(lambda n: n.strm_bw, nodes.itervalues()))/float(len(nodes))
-    circ_avg = sum(map(lambda n: (1.0-n.circ_fail_rate),
-                       nodes.itervalues()))/float(len(nodes))
-    plog("INFO", "Network filt_avg: "+str(filt_avg))
-    plog("INFO", "Network circ_avg: "+str(circ_avg))
-
-    if not cs_junk.group_by_class:
-      # FIXME: This may be expensive
-      pid_avg = filt_avg
-      prev_pid_avg = 2*pid_avg
-      f_nodes = nodes.values()
-
-      while prev_pid_avg > pid_avg:
-        f_nodes = filter(lambda n: n.desc_bw >= pid_avg, f_nodes)
-        prev_pid_avg = pid_avg
-        pid_avg = sum(map(lambda n: n.filt_bw, f_nodes))/float(len(f_nodes))
-
-      for cl in ["Guard+Exit", "Guard", "Exit", "Middle"]:
-        true_filt_avg[cl] = filt_avg
-        true_strm_avg[cl] = strm_avg
-        true_circ_avg[cl] = circ_avg
-        pid_tgt_avg[cl] = pid_avg
-
-      plog("INFO", "Network pid_avg: "+str(pid_avg))
-
+  if USE_NUMPY_PID and numpy:
+    plog("INFO", "Using the NumPy PID engine")
+    pid = VectorPID(nodes.values())
   else:
-    plog("INFO", "PID control disabled")
-    filt_avg = sum(map(lambda n: n.filt_bw, nodes.itervalues()))/float(len(nodes))
-    strm_avg = sum(map(lambda n: n.strm_bw, nodes.itervalues()))/float(len(nodes))
-    for cl in ["Guard+Exit", "Guard", "Exit", "Middle"]:
-      true_filt_avg[cl] = filt_avg
-      true_strm_avg[cl] = strm_avg
+    pid = ScalarPID()
 
+  (true_filt_avg, pid_tgt_avg, true_strm_avg, true_circ_avg) = \
+                 pid.class_avgs(cs_junk)
 
   prev_votes = None
   if cs_junk.bwauth_pid_control:
@@ -582,214 +1577,9 @@ def main(argv):
     if guard_cnt > 0:
       plog("INFO", "Avg of "+str(guard_cnt)+" guard measurement interval: "+str((guard_measure_time/guard_cnt)/3600.0))
 
-  tot_net_bw = 0
-  for n in nodes.itervalues():
-    n.fbw_ratio = n.filt_bw/true_filt_avg[n.node_class()]
-    n.sbw_ratio = n.strm_bw/true_strm_avg[n.node_class()]
-
-    if cs_junk.bwauth_pid_control:
-      if cs_junk.use_desc_bw:
-        n.use_bw = n.desc_bw
-      else:
-        n.use_bw = n.ns_bw
-
-      if cs_junk.use_pid_tgt:
-          n.pid_error = (n.strm_bw - pid_tgt_avg[n.node_class()]) \
-                           / pid_tgt_avg[n.node_class()]
-          # use filt_bw for pid_error < 0
-          if cs_junk.use_mercy:
-            if cs_junk.use_desc_bw:
-              if n.pid_error_sum < 0 and n.pid_error < 0:
-                n.pid_error = (n.filt_bw - pid_tgt_avg[n.node_class()]) \
-                           / pid_tgt_avg[n.node_class()]
-            else:
-              if n.desc_bw > n.ns_bw and n.pid_error < 0:
-                n.pid_error = (n.filt_bw - pid_tgt_avg[n.node_class()]) \
-                           / pid_tgt_avg[n.node_class()]
-      else:
-        if cs_junk.use_best_ratio and n.sbw_ratio > n.fbw_ratio:
-          n.pid_error = (n.strm_bw - true_strm_avg[n.node_class()]) \
-                           / true_strm_avg[n.node_class()]
-        else:
-          n.pid_error = (n.filt_bw - true_filt_avg[n.node_class()]) \
-                           / true_filt_avg[n.node_class()]
-
-      # XXX: Refactor the following 3 clauses out into it's own function, so we can log
-      # only in the event of update?
-      # Penalize nodes for circ failure rate
-      if cs_junk.use_circ_fails:
-        # Compute circ_error relative to 1.0 (full success), but only
-        # apply it if it is both below the network avg and worse than
-        # the pid_error
-        if (1.0-n.circ_fail_rate) < true_circ_avg[n.node_class()]:
-          circ_error = -n.circ_fail_rate # ((1.0-fail) - 1.0)/1.0
-          if circ_error < 0 and circ_error < n.pid_error:
-            plog("INFO",
-              "CPU overload for %s node %s=%s desc=%d ns=%d pid_error=%f circ_error=%f circ_fail=%f" %
-              (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw,
-               n.pid_error, circ_error, n.circ_fail_rate))
-            n.pid_error = min(circ_error,n.pid_error)
-
-      # Don't accumulate too much amplification for fast nodes
-      if cs_junk.use_desc_bw:
-        if n.pid_error_sum > cs_junk.pid_max and n.pid_error > 0:
-          plog("INFO", "Capping feedback for %s node %s=%s desc=%d ns=%d pid_error_sum=%f" %
-              (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, n.pid_error_sum))
-          n.pid_error_sum = cs_junk.pid_max
-      else:
-        if float(n.ns_bw)/n.desc_bw > cs_junk.pid_max and n.pid_error > 0:
-          plog("INFO", "Capping feedback for %s node %s=%s desc=%d ns=%d pid_error=%f" %
-              (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, n.pid_error))
-          n.pid_error = 0
-          n.pid_error_sum = 0
-
-      # Don't punish gimpy nodes too hard.
-      if cs_junk.use_mercy:
-        if not cs_junk.use_desc_bw:
-          # If node was demoted in the past and we plan to demote it again,
-          # let's just not and say we did.
-          if n.desc_bw > n.ns_bw and n.pid_error < 0:
-            plog("DEBUG", "Showing mercy for %s node %s=%s desc=%d ns=%d pid_error=%f" %
-                 (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, n.pid_error))
-            n.use_bw = n.desc_bw
-        if n.pid_error_sum < 0 and n.pid_error < 0:
-          plog("DEBUG", "Showing mercy for %s node %s=%s desc=%d ns=%d pid_error_sum=%f" %
-              (n.node_class(), n.nick, n.idhex, n.desc_bw, n.ns_bw, n.pid_error_sum))
-          n.pid_error_sum = 0
-
-      if n.idhex in prev_votes.vote_map:
-        # If there is a new sample, let's use it for all but guards
-        if n.measured_at > prev_votes.vote_map[n.idhex].measured_at:
-
-          # Nodes with the Guard flag will respond slowly to feedback,
-          # so they should be sampled less often, and in proportion to
-          # the appropriate Wgx weight.
-          if n.idhex in prev_consensus and \
-            ("Guard" in prev_consensus[n.idhex].flags \
-             and "Exit" not in prev_consensus[n.idhex].flags):
-            # Do full feedback if our previous vote > 2.5 weeks old
-            if n.idhex not in prev_votes.vote_map or \
-                n.measured_at - prev_votes.vote_map[n.idhex].measured_at \
-                    > cs_junk.guard_sample_rate:
-              n.new_bw = n.get_pid_bw(prev_votes.vote_map[n.idhex],
-                                      cs_junk.K_p,
-                                      cs_junk.K_i,
-                                      cs_junk.K_d,
-                                      cs_junk.K_i_decay)
-            else:
-              # Don't use feedback here, but we might as well use our
-              # new measurement against the previous vote.
-              n.copy_vote(prev_votes.vote_map[n.idhex])
-
-              if cs_junk.use_desc_bw:
-                n.new_bw = n.get_pid_bw(prev_votes.vote_map[n.idhex],
-                                    cs_junk.K_p,
-                                    cs_junk.K_i,
-                                    cs_junk.K_d,
-                                    0.0, False)
-              else:
-                # Use previous vote's feedback bw
-                # FIXME: compare to ns_bw or prev_vote bw?
-                if cs_junk.use_mercy and n.desc_bw > n.ns_bw and n.pid_error < 0:
-                  n.use_bw = n.desc_bw
-                else:
-                  n.use_bw = prev_votes.vote_map[n.idhex].pid_bw
-                n.new_bw = n.get_pid_bw(prev_votes.vote_map[n.idhex],
-                                    cs_junk.K_p,
-                                    0.0,
-                                    0.0,
-                                    0.0, False)
-
-              # Reset the remaining vote data..
-              n.measured_at = prev_votes.vote_map[n.idhex].measured_at
-              n.pid_error = prev_votes.vote_map[n.idhex].pid_error
-          else:
-            # Everyone else should be pretty instantenous to respond.
-            # Full feedback should be fine for them (we hope),
-            # except for Guard+Exits, we want to dampen just a little
-            # bit for them. Wgd seems a good choice, but might not be exact.
-            # We really want to magically combine Wgd and something that
-            # represents the client migration rate for Guards.. But who
-            # knows how to represent that and still KISS?
-            if n.idhex in prev_consensus and \
-              ("Guard" in prev_consensus[n.idhex].flags \
-               and "Exit" in prev_consensus[n.idhex].flags):
-              # For section2-equivalent mode and/or use_mercy, we should
-              # not use Wgd
-              if n.use_bw == n.desc_bw:
-                weight = 1.0
-              else:
-                weight = (1.0-cs_junk.bw_weights["Wgd"])
-              n.new_bw = n.get_pid_bw(prev_votes.vote_map[n.idhex],
-                              cs_junk.K_p*weight,
-                              cs_junk.K_i*weight,
-                              cs_junk.K_d*weight,
-                              cs_junk.K_i_decay)
-            else:
-              n.new_bw = n.get_pid_bw(prev_votes.vote_map[n.idhex],
-                              cs_junk.K_p,
-                              cs_junk.K_i,
-                              cs_junk.K_d,
-                              cs_junk.K_i_decay)
-        else:
-          # Reset values. Don't vote/sample this measurement round.
-          n.revert_to_vote(prev_votes.vote_map[n.idhex])
-      else: # No prev vote, pure consensus feedback this round
-        n.new_bw = n.use_bw + cs_junk.K_p*n.use_bw*n.pid_error
-        n.pid_error_sum = n.pid_error
-        n.pid_bw = n.new_bw
-        plog("DEBUG", "No prev vote for node "+n.nick+": Consensus feedback")
-    else: # No PID feedback
-      # Choose the larger between sbw and fbw
-      if n.sbw_ratio > n.fbw_ratio:
-        n.ratio = n.sbw_ratio
-      else:
-        n.ratio = n.fbw_ratio
-
-      n.pid_error = 0
-      n.pid_error_sum = 0
-      n.new_bw = n.desc_bw*n.ratio
-      n.pid_bw = n.new_bw # for transition between pid/no-pid
-
-    n.change = n.new_bw - n.desc_bw
-
-    if n.idhex in prev_consensus:
-      if prev_consensus[n.idhex].bandwidth != None:
-        prev_consensus[n.idhex].measured = True
-        tot_net_bw += n.new_bw
-      if IGNORE_GUARDS \
-           and ("Guard" in prev_consensus[n.idhex].flags and not "Exit" in \
-                  prev_consensus[n.idhex].flags):
-        plog("INFO", "Skipping voting for guard "+n.nick)
-        n.ignore = True
-      elif "Authority" in prev_consensus[n.idhex].flags:
-        plog("DEBUG", "Skipping voting for authority "+n.nick)
-        n.ignore = True
-
-  # Go through the list and cap them to NODE_CAP
-  for n in nodes.itervalues():
-    if n.new_bw >= 0x7fffffff:
-      plog("WARN", "Bandwidth of "+n.node_class()+" node "+n.nick+"="+n.idhex+" exceeded maxint32: "+str(n.new_bw))
-      n.new_bw = 0x7fffffff
-    if cs_junk.T_i > 0 and cs_junk.T_i_decay > 0 \
-       and math.fabs(n.pid_error_sum) > \
-           math.fabs(2*cs_junk.T_i*n.pid_error/cs_junk.T_i_decay):
-      plog("NOTICE", "Large pid_error_sum for node "+n.idhex+"="+n.nick+": "+
-                   str(n.pid_error_sum)+" vs "+str(n.pid_error))
-    if n.new_bw > tot_net_bw*NODE_CAP:
-      plog("INFO", "Clipping extremely fast "+n.node_class()+" node "+n.idhex+"="+n.nick+
-           " at "+str(100*NODE_CAP)+"% of network capacity ("+
-           str(n.new_bw)+"->"+str(int(tot_net_bw*NODE_CAP))+") "+
-           " pid_error="+str(n.pid_error)+
-           " pid_error_sum="+str(n.pid_error_sum))
-      n.new_bw = int(tot_net_bw*NODE_CAP)
-      n.pid_error_sum = 0 # Don't let unused error accumulate...
-    if n.new_bw <= 0:
-      if n.idhex in prev_consensus:
-        plog("INFO", n.node_class()+" node "+n.idhex+"="+n.nick+" has bandwidth <= 0: "+str(n.new_bw))
-      else:
-        plog("INFO", "New node "+n.idhex+"="+n.nick+" has bandwidth < 0: "+str(n.new_bw))
-      n.new_bw = 1
+  tot_net_bw = pid.update_bws(cs_junk, prev_votes, true_filt_avg,
+                              pid_tgt_avg, true_strm_avg, true_circ_avg)
+  pid.cap_bws(cs_junk, tot_net_bw)
 
   oldest_measured = min(map(lambda n: n.measured_at,
              filter(lambda n: n.idhex in prev_consensus,
@@ -804,13 +1594,16 @@ def main(argv):
   missed_nodes = 0.0
   missed_bw = 0
   tot_bw = 0
+  desc_map = None
   for n in prev_consensus.itervalues():
     if n.bandwidth != None:
       tot_bw += n.bandwidth
     if not n.measured:
       if "Fast" in n.flags and "Running" in n.flags:
+        if desc_map is None:
+          desc_map = get_recent_descs(c)
         try:
-          r = c.get_router(n)
+          r = get_router(c, n, desc_map)
         except TorCtl.ErrorReply:
           r = None
         if r and not r.down and r.bw > 0:
@@ -878,18 +1671,33 @@ def main(argv):
   out = file(argv[-1], "w")
   out.write(str(scan_age)+"\n")
 
-  # FIXME: Split out debugging data
   for n in n_print:
     if not n.ignore:
-      # Turns out str() is more accurate than %lf
-      out.write("node_id="+n.idhex+" bw="+str(base10_round(n.new_bw))+" nick="+n.nick+ " measured_at="+str(int(n.measured_at))+" updated_at="+str(int(n.updated_at))+" pid_error="+str(n.pid_error)+" pid_error_sum="+str(n.pid_error_sum)+" pid_bw="+str(int(n.pid_bw))+" pid_delta="+str(n.pid_delta)+" circ_fail="+str(n.circ_fail_rate)+" scanner="+str(n.scanner)+"\n")
+      out.write(vote_line(n))
   out.close()
 
   write_file_list(argv[1])
 
+def usage(argv):
+  print "Usage: "+argv[0]+" [--workers=N] [--numpy-pid] <datadir> <outfile>"
+
 if __name__ == "__main__":
   try:
-    main(sys.argv)
+    (flags, args) = getopt.getopt(sys.argv[1:], "", ["workers=", "numpy-pid"])
+  except getopt.GetoptError, e:
+    print e
+    usage(sys.argv)
+    sys.exit(1)
+  for (flag, val) in flags:
+    if flag == "--workers":
+      INGEST_WORKERS = int(val)
+    elif flag == "--numpy-pid":
+      USE_NUMPY_PID = True
+  if len(args) < 2:
+    usage(sys.argv)
+    sys.exit(1)
+  try:
+    main(sys.argv[:1]+args)
   except socket.error, e:
     traceback.print_exc()
     plog("WARN", "Socket error. Are the scanning Tors running?")
@@ -2,7 +2,9 @@
 from sys import argv as s_argv
 from sys import path
 from sys import exit
-from subprocess import Popen
+from subprocess import Popen, PIPE
+from os import pipe, close, fdopen
+from time import time
 path.append("../../")
 import TorCtl.TorUtil
 from TorCtl.TorUtil import plog as plog
@@ -21,6 +23,16 @@ PATH_TO_TORCTL_REPO = '../../.git/modules/TorCtl/'
 
 p = None
 
+def spawn_worker(cfg):
+  ''' start a long-lived bwauthority_child that keeps its Tor control
+  connection and router list across slices. returns the process and
+  the pipe it reports slice progress on '''
+  (r, w) = pipe()
+  child = Popen(["python", "bwauthority_child.py", cfg, "worker", str(w)],
+                stdin=PIPE)
+  close(w)
+  return (child, fdopen(r, "r"))
+
 def main(argv):
   TorCtl.TorUtil.read_config(argv[1])
   (branch, head) = get_git_version(PATH_TO_TORFLOW_REPO)
@@ -28,10 +40,33 @@ def main(argv):
   (branch, head) = get_git_version(PATH_TO_TORCTL_REPO)
   plog('NOTICE', 'TorCtl Version: %s' % branch+' '+head)
   slice_num = 0 
+  replies = None
   while True:
     plog('INFO', 'Beginning time loop')
     global p
-    p = Popen(["python", "bwauthority_child.py", argv[1], str(slice_num)])
+    if not replies:
+      (p, replies) = spawn_worker(argv[1])
+    assigned = time()
+    try:
+      p.stdin.write(str(slice_num)+"\n")
+      p.stdin.flush()
+    except IOError:
+      pass # The worker died. We'll see EOF below.
+    reply = replies.readline()
+    if reply.startswith("STARTED"):
+      # For a fresh worker this includes interpreter startup, imports,
+      # and connecting to Tor.
+      plog('INFO', 'Slice %d startup overhead: %.2fs'
+             % (slice_num, time() - assigned))
+      reply = replies.readline()
+    if reply.startswith("DONE"):
+      slice_num += 1
+      continue
+
+    # The worker exited. Handle its exit code as we always have.
+    replies.close()
+    replies = None
+    p.stdin.close()
     p.wait()
     if (p.returncode == 0):
       slice_num += 1
@@ -25,6 +25,7 @@ import sets
 import re
 import ssl
 import random
+import bisect
 
 sys.path.append("../../")
 
@@ -102,39 +103,74 @@ def read_config(filename):
   only_unmeasured = config.getint('BwAuthority', 'only_unmeasured')
   min_unmeasured = config.getint('BwAuthority', 'min_unmeasured')
 
+  # Older configs predate concurrent fetching
+  if config.has_option('BwAuthority', 'concurrent_streams'):
+    concurrent_streams = config.getint('BwAuthority', 'concurrent_streams')
+  else:
+    concurrent_streams = 1
+
   return (start_pct,stop_pct,nodes_per_slice,save_every,
             circs_per_node,out_dir,max_fetch_time,tor_dir,
             sleep_start,sleep_stop,min_streams,pid_file,db_url,only_unmeasured,
-            min_unmeasured)
+            min_unmeasured,concurrent_streams)
 
-def choose_url(percentile):
-  # TODO: Maybe we don't want to read the file *every* time?
-  # Maybe once per slice?
-  # Read in the bw auths file
+# The ./data/bwfiles size table, as (mtime, percentiles, file names).
+# Each percentile is the running maximum of the file's percentiles up to
+# that line, so the list is sorted and the first line above a given
+# percentile can be found by bisection.
+bwfiles = None
+
+def read_bwfiles(path, mtime):
   # here is a fine place to make sure we have bwfiles
   try:
-    f = file("./data/bwfiles", "r")
+    f = file(path, "r")
   except IOError:
     write_file_list('./data')
-  lines = []
+    f = file(path, "r")
+  pcts = []
+  fnames = []
   valid = False
   for l in f.readlines():
     if l == ".\n":
       valid = True
       break
     pair = l.split()
-    lines.append((int(pair[0]), pair[1]))
+    pct = int(pair[0])
+    if pcts:
+      pct = max(pct, pcts[-1])
+    pcts.append(pct)
+    fnames.append(pair[1])
+  f.close()
 
   if not valid:
     plog("ERROR", "File size list is invalid!")
 
-  for (pct, fname) in lines:
-    if percentile < pct:
-      return random.choice(urls) + fname
+  return (mtime, pcts, fnames)
+
+def choose_url(percentile):
+  # Read in the bw auths file once, and again only when it changes
+  global bwfiles
+  path = "./data/bwfiles"
+  try:
+    mtime = os.stat(path).st_mtime
+  except OSError:
+    mtime = None
+  table = bwfiles
+  if not table or table[0] != mtime:
+    table = bwfiles = read_bwfiles(path, mtime)
+  (mtime, pcts, fnames) = table
+
+  # The first file whose percentile is above ours
+  i = bisect.bisect_right(pcts, percentile)
+  if i < len(pcts):
+    return random.choice(urls) + fnames[i]
   raise PathSupport.NoNodesRemain("No nodes left for url choice!")
 
-def http_request(address):
-  ''' perform an http GET-request and return 1 for success or 0 for failure '''
+def http_request(address, on_connect=None, timeout=None):
+  ''' perform an http GET-request and return 1 for success or 0 for failure.
+  on_connect is called once the reply headers are in, before the body is
+  read. if timeout is given, the request fails once any read or connect
+  has waited that many seconds. '''
 
   request = urllib2.Request(address)
   try:
@@ -143,16 +179,30 @@ def http_request(address):
     context = None
   request.add_header('User-Agent', user_agent)
 
+  if timeout is None:
+    timeout = socket._GLOBAL_DEFAULT_TIMEOUT
   try:
     if context:
-      reply = urllib2.urlopen(request, context=context)
+      reply = urllib2.urlopen(request, timeout=timeout, context=context)
     else:
-      reply = urllib2.urlopen(request)
+      reply = urllib2.urlopen(request, timeout=timeout)
+    if on_connect:
+      on_connect()
     decl_length = reply.info().get("Content-Length")
     read_len = len(reply.read())
     plog("DEBUG", "Read: "+str(read_len)+" of declared "+str(decl_length))
     return 1
-  except (ValueError, urllib2.URLError) as e:
+  except socket.timeout:
+    plog("NOTICE", "Timed out fetching "+address)
+    return 0
+  except urllib2.URLError as e:
+    if isinstance(e.reason, socket.timeout):
+      plog("NOTICE", "Timed out fetching "+address)
+      return 0
+    plog('ERROR', 'The http-request address ' + address + ' is malformed')
+    plog('ERROR', str(e))
+    return 0
+  except ValueError as e:
     plog('ERROR', 'The http-request address ' + address + ' is malformed')
     plog('ERROR', str(e))
     return 0
@@ -173,6 +223,171 @@ def http_request(address):
     traceback.print_exc()
     return 0
 
+def close_exit_streams(hdlr, exit, reason):
+  ''' like hdlr.close_streams(), but only for the streams running through
+  exit, so that the other concurrent fetches are left alone '''
+  def notlambda(this):
+    for s in this.streams.values():
+      circ = s.circ or s.pending_circ
+      if s.ignored or not circ or circ.exit is not exit:
+        continue
+      plog("NOTICE", "Closing stream "+str(s.strm_id)+" via "+str(exit))
+      try:
+        this.c.close_stream(s.strm_id, reason)
+      except TorCtl.ErrorReply, e:
+        # This can happen. Streams can timeout before this call.
+        plog("NOTICE", "Error closing stream "+str(s.strm_id)+": "+str(e))
+  hdlr.schedule_immediate(notlambda)
+
+class RaceStream:
+  ''' A single fetch of a concurrent slice race.
+
+  PathBuilder only builds a fresh circuit for the first stream after a
+  new_exit(), and reports that circuit's exit as the last one used. So
+  new_exit() and the request up to the reply headers are serialized on
+  launch_lock: every fetch gets its own circuit and knows its exit, and
+  only the downloads themselves overlap.
+
+  Tor doesn't time out a stream once it is connected, so an exit that
+  stalls before the headers would hold launch_lock for good. The request
+  gets a socket timeout of max_fetch_time for that: the fetch fails and
+  closing its socket ends the stream. '''
+  def __init__(self, hdlr, launch_lock, max_fetch_time):
+    self.hdlr = hdlr
+    self.launch_lock = launch_lock
+    self.max_fetch_time = max_fetch_time
+    self.launching = False
+    self.timed_out = False
+    self.exit = None
+
+  def fetch(self, url):
+    # See the Tor bug note in speedrace(). 7 == TIMEOUT, so the bandwidth
+    # of a stream killed here is not counted.
+    timer = threading.Timer(self.max_fetch_time, self.timeout)
+    self.launch_lock.acquire()
+    self.launching = True
+    try:
+      # Every other racer's stream is attached by now, so their ports
+      # are no longer needed by the StreamSelector.
+      PathSupport.SmartSocket.clear_port_table()
+      self.hdlr.new_exit()
+      timer.start()
+      ret = http_request(url, self.connected, self.max_fetch_time)
+    finally:
+      timer.cancel()
+      if self.launching:
+        self.connected()
+    return ret
+
+  def connected(self):
+    # Nothing else has been attached since our stream
+    self.exit = self.hdlr.get_exit_node()
+    self.launching = False
+    self.launch_lock.release()
+    if self.timed_out:
+      # The reply took longer than max_fetch_time. Don't read the body.
+      plog("NOTICE", "Fetch via "+str(self.exit)+" timed out before the reply")
+      close_exit_streams(self.hdlr, self.exit, 7)
+
+  def timeout(self):
+    self.timed_out = True
+    if not self.exit:
+      # We don't know our exit until the reply headers are in, and any
+      # other exit may be carrying someone else's fetch. connected()
+      # closes our stream if it gets that far, and otherwise the socket
+      # timeout of the request ends it.
+      plog("NOTICE", "Fetch timed out before its reply headers")
+      return
+    plog("NOTICE", "Fetch via "+str(self.exit)+" timed out")
+    close_exit_streams(self.hdlr, self.exit, 7)
+
+def race_concurrently(hdlr, concurrent_streams, circs_per_node, max_fetch_time,
+                      url_pct, pct_range, save_every=0, save=None):
+  ''' run the fetches of a slice concurrent_streams at a time, each on its
+  own circuit. every save_every successful fetches, save(successful) is
+  called once all fetches in flight have finished, since saving closes
+  every circuit. returns (attempts, successful fetches) '''
+  launch_lock = threading.Lock()
+  count_lock = threading.Condition()
+  counts = {"attempt": 0, "successful": 0, "active": 0}
+  saving = []
+  errors = []
+  done = threading.Event()
+
+  def racer():
+    try:
+      while not done.isSet():
+        count_lock.acquire()
+        while saving and not done.isSet():
+          count_lock.wait(1)
+        successful = counts["successful"]
+        counts["active"] += 1
+        count_lock.release()
+        if hdlr.is_count_met(circs_per_node, successful):
+          count_lock.acquire()
+          counts["active"] -= 1
+          count_lock.notifyAll()
+          count_lock.release()
+          break
+        t0 = time.time()
+        url = choose_url(url_pct)
+        stream = RaceStream(hdlr, launch_lock, max_fetch_time)
+        plog("DEBUG", "Launching stream request for url "+url+" in "+pct_range)
+        ret = stream.fetch(url)
+
+        delta_build = time.time() - t0
+        if delta_build >= max_fetch_time:
+          plog('WARN', 'Timer exceeded limit: ' + str(delta_build) + '\n')
+
+        count_lock.acquire()
+        counts["active"] -= 1
+        counts["attempt"] += 1
+        must_save = False
+        # FIXME: As in speedrace(), timeouts get counted as 'sucessful' here
+        if ret == 1 and stream.exit:
+          counts["successful"] += 1
+          if save_every and not saving and \
+              counts["successful"] % save_every == 0:
+            saving.append(counts["successful"])
+            must_save = True
+        count_lock.notifyAll()
+        count_lock.release()
+        if ret == 1 and stream.exit:
+          plog('DEBUG', pct_range + ' circuit build+fetch took ' + str(delta_build) + ' for ' + str(stream.exit))
+        else:
+          plog('DEBUG', pct_range + ' circuit build+fetch failed for ' + str(stream.exit))
+
+        if must_save:
+          # No new fetches start until we're done. Let the ones in
+          # flight finish before their circuits are closed.
+          count_lock.acquire()
+          try:
+            while counts["active"] and not done.isSet():
+              count_lock.wait(1)
+            if not done.isSet():
+              save(counts["successful"])
+          finally:
+            del saving[:]
+            count_lock.notifyAll()
+            count_lock.release()
+    except:
+      errors.append(sys.exc_info())
+    done.set()
+
+  racers = []
+  for i in xrange(concurrent_streams):
+    t = threading.Thread(target=racer)
+    t.setDaemon(True)
+    t.start()
+    racers.append(t)
+  for t in racers:
+    # A plain join() would not let KeyboardInterrupt through
+    while t.isAlive():
+      t.join(1)
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+  return (counts["attempt"], counts["successful"])
+
 class BwScanHandler(ScanSupport.SQLScanHandler):
   def is_count_met(self, count, num_streams, position=0):
     cond = threading.Condition()
@@ -221,62 +436,76 @@ class BwScanHandler(ScanSupport.SQLScanHandler):
 
 def speedrace(hdlr, start_pct, stop_pct, circs_per_node, save_every, out_dir,
               max_fetch_time, sleep_start_tp, sleep_stop_tp, slice_num,
-              min_streams, sql_file, only_unmeasured):
+              min_streams, sql_file, only_unmeasured, concurrent_streams=1):
   plog("NOTICE", "Starting slice for percentiles "+str(start_pct)+"-"+str(stop_pct))
   hdlr.set_pct_rstr(start_pct, stop_pct)
 
+  def save(successful):
+    race_time = time.strftime("20%y-%m-%d-%H:%M:%S")
+    hdlr.close_circuits()
+    hdlr.commit()
+    lo = str(round(start_pct,1))
+    hi = str(round(stop_pct,1))
+    # Warning, don't remove the sql stats without changing the recompute
+    # param in write_strm_bws to True
+    hdlr.write_sql_stats(os.getcwd()+'/'+out_dir+'/sql-'+lo+':'+hi+"-"+str(successful)+"-"+race_time, sqlalchemy.or_(SQLSupport.RouterStats.circ_try_from > 0, SQLSupport.RouterStats.circ_try_to > 0))
+    hdlr.write_strm_bws(os.getcwd()+'/'+out_dir+'/bws-'+lo+':'+hi+"-"+str(successful)+"-"+race_time, stats_filter=SQLSupport.RouterStats.strm_closed >= 1)
+
   attempt = 0
   successful = 0
-  while True:
-    if hdlr.is_count_met(circs_per_node, successful): break
-    t0 = time.time()
-
-    hdlr.new_exit()
-    attempt += 1
-
-    # TODO: This noise is due to a difficult to find Tor bug that
-    # causes some exits to hang forever on streams :(
-    # FIXME: Hrmm, should we change the reason on this? Right now,
-    # 7 == TIMEOUT, which means we do not count the bandwidth of this
-    # stream.. however, we count it as 'successful' below
-    timer = threading.Timer(max_fetch_time, lambda: hdlr.close_streams(7))
-    timer.start()
-
+  if concurrent_streams > 1:
     # Always use median URL size for unmeasured nodes
     # They may be too slow..
     if only_unmeasured:
-      url = choose_url(50)
-    else:
-      url = choose_url(start_pct)
-
-    plog("DEBUG", "Launching stream request for url "+url+" in "+str(start_pct)+'-'+str(stop_pct) + '%')
-    ret = http_request(url)
-    timer.cancel()
-    PathSupport.SmartSocket.clear_port_table()
-
-    delta_build = time.time() - t0
-    if delta_build >= max_fetch_time:
-      plog('WARN', 'Timer exceeded limit: ' + str(delta_build) + '\n')
-
-    build_exit = hdlr.get_exit_node()
-    # FIXME: Timeouts get counted as 'sucessful' here, but do not
-    # count in the SQL stats!
-    if ret == 1 and build_exit:
-      successful += 1
-      plog('DEBUG', str(start_pct) + '-' + str(stop_pct) + '% circuit build+fetch took ' + str(delta_build) + ' for ' + str(build_exit))
+      url_pct = 50
     else:
-      plog('DEBUG', str(start_pct)+'-'+str(stop_pct)+'% circuit build+fetch failed for ' + str(build_exit))
-
-    if save_every and ret and successful and (successful % save_every) == 0:
-      race_time = time.strftime("20%y-%m-%d-%H:%M:%S")
-      hdlr.close_circuits()
-      hdlr.commit()
-      lo = str(round(start_pct,1))
-      hi = str(round(stop_pct,1))
-      # Warning, don't remove the sql stats without changing the recompute
-      # param in write_strm_bws to True
-      hdlr.write_sql_stats(os.getcwd()+'/'+out_dir+'/sql-'+lo+':'+hi+"-"+str(successful)+"-"+race_time, sqlalchemy.or_(SQLSupport.RouterStats.circ_try_from > 0, SQLSupport.RouterStats.circ_try_to > 0))
-      hdlr.write_strm_bws(os.getcwd()+'/'+out_dir+'/bws-'+lo+':'+hi+"-"+str(successful)+"-"+race_time, stats_filter=SQLSupport.RouterStats.strm_closed >= 1)
+      url_pct = start_pct
+    (attempt, successful) = race_concurrently(hdlr, concurrent_streams,
+           circs_per_node, max_fetch_time, url_pct,
+           str(start_pct)+'-'+str(stop_pct)+'%', save_every, save)
+  else:
+    while True:
+      if hdlr.is_count_met(circs_per_node, successful): break
+      t0 = time.time()
+
+      hdlr.new_exit()
+      attempt += 1
+
+      # TODO: This noise is due to a difficult to find Tor bug that
+      # causes some exits to hang forever on streams :(
+      # FIXME: Hrmm, should we change the reason on this? Right now,
+      # 7 == TIMEOUT, which means we do not count the bandwidth of this
+      # stream.. however, we count it as 'successful' below
+      timer = threading.Timer(max_fetch_time, lambda: hdlr.close_streams(7))
+      timer.start()
+
+      # Always use median URL size for unmeasured nodes
+      # They may be too slow..
+      if only_unmeasured:
+        url = choose_url(50)
+      else:
+        url = choose_url(start_pct)
+
+      plog("DEBUG", "Launching stream request for url "+url+" in "+str(start_pct)+'-'+str(stop_pct) + '%')
+      ret = http_request(url)
+      timer.cancel()
+      PathSupport.SmartSocket.clear_port_table()
+
+      delta_build = time.time() - t0
+      if delta_build >= max_fetch_time:
+        plog('WARN', 'Timer exceeded limit: ' + str(delta_build) + '\n')
+
+      build_exit = hdlr.get_exit_node()
+      # FIXME: Timeouts get counted as 'sucessful' here, but do not
+      # count in the SQL stats!
+      if ret == 1 and build_exit:
+        successful += 1
+        plog('DEBUG', str(start_pct) + '-' + str(stop_pct) + '% circuit build+fetch took ' + str(delta_build) + ' for ' + str(build_exit))
+      else:
+        plog('DEBUG', str(start_pct)+'-'+str(stop_pct)+'% circuit build+fetch failed for ' + str(build_exit))
+
+      if save_every and ret and successful and (successful % save_every) == 0:
+        save(successful)
 
   plog('INFO', str(start_pct) + '-' + str(stop_pct) + '% ' + str(successful) + ' fetches took ' + str(attempt) + ' tries.')
 
@@ -301,93 +530,134 @@ def speedrace(hdlr, start_pct, stop_pct, circs_per_node, save_every, out_dir,
 
   return successful
 
-def main(argv):
-  TorUtil.read_config(argv[1])
+def connect(out_dir, tor_dir, db_url, only_unmeasured):
+  try:
+    (c,hdlr) = setup_handler(out_dir, tor_dir+"/control_auth_cookie")
+  except Exception, e:
+    traceback.print_exc()
+    plog("WARN", "Can't connect to Tor: "+str(e))
+    sys.exit(STOP_PCT_REACHED)
+
+  if db_url:
+    hdlr.attach_sql_listener(db_url)
+    sql_file = None
+  else:
+    plog("INFO", "db_url not found in config. Defaulting to sqlite")
+    sql_file = os.getcwd()+'/'+out_dir+'/bwauthority.sqlite'
+    #hdlr.attach_sql_listener('sqlite:///'+sql_file)
+    hdlr.attach_sql_listener('sqlite://')
+
+  # set SOCKS proxy
+  socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, TorUtil.tor_host, TorUtil.tor_port)
+  socket.socket = socks.socksocket
+  plog("INFO", "Set socks proxy to "+TorUtil.tor_host+":"+str(TorUtil.tor_port))
+
+  hdlr.schedule_selmgr(lambda s: setattr(s, "only_unmeasured", only_unmeasured))
+  return (c,hdlr,sql_file)
+
+def run_slice(c, hdlr, sql_file, config, slice_num, replies=None):
   (start_pct,stop_pct,nodes_per_slice,save_every,circs_per_node,out_dir,
       max_fetch_time,tor_dir,sleep_start,sleep_stop,
              min_streams,pid_file_name,db_url,only_unmeasured,
-             min_unmeasured) = read_config(argv[1])
-  plog("NOTICE", "Child Process Spawned...")
+             min_unmeasured,concurrent_streams) = config
 
-  # make sure necessary out_dir directory exists
-  path = os.getcwd()+'/'+out_dir
-  if not os.path.exists(path):
-    os.makedirs(path)
- 
-  if pid_file_name:
-    pidfd = file(pid_file_name, 'w')
-    pidfd.write('%d\n' % os.getpid())
-    pidfd.close()
-
-    slice_num = int(argv[2])
-
-    try:
-      (c,hdlr) = setup_handler(out_dir, tor_dir+"/control_auth_cookie")
-    except Exception, e:
-      traceback.print_exc()
-      plog("WARN", "Can't connect to Tor: "+str(e))
-      sys.exit(STOP_PCT_REACHED)
+  hdlr.wait_for_consensus()
 
-    if db_url:
-      hdlr.attach_sql_listener(db_url)
-      sql_file = None
-    else:
-      plog("INFO", "db_url not found in config. Defaulting to sqlite")
-      sql_file = os.getcwd()+'/'+out_dir+'/bwauthority.sqlite'
-      #hdlr.attach_sql_listener('sqlite:///'+sql_file)
-      hdlr.attach_sql_listener('sqlite://')
-
-    # set SOCKS proxy
-    socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, TorUtil.tor_host, TorUtil.tor_port)
-    socket.socket = socks.socksocket
-    plog("INFO", "Set socks proxy to "+TorUtil.tor_host+":"+str(TorUtil.tor_port))
-
-    hdlr.schedule_selmgr(lambda s: setattr(s, "only_unmeasured", only_unmeasured))
-
-    hdlr.wait_for_consensus()
-
-    # Now that we have the consensus, we shouldn't need to listen
-    # for new consensus events.
+  # Now that we have the consensus, we shouldn't need to listen
+  # for new consensus events. A long-lived worker keeps listening,
+  # so that its router list is still current for the next slice.
+  if not replies:
     c.set_events([TorCtl.EVENT_TYPE.STREAM,
           TorCtl.EVENT_TYPE.BW,
           TorCtl.EVENT_TYPE.CIRC,
           TorCtl.EVENT_TYPE.STREAM_BW], True)
 
-    # We should go to sleep if there are less than 5 unmeasured nodes after
-    # consensus update
-    if min_unmeasured and hdlr.get_unmeasured() < min_unmeasured:
-      plog("NOTICE", "Less than "+str(min_unmeasured)+" unmeasured nodes ("+str(hdlr.get_unmeasured())+"). Sleeping for a bit")
-      time.sleep(3600) # Until next consensus arrives
-      plog("NOTICE", "Woke up from waiting for more unmeasured nodes.  Requesting slice restart.")
-      sys.exit(RESTART_SLICE)
+  # We should go to sleep if there are less than 5 unmeasured nodes after
+  # consensus update
+  if min_unmeasured and hdlr.get_unmeasured() < min_unmeasured:
+    plog("NOTICE", "Less than "+str(min_unmeasured)+" unmeasured nodes ("+str(hdlr.get_unmeasured())+"). Sleeping for a bit")
+    time.sleep(3600) # Until next consensus arrives
+    plog("NOTICE", "Woke up from waiting for more unmeasured nodes.  Requesting slice restart.")
+    sys.exit(RESTART_SLICE)
+
+  pct_step = hdlr.rank_to_percent(nodes_per_slice)
+  plog("INFO", "Percent per slice is: "+str(pct_step))
+  if pct_step > 100: pct_step = 100
+
+  # check to see if we are done
+  if (slice_num * pct_step + start_pct > stop_pct):
+      plog('NOTICE', 'Child stop point %s reached. Exiting with %s' % (stop_pct, STOP_PCT_REACHED))
+      sys.exit(STOP_PCT_REACHED)
+
+  if replies:
+    replies.write("STARTED "+str(slice_num)+"\n")
+
+  successful = speedrace(hdlr, slice_num*pct_step + start_pct, (slice_num + 1)*pct_step + start_pct, circs_per_node,
+            save_every, out_dir, max_fetch_time, sleep_start, sleep_stop, slice_num,
+            min_streams, sql_file, only_unmeasured, concurrent_streams)
 
-    pct_step = hdlr.rank_to_percent(nodes_per_slice)
-    plog("INFO", "Percent per slice is: "+str(pct_step))
-    if pct_step > 100: pct_step = 100
+  # For debugging memory leak..
+  #TorUtil.dump_class_ref_counts(referrer_depth=1)
 
-    # check to see if we are done
-    if (slice_num * pct_step + start_pct > stop_pct):
-        plog('NOTICE', 'Child stop point %s reached. Exiting with %s' % (stop_pct, STOP_PCT_REACHED))
-        sys.exit(STOP_PCT_REACHED)
+  # TODO: Change pathlen to 3 and kill exit+ConserveExit restrictions
+  # And record circ failure rates..
 
-    successful = speedrace(hdlr, slice_num*pct_step + start_pct, (slice_num + 1)*pct_step + start_pct, circs_per_node,
-              save_every, out_dir, max_fetch_time, sleep_start, sleep_stop, slice_num,
-              min_streams, sql_file, only_unmeasured)
+  #circ_measure(hdlr, pct, pct+pct_step, circs_per_node, save_every, 
+  #  out_dir, max_fetch_time, sleep_start, sleep_stop, slice_num, sql_file)
 
-    # For debugging memory leak..
-    #TorUtil.dump_class_ref_counts(referrer_depth=1)
+  # XXX: Hack this to return a codelen double the slice size on failure?
+  plog("INFO", "Slice success count: "+str(successful))
+  if successful == 0:
+    plog("WARN", "Slice success count was ZERO!")
 
-    # TODO: Change pathlen to 3 and kill exit+ConserveExit restrictions
-    # And record circ failure rates..
+  if replies:
+    replies.write("DONE "+str(slice_num)+"\n")
 
-    #circ_measure(hdlr, pct, pct+pct_step, circs_per_node, save_every, 
-    #  out_dir, max_fetch_time, sleep_start, sleep_stop, slice_num, sql_file)
+def main(argv):
+  TorUtil.read_config(argv[1])
+  config = read_config(argv[1])
+  (start_pct,stop_pct,nodes_per_slice,save_every,circs_per_node,out_dir,
+      max_fetch_time,tor_dir,sleep_start,sleep_stop,
+             min_streams,pid_file_name,db_url,only_unmeasured,
+             min_unmeasured,concurrent_streams) = config
+  plog("NOTICE", "Child Process Spawned...")
 
-    # XXX: Hack this to return a codelen double the slice size on failure?
-    plog("INFO", "Slice success count: "+str(successful))
-    if successful == 0:
-      plog("WARN", "Slice success count was ZERO!")
+  # make sure necessary out_dir directory exists
+  path = os.getcwd()+'/'+out_dir
+  if not os.path.exists(path):
+    os.makedirs(path)
+ 
+  if pid_file_name:
+    pidfd = file(pid_file_name, 'w')
+    pidfd.write('%d\n' % os.getpid())
+    pidfd.close()
 
+    (c,hdlr,sql_file) = connect(out_dir, tor_dir, db_url, only_unmeasured)
+
+    if argv[2] != "worker":
+      run_slice(c, hdlr, sql_file, config, int(argv[2]))
+      sys.exit(0)
+
+    # Worker mode, used by bwauthority.py: slice numbers arrive one
+    # per line on stdin, and progress is reported on the pipe whose fd
+    # is argv[3]. Exiting with STOP_PCT_REACHED or RESTART_SLICE (or
+    # dying) hands control back to the parent, which starts a new worker.
+    # The config is only read at startup, so a worker whose config file
+    # has changed hands its slice back to a fresh worker.
+    replies = os.fdopen(int(argv[3]), "w", 0)
+    cfg_mtime = os.stat(argv[1]).st_mtime
+    first = True
+    while True:
+      line = sys.stdin.readline()
+      if not line: break
+      if os.stat(argv[1]).st_mtime != cfg_mtime:
+        plog("NOTICE", argv[1]+" changed. Restarting to reread it.")
+        sys.exit(RESTART_SLICE)
+      if not first:
+        # A freshly spawned child started with empty stats
+        hdlr.reset_stats()
+      first = False
+      run_slice(c, hdlr, sql_file, config, int(line), replies)
     sys.exit(0)
 
 def ignore_streams(c,hdlr):
@@ -431,13 +701,13 @@ def setup_handler(out_dir, cookie_file):
   return (c,h)
 
 def usage(argv):
-  print "Usage: "+argv[0]+" <configfile>"
+  print "Usage: "+argv[0]+" <configfile> <slice_num>|worker <reply_fd>"
   return
 
 # initiate the program
 if __name__ == '__main__':
   try:
-    if len(sys.argv) < 2: usage(sys.argv)
+    if len(sys.argv) < 3: usage(sys.argv)
     else: main(sys.argv)
   except KeyboardInterrupt:
     plog('INFO', "Ctrl + C was pressed. Exiting ... ")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Benchmark of choose_url over many calls with random percentiles: the
+# old version that read and scanned ./data/bwfiles on every call,
+# against the cached, bisected table. Both must choose the same URL (or
+# both run out of files), for data/bwfiles and for an unsorted copy.
+#
+# Usage: bench_choose_url.py [calls]
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+bwauth_dir = os.path.join(here, "..")
+sys.path.insert(0, bwauth_dir)
+sys.path.append(os.path.join(here, "../../.."))
+sys.path.append(os.path.join(here, "../../libs"))
+import bwauthority_child
+from bwauthority_child import urls, PathSupport
+
+# choose_url before the table was cached
+def old_choose_url(percentile):
+  f = file("./data/bwfiles", "r")
+  lines = []
+  for l in f.readlines():
+    if l == ".\n":
+      break
+    pair = l.split()
+    lines.append((int(pair[0]), pair[1]))
+  f.close()
+  for (pct, fname) in lines:
+    if percentile < pct:
+      return random.choice(urls) + fname
+  raise PathSupport.NoNodesRemain("No nodes left for url choice!")
+
+def run(choose, pcts):
+  random.seed(8)
+  chosen = []
+  t0 = time.time()
+  for pct in pcts:
+    try:
+      chosen.append(choose(pct))
+    except PathSupport.NoNodesRemain:
+      chosen.append(None)
+  return (chosen, time.time()-t0)
+
+def compare(pcts):
+  bwauthority_child.bwfiles = None
+  (old, t_old) = run(old_choose_url, pcts)
+  (new, t_new) = run(bwauthority_child.choose_url, pcts)
+  assert old == new
+  return (t_old, t_new)
+
+def main(argv):
+  n = 100000
+  if len(argv) > 1: n = int(argv[1])
+  rand = random.Random(8)
+  pcts = [rand.randint(-5, 109) for i in xrange(n)]
+
+  os.chdir(bwauth_dir)
+  (t_old, t_new) = compare(pcts)
+  print "%d calls: per-call read %.1fus/call, cached table %.1fus/call " \
+        "(%.1fx)" % (n, t_old/n*1e6, t_new/n*1e6, t_old/t_new)
+
+  # The old scan took the first line above the percentile even when the
+  # lines were out of order
+  tmp = tempfile.mkdtemp()
+  try:
+    os.mkdir(os.path.join(tmp, "data"))
+    lines = file(os.path.join(bwauth_dir, "data", "bwfiles")).readlines()
+    body = lines[:lines.index(".\n")]
+    rand.shuffle(body)
+    file(os.path.join(tmp, "data", "bwfiles"), "w").write("".join(body)+".\n")
+    os.chdir(tmp)
+    compare(pcts[:10000])
+    print "Unsorted bwfiles: same choices"
+  finally:
+    os.chdir(bwauth_dir)
+    shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+  main(sys.argv)
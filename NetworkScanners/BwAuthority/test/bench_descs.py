@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Benchmark of the descriptor lookups aggregate.py makes against a
+# control port: one GETINFO desc/id per consensus entry, against one
+# GETINFO desc/all-recent plus desc/id for the routers missing from it.
+# Uses the fake control port of test_descs.py.
+#
+# Usage: bench_descs.py [routers [delay_ms]]
+
+import sys
+import time
+
+import test_descs
+
+def main(argv):
+  n = 6500
+  delay = 0
+  if len(argv) > 1: n = int(argv[1])
+  if len(argv) > 2: delay = float(argv[2])/1000
+  missing = n/100
+  net = test_descs.Network(1, {"current":n-3*missing, "new":missing,
+                               "stale":missing, "gone":missing})
+  port = test_descs.FakeControlPort(net, delay)
+  c = port.connect()
+  ns_list = c.get_network_status()
+
+  results = []
+  for how in (test_descs.lookup_each, test_descs.lookup_bulk):
+    del port.requests[:]
+    t0 = time.time()
+    routers = how(c, ns_list)
+    results.append((time.time()-t0, len(port.requests),
+                    map(test_descs.router_key, routers)))
+  c.close()
+  port.shutdown()
+
+  assert results[0][2] == results[1][2]
+  print "%d routers, %gms per request: desc/id each %d round trips %.2fs, " \
+        "all-recent %d round trips %.2fs" % \
+        (n, delay*1000, results[0][1], results[0][0], results[1][1],
+         results[1][0])
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Benchmark of slice file parsing: the per-field regexps aggregate.py
+# used to run over every line, against the single pass of
+# parse_fields/read_slice_lines. Both must yield the same values.
+#
+# Usage: bench_parse.py [lines]
+
+import os
+import re
+import sys
+import time
+import random
+import StringIO
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+sys.path.append(os.path.join(here, "../../.."))
+import aggregate
+
+# The Line constructor aggregate.py had before the single pass parser
+def regex_line(l):
+  d = {}
+  d['idhex'] = re.search("[\s]*node_id=([\S]+)[\s]*", l).group(1)
+  d['nick'] = re.search("[\s]*nick=([\S]+)[\s]*", l).group(1)
+  d['strm_bw'] = int(re.search("[\s]*strm_bw=([\S]+)[\s]*", l).group(1))
+  d['filt_bw'] = int(re.search("[\s]*filt_bw=([\S]+)[\s]*", l).group(1))
+  d['ns_bw'] = int(re.search("[\s]*ns_bw=([\S]+)[\s]*", l).group(1))
+  d['desc_bw'] = int(re.search("[\s]*desc_bw=([\S]+)[\s]*", l).group(1))
+  try:
+    d['circ_fail_rate'] = float(re.search("[\s]*circ_fail_rate=([\S]+)[\s]*", l).group(1))
+  except:
+    d['circ_fail_rate'] = 0
+  try:
+    d['strm_fail_rate'] = float(re.search("[\s]*strm_fail_rate=([\S]+)[\s]*", l).group(1))
+  except:
+    d['strm_fail_rate'] = 0
+  return d
+
+def slice_file(n):
+  random.seed(1)
+  lines = ["slicenum=3\n", "1400000000\n"]
+  for i in xrange(n):
+    lines.append("node_id=$%040X nick=n%d strm_bw=%d filt_bw=%d circ_fail_rate=%.3f desc_bw=%d ns_bw=%d\n"
+      % (random.getrandbits(160), i, random.randint(1, 10**7),
+         random.randint(1, 10**7), random.random(), random.randint(1, 10**7),
+         random.randint(1, 10**7)))
+  return "".join(lines)
+
+def main(argv):
+  n = 50000
+  if len(argv) > 1: n = int(argv[1])
+  data = slice_file(n)
+
+  t0 = time.time()
+  fp = StringIO.StringIO(data)
+  fp.readline()
+  fp.readline()
+  old = [regex_line(l) for l in fp]
+  t_old = time.time()-t0
+
+  t0 = time.time()
+  new = list(aggregate.read_slice_lines(StringIO.StringIO(data), "s", 1, "f"))
+  t_new = time.time()-t0
+
+  assert len(old) == len(new) == n
+  for (o, l) in zip(old, new):
+    for (k, v) in o.iteritems():
+      assert getattr(l, k) == v, (k, v, getattr(l, k))
+
+  print "%d lines: per-field regexps %.2fs, single pass %.2fs (%.1fx)" % \
+        (n, t_old, t_new, t_old/t_new)
+
+if __name__ == '__main__':
+  main(sys.argv)
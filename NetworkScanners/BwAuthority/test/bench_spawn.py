@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Benchmark of the per-slice startup cost bwauthority.py pays: a fresh
+# bwauthority_child per slice (interpreter startup, imports and config
+# parsing) against handing the slice number to a running worker over
+# its pipes. Connecting to Tor and loading the router list come on top
+# of the cold number and are not measured here.
+#
+# Usage: bench_spawn.py [slices]
+
+import os
+import sys
+import time
+from subprocess import Popen, PIPE
+
+here = os.path.dirname(os.path.abspath(__file__))
+bwauth_dir = os.path.join(here, "..")
+cfg = os.path.join(bwauth_dir, "data", "scanner.1", "bwauthority.cfg")
+
+# What a child does before it connects to Tor
+cold = """
+import sys
+sys.path.append("../../")
+import bwauthority_child
+bwauthority_child.read_config(%r)
+""" % cfg
+
+# A worker's loop, minus the slice itself
+warm = cold + """
+import os
+replies = os.fdopen(int(sys.argv[1]), "w", 0)
+cfg_mtime = os.stat(%r).st_mtime
+while True:
+  line = sys.stdin.readline()
+  if not line: break
+  if os.stat(%r).st_mtime != cfg_mtime: sys.exit(1)
+  replies.write("STARTED "+line)
+  replies.write("DONE "+line)
+""" % (cfg, cfg)
+
+def main(argv):
+  n = 20
+  if len(argv) > 1: n = int(argv[1])
+
+  t0 = time.time()
+  for i in xrange(n):
+    p = Popen([sys.executable, "-c", cold], cwd=bwauth_dir)
+    if p.wait() != 0:
+      raise Exception("child failed")
+  t_cold = (time.time()-t0)/n
+
+  (r, w) = os.pipe()
+  p = Popen([sys.executable, "-c", warm, str(w)], cwd=bwauth_dir, stdin=PIPE)
+  os.close(w)
+  replies = os.fdopen(r, "r")
+  p.stdin.write("0\n")
+  p.stdin.flush()
+  replies.readline()
+  replies.readline()
+  t0 = time.time()
+  for i in xrange(n):
+    p.stdin.write(str(i)+"\n")
+    p.stdin.flush()
+    assert replies.readline().startswith("STARTED")
+    assert replies.readline().startswith("DONE")
+  t_warm = (time.time()-t0)/n
+  p.stdin.close()
+  p.wait()
+
+  print "%d slices: fresh child %.1fms per slice, running worker %.2fms " \
+        "per slice" % (n, t_cold*1000, t_warm*1000)
+
+if __name__ == '__main__':
+  main(sys.argv)
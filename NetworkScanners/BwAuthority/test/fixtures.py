@@ -0,0 +1,56 @@
+# Helpers for the aggregate.py tests: the recorded scanner output in
+# test/data, copied to a scratch dir since aggregate removes and
+# catalogs slice files as it reads them.
+#
+# test/data holds three scanners' bws-*-done-* slice files (with a few
+# malformed lines, repeated nodes and tied timestamps), the previous
+# consensus as "idhex bandwidth flags" lines, and a previous vote file
+# mixing votes with and without PID fields.
+
+import os
+import sys
+import shutil
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+sys.path.append(os.path.join(here, "../../.."))
+import aggregate
+
+data_dir = os.path.join(here, "data")
+
+# Never expire the recorded files
+aggregate.MAX_AGE = 1e10
+
+class NetworkStatus:
+  def __init__(self, line):
+    (idhex, bw, flags) = line.split()
+    self.idhex = idhex
+    self.nickname = "ns"+idhex[:6]
+    if bw == "None": self.bandwidth = None
+    else: self.bandwidth = int(bw)
+    self.flags = flags.split(",")
+    self.measured = False
+
+# The previous consensus, keyed the way aggregate.main keys it
+def read_consensus():
+  cons = {}
+  for l in file(os.path.join(data_dir, "consensus")):
+    if not l.startswith("#"):
+      ns = NetworkStatus(l)
+      cons["$"+ns.idhex] = ns
+  return cons
+
+# A copy of test/data to run aggregate on. Remove it when done.
+def scratch_copy():
+  tmp = tempfile.mkdtemp(prefix="aggregate-test-")
+  shutil.copytree(data_dir, os.path.join(tmp, "data"))
+  return os.path.join(tmp, "data")
+
+# Load the slice files under datadir into a fresh aggregate.nodes
+def load_nodes(datadir, workers):
+  aggregate.nodes.clear()
+  del aggregate.bw_files[:]
+  aggregate.INGEST_WORKERS = workers
+  return aggregate.read_scan_data(["aggregate.py", datadir,
+                                   os.path.join(datadir, "out")])
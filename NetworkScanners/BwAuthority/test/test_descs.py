@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# Bulk descriptor lookup in aggregate.py against a fake control port.
+# get_recent_descs() plus get_router(c, ns, desc_map) must find the same
+# routers as a c.get_router(ns) per consensus entry, in one round trip
+# plus one per router whose descriptor is not in the bulk reply.
+#
+# The fake port serves a consensus and descriptors for four kinds of
+# routers: current (in desc/all-recent), new (only served by desc/id),
+# stale (desc/id serves a descriptor older than the consensus entry)
+# and gone (no descriptor at all).
+
+import os
+import sys
+import time
+import socket
+import random
+import unittest
+import threading
+import SocketServer
+from hashlib import sha1
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+sys.path.append(os.path.join(here, "../../.."))
+import aggregate
+from TorCtl import TorCtl
+
+def b64(s):
+  return s.encode("base64").replace("\n", "").rstrip("=")
+
+def make_desc(nick, idhex, ip, bw, published):
+  fp = " ".join([idhex[i:i+4] for i in xrange(0, 40, 4)])
+  return "router %s %s 9001 0 0\n" \
+         "platform Tor 0.2.5.8-rc on Linux\n" \
+         "published %s\n" \
+         "fingerprint %s\n" \
+         "uptime 86400\n" \
+         "bandwidth %d %d %d\n" \
+         "reject *:*\n" \
+         "router-signature\n" \
+         "-----BEGIN SIGNATURE-----\n" \
+         "%s\n" \
+         "-----END SIGNATURE-----\n" % \
+         (nick, ip, published, fp, bw, 2*bw, bw/2, b64(idhex*2))
+
+def desc_digest(desc):
+  end = desc.find("\nrouter-signature\n")+len("\nrouter-signature\n")
+  return b64(sha1(desc[:end]).digest())
+
+class Network:
+  def __init__(self, seed, counts):
+    rand = random.Random(seed)
+    self.ns_lines = []
+    self.bulk = []   # Descriptors in desc/all-recent
+    self.by_id = {}  # Descriptors served by desc/id/<idhex>
+    self.kinds = {}
+    kinds = []
+    for (kind, n) in sorted(counts.iteritems()):
+      kinds.extend([kind]*n)
+    rand.shuffle(kinds)
+    for (i, kind) in enumerate(kinds):
+      idbytes = "".join([chr(rand.randint(0, 255)) for j in xrange(20)])
+      idhex = idbytes.encode("hex").upper()
+      nick = "node%d" % i
+      ip = "10.%d.%d.%d" % (i/65536, (i/256)%256, i%256)
+      bw = rand.randint(20, 20000)*1024
+      self.kinds[idhex] = kind
+      desc = make_desc(nick, idhex, ip, bw, "2014-10-17 01:00:00")
+      if kind == "stale":
+        # The consensus lists a descriptor tor hasn't fetched yet
+        orhash = desc_digest(make_desc(nick, idhex, ip, bw+1,
+                                       "2014-10-17 02:00:00"))
+      else:
+        orhash = desc_digest(desc)
+      if kind in ("current", "stale"):
+        self.bulk.append(desc)
+      if kind != "gone":
+        self.by_id[idhex] = desc
+      self.ns_lines.append("r %s %s %s 2014-10-17 01:00:00 %s 9001 0\n"
+                           "s Fast Running Valid\n"
+                           "w Bandwidth=%d\n" %
+                           (nick, b64(idbytes), orhash, ip, bw/1024))
+
+class ControlHandler(SocketServer.StreamRequestHandler):
+  def reply_data(self, key, data):
+    lines = [l.startswith(".") and "."+l or l
+             for l in data.rstrip("\n").split("\n")]
+    self.wfile.write("250+"+key+"=\r\n"+"\r\n".join(lines)+"\r\n.\r\n"
+                     "250 OK\r\n")
+
+  def handle(self):
+    server = self.server
+    net = server.net
+    while True:
+      line = self.rfile.readline()
+      if not line: break
+      if server.delay: time.sleep(server.delay)
+      words = line.split()
+      if words[0] != "GETINFO":
+        self.wfile.write("250 OK\r\n")
+        continue
+      key = words[1]
+      server.requests.append(key)
+      if key == "ns/all":
+        self.reply_data(key, "".join(net.ns_lines))
+      elif key == "desc/all-recent" and not server.refuse_bulk:
+        self.reply_data(key, "".join(net.bulk))
+      elif key.startswith("desc/id/") and key[8:] in net.by_id:
+        self.reply_data(key, net.by_id[key[8:]])
+      else:
+        self.wfile.write("552 Unrecognized key \""+key+"\"\r\n")
+
+class FakeControlPort(SocketServer.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, net, delay=0):
+    SocketServer.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0),
+                                             ControlHandler)
+    self.net = net
+    self.delay = delay
+    self.refuse_bulk = False
+    self.requests = []
+    t = threading.Thread(target=self.serve_forever)
+    t.setDaemon(True)
+    t.start()
+
+  def connect(self):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect(self.server_address)
+    c = TorCtl.Connection(s)
+    c.launch_thread()
+    return c
+
+# The fields aggregate.main reads from a Router
+def router_key(r):
+  if r is None: return None
+  return (r.idhex, r.nickname, r.ip, r.bw, r.published, r.version)
+
+def lookup_each(c, ns_list):
+  return [c.get_router(ns) for ns in ns_list]
+
+def lookup_bulk(c, ns_list):
+  desc_map = aggregate.get_recent_descs(c)
+  return [aggregate.get_router(c, ns, desc_map) for ns in ns_list]
+
+class DescLookupTest(unittest.TestCase):
+  counts = {"current":80, "new":8, "stale":6, "gone":6}
+
+  def setUp(self):
+    self.net = Network(7, self.counts)
+    self.port = FakeControlPort(self.net)
+    self.c = self.port.connect()
+    self.ns_list = self.c.get_network_status()
+    del self.port.requests[:]
+
+  def tearDown(self):
+    self.c.close()
+    self.port.shutdown()
+    self.port.server_close()
+
+  def lookup(self, how):
+    del self.port.requests[:]
+    routers = how(self.c, self.ns_list)
+    return (map(router_key, routers), len(self.port.requests))
+
+  def test_consensus(self):
+    self.assertEqual(len(self.ns_list), sum(self.counts.values()))
+    for ns in self.ns_list:
+      self.assertTrue(ns.idhex in self.net.kinds)
+
+  def test_same_routers(self):
+    (each, each_trips) = self.lookup(lookup_each)
+    (bulk, bulk_trips) = self.lookup(lookup_bulk)
+    self.assertEqual(each, bulk)
+    self.assertEqual(each_trips, len(self.ns_list))
+    self.assertEqual(bulk_trips, 1+len(self.ns_list)-self.counts["current"])
+    for (ns, r) in zip(self.ns_list, bulk):
+      if self.net.kinds[ns.idhex] in ("current", "new"):
+        self.assertEqual(r[0], ns.idhex)
+      else:
+        self.assertEqual(r, None)
+
+  def test_bulk_refused(self):
+    (each, each_trips) = self.lookup(lookup_each)
+    self.port.refuse_bulk = True
+    (bulk, bulk_trips) = self.lookup(lookup_bulk)
+    self.assertEqual(each, bulk)
+    self.assertEqual(bulk_trips, 1+len(self.ns_list))
+
+  def test_bulk_split(self):
+    desc_map = aggregate.get_recent_descs(self.c)
+    self.assertEqual(len(desc_map), self.counts["current"]+self.counts["stale"])
+    for desc in desc_map.itervalues():
+      self.assertTrue(desc.startswith("router "))
+      self.assertTrue(desc.endswith("-----END SIGNATURE-----\n"))
+
+if __name__ == '__main__':
+  unittest.main()
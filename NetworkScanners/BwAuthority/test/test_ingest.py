@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# read_scan_data must produce the same nodes, file list and catalog no
+# matter how many worker processes read the scanners, both when the
+# slice files are new and when they are served from the catalog. Once
+# the catalog has them, it must not list or stat them again.
+
+import os
+import time
+import shutil
+import sqlite3
+import unittest
+
+import fixtures
+from fixtures import aggregate
+
+# A fourth scanner that measured scanner.1's nodes at the same times
+# but got different results. Which one wins the tie depends only on
+# the order of the scanners.
+def add_tied_scanner(datadir):
+  src = os.path.join(datadir, "scanner.1", "scan-data")
+  dst = os.path.join(datadir, "scanner.4", "scan-data")
+  os.makedirs(dst)
+  for f in os.listdir(src):
+    out = file(os.path.join(dst, f), "w")
+    for l in file(os.path.join(src, f)):
+      out.write(l.replace("strm_bw=", "strm_bw=1"))
+    out.close()
+
+# Everything read_scan_data leaves behind, with the scratch dir
+# stripped from the paths
+def snapshot(datadir, timestamps):
+  def strip(v):
+    if isinstance(v, basestring): return v.replace(datadir, "DATA")
+    return v
+  nodes = {}
+  for (idhex, n) in aggregate.nodes.iteritems():
+    nodes[idhex] = sorted([(k, strip(v)) for (k, v) in vars(n).iteritems()])
+  files = sorted([tuple(map(strip, f)) for f in aggregate.bw_files])
+  db = sqlite3.connect(os.path.join(datadir, aggregate.SCAN_CATALOG))
+  lines = sorted([tuple(map(strip, r)) for r in
+                  db.execute("SELECT * FROM lines")])
+  cataloged = sorted([strip(r[0]) for r in
+                      db.execute("SELECT path FROM files")])
+  db.close()
+  return (nodes, files, lines, cataloged, timestamps)
+
+class IngestWorkersTest(unittest.TestCase):
+  def setUp(self):
+    self.dirs = []
+
+  def tearDown(self):
+    for d in self.dirs:
+      shutil.rmtree(os.path.dirname(d))
+
+  def ingest(self, workers, runs=1):
+    datadir = fixtures.scratch_copy()
+    self.dirs.append(datadir)
+    add_tied_scanner(datadir)
+    for i in xrange(runs):
+      timestamps = fixtures.load_nodes(datadir, workers)
+    return snapshot(datadir, timestamps)
+
+  def test_new_files(self):
+    serial = self.ingest(1)
+    self.assertTrue(len(serial[0]) > 100)
+    for workers in (2, 3, 8):
+      self.assertEqual(serial, self.ingest(workers))
+
+  def test_cataloged_files(self):
+    serial = self.ingest(1)
+    self.assertEqual(serial, self.ingest(1, 2))
+    self.assertEqual(serial, self.ingest(3, 2))
+
+# Set every file and dir under datadir back by age seconds
+def age_files(datadir, age):
+  t = time.time()-age
+  for (d, dirs, files) in os.walk(datadir):
+    for f in files+[""]:
+      os.utime(os.path.join(d, f), (t, t))
+
+# Counts the os.stat() and os.listdir() calls aggregate makes under a dir
+class FileSystemCounter:
+  def __init__(self, datadir):
+    self.datadir = datadir
+    self.stats = []
+    self.listings = []
+  def install(self):
+    self.saved = (os.stat, os.listdir)
+    def stat(path):
+      if path.startswith(self.datadir): self.stats.append(path)
+      return self.saved[0](path)
+    def listdir(path):
+      if path.startswith(self.datadir): self.listings.append(path)
+      return self.saved[1](path)
+    (os.stat, os.listdir) = (stat, listdir)
+  def restore(self):
+    (os.stat, os.listdir) = self.saved
+
+class CatalogCrawlTest(unittest.TestCase):
+  def setUp(self):
+    self.datadir = fixtures.scratch_copy()
+    self.scan_dirs = [os.path.join(self.datadir, d, "scan-data")
+                      for d in os.listdir(self.datadir)
+                      if d.startswith("scanner.")]
+    self.slices = []
+    for d in self.scan_dirs:
+      self.slices += [os.path.join(d, f) for f in os.listdir(d)]
+
+  def tearDown(self):
+    shutil.rmtree(os.path.dirname(self.datadir))
+
+  def load(self):
+    c = FileSystemCounter(self.datadir)
+    c.install()
+    try:
+      timestamps = fixtures.load_nodes(self.datadir, 1)
+    finally:
+      c.restore()
+    return (c, snapshot(self.datadir, timestamps))
+
+  def test_settled_files(self):
+    age_files(self.datadir, 2*aggregate.CATALOG_SETTLE)
+    (c, first) = self.load()
+    self.assertEqual(sorted(c.stats), sorted(self.scan_dirs+self.slices))
+    # Nothing changed: one stat per scan dir, no listing, no file stats
+    (c, second) = self.load()
+    self.assertEqual(sorted(c.stats), sorted(self.scan_dirs))
+    self.assertEqual(c.listings, [self.datadir])
+    self.assertEqual(second, first)
+
+  def test_new_file(self):
+    age_files(self.datadir, 2*aggregate.CATALOG_SETTLE)
+    self.load()
+    # A new slice in scanner.1 is still being written as we run
+    d = os.path.join(self.datadir, "scanner.1", "scan-data")
+    src = os.path.join(d, sorted(os.listdir(d))[-1])
+    lines = file(src).readlines()
+    new = os.path.join(d, "bws-0.0:25.0-done-2014-10-18-00:00:00")
+    out = file(new, "w")
+    out.write("".join(["slicenum=9\n", "1413590400\n"]+lines[2:4]))
+    out.close()
+    (c, partial) = self.load()
+    self.assertEqual(c.listings, [self.datadir, d])
+    self.assertEqual(sorted(c.stats), sorted(self.scan_dirs+[new]))
+    # Finished later, without touching the dir: checked again, since it
+    # was not settled when the last run saw it
+    out = file(new, "a")
+    out.write("".join(lines[4:]))
+    out.close()
+    (c, complete) = self.load()
+    self.assertEqual(sorted(c.stats), sorted(self.scan_dirs+[new]))
+    self.assertNotEqual(complete, partial)
+    # and the same as reading it all with no catalog
+    os.remove(os.path.join(self.datadir, aggregate.SCAN_CATALOG))
+    self.assertEqual(self.load()[1], complete)
+
+if __name__ == '__main__':
+  unittest.main()
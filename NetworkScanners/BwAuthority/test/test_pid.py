@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# ScalarPID and VectorPID must write the same vote file. Runs both
+# engines over the recorded slice files in test/data for every
+# combination of the bwauth* consensus switches, with a few sets of
+# PID gains, and compares the vote lines and measured flags.
+
+import os
+import copy
+import shutil
+import unittest
+import itertools
+
+import fixtures
+from fixtures import aggregate
+
+# The consensus switches ConsensusJunk understands
+switches = ["bwauthpid=0", "bwauthnsbw=1", "bwauthcircs=1",
+            "bwauthbestratio=0", "bwauthbyclass=1", "bwauthpidtgt=1",
+            "bwauthmercy=1"]
+
+# PID gains, caps and guard sample rates, with the Wgd weight to use
+gains = [("", 0),
+         ("bwauthkp=5000 bwauthti=20000 bwauthtd=5000 bwauthtidecay=3000 "
+          "bwauthpidmax=15000 bwauthguardrate=10", 3000),
+         ("bwauthkp=10000 bwauthti=50000 bwauthtidecay=0 bwauthpidmax=0",
+          10000)]
+
+class FakeConnection:
+  def __init__(self, params, wgd):
+    self.consensus = "params circwindow=1000 "+params+"\n" \
+        "bandwidth-weights Wgd=%d Wgg=10000\n" % wgd
+
+  def sendAndRecv(self, msg):
+    return [("250", "", self.consensus)]
+
+class PIDEngineTest(unittest.TestCase):
+  def setUp(self):
+    self.datadir = fixtures.scratch_copy()
+    fixtures.load_nodes(self.datadir, 1)
+    self.nodes = copy.deepcopy(aggregate.nodes)
+    self.consensus = fixtures.read_consensus()
+    self.votes = os.path.join(fixtures.data_dir, "prev-votes")
+
+  def tearDown(self):
+    shutil.rmtree(os.path.dirname(self.datadir))
+
+  # The part of aggregate.main between reading the scans and writing
+  # the vote file
+  def vote(self, engine, cs_junk):
+    aggregate.nodes.clear()
+    aggregate.nodes.update(copy.deepcopy(self.nodes))
+    aggregate.prev_consensus.clear()
+    aggregate.prev_consensus.update(copy.deepcopy(self.consensus))
+    nodes = aggregate.nodes
+    for idhex in nodes.iterkeys():
+      if idhex in aggregate.prev_consensus:
+        nodes[idhex].flags = aggregate.prev_consensus[idhex].flags
+    if engine == "vector":
+      pid = aggregate.VectorPID(nodes.values())
+    else:
+      pid = aggregate.ScalarPID()
+    try:
+      avgs = pid.class_avgs(cs_junk)
+      prev_votes = None
+      if cs_junk.bwauth_pid_control:
+        prev_votes = aggregate.VoteSet(self.votes)
+      tot_net_bw = pid.update_bws(cs_junk, prev_votes, *avgs)
+      pid.cap_bws(cs_junk, tot_net_bw)
+    except ZeroDivisionError:
+      return ["ZeroDivisionError"]
+    lines = [aggregate.vote_line(n) for n in nodes.itervalues()
+             if not n.ignore]
+    lines.sort()
+    measured = [idhex for (idhex, ns) in aggregate.prev_consensus.iteritems()
+                if ns.measured]
+    measured.sort()
+    return lines + measured
+
+  def test_fixtures_loaded(self):
+    self.assertTrue(len(self.nodes) > 100)
+
+  def test_engines_agree(self):
+    if not aggregate.numpy:
+      self.skipTest("numpy is not installed")
+    runs = 0
+    voted = 0
+    for (params, wgd) in gains:
+      for on in itertools.product((False, True), repeat=len(switches)):
+        p = " ".join([s for (s, o) in zip(switches, on) if o]+[params])
+        cs_junk = aggregate.ConsensusJunk(FakeConnection(p, wgd))
+        scalar = self.vote("scalar", cs_junk)
+        vector = self.vote("vector", cs_junk)
+        self.assertEqual(scalar, vector, "votes differ for params "+p)
+        runs += 1
+        if scalar != ["ZeroDivisionError"]: voted += 1
+    self.assertEqual(runs, len(gains)*2**len(switches))
+    self.assertTrue(voted > runs/2)
+
+if __name__ == '__main__':
+  unittest.main()
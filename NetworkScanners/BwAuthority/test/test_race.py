@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# The concurrent slice race of bwauthority_child against a fake scan
+# handler and fake fetches: save_every checkpoints must only be written
+# with no fetch in flight, and a fetch that times out only ever closes
+# the streams of its own exit.
+
+import os
+import sys
+import time
+import random
+import unittest
+import threading
+import SocketServer
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+sys.path.append(os.path.join(here, "../../.."))
+sys.path.append(os.path.join(here, "../../libs"))
+import bwauthority_child
+
+class FakeHandler:
+  def __init__(self, target):
+    self.target = target
+    self.lock = threading.Lock()
+    self.exits = 0
+    self.exit = None
+    self.in_flight = 0
+    self.closed = []
+
+  def is_count_met(self, count, successful):
+    return successful >= self.target
+
+  def new_exit(self):
+    self.exits += 1
+    self.exit = "exit%d" % self.exits
+
+  def get_exit_node(self):
+    return self.exit
+
+class FakeFetches:
+  ''' Stands in for http_request and close_exit_streams. A fetch takes
+  connect_time to get its reply headers and body_time to read the body,
+  unless its stream is closed first. '''
+  def __init__(self, hdlr, connect_time, body_time):
+    self.hdlr = hdlr
+    self.connect_time = connect_time
+    self.body_time = body_time
+    self.closed = {}
+    self.attached = set()
+
+  def http_request(self, url, on_connect=None, timeout=None):
+    hdlr = self.hdlr
+    hdlr.lock.acquire()
+    hdlr.in_flight += 1
+    hdlr.lock.release()
+    try:
+      time.sleep(random.uniform(*self.connect_time))
+      exit = hdlr.exit
+      self.attached.add(exit)
+      on_connect()
+      closed = self.closed.setdefault(exit, threading.Event())
+      closed.wait(random.uniform(*self.body_time))
+      return 1
+    finally:
+      hdlr.lock.acquire()
+      hdlr.in_flight -= 1
+      hdlr.lock.release()
+
+  def close_exit_streams(self, hdlr, exit, reason):
+    # Streams that aren't attached yet can't be told apart by exit
+    assert exit in self.attached
+    hdlr.closed.append((exit, reason))
+    self.closed.setdefault(exit, threading.Event()).set()
+
+class StallingHandler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    path = self.rfile.readline().split()[1]
+    while self.rfile.readline() not in ("\r\n", "\n", ""):
+      pass
+    if path == "/stall":
+      # Accept the request and never answer it
+      self.server.stop.wait(30)
+      return
+    self.wfile.write("HTTP/1.0 200 OK\r\nContent-Length: 1024\r\n\r\n"+
+                     "x"*1024)
+
+class StallingServer(SocketServer.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  def __init__(self):
+    SocketServer.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0),
+                                             StallingHandler)
+    self.stop = threading.Event()
+
+class RaceTest(unittest.TestCase):
+  def setUp(self):
+    random.seed(3)
+    self.saved = (bwauthority_child.http_request,
+                  bwauthority_child.close_exit_streams,
+                  bwauthority_child.choose_url)
+    bwauthority_child.choose_url = lambda pct: "https://127.0.0.1/16M"
+
+  def tearDown(self):
+    (bwauthority_child.http_request,
+     bwauthority_child.close_exit_streams,
+     bwauthority_child.choose_url) = self.saved
+
+  def race(self, hdlr, fetches, streams, max_fetch_time, save_every=0,
+           save=None):
+    bwauthority_child.http_request = fetches.http_request
+    bwauthority_child.close_exit_streams = fetches.close_exit_streams
+    return bwauthority_child.race_concurrently(hdlr, streams, 5,
+             max_fetch_time, 50, "0-5%", save_every, save)
+
+  def test_save_every(self):
+    hdlr = FakeHandler(40)
+    fetches = FakeFetches(hdlr, (0, 0.002), (0, 0.02))
+    saves = []
+    def save(successful):
+      saves.append((successful, hdlr.in_flight))
+    (attempt, successful) = self.race(hdlr, fetches, 4, 10, 5, save)
+    self.assertTrue(successful >= 40)
+    self.assertEqual(len(saves), successful/5)
+    for (n, in_flight) in saves:
+      self.assertEqual(in_flight, 0)
+    self.assertEqual([n/5 for (n, i) in saves], range(1, len(saves)+1))
+
+  def test_no_save_every(self):
+    hdlr = FakeHandler(20)
+    fetches = FakeFetches(hdlr, (0, 0.002), (0, 0.01))
+    (attempt, successful) = self.race(hdlr, fetches, 4, 10)
+    self.assertEqual(attempt, successful)
+    self.assertTrue(20 <= successful < 24)
+
+  def test_timeout_before_attach(self):
+    # Every fetch takes longer than max_fetch_time to get its reply
+    hdlr = FakeHandler(4)
+    fetches = FakeFetches(hdlr, (0.2, 0.2), (10, 10))
+    t0 = time.time()
+    (attempt, successful) = self.race(hdlr, fetches, 2, 0.1)
+    self.assertTrue(time.time()-t0 < 5)
+    self.assertEqual(sorted(hdlr.closed),
+                     sorted([("exit%d" % i, 7) for i in xrange(1, attempt+1)]))
+
+  def test_timeout_while_reading(self):
+    hdlr = FakeHandler(6)
+    fetches = FakeFetches(hdlr, (0, 0.002), (10, 10))
+    t0 = time.time()
+    (attempt, successful) = self.race(hdlr, fetches, 3, 0.1)
+    self.assertTrue(time.time()-t0 < 5)
+    self.assertEqual(sorted(hdlr.closed),
+                     sorted([("exit%d" % i, 7) for i in xrange(1, attempt+1)]))
+
+  def test_stall_before_headers(self):
+    # The first fetch goes to an exit that connects and then never sends
+    # the reply headers. It must not keep the other racers from launching.
+    server = StallingServer()
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    urls = ["/stall"]
+    def choose_url(pct):
+      if urls: path = urls.pop()
+      else: path = "/ok"
+      return "http://%s:%d%s" % (server.server_address+(path,))
+    bwauthority_child.choose_url = choose_url
+    hdlr = FakeHandler(6)
+    # The stalled fetch still holds launch_lock when it gives up, so the
+    # exit it closes is its own
+    bwauthority_child.close_exit_streams = \
+      lambda hdlr, exit, reason: hdlr.closed.append((exit, reason))
+    result = []
+    def race():
+      result.append(bwauthority_child.race_concurrently(hdlr, 3, 5, 0.5, 50,
+                                                        "0-5%"))
+    racer = threading.Thread(target=race)
+    racer.setDaemon(True)
+    t0 = time.time()
+    racer.start()
+    racer.join(10)
+    server.stop.set()
+    server.shutdown()
+    server.server_close()
+    self.assertFalse(racer.isAlive())
+    (attempt, successful) = result[0]
+    self.assertTrue(successful >= 6)
+    self.assertEqual(attempt, successful+1)
+    self.assertEqual(hdlr.closed, [("exit1", 7)])
+    self.assertTrue(time.time()-t0 < 3)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -11,14 +11,142 @@ import re
 import socket
 import struct
 import sys
+import thread
 import time
 import traceback
+import zlib
 
 if sys.version_info < (2, 5):
     from sets import Set as set
+    from sha import sha as blob_hash # There is no sha256 before hashlib
+else:
+    from hashlib import sha256 as blob_hash
+
+try:
+  import sqlite3
+except ImportError:
+  sqlite3 = None # DataHandler falls back to reading the whole result tree
 
 from OpenSSL import crypto
 
+# soat subclasses Checkpointed, so it has to be defined before soat is
+# imported, in case soat is the one importing us.
+_ALL_KEYS = object()
+
+class Checkpointed:
+  '''
+  Mixin for objects that DataHandler.saveTest checkpoints as a snapshot
+  plus an append-only journal of what changed since.
+
+  An attribute is journaled whole whenever it is rebound. Containers
+  (dicts, sets and lists) named in keyed_state are journaled only at the
+  keys passed to _touch(), which code that changes them in place must
+  call. Any other attribute changed in place needs a _touch() without a
+  key. Attributes in derived_state are never journaled, and are
+  recomputed by rebuild_derived_state() after a replay.
+  '''
+  keyed_state = ()
+  derived_state = ()
+
+  def __getstate__(self):
+    # Journal bookkeeping is neither pickled nor copied
+    state = self.__dict__.copy()
+    state.pop("_dirty", None)
+    state.pop("_saved", None)
+    return state
+
+  def _touch(self, attr, key=_ALL_KEYS):
+    dirty = self.__dict__.setdefault("_dirty", {})
+    if key is _ALL_KEYS or attr not in self.keyed_state:
+      dirty[attr] = None
+    elif dirty.get(attr, ()) is not None:
+      dirty.setdefault(attr, set()).add(key)
+
+  def _touch_container(self, container, key):
+    ''' _touch() key of whichever keyed_state attribute container is '''
+    for attr in self.keyed_state:
+      if self.__dict__.get(attr) is container:
+        self._touch(attr, key)
+        return
+
+  def journal_start(self):
+    ''' Take the current state as saved '''
+    self._dirty = {}
+    self._saved = self.__getstate__()
+
+  def journal_record(self):
+    ''' Return what changed since journal_start(), and start again '''
+    dirty = self.__dict__.get("_dirty", {})
+    saved = self.__dict__.get("_saved", {})
+    whole = {}
+    keyed = {}
+    state = self.__getstate__()
+    for attr,value in state.iteritems():
+      if attr in self.derived_state:
+        continue
+      if attr not in saved or saved[attr] is not value \
+         or dirty.get(attr, ()) is None:
+        whole[attr] = value
+      elif attr in dirty:
+        keyed[attr] = self._delta(value, dirty[attr])
+    unset = [attr for attr in saved if attr not in state]
+    self.journal_start()
+    return (whole, keyed, unset)
+
+  def _delta(self, container, keys):
+    if isinstance(container, dict):
+      changed = {}
+      removed = []
+      for key in keys:
+        if key in container:
+          changed[key] = container[key]
+        else:
+          removed.append(key)
+      return ("dict", changed, removed)
+    elif isinstance(container, list):
+      items = {}
+      for pos in keys:
+        if pos < len(container):
+          items[pos] = container[pos]
+      return ("list", len(container), items)
+    else:
+      added = []
+      removed = []
+      for key in keys:
+        if key in container:
+          added.append(key)
+        else:
+          removed.append(key)
+      return ("set", added, removed)
+
+  def journal_replay(self, record):
+    ''' Apply a journal_record() '''
+    (whole, keyed, unset) = record
+    for attr in unset:
+      self.__dict__.pop(attr, None)
+    self.__dict__.update(whole)
+    for attr,delta in keyed.iteritems():
+      container = self.__dict__[attr]
+      if delta[0] == "list":
+        (kind, length, items) = delta
+        if length > len(container):
+          container.extend([None]*(length-len(container)))
+        for pos,item in items.iteritems():
+          container[pos] = item
+        del container[length:]
+      else:
+        (kind, changed, removed) = delta
+        if kind == "dict":
+          container.update(changed)
+          for key in removed:
+            container.pop(key, None)
+        else:
+          container.update(changed)
+          container.difference_update(removed)
+
+  def rebuild_derived_state(self):
+    pass
+
 from soat import Tag, SoupStrainer
 
 from soat_config import *
@@ -44,7 +172,8 @@ __all__ = [ # Classes
            "LoggingJSParser", "LoggingJSLexer", "TestResult", "SSLTestResult", "SSLDomain", "HttpTestResult",
            "CookieTestResult", "JsTestResult", "HtmlTestResult", "SSHTestResult", "DNSTestResult",
            "DNSRebindTestResult", "SMTPTestResult", "IMAPTestResult", "POPTestResult", "DataHandler",
-           "SnakePickler", "SoupDiffer", "HeaderDiffer", "JSDiffer", "JSSoupDiffer",
+           "ResultRecord", "Checkpointed",
+           "SnakePickler", "BaselineStore", "ParsedBaseline", "SoupSummary", "SoupDiffer", "HeaderDiffer", "JSDiffer", "JSSoupDiffer",
             # Functions
            "FullyStrainedSoup",
             # Constants
@@ -63,7 +192,7 @@ __all__ = [ # Classes
            "E_SOCKS", "E_POLICY", "E_NETUNREACH", "E_HOSTUNREACH", "E_REFUSED",
            "E_TIMEOUT", "E_SLOWXFER", "E_NOCONTENT", "E_CRYPTO", "E_URL", "E_MISC", "SOCKS_ERRS",
            # Exception classes
-           "SlowXferException", "RedirectException", "NoURLsFound",
+           "SlowXferException", "MaxContentSizeException", "RedirectException", "NoURLsFound",
           ]
 
 
@@ -318,9 +447,16 @@ class SSLDomain:
     self.ip_map = {}
     self.cert_rotates = False
     self.cert_changed = False
+    # When the certs were last fetched directly. See ssl_cache_ttl.
+    self.refreshed = 0
+    self._pickle_revision = 1
 
   def depickle_upgrade(self):
-    pass
+    if not "_pickle_revision" in self.__dict__: # upgrade to v0
+      self._pickle_revision = 0
+    if self._pickle_revision < 1:
+      self.refreshed = 0
+      self._pickle_revision = 1
 
   def add_cert(self, ip, cert_string):
     if ip in self.ip_map and self.ip_map[ip] != cert_string:
@@ -441,15 +577,15 @@ class JsTestResult(TestResult):
     ret = TestResult.__str__(self)
     if self.verbose:
       if self.content and self.content_old:
-        diff = difflib.unified_diff(open(self.content).read().split("\n"),
-                             open(self.content_old).read().split("\n"), 
+        diff = difflib.unified_diff(BaselineStore.read(self.content).split("\n"),
+                             BaselineStore.read(self.content_old).split("\n"), 
                              "Non-Tor1", "Non-Tor2",
                              lineterm="")
         for line in diff:
           ret+=line+"\n"
       if self.content and self.content_exit:
-        diff = difflib.unified_diff(open(self.content).read().split("\n"),
-                             open(self.content_exit).read().split("\n"), 
+        diff = difflib.unified_diff(BaselineStore.read(self.content).split("\n"),
+                             BaselineStore.read(self.content_exit).split("\n"), 
                               "Non-Tor", "Exit",
                               lineterm="")
         for line in diff:
@@ -510,15 +646,15 @@ class HtmlTestResult(TestResult):
     if self.verbose:
       soup = old_soup = tor_soup = None
       if self.content:
-        content = open(self.content).read().decode('ascii', 'ignore')
+        content = BaselineStore.read(self.content).decode('ascii', 'ignore')
         soup = FullyStrainedSoup(content)
 
       if self.content_old:
-        content_old = open(self.content_old).read().decode('ascii', 'ignore')
+        content_old = BaselineStore.read(self.content_old).decode('ascii', 'ignore')
         old_soup = FullyStrainedSoup(content_old)
 
       if self.content_exit:
-        content_exit = open(self.content_exit).read().decode('ascii', 'ignore')
+        content_exit = BaselineStore.read(self.content_exit).decode('ascii', 'ignore')
         tor_soup = FullyStrainedSoup(content_exit)
 
       if self.verbose > 1:
@@ -613,9 +749,49 @@ class POPTestResult(TestResult):
     super(POPTestResult, self).__init__(exit_obj, pop_site, status)
     self.proto = "pop"
 
+class ResultRecord:
+  ''' The fields of a saved TestResult that DataHandler indexes '''
+  def __init__(self, filename, result_class, exit_node, status, reason, site,
+               timestamp):
+    self.filename = filename
+    self.result_class = result_class
+    self.exit_node = exit_node
+    self.status = status
+    self.reason = reason
+    self.site = site
+    self.timestamp = timestamp
+
+  def matches(self, rdir=None, exit_node=None, statuses=[], reasons=[],
+              result_classes=[], after=None, before=None):
+    if rdir and not self.filename.startswith(rdir):
+      return False
+    if exit_node and self.exit_node != exit_node:
+      return False
+    if statuses and self.status not in statuses:
+      return False
+    if reasons and self.reason not in reasons:
+      return False
+    if result_classes and self.result_class not in result_classes:
+      return False
+    if after is not None and self.timestamp < after:
+      return False
+    if before is not None and before < self.timestamp:
+      return False
+    return True
+
 class DataHandler:
+  # Bump this when the index tables change. Old indexes are rebuilt.
+  INDEX_VERSION = 2
+  # Directories modified this recently are listed again on the next
+  # sync, since a file added in the same mtime tick would not show.
+  RACY_MTIME = 2
+
   def __init__(self, my_data_dir=soat_dir):
     self.data_dir = my_data_dir
+    self.index_file = os.path.join(my_data_dir, "results.sqlite")
+    self.__index = None
+    # test filename -> [snapshot size, journal size]
+    self.__journals = {}
 
   ''' Class for saving and managing test result data '''
   def filterResults(self, results, protocols=[], show_good=False, 
@@ -683,20 +859,218 @@ class DataHandler:
     return self.__getResults(self.data_dir + 'dnsbrebind/')
 
   def __getResults(self, rdir):
-    ''' 
-    recursively traverse the directory tree starting with dir
-    gather test results from files ending with .result
+    ''' gather the test results saved under rdir '''
+    return self.getResults(rdir=rdir)
+
+  def getResults(self, **filters):
+    '''
+    load the saved results that match filters. See getRecords() for
+    the filters. Only the matching .result files are unpickled.
     '''
     results = []
-
-    for root, dirs, files in os.walk(rdir):
-      for f in files:
-        if f.endswith('.result'):
-          result = SnakePickler.load(os.path.join(root, f))
-          result.rebase(self.data_dir)
-          results.append(result)
+    for record in self.getRecords(**filters):
+      try:
+        result = SnakePickler.load(record.filename)
+      except IOError:
+        continue # Removed since we looked
+      if result:
+        result.rebase(self.data_dir)
+        results.append(result)
     return results
 
+  def getRecords(self, rdir=None, exit_node=None, statuses=[], reasons=[],
+                 result_classes=[], after=None, before=None):
+    '''
+    look up saved results in the index, without unpickling them.
+    rdir limits the search to one directory tree, after and before
+    bound the result timestamps, and the rest match the ResultRecord
+    fields. Returns a list of ResultRecords.
+    '''
+    if rdir:
+      rdir = os.path.normpath(rdir)+os.sep
+    index = self.__openIndex()
+    if not index:
+      records = []
+      for filename in self.__resultFiles(rdir or self.data_dir):
+        record = self.__toRecord(filename, SnakePickler.load(filename))
+        if record and record.matches(rdir, exit_node, statuses, reasons,
+                                     result_classes, after, before):
+          records.append(record)
+      return records
+
+    where = []
+    args = []
+    if rdir:
+      where.append("substr(filename, 1, ?) = ?")
+      args.extend([len(rdir), rdir])
+    if exit_node:
+      where.append("exit_node = ?")
+      args.append(exit_node)
+    for (column, values) in (("status", statuses), ("reason", reasons),
+                             ("result_class", result_classes)):
+      if values:
+        where.append(column+" IN ("+",".join("?"*len(values))+")")
+        args.extend(values)
+    if after is not None:
+      where.append("timestamp >= ?")
+      args.append(after)
+    if before is not None:
+      where.append("timestamp <= ?")
+      args.append(before)
+    query = "SELECT filename, result_class, exit_node, status, reason, site, timestamp FROM results"
+    if where:
+      query += " WHERE "+" AND ".join(where)
+    try:
+      self.__syncIndex(index)
+      return [ResultRecord(*row) for row in index.execute(query, args)]
+    except sqlite3.Error, e:
+      plog("WARN", "Result index query failed, reading the tree instead: "+str(e))
+      self.__index = False
+      return self.getRecords(rdir, exit_node, statuses, reasons,
+                             result_classes, after, before)
+
+  def rebuildIndex(self):
+    ''' re-read every .result file into the index '''
+    index = self.__openIndex()
+    if not index:
+      return
+    index.execute("DELETE FROM results")
+    index.execute("DELETE FROM dirs")
+    self.__syncIndex(index)
+
+  def __toRecord(self, filename, result):
+    if not result:
+      return None
+    return ResultRecord(filename, result.__class__.__name__,
+                        result.exit_node, result.status, result.reason,
+                        result.site, result.timestamp)
+
+  def __openIndex(self):
+    '''
+    The index maps each .result file under data_dir to its ResultRecord
+    fields. It is only a cache of the tree: it is checked against the
+    tree before each query, and rebuilt if it is unreadable. It also
+    keeps the mtime of each directory as of its last listing.
+    '''
+    if self.__index is not None:
+      return self.__index
+    self.__index = False
+    if not sqlite3 or not os.path.isdir(self.data_dir):
+      return self.__index
+    for attempt in (1, 2):
+      try:
+        index = sqlite3.connect(self.index_file, check_same_thread=False)
+        index.text_factory = str
+        # Losing the last few updates on a crash is fine. The next sync
+        # brings them back.
+        index.execute("PRAGMA synchronous = OFF")
+        if index.execute("PRAGMA user_version").fetchone()[0] != DataHandler.INDEX_VERSION:
+          index.execute("DROP TABLE IF EXISTS results")
+          index.execute("DROP TABLE IF EXISTS dirs")
+          index.execute("CREATE TABLE results (filename TEXT PRIMARY KEY, result_class TEXT, exit_node TEXT, status INTEGER, reason TEXT, site TEXT, timestamp REAL, dir TEXT)")
+          index.execute("CREATE INDEX results_exit_node ON results (exit_node)")
+          index.execute("CREATE INDEX results_dir ON results (dir)")
+          index.execute("CREATE TABLE dirs (path TEXT PRIMARY KEY, mtime REAL)")
+          index.execute("PRAGMA user_version = %d" % DataHandler.INDEX_VERSION)
+          index.commit()
+        self.__index = index
+        break
+      except sqlite3.DatabaseError, e:
+        plog("WARN", "Unable to open result index "+self.index_file+": "+str(e))
+        if attempt == 1:
+          try: os.unlink(self.index_file)
+          except OSError: break
+    return self.__index
+
+  def __resultFiles(self, rdir):
+    '''
+    list the .result files under rdir. Like os.walk, but without a stat
+    of every result file to see if it is a directory.
+    '''
+    found = []
+    dirs = [os.path.normpath(rdir)]
+    while dirs:
+      (files, subdirs) = self.__listDir(dirs.pop())
+      found.extend(files)
+      dirs.extend(subdirs)
+    return found
+
+  def __listDir(self, rdir):
+    ''' returns the .result files and the subdirectories in rdir '''
+    files = []
+    subdirs = []
+    try:
+      names = os.listdir(rdir)
+    except OSError:
+      return (files, subdirs)
+    for name in names:
+      path = os.path.join(rdir, name)
+      if name.endswith('.result'):
+        files.append(path)
+      elif os.path.isdir(path):
+        subdirs.append(path)
+    return (files, subdirs)
+
+  def __syncIndex(self, index):
+    '''
+    bring the index up to date with the .result files on disk. Adding
+    or removing a file changes its directory's mtime, so only the
+    directories whose mtime moved since they were last listed are
+    listed again. The indexed fields never change once a result is
+    saved, so only added and removed files need looking at.
+    '''
+    listed = dict(index.execute("SELECT path, mtime FROM dirs"))
+    children = {}
+    for path in listed:
+      children.setdefault(os.path.dirname(path), []).append(path)
+    now = time.time()
+    seen = set([])
+    dirs = [os.path.normpath(self.data_dir)]
+    while dirs:
+      rdir = dirs.pop()
+      try:
+        mtime = os.stat(rdir).st_mtime
+      except OSError:
+        continue
+      seen.add(rdir)
+      if listed.get(rdir) == mtime:
+        dirs.extend(children.get(rdir, []))
+        continue
+      (files, subdirs) = self.__listDir(rdir)
+      dirs.extend(subdirs)
+      on_disk = set(files)
+      indexed = set([row[0] for row in
+                     index.execute("SELECT filename FROM results WHERE dir = ?",
+                                   (rdir,))])
+      index.executemany("DELETE FROM results WHERE filename = ?",
+                        [(f,) for f in indexed - on_disk])
+      complete = True
+      for filename in on_disk - indexed:
+        try:
+          result = SnakePickler.load(filename)
+        except IOError:
+          continue
+        # Unreadable (or half written) results are retried next time
+        if result:
+          self.__indexResult(index, filename, result)
+        else:
+          complete = False
+      if not complete or now - mtime < DataHandler.RACY_MTIME:
+        mtime = None
+      index.execute("INSERT OR REPLACE INTO dirs VALUES (?,?)", (rdir, mtime))
+    # Directories that are gone, and their results
+    for path in set(listed) - seen:
+      index.execute("DELETE FROM results WHERE dir = ?", (path,))
+      index.execute("DELETE FROM dirs WHERE path = ?", (path,))
+    index.commit()
+
+  def __indexResult(self, index, filename, result):
+    record = self.__toRecord(filename, result)
+    index.execute("INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?,?,?)",
+                  (filename, record.result_class, record.exit_node,
+                   record.status, record.reason, record.site,
+                   record.timestamp, os.path.dirname(filename)))
+
   def getResult(self, file):
     return SnakePickler.load(file)
 
@@ -763,6 +1137,18 @@ class DataHandler:
     if result.filename is None:
       result.filename = self.__resultFilename(result)
     SnakePickler.dump(result, result.filename)
+    index = self.__openIndex()
+    if index:
+      filename = os.path.normpath(result.filename)
+      try:
+        if os.path.exists(filename):
+          self.__indexResult(index, filename, result)
+        else:
+          # The dump failed and removed the file
+          index.execute("DELETE FROM results WHERE filename = ?", (filename,))
+        index.commit()
+      except sqlite3.Error, e:
+        plog("WARN", "Unable to index "+filename+": "+str(e))
 
   def __testFilename(self, test, position=-1):
     if hasattr(test, "save_name"):
@@ -782,13 +1168,90 @@ class DataHandler:
         i+=1
       position = i-1
     
-    test = SnakePickler.load(filename+"."+str(position)+".test")
+    filename = filename+"."+str(position)+".test"
+    test = SnakePickler.load(filename)
+    if isinstance(test, Checkpointed):
+      journal_size = self.__replayJournal(test, filename+".journal")
+      test.rebuild_derived_state()
+      test.journal_start()
+      if journal_size is not None and test.filename == filename:
+        self.__journals[filename] = [os.path.getsize(filename), journal_size]
     return test
 
   def saveTest(self, test):
+    ''' Checkpoint test. Checkpointed tests append what changed to a
+        journal, and are only pickled whole once that outgrows the last
+        snapshot. '''
     if not test.filename:
       test.filename = self.__testFilename(test)
+    journal = test.filename+".journal"
+    sizes = self.__journals.get(test.filename)
+    if sizes and sizes[1] < sizes[0]:
+      try:
+        f = file(journal, "ab")
+        try:
+          pickle.dump(test.journal_record(), f, 2)
+          sizes[1] = f.tell()
+        finally:
+          f.close()
+        return
+      except Exception, e:
+        plog("WARN", "Unable to journal "+test.filename+", saving it whole: "+str(e))
+    if not isinstance(test, Checkpointed):
+      SnakePickler.dump(test, test.filename)
+      return
+    # The generation ties the journal to this snapshot, so that a crash
+    # between writing the two doesn't replay older changes over it
+    test._journal_generation = getattr(test, "_journal_generation", 0) + 1
+    self.__journals.pop(test.filename, None)
     SnakePickler.dump(test, test.filename)
+    if not os.path.exists(test.filename):
+      return # dump failed, and will be retried next time
+    tmp = tmp_name(journal)
+    f = file(tmp, "wb")
+    pickle.dump(test._journal_generation, f, 2)
+    f.close()
+    os.rename(tmp, journal)
+    test.journal_start()
+    self.__journals[test.filename] = [os.path.getsize(test.filename),
+                                      os.path.getsize(journal)]
+
+  def __replayJournal(self, test, journal):
+    ''' Apply the records in journal to test. Returns the journal size,
+        or None if it doesn't belong to test's snapshot. '''
+    try:
+      f = file(journal, "rb")
+    except IOError:
+      return None
+    good = 0
+    count = 0
+    try:
+      try:
+        if pickle.load(f) != getattr(test, "_journal_generation", None):
+          plog("NOTICE", "Ignoring "+journal+", which predates its snapshot")
+          return None
+        good = f.tell()
+        while True:
+          try:
+            record = pickle.load(f)
+          except EOFError:
+            break
+          test.journal_replay(record)
+          count += 1
+          good = f.tell()
+      except Exception, e:
+        plog("WARN", "Error replaying "+journal+" after "+str(count)+" records: "+str(e))
+    finally:
+      f.close()
+    # Cut off a record that was partly written when we died, so that
+    # later records aren't appended after it
+    if good < os.path.getsize(journal):
+      plog("NOTICE", "Truncating "+journal+" after "+str(count)+" records")
+      f = file(journal, "r+b")
+      f.truncate(good)
+      f.close()
+    plog("INFO", "Replayed "+str(count)+" records from "+journal)
+    return good
 
 # These three bits are needed to fully recursively strain the parsed soup.
 # For some reason, the SoupStrainer does not get applied recursively..
@@ -836,11 +1299,19 @@ def FullyStrainedSoup(html):
     soup.append(tag)
   return soup      
 
+def tmp_name(filename):
+  ''' a name to write filename under before renaming it into place '''
+  return "%s.%d.%d.tmp" % (filename, os.getpid(), thread.get_ident())
+
 class SnakePickler:
   def dump(obj, filename):
     if not "depickle_upgrade" in dir(obj.__class__):
       plog("WARN", "Pickling instance of "+obj.__class__.__name__+" without upgrade method")
-    f = file(filename, "w")
+    # Write a new file and rename it over the old one, so nobody sees half
+    # a pickle, and so baselines hard linked by BaselineStore are replaced
+    # rather than written through
+    tmp = tmp_name(filename)
+    f = file(tmp, "w")
     try:
       pickle.dump(obj, f)
     except KeyboardInterrupt:
@@ -848,25 +1319,30 @@ class SnakePickler:
       while not finished:
         try:
           f.close()
-          f = file(filename, "w")
+          f = file(tmp, "w")
           pickle.dump(obj, f)
           f.close()
+          os.rename(tmp, filename)
           finished = True
         except KeyboardInterrupt:
           pass
       raise KeyboardInterrupt
     except Exception, e:
       plog("WARN", "Exception during pickle dump: " + str(e))
-      try:
-        os.unlink(filename)
-      except: pass
+      f.close()
+      for name in (tmp, filename):
+        try:
+          os.unlink(name)
+        except: pass
+      return
     f.close()
+    os.rename(tmp, filename)
   dump = Callable(dump)
 
   def load(filename):
-    f = file(filename, "r")
+    data = BaselineStore.read(filename)
     try:
-      obj = pickle.load(f)
+      obj = pickle.loads(data)
     except Exception, e:
       plog("WARN", "Error loading object from "+filename+": "+str(e))
       return None
@@ -874,29 +1350,182 @@ class SnakePickler:
       plog("WARN", "De-pickling instance of "+obj.__class__.__name__+" without upgrade method")
     else:
       obj.depickle_upgrade()
-    f.close()
     return obj
   load = Callable(load)
-     
+
+class BaselineStore:
+  '''
+  Content addressed storage for test baselines: the non-Tor page
+  content, hashes, headers and cookies saved per URL, and the certs saved
+  per SSL host.
+
+  Each distinct blob is written once, to root/<xx>/<rest of its sha256>.
+  The per URL and per host files the tests (and results) refer to are
+  hard links to it, so the blob's link count is its reference count,
+  and gc() removes blobs nothing links to any more. With compress set,
+  blobs are stored zlib compressed behind COMPRESSED_MAGIC. Use read()
+  rather than open() on files that may be baselines.
+  '''
+  COMPRESSED_MAGIC = "SOATZ1\n"
+
+  def __init__(self, root, compress=False):
+    self.root = root
+    self.compress = compress
+
+  def blob_path(self, key):
+    return os.path.join(self.root, key[:2], key[2:])
+
+  def hash(data):
+    ''' the hex sha256 that identifies data '''
+    return blob_hash(data).hexdigest()
+  hash = Callable(hash)
+
+  def put(self, data, filename):
+    ''' store data, and point filename at it. returns the blob key '''
+    key = BaselineStore.hash(data)
+    if self.compress:
+      key += ".z"
+      data = BaselineStore.COMPRESSED_MAGIC+zlib.compress(data)
+    blob = self.blob_path(key)
+    tmp = tmp_name(filename)
+    for attempt in (1, 2):
+      if not os.path.exists(blob):
+        self._write(blob, data)
+      try:
+        os.link(blob, tmp)
+        break
+      except OSError, e:
+        if os.path.exists(tmp):
+          os.unlink(tmp)
+        if attempt == 1 and not os.path.exists(blob):
+          continue # gc()ed under us. Write it again
+        # No hard links here. Fall back to a private copy.
+        plog("INFO", "Unable to link "+filename+" to "+blob+": "+str(e))
+        self._write(tmp, data)
+        break
+    os.rename(tmp, filename)
+    return key
+
+  def dump(self, obj, filename):
+    ''' pickle obj into the store as filename. Read it with SnakePickler '''
+    return self.put(pickle.dumps(obj), filename)
+
+  def get(self, key):
+    ''' the data stored under key '''
+    return BaselineStore.read(self.blob_path(key))
+
+  def refcount(self, key):
+    ''' number of files pointing at the blob for key '''
+    try:
+      return os.stat(self.blob_path(key)).st_nlink - 1
+    except OSError:
+      return 0
+
+  def gc(self):
+    ''' remove blobs nothing refers to. returns (blobs, bytes) freed '''
+    blobs = size = 0
+    for root, dirs, files in os.walk(self.root):
+      for f in files:
+        blob = os.path.join(root, f)
+        try:
+          st = os.stat(blob)
+          if st.st_nlink == 1:
+            os.unlink(blob)
+            blobs += 1
+            size += st.st_size
+        except OSError:
+          pass
+    return (blobs, size)
+
+  def _write(self, filename, data):
+    # Write to a temporary name and rename it, so a blob is either
+    # complete or absent
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+      try:
+        os.makedirs(dirname)
+      except OSError:
+        if not os.path.isdir(dirname): raise
+    tmp = tmp_name(filename)
+    f = file(tmp, "w")
+    try:
+      f.write(data)
+    finally:
+      f.close()
+    os.rename(tmp, filename)
+
+  def read(filename):
+    ''' the contents of filename, uncompressed if it is a compressed blob '''
+    f = file(filename, "r")
+    try:
+      data = f.read()
+    finally:
+      f.close()
+    if data.startswith(BaselineStore.COMPRESSED_MAGIC):
+      data = zlib.decompress(data[len(BaselineStore.COMPRESSED_MAGIC):])
+    return data
+  read = Callable(read)
+
+class ParsedBaseline:
+  """ The parsed form of a page's baseline content: a SoupSummary for
+      html, a JSDiffer for js. Building these is the expensive part of a
+      comparison, so it is done once per baseline and saved with it.
+      content_hash ties it to the content it was built from. """
+  def __init__(self, content, filetype):
+    self.content_hash = BaselineStore.hash(content)
+    self.filetype = filetype
+    if filetype == 'html':
+      self.parsed = SoupSummary(FullyStrainedSoup(content.decode('ascii', 'ignore')))
+    elif filetype == 'js':
+      self.parsed = JSDiffer(content)
+    else:
+      self.parsed = None
+    self._pickle_revision = 0
+
+  def depickle_upgrade(self):
+    pass
+
+  def matches(self, content, filetype):
+    return self.filetype == filetype \
+        and self.content_hash == BaselineStore.hash(content)
+
+class SoupSummary:
+  """ The tag, attribute and content sets of a soup that SoupDiffer
+      works from """
+  def __init__(self, soup):
+    self.tags = SoupDiffer._get_tags(soup)
+    self.attrs = SoupDiffer._get_attributes(soup)
+    self.content = SoupDiffer._get_content(soup)
+    self._pickle_revision = 0
+
+  def depickle_upgrade(self):
+    pass
+
 class SoupDiffer:
-  """ Diff two soup tag sets, optionally writing diffs to outfile. """
+  """ Diff two soup tag sets, optionally writing diffs to outfile.
+      Either soup may be given as a SoupSummary instead. """
   def __init__(self, soup_old, soup_new):
-    tags_old = self._get_tags(soup_old)
-    tags_new = self._get_tags(soup_new)
+    if not isinstance(soup_old, SoupSummary):
+      soup_old = SoupSummary(soup_old)
+    if not isinstance(soup_new, SoupSummary):
+      soup_new = SoupSummary(soup_new)
+
+    tags_old = soup_old.tags
+    tags_new = soup_new.tags
     self.tag_pool = tags_new | tags_old
     self.changed_tag_map = {}
     self._update_changed_tag_map(tags_old, tags_new)
     self._update_changed_tag_map(tags_new, tags_old)
 
-    attrs_new = self._get_attributes(soup_new)
-    attrs_old = self._get_attributes(soup_old)
+    attrs_new = soup_new.attrs
+    attrs_old = soup_old.attrs
     self.attr_pool = attrs_new | attrs_old
     self.changed_attr_map = {}
     self._update_changed_attr_map(attrs_new, attrs_old)
     self._update_changed_attr_map(attrs_old, attrs_new)
 
-    cntnt_new = self._get_content(soup_new)
-    cntnt_old = self._get_content(soup_old)
+    cntnt_new = soup_new.content
+    cntnt_old = soup_old.content
     self.content_pool = cntnt_new | cntnt_old
     self.content_changed = bool(cntnt_new ^ cntnt_old) 
     self._pickle_revision = 0    
@@ -904,21 +1533,24 @@ class SoupDiffer:
   def depickle_upgrade(self):
     pass
 
-  def _get_tags(self, soup):
+  def _get_tags(soup):
     return set(map(str,
            [tag for tag in soup.findAll() if isinstance(tag, Tag)]))
+  _get_tags = Callable(_get_tags)
 
-  def _get_attributes(self, soup):
+  def _get_attributes(soup):
     attr_soup = [(tag.name, tag.attrs) for tag in soup.findAll()]
     attrs = set([])
     for (tag, attr_list) in attr_soup:
       for at in attr_list:
         attrs.add((tag, at)) 
     return attrs
+  _get_attributes = Callable(_get_attributes)
 
-  def _get_content(self, soup):
+  def _get_content(soup):
     return set(map(str,
       [tag for tag in soup.findAll() if not isinstance(tag, Tag)]))
+  _get_content = Callable(_get_content)
   
   def _update_changed_tag_map(self, tags_old, tags_new):
     """ Create a map of changed tags to ALL attributes that tag
@@ -1033,11 +1665,17 @@ class HeaderDiffer:
 
 class JSDiffer:
   def __init__(self, js_string):
-    self._pickle_revision = 0    
-    self.ast_cnts = self._count_ast_elements(js_string)
+    self._pickle_revision = 1
+    # Fingerprints of the content we have found no differences in
+    self.fingerprints = set()
+    scripts = self._lex_scripts(js_string)
+    self.ast_cnts = self._count_ast_elements(scripts)
+    self._add_fingerprint(scripts, self.ast_cnts)
 
   def depickle_upgrade(self):
-    pass
+    if self._pickle_revision < 1:
+      self.fingerprints = set()
+      self._pickle_revision = 1
 
   def _ast_recursive_worker(ast, ast_cnts):
     node = JSTokenNames[ast.getType()]
@@ -1049,22 +1687,69 @@ class JSDiffer:
       JSDiffer._ast_recursive_worker(child, ast_cnts)
   _ast_recursive_worker = Callable(_ast_recursive_worker)
 
-  def _antlr_parse(self, js_string):
+  def _antlr_lex(js_string):
+    js_string = js_string.replace("\n\r","\n").replace("\r\n","\n").replace("\r","\n")+";"
     char_stream = antlr3.ANTLRStringStream(js_string)
     lexer = LoggingJSLexer(char_stream)
     tokens = antlr3.CommonTokenStream(lexer)
+    tokens.fillBuffer()
+    return tokens
+  _antlr_lex = Callable(_antlr_lex)
+
+  def _antlr_parse(tokens):
     parser = LoggingJSParser(tokens)
     program = parser.program()
     program.tree.parse_errors = parser.parse_errors__
-    program.tree.lex_errors = lexer.lex_errors__
+    program.tree.lex_errors = tokens.tokenSource.lex_errors__
     return program.tree
-                            
-  def _count_ast_elements(self, js_string, name="global"):
-    ast_cnts = {}
+  _antlr_parse = Callable(_antlr_parse)
+
+  def _lex_scripts(self, js_string):
+    """ (name, script, tokens) for each script in the content. tokens
+        is None if the script could not be lexed. """
+    return [JSDiffer._lex_script(js_string, "global")]
+
+  def _lex_script(script, name):
     try:
-      js_string = js_string.replace("\n\r","\n").replace("\r\n","\n").replace("\r","\n")+";"
-      
-      ast = self._antlr_parse(js_string)
+      return (name, script, JSDiffer._antlr_lex(script))
+    except UnicodeDecodeError:
+      return (name, script, None)
+  _lex_script = Callable(_lex_script)
+
+  def _fingerprint(scripts):
+    """ A hash of the sequence of token types the parser sees in scripts,
+        or None if any of them did not lex cleanly. The grammar has no
+        semantic predicates, so scripts with the same token types parse
+        to the same tree, and so have the same ast counts. """
+    fingerprint = blob_hash()
+    for name, script, tokens in scripts:
+      if not tokens or tokens.tokenSource.lex_errors__:
+        return None
+      fingerprint.update("".join([chr(t.type) for t in tokens.tokens
+                          if t.channel == antlr3.DEFAULT_CHANNEL])+"\xff")
+    return fingerprint.hexdigest()
+  _fingerprint = Callable(_fingerprint)
+
+  def _add_fingerprint(self, scripts, ast_cnts):
+    # Parse errors are counted by line, which the token types don't
+    # fix, so only content that parsed cleanly can be matched this way.
+    for node in ast_cnts.iterkeys():
+      if node.startswith("ParseError:"): return
+    fingerprint = JSDiffer._fingerprint(scripts)
+    if fingerprint:
+      self.fingerprints.add(fingerprint)
+
+  def _count_ast_elements(self, scripts):
+    ast_cnts = {}
+    for name, js_string, tokens in scripts:
+      if not tokens:
+        name+=":UnicodeDecodeError"
+        plog("INFO", "Unicode error "+name+" on "+js_string)
+        if not "ParseError:"+name in ast_cnts:
+          ast_cnts["ParseError:"+name] = 1
+        else: ast_cnts["ParseError:"+name] +=1
+        continue
+      ast = JSDiffer._antlr_parse(tokens)
       JSDiffer._ast_recursive_worker(ast, ast_cnts)
       for e in ast.lex_errors+ast.parse_errors:
         name+=":"+e.__class__.__name__
@@ -1078,12 +1763,6 @@ class JSDiffer:
         if not "ParseError:"+name in ast_cnts:
           ast_cnts["ParseError:"+name] = 1
         else: ast_cnts["ParseError:"+name] += 1
-    except UnicodeDecodeError, e:
-      name+=":"+e.__class__.__name__
-      plog("INFO", "Unicode error "+name+" on "+js_string)
-      if not "ParseError:"+name in ast_cnts:
-        ast_cnts["ParseError:"+name] = 1
-      else: ast_cnts["ParseError:"+name] +=1
     return ast_cnts
 
   def _difference_pruner(self, other_cnts):
@@ -1134,34 +1813,32 @@ class JSDiffer:
     return ret
 
   def prune_differences(self, other_string):
-    other_cnts = self._count_ast_elements(other_string)
+    scripts = self._lex_scripts(other_string)
+    if JSDiffer._fingerprint(scripts) in self.fingerprints:
+      return
+    other_cnts = self._count_ast_elements(scripts)
     self._difference_pruner(other_cnts)
+    # Whatever has these counts no longer differs
+    self._add_fingerprint(scripts, other_cnts)
 
   def contains_differences(self, other_string):
-    other_cnts = self._count_ast_elements(other_string)
+    scripts = self._lex_scripts(other_string)
+    if JSDiffer._fingerprint(scripts) in self.fingerprints:
+      return False
+    other_cnts = self._count_ast_elements(scripts)
     return self._difference_checker(other_cnts) 
 
   def show_differences(self, other_string):
-    other_cnts = self._count_ast_elements(other_string)
+    scripts = self._lex_scripts(other_string)
+    if JSDiffer._fingerprint(scripts) in self.fingerprints:
+      return ""
+    other_cnts = self._count_ast_elements(scripts)
     return self._difference_printer(other_cnts) 
 
 
 class JSSoupDiffer(JSDiffer):
-  def _add_cnts(tag_cnts, ast_cnts):
-    ret_cnts = {}
-    for n in tag_cnts.iterkeys():
-      if n in ast_cnts:
-        ret_cnts[n] = tag_cnts[n]+ast_cnts[n]
-      else:
-        ret_cnts[n] = tag_cnts[n]
-    for n in ast_cnts.iterkeys():
-      if n not in tag_cnts:
-        ret_cnts[n] = ast_cnts[n]
-    return ret_cnts
-  _add_cnts = Callable(_add_cnts)
-
-  def _count_ast_elements(self, soup, name="Soup"):
-    ast_cnts = {}
+  def _lex_scripts(self, soup):
+    scripts = []
     for tag in soup.findAll():
       if tag.name == 'script':
         for child in tag.childGenerator():
@@ -1169,8 +1846,7 @@ class JSSoupDiffer(JSDiffer):
             plog("ERROR", "Script tag with subtag!")
           else:
             script = str(child).replace("<!--", "").replace("-->", "").replace("<![CDATA[", "").replace("]]>", "")
-            tag_cnts = JSDiffer._count_ast_elements(self, script, tag.name)
-            ast_cnts = JSSoupDiffer._add_cnts(tag_cnts, ast_cnts)
+            scripts.append(JSDiffer._lex_script(script, tag.name))
       for attr in tag.attrs:
         # hrmm.. %-encoding too? Firefox negs on it..
         parse = ""
@@ -1180,14 +1856,16 @@ class JSSoupDiffer(JSDiffer):
         elif attr[0] in attrs_with_raw_script_map:
           parse = str(attr[1])
         if not parse: continue
-        tag_cnts = JSDiffer._count_ast_elements(self,parse,tag.name+":"+attr[0])
-        ast_cnts = JSSoupDiffer._add_cnts(tag_cnts, ast_cnts)
-    return ast_cnts
+        scripts.append(JSDiffer._lex_script(parse, tag.name+":"+attr[0]))
+    return scripts
 
 
 class SlowXferException(Exception):
   pass
 
+class MaxContentSizeException(Exception):
+  pass
+
 class RedirectException(Exception):
   def __init__(self, code, orig, new):
     self.code = code
@@ -162,7 +162,7 @@ def send_mail(fro, to, subject, text, files=[]):
 
   for f in files:
     part = MIMEBase('application', "octet-stream")
-    part.set_payload( open(f,"rb").read() )
+    part.set_payload( BaselineStore.read(f) )
     Encoders.encode_base64(part)
     part.add_header('Content-Disposition', 'attachment; filename="%s"'
                    % os.path.basename(f))
@@ -199,10 +199,18 @@ def main(argv):
 
   if conf.use_file:
     results = [dh.getResult(conf.use_file)]
-  elif conf.node:
-    results = dh.filterByNode(dh.getAll(), conf.node)
   else:
-    results = dh.getAll()
+    # Let the result index skip what we'd filter out below anyway
+    statuses = []
+    if conf.statuscode:
+      statuses = [conf.statuscode]
+    result_classes = []
+    if conf.resultfilter:
+      result_classes = [conf.resultfilter]
+    results = dh.getResults(exit_node=conf.node, statuses=statuses,
+                            reasons=conf.reasons,
+                            result_classes=result_classes,
+                            after=conf.after, before=conf.before)
 
   if conf.sortby == "url":
     results.sort(lambda x, y: cmp(x.site, y.site))
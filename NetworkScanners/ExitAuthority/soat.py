@@ -23,9 +23,10 @@ To run SoaT:
 
 '''
 
-__all__ = ["ExitNodeScanner", "DNSRebindScanner", "load_wordlist"]
+__all__ = ["ExitNodeScanner", "DNSRebindScanner", "AddressRanges", "load_wordlist"]
 
 import atexit
+import bisect
 import cookielib
 import copy
 import getopt
@@ -34,7 +35,7 @@ import mimetypes
 import os
 import random
 import re
-import signal
+import select
 import smtplib
 import socket
 import sys
@@ -44,11 +45,10 @@ import traceback
 import urllib
 import urllib2
 import urlparse
-import zlib,gzip
+import zlib
 import struct
 
 import Queue
-import StringIO
 
 from OpenSSL import SSL, crypto
 
@@ -112,6 +112,7 @@ import Pyssh.pyssh as pyssh
 search_cookies=None
 scanhdlr=None
 datahandler=None
+baselines=None
 linebreak = '\r\n'
 
 # Do NOT modify this object directly after it is handed to PathBuilder
@@ -129,12 +130,65 @@ __selmgr = PathSupport.SelectionManager(
       use_guards=False,
       exit_ports=[443])
 
-# Needed for our own sigalarm-based timeouts.
+# Raised when a Deadline passes.
 # We can't use socket.timeout because it is a different
 # identifier when we are using socksipy's 'socket'
 class ReadTimeout(Exception):
   pass
 
+class Deadline:
+  ''' An absolute time limit shared by a series of socket operations '''
+  def __init__(self, secs):
+    self.restart(secs)
+
+  def restart(self, secs):
+    self.expires = time.time() + secs
+
+  def remaining(self):
+    ''' seconds left, or ReadTimeout if there are none '''
+    left = self.expires - time.time()
+    if left <= 0:
+      raise ReadTimeout("Deadline passed")
+    return left
+
+class DeadlineSocket:
+  '''
+  Wraps a socket so each blocking call times out when the deadline does,
+  rather than after a fixed time of its own. Unlike SIGALRM this works
+  off the main thread and to fractions of a second.
+  '''
+  def __init__(self, sock, deadline):
+    self._sock = sock
+    self.deadline = deadline
+
+  def __getattr__(self, name):
+    return getattr(self._sock, name)
+
+  def _arm(self):
+    self._sock.settimeout(self.deadline.remaining())
+
+  def connect(self, address):
+    self._arm()
+    return self._sock.connect(address)
+
+  def recv(self, *args):
+    self._arm()
+    return self._sock.recv(*args)
+
+  def send(self, *args):
+    self._arm()
+    return self._sock.send(*args)
+
+  def sendall(self, *args):
+    self._arm()
+    return self._sock.sendall(*args)
+
+  def makefile(self, mode='r', bufsize=-1):
+    # Like socket.makefile(), the file wraps the underlying socket, so it
+    # outlives close() here. It has to see our recv() too, though.
+    return socket._fileobject(DeadlineSocket(self._sock._sock, self.deadline),
+                              mode, bufsize)
+
 # Oh yeah. so dirty. Blame this guy if you hate me:
 # http://mail.python.org/pipermail/python-bugs-list/2008-October/061202.html
 _origsocket = socket.socket
@@ -145,25 +199,188 @@ class BindingSocket(_origsocket):
     if BindingSocket.bind_to:
       plog("DEBUG", "Binding socket to "+BindingSocket.bind_to)
       self.bind((BindingSocket.bind_to, 0))
-socket.socket = BindingSocket
 
+# Exit workers fetch over Tor and directly at the same time, so which
+# kind of socket socket.socket() hands out is decided per thread.
+class _ThreadState(threading.local):
+  socket = BindingSocket
+  worker = None # The ExitWorker running on this thread, if any
+  deadline = None # The Deadline for this thread's current HTTP request
+_thread_state = _ThreadState()
+
+class ThreadSocket(_origsocket):
+  ''' socket.socket() hands out a socket of the kind the calling thread
+  has chosen. It stays a class, so it can still be subclassed. '''
+  def __new__(cls, *args, **kwargs):
+    if cls is ThreadSocket:
+      return _thread_state.socket(*args, **kwargs)
+    return _origsocket.__new__(cls)
+socket.socket = ThreadSocket
+
+class ExitSocket(socks.socksocket):
+  ''' A SOCKS socket whose stream goes through the calling worker's exit '''
+  def connect(self, destpair):
+    _thread_state.worker.connect(self, destpair)
 
 def torify(func, *args):
-  defaultsocket = socket.socket
+  defaultsocket = _thread_state.socket
   socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, TorUtil.tor_host, TorUtil.tor_port)
-  socket.socket = socks.socksocket
+  if _thread_state.worker:
+    # ExitWorker.connect() looks after the port table
+    _thread_state.socket = ExitSocket
+  else:
+    _thread_state.socket = socks.socksocket
   rval = None
   try:
     rval = apply(func, args)
   except:
-    PathSupport.SmartSocket.clear_port_table()
-    socket.socket = defaultsocket
+    if not _thread_state.worker:
+      PathSupport.SmartSocket.clear_port_table()
+    _thread_state.socket = defaultsocket
     raise
   # reset the connection method back to direct
-  PathSupport.SmartSocket.clear_port_table()
-  socket.socket = defaultsocket
+  if not _thread_state.worker:
+    PathSupport.SmartSocket.clear_port_table()
+  _thread_state.socket = defaultsocket
   return rval
 
+def get_exit_node():
+  ''' the exit router that this thread's Tor streams go through '''
+  worker = _thread_state.worker
+  if worker:
+    if worker.lost:
+      return None
+    return worker.router
+  return scanhdlr.get_exit_node()
+
+class TorResolver:
+  '''
+  Resolves names and addresses through the current exit with Tor's SOCKS
+  RESOLVE and RESOLVE_PTR extensions. Answers are cached per (exit, name)
+  and (exit, address).
+  '''
+  def __init__(self):
+    self.cache = {}
+    self.ptr_cache = {}
+    self.cache_lock = threading.Lock()
+
+  def resolve(self, name):
+    ''' Return the address of name, or None if Tor couldn't resolve it '''
+    if len(name) > 255:
+      plog("INFO", "Tor could not resolve "+name+": name too long")
+      return None
+    request = "\x03"+chr(len(name))+name
+    return self._lookup("\xf0", request, name, self.cache)
+
+  def resolve_ptr(self, address):
+    ''' Return the name of address, or None if Tor couldn't find one '''
+    try:
+      if ":" in address:
+        request = "\x04"+socket.inet_pton(socket.AF_INET6, address)
+      else:
+        request = "\x01"+socket.inet_pton(socket.AF_INET, address)
+    except socket.error:
+      plog("INFO", "Tor could not reverse resolve "+address+": bad address")
+      return None
+    return self._lookup("\xf1", request, address, self.ptr_cache)
+
+  def _lookup(self, command, request, name, cache):
+    exit_node = get_exit_node()
+    key = (exit_node and exit_node.idhex, name)
+    self.cache_lock.acquire()
+    try:
+      if key in cache:
+        return cache[key]
+    finally:
+      self.cache_lock.release()
+
+    deadline = Deadline(read_timeout)
+    s = None
+    answer = None
+    try:
+      try:
+        if _thread_state.worker:
+          # Our exit only has to stay pinned until the stream is attached
+          s = _thread_state.worker.through_exit(self._launch, command,
+                                                request, deadline, True)
+        else:
+          s = self._launch(command, request, deadline, False)
+        answer = self._read(s)
+      except ReadTimeout:
+        plog("WARN", "Timed out resolving "+name+" via Tor")
+      except (ValueError, socket.error, socks.ProxyError), e:
+        plog("INFO", "Tor could not resolve "+name+": "+str(e))
+    finally:
+      if s:
+        s.close()
+      if not _thread_state.worker:
+        PathSupport.SmartSocket.clear_port_table()
+
+    if answer is not None:
+      self.cache_lock.acquire()
+      try:
+        cache[key] = answer
+      finally:
+        self.cache_lock.release()
+    return answer
+
+  def _launch(self, command, request, deadline, wait_attach):
+    ''' Send Tor the RESOLVE or RESOLVE_PTR command for the encoded
+    address in request. With wait_attach, only return once Tor has
+    attached the stream to a circuit. '''
+    # A socksocket, so that the stream gets attached to our exit
+    s = DeadlineSocket(socks.socksocket(), deadline)
+    try:
+      s._arm()
+      socks._orgsocket.connect(s._sock, (TorUtil.tor_host, TorUtil.tor_port))
+      s.sendall("\x05\x01\x00")
+      if self._recv(s, 2) != "\x05\x00":
+        raise socks.GeneralProxyError((1, socks._generalerrors[1]))
+      source = "%s:%d" % s.getsockname()[:2]
+      if wait_attach:
+        scanhdlr.attachments.expect(source)
+      try:
+        s.sendall("\x05"+command+"\x00"+request+"\x00\x00")
+        if wait_attach:
+          scanhdlr.attachments.wait(source, deadline)
+      finally:
+        if wait_attach:
+          scanhdlr.attachments.forget(source)
+    except:
+      s.close()
+      raise
+    return s
+
+  def _recv(self, s, n):
+    data = ""
+    while len(data) < n:
+      chunk = s.recv(n - len(data))
+      if not chunk:
+        raise socks.GeneralProxyError((1, socks._generalerrors[1]))
+      data += chunk
+    return data
+
+  def _read(self, s):
+    ''' Read the answer to a RESOLVE or RESOLVE_PTR request '''
+    reply = self._recv(s, 4)
+    if reply[0] != "\x05":
+      raise socks.GeneralProxyError((1, socks._generalerrors[1]))
+    if reply[1] != "\x00":
+      code = min(ord(reply[1]), 9)
+      raise socks.Socks5Error((code, socks._socks5errors[code]))
+    if reply[3] == "\x01":
+      answer = socket.inet_ntoa(self._recv(s, 4))
+    elif reply[3] == "\x04":
+      answer = socket.inet_ntop(socket.AF_INET6, self._recv(s, 16))
+    elif reply[3] == "\x03":
+      answer = self._recv(s, ord(self._recv(s, 1)))
+    else:
+      raise socks.GeneralProxyError((1, socks._generalerrors[1]))
+    self._recv(s, 2) # port
+    return answer
+
+tor_resolver = TorResolver()
+
 
 # Nice.. HTTPConnection.connect is doing DNS for us! Fix that:
 # Hrmm.. suppose we could also bind here.. but BindingSocket is
@@ -171,8 +388,8 @@ def torify(func, *args):
 class NoDNSHTTPConnection(httplib.HTTPConnection):
   def connect(self):
     try:
-      self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-      self.sock.settimeout(read_timeout) # Mnemotronic tonic
+      deadline = _thread_state.deadline or Deadline(read_timeout)
+      self.sock = DeadlineSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0), deadline)
       if self.debuglevel > 0:
         print "connect: (%s, %s)" % (self.host, self.port)
       self.sock.connect((str(self.host), self.port))
@@ -200,10 +417,57 @@ class NullRedirectHandler(urllib2.HTTPRedirectHandler):
     raise RedirectException(code, req.get_full_url(), newurl)
   http_error_302 = http_error_303 = http_error_307 = http_error_301
 
+class StreamAttachments:
+  '''
+  Lets a thread wait for Tor to attach the stream it opened from a local
+  address. Tor only gives the source address when a stream is new, so
+  expected streams are followed by id from then on.
+  '''
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.expected = {} # source address -> attached yet
+    self.streams = {} # stream id -> source address
+
+  def expect(self, source):
+    self.cond.acquire()
+    self.expected[source] = False
+    self.cond.release()
+
+  def forget(self, source):
+    self.cond.acquire()
+    self.expected.pop(source, None)
+    for (strm_id, address) in self.streams.items():
+      if address == source:
+        del self.streams[strm_id]
+    self.cond.release()
+
+  def wait(self, source, deadline):
+    ''' Wait until the stream from source is attached, or has failed '''
+    self.cond.acquire()
+    try:
+      while not self.expected.get(source, True):
+        self.cond.wait(deadline.remaining())
+    finally:
+      self.cond.release()
+
+  def stream_status_event(self, s):
+    self.cond.acquire()
+    try:
+      if s.status in ("NEW", "NEWRESOLVE"):
+        if s.source_addr in self.expected:
+          self.streams[s.strm_id] = s.source_addr
+      elif s.strm_id in self.streams and \
+           s.status in ("SENTCONNECT", "SENTRESOLVE", "FAILED", "CLOSED"):
+        self.expected[self.streams.pop(s.strm_id)] = True
+        self.cond.notifyAll()
+    finally:
+      self.cond.release()
+
 class ExitScanHandler(ScanSupport.ScanHandler):
   def __init__(self, c, selmgr, strm_selector, fixed_exits=[]):
     ScanSupport.ScanHandler.__init__(self, c, selmgr,
                                      strm_selector=strm_selector)
+    self.attachments = StreamAttachments()
     self.rlock = threading.Lock()
     self.new_nodes=True
     self.fixed_exits = set([])
@@ -248,6 +512,10 @@ class ExitScanHandler(ScanSupport.ScanHandler):
     plog("DEBUG", "get_nodes_for_port end")
     return cond._result
 
+  def stream_status_event(self, s):
+    ScanSupport.ScanHandler.stream_status_event(self, s)
+    self.attachments.stream_status_event(s)
+
   def new_consensus_event(self, n):
     plog("DEBUG", "newconsensus_event begin")
     try:
@@ -363,6 +631,110 @@ class ExitScanHandler(ScanSupport.ScanHandler):
 
     self.__dnshandler = DNSRebindScanner(self, c)
 
+class ExitWorker(threading.Thread):
+  '''
+  Runs tests through one exit at a time, alongside other workers.
+
+  PathBuilder attaches new streams to whatever exit was set last, so
+  stream launches are serialized on launch_lock. Each launch pins our exit
+  first, and only the transfers themselves overlap. Test state is only
+  ever changed on the main thread (see written()), which also marks the
+  exits we finish.
+  '''
+  launch_lock = threading.Lock()
+  last_exit = None # The exit PathBuilder will attach the next stream to
+
+  def __init__(self, writer):
+    threading.Thread.__init__(self)
+    self.setDaemon(True)
+    self.writer = writer
+    self.jobs = Queue.Queue()
+    self.replies = Queue.Queue()
+    self.exit = None
+    self.router = None
+    self.lost = False
+
+  def _pin(self):
+    # Called with launch_lock held. Every other worker's stream is
+    # attached by now, so the next one can be pointed at our exit.
+    if ExitWorker.last_exit == self.exit:
+      return True
+    PathSupport.SmartSocket.clear_port_table()
+    scanhdlr.set_exit_node("$"+self.exit)
+    if scanhdlr.selmgr.bad_restrictions:
+      plog("NOTICE", "$"+self.exit+" is not available.")
+      self.lost = True
+      ExitWorker.last_exit = None
+      return False
+    scanhdlr.new_exit()
+    ExitWorker.last_exit = self.exit
+    return True
+
+  def connect(self, sock, destpair):
+    self.through_exit(socks.socksocket.connect, sock, destpair)
+
+  def through_exit(self, func, *args):
+    ''' run func while the streams Tor attaches go through our exit. func
+    has to wait until its streams are attached. '''
+    ExitWorker.launch_lock.acquire()
+    try:
+      if not self._pin():
+        raise socks.GeneralProxyError((1, "Exit $"+self.exit+" unavailable"))
+      return func(*args)
+    finally:
+      ExitWorker.launch_lock.release()
+
+  def write(self, func, args, kwargs):
+    ''' run func on the main thread and return its result '''
+    self.writer.put(("call", self, (func, args, kwargs)))
+    (exc_info, rval) = self.replies.get()
+    if exc_info:
+      raise exc_info[0], exc_info[1], exc_info[2]
+    return rval
+
+  def run(self):
+    _thread_state.worker = self
+    while True:
+      to_run = self.jobs.get()
+      results = []
+      # Like select_exit_from_set(), skip exits we can't get at all
+      ExitWorker.launch_lock.acquire()
+      try:
+        self._pin()
+      finally:
+        ExitWorker.launch_lock.release()
+      try:
+        for test in to_run:
+          if self.lost:
+            break
+          # Per-run fields (cookie jars, fetch queue, counters) live on a
+          # shallow copy. Everything else is shared with the real test.
+          shadow = copy.copy(test)
+          shadow._shadow_of = test
+          if hasattr(test, "fetch_queue"):
+            shadow.fetch_queue = []
+          results.append((test, shadow.run_test()))
+      except:
+        self.writer.put(("error", self, sys.exc_info()))
+        continue
+      self.writer.put(("done", self, results))
+
+def written(func):
+  '''
+  Decorator for the Test methods that change test state or save
+  results. Called from an ExitWorker, they are handed to the main thread
+  to run there, one at a time, on the real Test object.
+  '''
+  def wrapper(self, *args, **kwargs):
+    self = getattr(self, "_shadow_of", self)
+    worker = _thread_state.worker
+    if worker and worker is threading.currentThread():
+      return worker.write(func, (self,)+args, kwargs)
+    return func(self, *args, **kwargs)
+  wrapper.__name__ = func.__name__
+  wrapper.__doc__ = func.__doc__
+  return wrapper
+
 class Http_Return:
   def __init__(self, rt):
     (self.code, self.headers, self.new_cookies, self.mime_type, self.content) = rt
@@ -378,6 +750,9 @@ def http_request(address, cookie_jar=None, headers=firefox_headers):
   new_cookies = []
   mime_type = ""
   rval = (None, None, None, None, None)
+  # Connecting, sending the request and reading the headers share one
+  # deadline. decompress_response_data() restarts it for the body.
+  _thread_state.deadline = Deadline(read_timeout)
   try:
     plog("DEBUG", "Starting request for: "+address)
     if cookie_jar != None:
@@ -405,6 +780,9 @@ def http_request(address, cookie_jar=None, headers=firefox_headers):
     rval = (E_TIMEOUT, None, [], "", e.__class__.__name__+str(e))
   except SlowXferException, e:
     rval = (E_SLOWXFER, None, [], "", e.__class__.__name__+str(e))
+  except MaxContentSizeException, e:
+    plog("WARN", "Max content size exceeded for "+address+": "+str(e))
+    rval = (reply.code, None, [], "", "")
   except RedirectException, e:
     rval = (e.code, None, [], "", e.new_url)
   except httplib.BadStatusLine, e:
@@ -441,13 +819,16 @@ def http_request(address, cookie_jar=None, headers=firefox_headers):
     plog('WARN', 'An unknown HTTP error occured for '+address+": "+str(e))
     traceback.print_exc()
     rval = (E_MISC, None, [], "", e.__class__.__name__+str(e))
+  finally:
+    # Also on the early return above
+    _thread_state.deadline = None
   plog("INFO", "Completed HTTP Reqest for: "+address)
   return Http_Return(rval)
 
 
 # SSL request handling
 def ssl_request(address):
-  # The SIGALARM can be triggered outside of the try/except in
+  # The deadline can also pass outside of the try/except in
   # _ssl_request, so we need to catch socket.timeout here
   try:
     return _ssl_request(address)
@@ -471,24 +852,22 @@ def _ssl_request(address, method='TLSv1_METHOD'):
   ctx = SSL.Context(getattr(SSL,method))
 
   s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  s.settimeout(None)
+  # The connect and handshake must be done within read_timeout
+  deadline = Deadline(read_timeout)
 
-  def _raise_timeout(signum, frame):
-    raise ReadTimeout("SSL connection timed out")
-  signal.signal(signal.SIGALRM, _raise_timeout)
   # open an ssl connection
   rval = (None, None, None)
   try:
     c = SSL.Connection(ctx, s)
     c.set_connect_state()
-    signal.alarm(int(read_timeout)) # raise a timeout after read_timeout
+    s.settimeout(deadline.remaining())
     c.connect((address_name, port)) # DNS OK.
     # XXX: A PEM encoded certificate request was a bizarre and fingerprintable
     # thing to send here. All we actually need to do is perform a handshake,
     # but it might be good to make a simple GET request to further limit
     # fingerprintability.
     # c.send(crypto.dump_certificate_request(crypto.FILETYPE_PEM,request))
-    c.do_handshake()
+    _ssl_handshake(c, deadline)
     rval = (0, c.get_peer_certificate(), None)
   except (ReadTimeout, socket.timeout), e:
     rval = (E_TIMEOUT, None, "Socket timeout")
@@ -516,7 +895,6 @@ def _ssl_request(address, method='TLSv1_METHOD'):
       traceback.print_exc()
       rval = (E_MISC, None, e.__class__.__name__+str(e))
   except SSL.Error, e:
-    signal.alarm(0) # Since we might recurse
     for (lib, func, reason) in e[0]:
       if reason in ('wrong version number','sslv3 alert illegal parameter'):
         # Check if the server supports a different SSL version
@@ -529,16 +907,27 @@ def _ssl_request(address, method='TLSv1_METHOD'):
       traceback.print_exc()
       rval = (E_MISC, None,  e.__class__.__name__+str(e))
   except KeyboardInterrupt:
-    signal.alarm(0)
     raise
   except Exception, e:
     plog('WARN', 'An unknown SSL error occured for '+address+': '+str(e))
     traceback.print_exc()
     rval = (E_MISC, None,  e.__class__.__name__+str(e))
-  signal.alarm(0)
   plog("INFO", "SSL Request done for addrress: "+str(address))
   return rval
 
+def _ssl_handshake(c, deadline):
+  ''' handshake on c, whose socket has a timeout and so does not block,
+      waiting in select() for at most what is left of deadline '''
+  while True:
+    try:
+      return c.do_handshake()
+    except SSL.WantReadError:
+      ready = select.select([c], [], [], deadline.remaining())[0]
+    except SSL.WantWriteError:
+      ready = select.select([], [c], [], deadline.remaining())[1]
+    if not ready:
+      raise ReadTimeout("SSL handshake timed out")
+
 class Targets:
   """
   The class used to store the targets of a Test.
@@ -552,36 +941,56 @@ class Targets:
   __len__
   __getitem__
 
+  Both add and remove are constant time: positions maps each target to
+  its place in list, and key_positions does the same for each lookup
+  list. Removing a target moves the last one into its place.
   """
   def __init__(self):
     self.list = []
     self.lookup = {}
+    self.rebuild_index()
+  def rebuild_index(self):
+    """ (Re)build positions and key_positions from list and lookup """
+    self.positions = {}
+    for pos,entry in enumerate(self.list):
+      self.positions[entry[0]] = pos
+    self.key_positions = {}
+    for key,targets in self.lookup.iteritems():
+      self.key_positions[key] = {}
+      for pos,target in enumerate(targets):
+        self.key_positions[key][target] = pos
   def add(self, target, keys=[]):
     if not target:
       return
-    for pos,entry in enumerate(self.list):
-      if entry[0] == target:
-        newkeys = set.difference(set(keys),self.list[pos][1])
-        self.list[pos][1].update(newkeys)
-        break
+    if target in self.positions:
+      oldkeys = self.list[self.positions[target]][1]
+      newkeys = set.difference(set(keys),oldkeys)
+      oldkeys.update(newkeys)
     else:
       newkeys = set(keys)
+      self.positions[target] = len(self.list)
       self.list.append((target,newkeys))
     for key in newkeys:
-      try:
-        self.lookup[key].append(target)
-      except KeyError:
-        self.lookup[key] = [target]
+      if key not in self.lookup:
+        self.lookup[key] = []
+        self.key_positions[key] = {}
+      self.key_positions[key][target] = len(self.lookup[key])
+      self.lookup[key].append(target)
   def remove(self,target):
-    retval = False
-    for pos,entry in enumerate(self.list):
-      if entry[0] == target:
-        for key in self.list[pos][1]:
-          self.lookup[key].remove(target)
-        self.list.pop(pos)
-        retval = True
-        break
-    return retval
+    if target not in self.positions:
+      return False
+    pos = self.positions.pop(target)
+    for key in self.list[pos][1]:
+      self._swap_out(self.lookup[key], self.key_positions[key],
+                     self.key_positions[key].pop(target), lambda t: t)
+    self._swap_out(self.list, self.positions, pos, lambda entry: entry[0])
+    return True
+  def _swap_out(self, items, positions, pos, target_of):
+    """ Drop items[pos] by moving the last item into its place """
+    last = items.pop()
+    if pos < len(items):
+      items[pos] = last
+      positions[target_of(last)] = pos
   def bykey(self,key):
     return self.lookup.get(key,[])
   def keys(self):
@@ -594,8 +1003,16 @@ class Targets:
     return self.list[index]
 
 # Base Test Classes
-class Test:
+class Test(Checkpointed):
   """ Base class for our tests """
+  # Journaled a key at a time by DataHandler.saveTest. See Checkpointed.
+  keyed_state = ("results", "nodes", "node_results", "banned_targets",
+                 "successes", "connect_fails", "timeout_fails", "dns_fails",
+                 "exit_fails", "dynamic_fails", "connect_fails_per_exit",
+                 "timeout_fails_per_exit", "dns_fails_per_exit",
+                 "exit_fails_per_exit")
+  derived_state = ("site_results", "result_positions")
+
   def __init__(self, proto, port):
     """Sets the variables that are static for the lifetime of the test and calls self._reset() which sets the variables that are not."""
     self.proto = proto
@@ -611,7 +1028,7 @@ class Test:
     self.nodes_to_mark = 0
     self.tests_per_node = num_tests_per_node
     self._reset()
-    self._pickle_revision = 8 # Will increment as fields are added
+    self._pickle_revision = 9 # Will increment as fields are added
 
   def run_test(self):
     raise NotImplementedError()
@@ -651,6 +1068,12 @@ class Test:
     if self._pickle_revision < 8:
       self.url_reserve = {}
       self._pickle_revision = 8
+    if self._pickle_revision < 9:
+      # Index targets and results so removing a target doesn't scan them
+      if isinstance(self.targets, Targets):
+        self.targets.rebuild_index()
+      self.rebuild_derived_state()
+      self._pickle_revision = 9
 
   def _is_useable_url(self, url, valid_schemes=None, filetype=None):
     (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(url)
@@ -680,6 +1103,7 @@ class Test:
 
   def add_target(self, target):
     self.targets.add(target)
+    self._touch("targets")
 
   def select_targets(self):
     ret = []
@@ -692,9 +1116,12 @@ class Test:
     if not self.targets:
       raise NoURLsFound("No URLS found for protocol "+self.proto)
 
+  @written
   def remove_target(self, target, reason="None"):
     self.banned_targets.add(target)
+    self._touch("banned_targets", target)
     self.targets.remove(target)
+    self._touch("targets")
     if target in self.dynamic_fails:
       del self.dynamic_fails[target]
     if target in self.successes:
@@ -707,10 +1134,13 @@ class Test:
       del self.dns_fails[target]
     if target in self.timeout_fails:
       del self.timeout_fails[target]
-    kill_results = []
-    for r in self.results:
-      if r.site == target:
-        kill_results.append(r)
+    for stat in ("dynamic_fails", "successes", "exit_fails", "connect_fails",
+                 "dns_fails", "timeout_fails"):
+      self._touch(stat, target)
+    kill_results = self.site_results.pop(target, [])
+    # site_results is rebuilt in results order on resume. Follow that
+    # order, so that a resumed scan removes results the same way.
+    kill_results.sort(key=self.result_positions.get)
     for r in kill_results:
       # XXX: Need to re-add this node to our test set
       # (If it is still up)
@@ -723,20 +1153,20 @@ class Test:
           pass
         r.mark_false_positive(reason)
         datahandler.saveResult(r)
-      self.results.remove(r)
+      self._remove_result(r)
 
     self.refill_targets()
 
   def load_rescan(self, type, since=None):
     self.rescan_nodes = set([])
-    results = datahandler.getAll()
-    for r in results:
-      if r.status == type:
-        if not since or r.timestamp >= since:
-          self.rescan_nodes.add(r.exit_node)
+    if not since:
+      since = None
+    for r in datahandler.getRecords(statuses=[type], after=since):
+      self.rescan_nodes.add(r.exit_node)
     plog("INFO", "Loaded "+str(len(self.rescan_nodes))+" nodes to rescan")
     if self.nodes and self.rescan_nodes:
       self.nodes &= self.rescan_nodes
+      self._touch("nodes")
     self.scan_nodes = len(self.nodes)
     self.tests_per_node = num_rescan_tests_per_node
     self.nodes_to_mark = self.scan_nodes*self.tests_per_node
@@ -776,7 +1206,7 @@ class Test:
                      self.nodes))
 
   def mark_chosen(self, node, result):
-    exit_node = scanhdlr.get_exit_node()
+    exit_node = get_exit_node()
     if not exit_node:
       plog("WARN", "Exit node disappeared during scan: "+node)
       return
@@ -788,8 +1218,10 @@ class Test:
     if not node in self.node_results:
       self.node_results[node] = []
     self.node_results[node].append(result)
+    self._touch("node_results", node)
     if len(self.node_results[node]) >= self.tests_per_node:
       self.nodes.remove(node)
+      self._touch("nodes", node)
       self.scan_nodes = len(self.nodes)
       self.nodes_to_mark = self.scan_nodes*self.tests_per_node
       plog("INFO", "Removed node "+node+". "+str(len(self.nodes))+" nodes remain")
@@ -805,6 +1237,7 @@ class Test:
       if result.filename is not None:
         result.finish_timestamp = ts
         datahandler.saveResult(result)
+    self._touch("results")
 
   def finished(self):
     return not self.nodes
@@ -848,9 +1281,11 @@ class Test:
       if not r.confirmed and not r.false_positive and r.status == TEST_FAILURE:
         r.confirmed=True # only save confirmed stuff once.
         datahandler.saveResult(r)
+        self._touch("results")
 
   def _reset(self):
     self.results = []
+    self.result_positions = {}
     # Empty target list for new test
     self.targets = Targets()
     self.tests_run = 0
@@ -863,6 +1298,7 @@ class Test:
     self.exit_fails_per_exit = {}
     self.node_results = {}
     # These are indexed by target URI:
+    self.site_results = {}
     self.connect_fails = {}
     self.timeout_fails = {}
     self.dns_fails = {}
@@ -896,11 +1332,41 @@ class Test:
       tot_cnt += len(self.timeout_fails[site])
     return tot_cnt
 
+  def add_result(self, result):
+    self._index_result(result, len(self.results))
+    self._touch("results", len(self.results))
+    self.results.append(result)
+
+  def _index_result(self, result, pos):
+    # Results hash by identity, which pickling preserves
+    self.result_positions[result] = pos
+    if result.site in self.site_results:
+      self.site_results[result.site].append(result)
+    else:
+      self.site_results[result.site] = [result]
+
+  def _remove_result(self, result):
+    # Like Targets, move the last result into the removed one's place.
+    # site_results is left to the caller.
+    pos = self.result_positions.pop(result)
+    last = self.results.pop()
+    if pos < len(self.results):
+      self.results[pos] = last
+      self.result_positions[last] = pos
+      self._touch("results", pos)
+
+  def rebuild_derived_state(self):
+    self.site_results = {}
+    self.result_positions = {}
+    for pos,result in enumerate(self.results):
+      self._index_result(result, pos)
+
   def record_site_stats(self, result, stat):
     if result.site in stat:
       stat[result.site].add(result.exit_node)
     else:
       stat[result.site] = set([result.exit_node])
+    self._touch_container(stat, result.site)
     result.site_result_rate = (len(stat[result.site]), self.site_tests(result.site))
     return result.site_result_rate
 
@@ -909,9 +1375,11 @@ class Test:
       stat_per_exit[result.exit_node] += 1
     else:
       stat_per_exit[result.exit_node] = 1
+    self._touch_container(stat_per_exit, result.exit_node)
     result.exit_result_rate = (stat_per_exit[result.exit_node], len(self.node_results.get(result.exit_node,[]))+1)
     return result.exit_result_rate
 
+  @written
   def register_success(self, result):
     if self.rescan_nodes:
       result.from_rescan = True
@@ -920,11 +1388,12 @@ class Test:
     plog("INFO", self.proto+" success at "+result.exit_node+". This makes "+str(win_cnt)+"/"+str(total)+" node successes for "+result.site)
     return TEST_SUCCESS
 
+  @written
   def register_connect_failure(self, result):
     plog("NOTICE", "Registering connect failure")
     if self.rescan_nodes:
       result.from_rescan = True
-    self.results.append(result)
+    self.add_result(result)
 
     (similar, exit_count) = self.record_site_stats(result, self.connect_fails)
     (fails, result_count) = self.record_exit_stats(result, self.connect_fails_per_exit)
@@ -943,11 +1412,12 @@ class Test:
       plog("NOTICE", self.proto+" connect fail at "+result.exit_node+". This makes "+str(fails)+" fails")
       return TEST_INCONCLUSIVE
 
+  @written
   def register_dns_failure(self, result):
     plog("NOTICE", "Registering dns failure")
     if self.rescan_nodes:
       result.from_rescan = True
-    self.results.append(result)
+    self.add_result(result)
 
     (similar, exit_count) = self.record_site_stats(result, self.dns_fails)
     (fails, result_count) = self.record_exit_stats(result, self.dns_fails_per_exit)
@@ -966,11 +1436,12 @@ class Test:
       plog("NOTICE", self.proto+" dns fail at "+result.exit_node+". This makes "+str(fails)+" fails")
       return TEST_INCONCLUSIVE
 
+  @written
   def register_timeout_failure(self, result):
     plog("NOTICE", "Registering timeout failure")
     if self.rescan_nodes:
       result.from_rescan = True
-    self.results.append(result)
+    self.add_result(result)
 
     (similar, exit_count) = self.record_site_stats(result, self.timeout_fails)
     (fails, result_count) = self.record_exit_stats(result, self.timeout_fails_per_exit)
@@ -989,11 +1460,12 @@ class Test:
       plog("NOTICE", self.proto+" timeout at "+result.exit_node+". This makes "+str(fails)+" timeouts")
       return TEST_INCONCLUSIVE
 
+  @written
   def register_exit_failure(self, result):
     plog("NOTICE", "Registering exit failure")
     if self.rescan_nodes:
       result.from_rescan = True
-    self.results.append(result)
+    self.add_result(result)
 
     (similar, exit_count) = self.record_site_stats(result, self.exit_fails)
     (fails, result_count) = self.record_exit_stats(result, self.exit_fails_per_exit)
@@ -1002,11 +1474,12 @@ class Test:
     datahandler.saveResult(result)
     return TEST_FAILURE
 
+  @written
   def register_dynamic_failure(self, result):
     plog("NOTICE", "Registering dynamic failure")
     if self.rescan_nodes:
       result.from_rescan = True
-    self.results.append(result)
+    self.add_result(result)
 
     (similar, exit_count) = self.record_site_stats(result, self.dynamic_fails)
 
@@ -1014,20 +1487,24 @@ class Test:
     datahandler.saveResult(result)
     return TEST_FAILURE
 
+  @written
   def register_inconclusive(self, result):
     if self.rescan_nodes:
       result.from_rescan = True
-    self.results.append(result)
+    self.add_result(result)
     datahandler.saveResult(result)
     return TEST_INCONCLUSIVE
 
 class BaseHTTPTest(Test):
+  keyed_state = Test.keyed_state + ("httpcode_fails", "httpcode_fails_per_exit")
+
   def __init__(self):
     # FIXME: Handle http urls w/ non-80 ports..
     self.fetch_queue = []
     Test.__init__(self, "HTTP", 80)
     self.save_name = "HTTPTest"
-    self.compare_funcs = {'html': self.compare_html, "js": self.compare_js}
+    # By name, since bound methods can't be pickled
+    self.compare_funcs = {'html': "compare_html", "js": "compare_js"}
 
   def _reset(self):
     self.httpcode_fails = {}
@@ -1067,7 +1544,7 @@ class BaseHTTPTest(Test):
                           tor_cookies)
       if self.rescan_nodes:
         result.from_rescan = True
-      self.results.append(result)
+      self.add_result(result)
       datahandler.saveResult(result)
       return TEST_FAILURE
     return TEST_SUCCESS
@@ -1107,12 +1584,14 @@ class BaseHTTPTest(Test):
     else:
       return TEST_SUCCESS
 
+  @written
   def remove_target(self, target, reason="None"):
     # Remove from targets list and targets by type dictionary
     self.targets.remove(target)
     # Delete results in httpcode_fails
     if target in self.httpcode_fails:
       del self.httpcode_fails[target]
+      self._touch("httpcode_fails", target)
     Test.remove_target(self, target, reason)
 
   def remove_false_positives(self):
@@ -1126,10 +1605,11 @@ class BaseHTTPTest(Test):
       tot_cnt += len(self.httpcode_fails[site])
     return tot_cnt
 
+  @written
   def register_http_failure(self, result):
     if self.rescan_nodes:
       result.from_rescan = True
-    self.results.append(result)
+    self.add_result(result)
 
     (similar, exit_count) = self.record_site_stats(result, self.httpcode_fails)
     (fails, result_count) = self.record_exit_stats(result, self.httpcode_fails_per_exit)
@@ -1228,7 +1708,7 @@ class BaseHTTPTest(Test):
     preq = torify(http_request, address, my_tor_cookie_jar, self.headers)
     psha1sum = sha(preq.content)
 
-    exit_node = scanhdlr.get_exit_node()
+    exit_node = get_exit_node()
     if not exit_node:
       # CA: how can this happen?
       plog('NOTICE', 'We had no exit node to test, skipping to the next test.')
@@ -1377,9 +1857,8 @@ class BaseHTTPTest(Test):
   def save_compare_data(self, address, filetype, req):
     context = self. address_to_context(address)
 
-    f = open(context + '.content', 'w')
-    f.write(req.content)
-    f.close()
+    # Identical content, hashes and headers are only stored once
+    baselines.put(req.content, context + '.content')
 
     lines = req.content.split('\n')
 
@@ -1390,14 +1869,29 @@ class BaseHTTPTest(Test):
       hashes.append(working_hash.hexdigest())
 
     # Save these line-by-line hashes for later use
-    SnakePickler.dump(hashes, context + '.hashes')
+    baselines.dump(hashes, context + '.hashes')
 
     # Save the response headers in case we want them for a later test
     headerdiffer = HeaderDiffer(req.headers)
-    SnakePickler.dump(headerdiffer, context + '.headerdiff')
+    baselines.dump(headerdiffer, context + '.headerdiff')
 
     # Save the new cookies in case we need them for a later test
-    SnakePickler.dump(req.new_cookies,context + '.cookies')
+    baselines.dump(req.new_cookies,context + '.cookies')
+
+    # Parse the content now, rather than in every comparison against it
+    if filetype in self.compare_funcs:
+      baselines.dump(ParsedBaseline(req.content, filetype), context + '.parsed')
+
+  def load_parsed_baseline(self, context, old_content, filetype):
+    """ The parsed form of the baseline content, rebuilt if it was saved
+        for some other content """
+    parsed = None
+    if os.path.exists(context + '.parsed'):
+      parsed = SnakePickler.load(context + '.parsed')
+    if not parsed or not parsed.matches(old_content, filetype):
+      parsed = ParsedBaseline(old_content, filetype)
+      baselines.dump(parsed, context + '.parsed')
+    return parsed.parsed
 
   def compare(self,address,filetype,req):
     """The generic function for comparing webcontent."""
@@ -1408,10 +1902,7 @@ class BaseHTTPTest(Test):
 
     new_linelist = req.content.split('\n')
 
-    f = open(context + '.content')
-    old_content = f.read()
-    f.close()
-
+    old_content = BaselineStore.read(context + '.content')
 
     old_hashes = SnakePickler.load(context + '.hashes')
 
@@ -1432,7 +1923,7 @@ class BaseHTTPTest(Test):
 
     if retval == COMPARE_NOEQUAL:
       try:
-        retval = self.compare_funcs[filetype](req.content,old_content,context)
+        retval = getattr(self, self.compare_funcs[filetype])(req.content,old_content,context)
       except KeyError:
         pass
 
@@ -1441,8 +1932,8 @@ class BaseHTTPTest(Test):
     return retval
 
   def compare_js(self,new_content,old_content,context):
-    # TODO check for truncation? Store differ?
-    jsdiff = JSDiffer(old_content)
+    # TODO check for truncation?
+    jsdiff = self.load_parsed_baseline(context, old_content, 'js')
     has_changes = jsdiff.contains_differences(new_content)
     if not has_changes:
       return COMPARE_EQUAL
@@ -1450,8 +1941,8 @@ class BaseHTTPTest(Test):
       return COMPARE_NOEQUAL
 
   def compare_html(self,new_content,old_content,context):
-    # TODO check for truncation? Store differ?
-    old_soup = FullyStrainedSoup(old_content.decode('ascii', 'ignore'))
+    # TODO check for truncation?
+    old_soup = self.load_parsed_baseline(context, old_content, 'html')
     new_soup = FullyStrainedSoup(new_content.decode('ascii', 'ignore'))
     htmldiff = SoupDiffer(old_soup,new_soup)
     html_has_changes = htmldiff.content_changed
@@ -1463,9 +1954,7 @@ class BaseHTTPTest(Test):
 
   def load_original_sha1sum(self, address):
     context = self.address_to_context(address)
-    f = open(context + '.content')
-    old_content = f.read()
-    f.close()
+    old_content = BaselineStore.read(context + '.content')
     return sha(old_content)
 
 # TODO move these somewhere sensible
@@ -1489,6 +1978,12 @@ def is_script_mimetype(mime_type):
   return is_script
 
 class BaseSSLTest(Test):
+  # ssl_file_name -> Lock, for the cert files exit workers share
+  cert_locks = {}
+  cert_locks_lock = threading.Lock()
+  # ssl_file_name -> SSLDomain, so exits share the direct fetches
+  ssl_domains = {}
+
   def __init__(self):
     Test.__init__(self, "SSL", 443)
     self.save_name = "SSLTest"
@@ -1511,6 +2006,15 @@ class BaseSSLTest(Test):
         ret = m.to_addr
     return ret
 
+  def _cert_lock(self, ssl_file_name):
+    BaseSSLTest.cert_locks_lock.acquire()
+    try:
+      if ssl_file_name not in BaseSSLTest.cert_locks:
+        BaseSSLTest.cert_locks[ssl_file_name] = threading.Lock()
+      return BaseSSLTest.cert_locks[ssl_file_name]
+    finally:
+      BaseSSLTest.cert_locks_lock.release()
+
   def _update_cert_list(self, ssl_domain, check_ips):
     changed = False
     for ip in check_ips:
@@ -1530,15 +2034,8 @@ class BaseSSLTest(Test):
         plog('WARN', 'Error dumping cert for '+ssl_domain.domain+":"+ip+" E:"+str(e))
     return changed
 
-  def check_ssl(self, address):
-    ''' check whether an https connection to a given address is molested '''
-    plog('INFO', 'Conducting an ssl test with destination ' + address)
-
-    # an address representation acceptable for a filename (first 20 chars excluding www.)
-    shortaddr = address.replace('www.','',1)[:min(len(address), 20)]
-    address_file = DataHandler.safeFilename(shortaddr)
-    ssl_file_name = ssl_certs_dir + address_file + '.ssl'
-
+  def _resolve(self, address):
+    ''' Return the "ip:port"s to fetch address' certs from directly '''
     if address.rfind(":") != -1:
       # FIXME: %-encoding?
       port = address[address.rfind(":")+1:]
@@ -1547,13 +2044,6 @@ class BaseSSLTest(Test):
       port = 443
       address_name = address
 
-    # load the original cert and compare
-    # if we don't have the original cert yet, get it
-    try:
-      ssl_domain = SnakePickler.load(ssl_file_name)
-    except IOError:
-      ssl_domain = SSLDomain(address)
-
     check_ips = []
     resolved = []
     # Make 3 resolution attempts
@@ -1565,37 +2055,79 @@ class BaseSSLTest(Test):
         plog("NOTICE", "Local resolution failure #%d for %s" % (attempt, address))
 
     for res in resolved:
-      if res[4][0] not in check_ips:
-        check_ips.append(res[4][0]+":"+str(port))
+      ip = res[4][0]+":"+str(port)
+      if ip not in check_ips:
+        check_ips.append(ip)
+    return check_ips
+
+  def _get_ssl_domain(self, address, ssl_file_name, refresh):
+    ''' Return (ssl_domain, refreshed, refetched). The SSLDomain from
+    the last direct fetch of address' certs is used unless it is older
+    than ssl_cache_ttl or refresh is set. Otherwise address is resolved
+    and its certs fetched again, and refreshed is True. ssl_domain is
+    None if address did not resolve. '''
+    # Other exit workers may be updating this cert file too
+    lock = self._cert_lock(ssl_file_name)
+    lock.acquire()
+    try:
+      ssl_domain = BaseSSLTest.ssl_domains.get(ssl_file_name)
+      if not ssl_domain:
+        try:
+          ssl_domain = SnakePickler.load(ssl_file_name)
+        except IOError:
+          pass
+      if ssl_domain and not refresh and \
+         time.time() - ssl_domain.refreshed < ssl_cache_ttl:
+        BaseSSLTest.ssl_domains[ssl_file_name] = ssl_domain
+        return (ssl_domain, False, False)
+
+      check_ips = self._resolve(address)
+      if not check_ips:
+        return (None, True, False)
+
+      # Refresh a copy. Other exit workers may be using this one.
+      if ssl_domain:
+        ssl_domain = copy.deepcopy(ssl_domain)
+      else:
+        ssl_domain = SSLDomain(address)
+      changed = self._update_cert_list(ssl_domain, check_ips)
+
+      refetched = False
+      if ssl_domain.cert_map and ssl_domain.cert_changed:
+        ssl_domain = SSLDomain(address)
+        plog('INFO', 'Fetching all new certs for '+address)
+        changed = self._update_cert_list(ssl_domain, check_ips)
+        refetched = True
+
+      if changed:
+        ssl_domain.refreshed = time.time()
+        baselines.dump(ssl_domain, ssl_file_name)
+        BaseSSLTest.ssl_domains[ssl_file_name] = ssl_domain
+      return (ssl_domain, True, refetched)
+    finally:
+      lock.release()
 
-    if not check_ips:
+  def _check_ssl_domain(self, address, ssl_file_name, ssl_domain, refetched):
+    ''' Return TEST_INCONCLUSIVE, and drop address, if we have no
+    usable certs for it. Otherwise return None. '''
+    if not ssl_domain:
       plog("WARN", "Local resolution failure for "+address)
       self.remove_target(address, INCONCLUSIVE_NOLOCALCONTENT)
       return TEST_INCONCLUSIVE
 
-    if self._update_cert_list(ssl_domain, check_ips):
-      SnakePickler.dump(ssl_domain, ssl_file_name)
-
-    if not ssl_domain.cert_map:
+    if not refetched and not ssl_domain.cert_map:
       plog('WARN', 'Error getting the correct cert for ' + address)
       self.remove_target(address, INCONCLUSIVE_NOLOCALCONTENT)
       return TEST_INCONCLUSIVE
 
-    if ssl_domain.cert_changed:
-      ssl_domain = SSLDomain(address)
-      plog('INFO', 'Fetching all new certs for '+address)
-      if self._update_cert_list(ssl_domain, check_ips):
-        SnakePickler.dump(ssl_domain, ssl_file_name)
+    if refetched:
       if ssl_domain.cert_changed:
         plog("NOTICE", "Fully dynamic certificate host "+address)
 
         result = SSLTestResult(None, "NotStored!", address, ssl_file_name,
                                TEST_INCONCLUSIVE,
                                INCONCLUSIVE_DYNAMICSSL)
-        if self.rescan_nodes:
-          result.from_rescan = True
-        datahandler.saveResult(result)
-        self.results.append(result)
+        self.register_inconclusive(result)
         self.remove_target(address, FALSEPOSITIVE_DYNAMIC)
         return TEST_INCONCLUSIVE
 
@@ -1604,27 +2136,36 @@ class BaseSSLTest(Test):
       result = SSLTestResult(None, "NotStored!", address, ssl_file_name,
                              TEST_INCONCLUSIVE,
                              INCONCLUSIVE_NOLOCALCONTENT)
-      if self.rescan_nodes:
-        result.from_rescan = True
-      datahandler.saveResult(result)
-      self.results.append(result)
+      self.register_inconclusive(result)
       self.remove_target(address, FALSEPOSITIVE_DEADSITE)
       return TEST_INCONCLUSIVE
+    return None
+
+  def check_ssl(self, address):
+    ''' check whether an https connection to a given address is molested '''
+    plog('INFO', 'Conducting an ssl test with destination ' + address)
+
+    # an address representation acceptable for a filename (first 20 chars excluding www.)
+    shortaddr = address.replace('www.','',1)[:min(len(address), 20)]
+    address_file = DataHandler.safeFilename(shortaddr)
+    ssl_file_name = ssl_certs_dir + address_file + '.ssl'
+
+    (ssl_domain, refreshed, refetched) = self._get_ssl_domain(address,
+                                                   ssl_file_name, False)
+    ret = self._check_ssl_domain(address, ssl_file_name, ssl_domain, refetched)
+    if ret is not None:
+      return ret
 
     # get the cert via tor
     (code, cert, exc) = torify(ssl_request, address)
 
-    exit_node = scanhdlr.get_exit_node()
+    exit_node = get_exit_node()
     if not exit_node:
       plog('NOTICE', 'We had no exit node to test, skipping to the next test.')
       result = SSLTestResult(None,
                               address, ssl_file_name, TEST_INCONCLUSIVE,
                               INCONCLUSIVE_NOEXIT)
-      if self.rescan_nodes:
-        result.from_rescan = True
-      self.results.append(result)
-      datahandler.saveResult(result)
-      return TEST_INCONCLUSIVE
+      return self.register_inconclusive(result)
     exit_node = "$"+exit_node.idhex
 
     if not cert:
@@ -1665,6 +2206,17 @@ class BaseSSLTest(Test):
       self.register_exit_failure(result)
       return TEST_FAILURE
 
+    if not refreshed and not ssl_domain.seen_cert(cert_pem):
+      # Our certs may just be older than the exit's. Check before
+      # blaming it.
+      plog("INFO", "Unknown cert for "+address+". Refreshing its certs.")
+      (ssl_domain, refreshed, refetched) = self._get_ssl_domain(address,
+                                                     ssl_file_name, True)
+      ret = self._check_ssl_domain(address, ssl_file_name, ssl_domain,
+                                   refetched)
+      if ret is not None:
+        return ret
+
     # if certs match, everything is ok
     if ssl_domain.seen_cert(cert_pem):
       result = SSLTestResult(self.node_map[exit_node[1:]],
@@ -1724,6 +2276,7 @@ class FixedTargetHTTPTest(FixedTargetTest, BaseHTTPTest):
 
   def add_target(self, target):
     self.targets.add(target[0],[target[1]])
+    self._touch("targets")
 
 class FixedTargetSSLTest(FixedTargetTest, BaseSSLTest):
   def __init__(self, targets):
@@ -1854,6 +2407,7 @@ class SearchBasedTest:
       self.url_reserve[filetype].extend(list(type_urls - set(chosen)))
       type_urls = chosen
 
+    self._touch("url_reserve")
     plog("INFO","Got urls for filetype!")
 
     return type_urls
@@ -1899,6 +2453,7 @@ class SearchBasedHTTPTest(SearchBasedTest, BaseHTTPTest):
 
   def add_target(self, target):
     self.targets.add(target[0],[target[1]])
+    self._touch("targets")
     return True
 
   def get_targets(self):
@@ -2485,23 +3040,21 @@ class DNSRebindScanner(TorCtl.EventHandler):
   def __init__(self, mt, c):
     TorCtl.EventHandler.__init__(self)
     self.__mt = mt
+    self.__nonpublic = AddressRanges(ipv4_nonpublic + ipv6_nonpublic)
     c.set_event_handler(self)
     c.set_events([TorCtl.EVENT_TYPE.STREAM], True)
     self.c=c
 
   def stream_status_event(self, event):
     if event.status == 'REMAP':
-      octets = map(lambda x: int2bin(x).zfill(8), event.target_host.split('.'))
-      ipbin = ''.join(octets)
-      for network in ipv4_nonpublic:
-        if ipbin[:len(network)] == network:
-          handler = DataHandler()
-          node = "$"+self.__mt.get_exit_node().idhex
-          plog("ERROR", "DNS Rebeind failure via "+node)
-
-          result = DNSRebindTestResult(self.__mt.node_manager.idhex_to_r(node),
-                                       '', TEST_FAILURE)
-          handler.saveResult(result)
+      if event.target_host in self.__nonpublic:
+        handler = DataHandler()
+        node = "$"+self.__mt.get_exit_node().idhex
+        plog("ERROR", "DNS Rebeind failure via "+node)
+
+        result = DNSRebindTestResult(self.__mt.node_manager.idhex_to_r(node),
+                                     '', TEST_FAILURE)
+        handler.saveResult(result)
     # TODO: This is currently handled via socks error codes,
     # but stream events would give us more info...
     #elif event.status == "FAILED" or event.status == "CLOSED":
@@ -2547,22 +3100,36 @@ def decompress_response_data(response):
   if not tot_len:
     tot_len = "0"
 
-  def _raise_timeout(signum, frame):
-    raise ReadTimeout("HTTP read timed out")
-  signal.signal(signal.SIGALRM, _raise_timeout)
+  # Decompress as we read, so max_content_size applies to what we
+  # actually keep, and a small compressed body can't inflate without bound
+  if encoding == 'gzip' or encoding == 'x-gzip':
+    decompressor = zlib.decompressobj(16+zlib.MAX_WBITS) # gzip wrapper
+  elif encoding == 'deflate':
+    decompressor = zlib.decompressobj()
+  else:
+    decompressor = None
+
+  # The whole body must be read by the deadline. The socket
+  # NoDNSHTTPConnection made times out its reads when it passes.
+  deadline = _thread_state.deadline
+  if deadline:
+    deadline.restart(read_timeout)
+  else:
+    deadline = Deadline(read_timeout)
 
   start = 0
-  data = ""
+  len_read = 0 # bytes off the wire
+  size = 0 # bytes of content
+  chunks = []
   while True:
-    signal.alarm(int(read_timeout)) # raise a timeout after read_timeout
-    data_read = response.read(500) # Cells are 495 bytes..
-    signal.alarm(0)
+    data_read = response.read(4096)
+    deadline.remaining()
+    now = time.time()
     if not start:
-      start = time.time()
+      start = now
     # TODO: if this doesn't work, check stream observer for
     # lack of progress.. or for a sign we should read..
-    len_read = len(data)
-    now = time.time()
+    len_read += len(data_read)
 
     #plog("DEBUG", "Read "+str(len_read)+"/"+str(tot_len)) #Very verbose
     # Wait 5 seconds before counting data
@@ -2574,36 +3141,101 @@ def decompress_response_data(response):
 
     if not data_read:
       break
-    data += data_read
-
+    if decompressor:
+      # Ask for at most one byte past the limit
+      data_read = decompressor.decompress(data_read, max_content_size-size+1)
+    size += len(data_read)
+    if size > max_content_size:
+      raise MaxContentSizeException("over "+str(max_content_size)+" bytes")
+    chunks.append(data_read)
+
+  if decompressor:
+    chunks.append(decompressor.flush())
+    if size + len(chunks[-1]) > max_content_size:
+      raise MaxContentSizeException("over "+str(max_content_size)+" bytes")
   plog("INFO", "Completed read")
-  if encoding == 'gzip' or encoding == 'x-gzip':
-    return gzip.GzipFile('', 'rb', 9, StringIO.StringIO(data)).read()
-  elif encoding == 'deflate':
-    return StringIO.StringIO(zlib.decompress(data)).read()
-  else:
-    return data
+  return "".join(chunks)
 
 def tor_resolve(address):
   ''' performs a DNS query explicitly via tor '''
-  import commands
-  return commands.getoutput("tor-resolve '%s'" % address)
+  return tor_resolver.resolve(address)
 
-def int2bin(n):
+def tor_resolve_ptr(address):
+  ''' performs a reverse DNS query explicitly via tor '''
+  return tor_resolver.resolve_ptr(address)
+
+def ip2int(address):
   '''
-  simple decimal -> binary conversion, needed for comparing IP addresses
+  convert an IPv4 or IPv6 address to (family, integer), or None if it
+  is neither
   '''
-  n = int(n)
-  if n < 0:
-    raise ValueError, "Negative values are not accepted."
-  elif n == 0:
-    return '0'
-  else:
-    bin = ''
-    while n > 0:
-      bin += str(n % 2)
-      n = n >> 1
-    return bin[::-1]
+  try:
+    if ":" in address:
+      # Drop any scope, as in fe80::1%eth0
+      address = address.split("%", 1)[0]
+      (high, low) = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, address))
+      return (socket.AF_INET6, high << 64 | low)
+    return (socket.AF_INET, struct.unpack("!I", socket.inet_pton(socket.AF_INET, address))[0])
+  except (socket.error, TypeError, ValueError):
+    return None
+
+def parse_range(cidr):
+  '''
+  parse an AddressRanges range to (family, network, host bits)
+  '''
+  if cidr and len(cidr) <= 32 and not cidr.strip("01"):
+    return (socket.AF_INET, int(cidr, 2) << 32 - len(cidr), 32 - len(cidr))
+  parsed = None
+  if cidr.count("/") == 1:
+    (address, bits) = cidr.split("/")
+    parsed = ip2int(address)
+  if not parsed or not bits.isdigit():
+    raise ValueError("Bad network '"+cidr+"': expected an address and prefix length, like 10.0.0.0/8")
+  (family, start) = parsed
+  host_bits = {socket.AF_INET: 32, socket.AF_INET6: 128}[family] - int(bits)
+  if host_bits < 0:
+    raise ValueError("Bad network '"+cidr+"': prefix length is too long")
+  return (family, start, host_bits)
+
+class AddressRanges:
+  '''
+  A set of CIDR ranges, like ipv4_nonpublic, that supports "address in
+  ranges". The ranges are compiled into sorted, merged (start, end)
+  intervals per address family, so a lookup is one bisect. IPv4 mapped
+  IPv6 addresses (::ffff:a.b.c.d) are looked up as IPv4.
+
+  Ranges may also be given in the old ipv4_nonpublic form, the leading
+  bits of the network as a string of 0s and 1s ('00001010' for
+  10.0.0.0/8).
+  '''
+  def __init__(self, cidrs):
+    intervals = {socket.AF_INET: [], socket.AF_INET6: []}
+    for cidr in cidrs:
+      (family, start, host_bits) = parse_range(cidr)
+      start = start >> host_bits << host_bits
+      intervals[family].append((start, start + (1 << host_bits) - 1))
+    self.starts = {}
+    self.ends = {}
+    for family in intervals:
+      merged = []
+      intervals[family].sort()
+      for (start, end) in intervals[family]:
+        if merged and start <= merged[-1][1] + 1:
+          merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+          merged.append((start, end))
+      self.starts[family] = map(lambda i: i[0], merged)
+      self.ends[family] = map(lambda i: i[1], merged)
+
+  def __contains__(self, address):
+    parsed = ip2int(address)
+    if not parsed:
+      return False
+    (family, n) = parsed
+    if family == socket.AF_INET6 and n >> 32 == 0xffff:
+      (family, n) = (socket.AF_INET, n & 0xffffffff)
+    i = bisect.bisect_right(self.starts[family], n) - 1
+    return i >= 0 and n <= self.ends[family][i]
 
 def cleanup(c, l, f):
   plog("INFO", "Resetting __LeaveStreamsUnattached=0 and FetchUselessDescriptors="+f)
@@ -2657,6 +3289,213 @@ def usage():
     print ''
 
 
+def check_finished(tests, fixed_exits, do_rescan):
+  ''' rewind the tests that have run out of nodes, as configured.
+  returns True once every test is done '''
+  all_finished = True
+  for test in tests.itervalues():
+    if not test.finished():
+      all_finished = False
+    else:
+      plog("NOTICE", test.proto+" test has finished all nodes.")
+      datahandler.saveTest(test)
+      if not fixed_exits:
+        test.remove_false_positives()
+      else:
+        plog("NOTICE", "Not removing false positives for fixed-exit scan")
+      if not do_rescan and rescan_at_finish:
+        if not test.toggle_rescan():
+          # Only timestamp as finished after the rescan
+          test.timestamp_results(time.time())
+        test.rewind()
+        all_finished = False
+      elif restart_at_finish:
+        test.timestamp_results(time.time())
+        test.rewind()
+        all_finished = False
+      else:
+        test.timestamp_results(time.time())
+  return all_finished
+
+def pick_exit(tests, skip):
+  ''' choose an exit not in skip, and the tests to run through it.
+  returns (exit idhex, tests), or None '''
+  avail_tests = filter(lambda t: not t.finished(), tests.values())
+  if not avail_tests:
+    return None
+  # As in the serial loop: run a random subset of our tests in random
+  # order, through an exit they have in common if there is one
+  n_tests = random.choice(xrange(1,len(avail_tests)+1))
+  to_run = random.sample(avail_tests, n_tests)
+  common_nodes = reduce(set.intersection, map(lambda t: t.nodes, to_run))
+  common_nodes = common_nodes - skip
+  if not common_nodes and len(to_run) > 1:
+    plog("NOTICE", "No free nodes in common between "+", ".join(map(lambda t: t.proto, to_run)))
+    for test in to_run:
+      nodes = test.nodes - skip
+      if nodes:
+        to_run = [test]
+        common_nodes = nodes
+        break
+  if not common_nodes:
+    return None
+  return (random.choice(list(common_nodes)), to_run)
+
+def run_exit_serially(tests, fixed_exits, do_rescan):
+  ''' the scan loop, one exit at a time '''
+  while 1:
+    avail_tests = tests.values()
+    if scanhdlr.has_new_nodes():
+      plog("INFO", "Got signal for node update.")
+      for test in avail_tests:
+        test.update_nodes()
+      plog("INFO", "Node update complete.")
+
+    # Get as much milage out of each exit as we safely can:
+    # Run a random subset of our tests in random order. Tests that have
+    # finished and were not rewound have nothing left to run.
+    avail_tests = filter(lambda t: not t.finished(), avail_tests)
+    n_tests = random.choice(xrange(1,len(avail_tests)+1))
+
+    to_run = random.sample(avail_tests, n_tests)
+
+    common_nodes = None
+    # Do set intersection and reuse nodes for shared tests
+    for test in to_run:
+      if test.finished():
+        continue
+      if not common_nodes:
+        common_nodes = copy.copy(test.nodes)
+      else:
+        common_nodes &= test.nodes
+      scanhdlr._sanity_check(map(lambda id: test.node_map[id],
+                                             test.nodes))
+    print "COMMON NODES"
+    print common_nodes
+
+    if common_nodes is None:
+      common_nodes = set([])
+
+    current_exit_idhex = scanhdlr.select_exit_from_set(common_nodes)
+    any_avail = bool(current_exit_idhex is not None)
+    if any_avail:
+      plog("DEBUG", "Chose to run "+str(n_tests)+" tests via "+str(current_exit_idhex)+" (tests share "+str(len(common_nodes))+" exit nodes)")
+      for test in to_run:
+        result = test.run_test()
+        if result != TEST_INCONCLUSIVE:
+          test.mark_chosen(current_exit_idhex, result)
+        datahandler.saveTest(test)
+        plog("INFO", test.proto+" test via "+current_exit_idhex+" has result "+str(result))
+        plog("INFO", test.proto+" attempts: "+str(test.tests_run)+".  Completed: "+str(test.total_nodes - test.scan_nodes)+"/"+str(test.total_nodes)+" ("+str(test.percent_complete())+"%)")
+    elif len(to_run) > 1:
+      plog("NOTICE", "No nodes in common between "+", ".join(map(lambda t: t.proto, to_run)))
+      for test in to_run:
+        if test.finished():
+          continue
+        current_exit_idhex = scanhdlr.select_exit_from_set(test.nodes.copy())
+        if current_exit_idhex:
+          any_avail = True
+          result = test.run_test()
+          if result != TEST_INCONCLUSIVE:
+            test.mark_chosen(current_exit_idhex, result)
+          datahandler.saveTest(test)
+          plog("INFO", test.proto+" test via "+current_exit_idhex+" has result "+str(result))
+          plog("INFO", test.proto+" attempts: "+str(test.tests_run)+".  Completed: "+str(test.total_nodes - test.scan_nodes)+"/"+str(test.total_nodes)+" ("+str(test.percent_complete())+"%)")
+        else:
+          plog("INFO", "No available exits for "+test.proto+" test.")
+          continue
+
+    if check_finished(tests, fixed_exits, do_rescan):
+      plog("NOTICE", "All tests have finished. Exiting\n")
+      return
+    if not any_avail:
+      plog("NOTICE", "Not enough exits were available to complete the tests. Exiting")
+      return
+
+def run_exit_workers(tests, fixed_exits, do_rescan):
+  ''' the scan loop for exit_concurrency > 1. Keeps that many exits
+  under test at once, and applies the workers' results here, on the main
+  thread '''
+  writer = Queue.Queue()
+  idle = []
+  for i in xrange(exit_concurrency):
+    worker = ExitWorker(writer)
+    worker.start()
+    idle.append(worker)
+  busy = {} # exit idhex -> worker
+  unavailable = set([]) # exits we could not get since the last node update
+  update_pending = False
+  done_tests = set([])
+
+  while 1:
+    if scanhdlr.has_new_nodes():
+      plog("INFO", "Got signal for node update.")
+      update_pending = True
+    # Node updates and rewinds replace state the workers share with us,
+    # so we let them finish first
+    any_finished = bool(filter(lambda t: t.finished() and t not in done_tests,
+                               tests.values()))
+    if not busy:
+      if update_pending:
+        for test in tests.itervalues():
+          test.update_nodes()
+        unavailable = set([])
+        update_pending = False
+        plog("INFO", "Node update complete.")
+      if any_finished:
+        if check_finished(tests, fixed_exits, do_rescan):
+          plog("NOTICE", "All tests have finished. Exiting\n")
+          return
+        # Whatever is still finished was not rewound, and stays that way
+        done_tests = set(filter(lambda t: t.finished(), tests.values()))
+        any_finished = False
+
+    while idle and not (update_pending or any_finished):
+      choice = pick_exit(tests, unavailable | set(busy))
+      if not choice:
+        break
+      (exit, to_run) = choice
+      worker = idle.pop()
+      worker.exit = exit
+      worker.router = to_run[0].node_map[exit]
+      worker.lost = False
+      busy[exit] = worker
+      plog("DEBUG", "Chose to run "+str(len(to_run))+" tests via "+exit+" ("+str(len(busy))+" exits under test)")
+      worker.jobs.put(to_run)
+
+    if not busy:
+      if update_pending or any_finished:
+        continue
+      plog("NOTICE", "Not enough exits were available to complete the tests. Exiting")
+      return
+
+    (kind, worker, arg) = writer.get()
+    if kind == "error":
+      raise arg[0], arg[1], arg[2]
+    _thread_state.worker = worker
+    try:
+      if kind == "call":
+        (func, args, kwargs) = arg
+        try:
+          worker.replies.put((None, func(*args, **kwargs)))
+        except:
+          worker.replies.put((sys.exc_info(), None))
+      elif kind == "done":
+        if worker.lost:
+          # select_exit_from_set() drops these in the serial loop
+          unavailable.add(worker.exit)
+        for (test, result) in arg:
+          test.tests_run += 1
+          if result != TEST_INCONCLUSIVE:
+            test.mark_chosen(worker.exit, result)
+          datahandler.saveTest(test)
+          plog("INFO", test.proto+" test via "+worker.exit+" has result "+str(result))
+          plog("INFO", test.proto+" attempts: "+str(test.tests_run)+".  Completed: "+str(test.total_nodes - test.scan_nodes)+"/"+str(test.total_nodes)+" ("+str(test.percent_complete())+"%)")
+        del busy[worker.exit]
+        idle.append(worker)
+    finally:
+      _thread_state.worker = None
+
 # main logic
 def main(argv):
   # make sure we have something to test for
@@ -2733,6 +3572,9 @@ def main(argv):
   global datahandler
   datahandler = DataHandler()
 
+  global baselines
+  baselines = BaselineStore(baseline_dir, compress_baselines)
+
   # initiate the passive dns rebind attack monitor
   if do_dns_rebind:
     scanhdlr.check_dns_rebind(data_dir+"tor/control_auth_cookie")
@@ -2766,6 +3608,8 @@ def main(argv):
   if do_http:
     tocheck += [http_content_dir]
     tocheck += [os.path.join(http_data_dir, r) for r in rsubdirs]
+  if do_ssl or do_http:
+    tocheck += [baseline_dir]
   if do_dns_rebind:
     rebind_data_dir = os.path.join(soat_dir, 'dnsrebind')
     tocheck += [os.path.join(rebind_data_dir, r) for r in rsubdirs]
@@ -2788,6 +3632,11 @@ def main(argv):
     plog("ERROR", "Could not create result directories")
     return
 
+  # Drop baselines no test refers to any more
+  (blobs, size) = baselines.gc()
+  if blobs:
+    plog("INFO", "Removed "+str(blobs)+" unused baselines ("+str(size)+" bytes)")
+
   # Initialize tests
   if do_resume:
     if do_ssl:
@@ -2837,96 +3686,10 @@ def main(argv):
       test.rewind()
 
   # start testing
-  while 1:
-    avail_tests = tests.values()
-    if scanhdlr.has_new_nodes():
-      plog("INFO", "Got signal for node update.")
-      for test in avail_tests:
-        test.update_nodes()
-      plog("INFO", "Node update complete.")
-
-    # Get as much milage out of each exit as we safely can:
-    # Run a random subset of our tests in random order
-    n_tests = random.choice(xrange(1,len(avail_tests)+1))
-
-    to_run = random.sample(avail_tests, n_tests)
-
-    common_nodes = None
-    # Do set intersection and reuse nodes for shared tests
-    for test in to_run:
-      if test.finished():
-        continue
-      if not common_nodes:
-        common_nodes = copy.copy(test.nodes)
-      else:
-        common_nodes &= test.nodes
-      scanhdlr._sanity_check(map(lambda id: test.node_map[id],
-                                             test.nodes))
-    print "COMMON NODES"
-    print common_nodes
-
-    if common_nodes is None:
-      common_nodes = set([])
-
-    current_exit_idhex = scanhdlr.select_exit_from_set(common_nodes)
-    any_avail = bool(current_exit_idhex is not None)
-    if any_avail:
-      plog("DEBUG", "Chose to run "+str(n_tests)+" tests via "+str(current_exit_idhex)+" (tests share "+str(len(common_nodes))+" exit nodes)")
-      for test in to_run:
-        result = test.run_test()
-        if result != TEST_INCONCLUSIVE:
-          test.mark_chosen(current_exit_idhex, result)
-        datahandler.saveTest(test)
-        plog("INFO", test.proto+" test via "+current_exit_idhex+" has result "+str(result))
-        plog("INFO", test.proto+" attempts: "+str(test.tests_run)+".  Completed: "+str(test.total_nodes - test.scan_nodes)+"/"+str(test.total_nodes)+" ("+str(test.percent_complete())+"%)")
-    elif len(to_run) > 1:
-      plog("NOTICE", "No nodes in common between "+", ".join(map(lambda t: t.proto, to_run)))
-      for test in to_run:
-        if test.finished():
-          continue
-        current_exit_idhex = scanhdlr.select_exit_from_set(test.nodes.copy())
-        if current_exit_idhex:
-          any_avail = True
-          result = test.run_test()
-          if result != TEST_INCONCLUSIVE:
-            test.mark_chosen(current_exit_idhex, result)
-          datahandler.saveTest(test)
-          plog("INFO", test.proto+" test via "+current_exit_idhex+" has result "+str(result))
-          plog("INFO", test.proto+" attempts: "+str(test.tests_run)+".  Completed: "+str(test.total_nodes - test.scan_nodes)+"/"+str(test.total_nodes)+" ("+str(test.percent_complete())+"%)")
-        else:
-          plog("INFO", "No available exits for "+test.proto+" test.")
-          continue
-
-    # Check each test for rewind
-    all_finished = True
-    for test in tests.itervalues():
-      if not test.finished():
-        all_finished = False
-      else:
-        plog("NOTICE", test.proto+" test has finished all nodes.")
-        datahandler.saveTest(test)
-        if not fixed_exits:
-          test.remove_false_positives()
-        else:
-          plog("NOTICE", "Not removing false positives for fixed-exit scan")
-        if not do_rescan and rescan_at_finish:
-          if not test.toggle_rescan():
-            # Only timestamp as finished after the rescan
-            test.timestamp_results(time.time())
-          test.rewind()
-          all_finished = False
-        elif restart_at_finish:
-          test.timestamp_results(time.time())
-          test.rewind()
-          all_finished = False
-        else:
-          test.timestamp_results(time.time())
-    if all_finished:
-      plog("NOTICE", "All tests have finished. Exiting\n")
-      return
-    if not any_avail:
-      plog("NOTICE", "Not enough exits were available to complete the tests. Exiting")
-      return
+  if exit_concurrency > 1:
+    run_exit_workers(tests, fixed_exits, do_rescan)
+  else:
+    run_exit_serially(tests, fixed_exits, do_rescan)
 
 # initiate the program
 #
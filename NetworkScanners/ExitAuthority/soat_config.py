@@ -27,6 +27,11 @@ ssl_wordlist_file = './wordlist.txt';
 # Number of SSL hosts to scan
 num_ssl_hosts = 10
 
+# Fetch the certs of an SSL host directly (not over Tor) at most this
+# often, in seconds. Exits are compared against the stored certs in
+# between, unless an exit's cert differs from all of them.
+ssl_cache_ttl = 60*60
+
 # Number of HTML urls to scan
 num_html_urls = 10
 
@@ -111,9 +116,19 @@ restart_at_finish = True
 # Kill fetches if they drop below 100bytes/sec on average
 min_rate=100
 
-# Give up if a socket read takes more than this long to complete
+# Give up if a socket read, or reading a whole HTTP response body, takes
+# more than this long to complete
 read_timeout=120.0
 
+# Number of exits to run HTTP and SSL tests through at once. Each exit
+# gets its own worker thread and circuits. 1 keeps the serial scan loop.
+exit_concurrency = 1
+
+# The non-Tor content and certs that tests compare against are stored
+# once per distinct blob under baseline_dir. Set this to zlib compress
+# them there. Use snakeinspector or BaselineStore.read() to view them.
+compress_baselines = False
+
 # Ignore nodes advertising no bandwidth.... (hackish)
 min_node_bw=1024
 
@@ -161,16 +176,29 @@ default_search_mode = google_search_mode
 # Regex of characters we consider unsafe to write to the filesystem
 unsafe_filechars = "[^a-zA-Z0-9-\.+]"
 
-# non-public IPv4 address ranges network portions
+# non-public IPv4 address ranges. The old form, the network's leading
+# bits as a string ('00001010' for 10.0.0.0/8), is also accepted.
 # refer to: www.iana.org/assignments/ipv4-address-space, www.iana.org/assignments/multicast-addresses
 ipv4_nonpublic = [
-  '00000000',     # default route and its network: 0.0.0.0/8
-  '00001010',     # private 10.0.0.0/8
-  '01111111',     # loopback 127.0.0.0/8
-  '1010100111111110', # link-local 169.254.0.0/16
-  '101011000001',   # private 172.16.0.0/12
-  '1100000010101000', # private 192.168.0.0/16
-  '111'         # multicast & experimental 224.0.0.0/3
+  '0.0.0.0/8',      # default route and its network
+  '10.0.0.0/8',     # private
+  '127.0.0.0/8',    # loopback
+  '169.254.0.0/16', # link-local
+  '172.16.0.0/12',  # private
+  '192.168.0.0/16', # private
+  '224.0.0.0/3'     # multicast & experimental
+]
+
+# non-public IPv6 address ranges. IPv4 mapped addresses are checked
+# against ipv4_nonpublic.
+# refer to: www.iana.org/assignments/iana-ipv6-special-registry
+ipv6_nonpublic = [
+  '::/128',         # unspecified
+  '::1/128',        # loopback
+  'fc00::/7',       # unique local
+  'fe80::/10',      # link-local
+  'fec0::/10',      # site-local (deprecated)
+  'ff00::/8'        # multicast
 ]
 
 # The BeautifulSoup Parser we use.
@@ -273,4 +301,5 @@ http_content_dir = soat_dir + 'http/content/'
 http_failed_dir = soat_dir + 'http/failed/'
 http_inconclusive_dir = soat_dir + 'http/inconclusive/'
 http_falsepositive_dir = soat_dir + 'http/falsepositive/'
+baseline_dir = soat_dir + 'baselines/'
 
@@ -39,7 +39,8 @@ class ResultNode:
 
 def main(argv):
   dh = DataHandler()
-  data = dh.getAll()
+  # The index has all we count here, so no results need unpickling
+  data = dh.getRecords()
 
   reason_counts = {}
   nodeResults = {}
@@ -54,19 +55,19 @@ def main(argv):
       rn = ResultNode(result.exit_node)
       nodeResults[result.exit_node] = rn
 
-    tests.add(result.__class__.__name__) 
-    if result.__class__.__name__ not in rn.counts:
-      rn.counts[result.__class__.__name__] = ResultCount(result.__class__.__name__)
+    tests.add(result.result_class) 
+    if result.result_class not in rn.counts:
+      rn.counts[result.result_class] = ResultCount(result.result_class)
 
     if result.status == TEST_SUCCESS:
       rn.total.good += 1
-      rn.counts[result.__class__.__name__].good += 1
+      rn.counts[result.result_class].good += 1
     elif result.status == TEST_INCONCLUSIVE:
       rn.total.inconclusive += 1
-      rn.counts[result.__class__.__name__].inconclusive += 1
+      rn.counts[result.result_class].inconclusive += 1
     elif result.status == TEST_FAILURE:
       rn.total.bad += 1
-      rn.counts[result.__class__.__name__].bad += 1
+      rn.counts[result.result_class].bad += 1
       if result.reason not in reason_counts:
         reason_counts[result.reason] = 1
       else:
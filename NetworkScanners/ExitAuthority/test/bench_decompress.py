@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Benchmark of decompress_response_data against the local server of
+# test_decompress, streaming large bodies as they are, gzipped and
+# deflated: the old reader, which read 500 bytes at a time under
+# SIGALRM, concatenated them and only then decompressed, against
+# decompressing as the body comes in. Both must return the same
+# content. Then a gzip bomb, which the old reader inflated in full.
+#
+# Usage: bench_decompress.py [MB] [bomb MB]
+
+import sys
+import time
+import gzip
+import zlib
+import signal
+import StringIO
+
+from test_decompress import start_server, fetch, body
+import soat
+from TorCtl import TorUtil
+
+# decompress_response_data before it streamed, on the main thread
+def old_decompress(response):
+  encoding = response.info().get("Content-Encoding")
+  def _raise_timeout(signum, frame):
+    raise soat.ReadTimeout("HTTP read timed out")
+  signal.signal(signal.SIGALRM, _raise_timeout)
+  data = ""
+  while True:
+    signal.alarm(int(soat.read_timeout))
+    data_read = response.read(500)
+    signal.alarm(0)
+    if not data_read:
+      break
+    data += data_read
+  if encoding == 'gzip' or encoding == 'x-gzip':
+    return gzip.GzipFile('', 'rb', 9, StringIO.StringIO(data)).read()
+  elif encoding == 'deflate':
+    return zlib.decompress(data)
+  return data
+
+def best(server, path, func, tries=3):
+  times = []
+  for i in xrange(tries):
+    reply = fetch(server, path)
+    t0 = time.time()
+    try:
+      content = func(reply)
+    except soat.MaxContentSizeException:
+      content = None
+    times.append(time.time()-t0)
+  return (content, min(times))
+
+def main(argv):
+  mb = 4
+  bomb_mb = 64
+  if len(argv) > 1: mb = int(argv[1])
+  if len(argv) > 2: bomb_mb = int(argv[2])
+  TorUtil.loglevel = "ERROR"
+  server = start_server()
+  limit = soat.max_content_size
+  try:
+    soat.max_content_size = mb*1024*1024
+    for size in (limit, mb*1024*1024):
+      for encoding in ("identity", "gzip", "deflate"):
+        path = "%s/%d" % (encoding, size)
+        (old, t_old) = best(server, path, old_decompress)
+        (new, t_new) = best(server, path, soat.decompress_response_data)
+        assert old == new == body(size)
+        print "%-8s %5dKB: old %6.1f ms, new %6.1f ms" % \
+              (encoding, size/1024, t_old*1e3, t_new*1e3)
+
+    soat.max_content_size = limit
+    size = bomb_mb*1024*1024
+    path = "bomb/%d" % size
+    wire = len(server.body("bomb", size))
+    (old, t_old) = best(server, path, old_decompress, 1)
+    (new, t_new) = best(server, path, soat.decompress_response_data, 1)
+    assert len(old) == size and new is None
+    print "%dMB gzip bomb (%dKB on the wire): old inflated it all in " \
+          "%.1f ms, new gave up after %dKB in %.1f ms" % \
+          (bomb_mb, wire/1024, t_old*1e3, limit/1024, t_new*1e3)
+  finally:
+    soat.max_content_size = limit
+    server.shutdown()
+    server.server_close()
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# Benchmark of the DataHandler result index over a synthetic tree of
+# saved results: reading the whole tree the way getAll used to, against
+# indexed queries, and the per-query cost of keeping the index in step
+# with the tree. Also checks that the index answers like the tree does,
+# including after results are added and removed behind its back.
+#
+# Usage: bench_index.py [results] [workdir]
+
+import os
+import sys
+import time
+import shutil
+import random
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+sys.path.append(os.path.join(here, "../../.."))
+from libsoat import *
+from TorCtl import TorUtil
+from soat_config import soat_dir as data_dir
+
+class FakeRouter:
+  def __init__(self, i):
+    self.idhex = "%040X" % i
+    self.nickname = "r%d" % i
+    self.ip = i
+    self.contact = "c"
+
+def generate(n):
+  ''' saves n results over 1000 routers and 300 sites, unindexed '''
+  dh = DataHandler()
+  dh._DataHandler__index = False
+  routers = [FakeRouter(i) for i in xrange(1000)]
+  for i in xrange(n):
+    r = random.choice(routers)
+    status = random.choice([TEST_SUCCESS]*6+[TEST_INCONCLUSIVE]*3+[TEST_FAILURE])
+    reason = None
+    if status == TEST_INCONCLUSIVE:
+      reason = INCONCLUSIVE_NOEXIT
+    elif status == TEST_FAILURE:
+      reason = random.choice([FAILURE_EXITONLY, FAILURE_TIMEOUT])
+    k = random.random()
+    if k < 0.6:
+      res = HttpTestResult(r, "http://site%d.example/p.html" % (i % 300),
+                           status, reason)
+    elif k < 0.9:
+      res = SSLTestResult(r, "site%d.example" % (i % 300), "x.ssl", status,
+                          reason)
+    else:
+      res = DNSTestResult(r, "site%d.example" % (i % 300), status)
+    res.timestamp = 1e9+i
+    d = os.path.dirname(dh._DataHandler__resultFilename(res))
+    if not os.path.isdir(d):
+      os.makedirs(d)
+    dh.saveResult(res)
+
+def walk_all():
+  ''' what getAll did before the index '''
+  results = []
+  for root, dirs, files in os.walk(data_dir):
+    for f in files:
+      if f.endswith('.result'):
+        result = SnakePickler.load(os.path.join(root, f))
+        result.rebase(data_dir)
+        results.append(result)
+  return results
+
+def walk_sync(index):
+  ''' what each query paid to check the index before it kept dir mtimes '''
+  on_disk = set(DataHandler()._DataHandler__resultFiles(data_dir))
+  indexed = set([row[0] for row in
+                 index.execute("SELECT filename FROM results")])
+  return on_disk - indexed, indexed - on_disk
+
+def timed(name, f, reps=1):
+  t0 = time.time()
+  for i in xrange(reps):
+    v = f()
+  print "%-44s %9.2fms" % (name, (time.time()-t0)*1000/reps)
+  return v
+
+# getAll rebases the filenames it returns
+def key(r):
+  return (os.path.basename(r.filename), r.exit_node, r.status, r.reason,
+          r.site, r.timestamp)
+
+def main(argv):
+  n = 100000
+  if len(argv) > 1: n = int(argv[1])
+  if len(argv) > 2:
+    work = argv[2]
+    keep = True
+  else:
+    work = tempfile.mkdtemp()
+    keep = False
+  TorUtil.loglevel = "ERROR"
+  random.seed(1)
+  os.chdir(work)
+  try:
+    if not os.path.isdir(data_dir):
+      os.makedirs(data_dir)
+      t0 = time.time()
+      generate(n)
+      print "generated %d results in %.1fs" % (n, time.time()-t0)
+    # Directories changed within RACY_MTIME are listed on every sync
+    time.sleep(DataHandler.RACY_MTIME+0.1)
+    index_file = os.path.join(data_dir, "results.sqlite")
+    if os.path.exists(index_file):
+      os.unlink(index_file)
+    node = "%040X" % 7
+
+    old = timed("getAll by walking the tree", walk_all)
+    timed("filterByNode(getAll)",
+          lambda: DataHandler().filterByNode(walk_all(), node))
+    timed("index build (first query)",
+          lambda: DataHandler().getRecords(exit_node=node))
+    new_node = timed("getResults(exit_node)",
+                     lambda: DataHandler().getResults(exit_node=node), 10)
+    recs = timed("getRecords(statuses, after)",
+                 lambda: DataHandler().getRecords(statuses=[TEST_FAILURE],
+                                                  after=1e9+n/2), 10)
+    index = DataHandler()._DataHandler__openIndex()
+    timed("sync, walking the tree", lambda: walk_sync(index), 3)
+    timed("sync, by directory mtime",
+          lambda: DataHandler()._DataHandler__syncIndex(index), 10)
+
+    assert sorted(map(key, DataHandler().filterByNode(old, node))) \
+           == sorted(map(key, new_node))
+    assert set([key(r) for r in old if r.status == TEST_FAILURE and
+                r.timestamp >= 1e9+n/2]) == set(map(key, recs))
+    assert sorted(map(key, old)) == sorted(map(key, DataHandler().getAll()))
+
+    # Results added and removed without going through saveResult
+    gone = new_node[0].filename
+    os.unlink(gone)
+    added = os.path.join(os.path.dirname(new_node[1].filename),
+                         "copy.result")
+    shutil.copy(new_node[1].filename, added)
+    records = DataHandler().getRecords(exit_node=node)
+    names = set([r.filename for r in records])
+    assert len(records) == len(new_node)
+    assert os.path.normpath(gone) not in names
+    assert os.path.normpath(added) in names
+    print "%d results, %d for one exit: index agrees with the tree" \
+          % (len(old), len(new_node))
+  finally:
+    if not keep:
+      shutil.rmtree(work)
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# Benchmark of JSDiffer.contains_differences over the random scripts of
+# test_jsdiff, with and without the token fingerprint check. Content
+# that only changed the way a dynamic page does takes the fast path;
+# anything else costs the full parse either way.
+#
+# Usage: bench_jsdiff.py [scripts] [statements]
+
+import sys
+import time
+import random
+
+from test_jsdiff import script, mutations, full_parse
+from libsoat import JSDiffer
+from TorCtl import TorUtil
+
+DYNAMIC = ("same", "strings", "numbers", "spacing", "rename")
+
+def main(argv):
+  n = 10
+  statements = 60
+  if len(argv) > 1: n = int(argv[1])
+  if len(argv) > 2: statements = int(argv[2])
+  TorUtil.loglevel = "ERROR"
+  rand = random.Random(20)
+  kb = {}
+  fast = {}
+  full = {}
+  for i in xrange(n):
+    s = script(rand, statements)
+    differ = JSDiffer(s)
+    for (kind, m) in mutations(rand, s):
+      if kind == "garbage":
+        continue # The lexer reports each error on stderr
+      k = kind in DYNAMIC and "dynamic" or "changed"
+      t0 = time.time()
+      a = differ.contains_differences(m)
+      t1 = time.time()
+      b = full_parse(differ, m, "contains_differences")
+      t2 = time.time()
+      assert a == b
+      kb[k] = kb.get(k, 0) + len(m)/1024.0
+      fast[k] = fast.get(k, 0) + t1-t0
+      full[k] = full.get(k, 0) + t2-t1
+  for k in ("dynamic", "changed"):
+    print "%-8s %6.1f KB: full parse %6.1f KB/s, with fingerprints " \
+          "%8.1f KB/s (%.1fx)" % (k, kb[k], kb[k]/full[k], kb[k]/fast[k],
+                                  full[k]/fast[k])
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Benchmark of compare_html and compare_js per comparison, for exit
+# content that differs from the baseline: parsing the baseline again
+# each time, as they used to, against loading the ParsedBaseline that
+# save_compare_data stored with it. Both must give the same verdicts.
+#
+# Usage: bench_parsed.py [exits] [html KB] [js statements]
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from test_jsdiff import script, mutations, page
+import soat
+import libsoat
+from libsoat import JSDiffer, SoupDiffer, FullyStrainedSoup, ParsedBaseline
+from TorCtl import TorUtil
+
+WORDS = ["exit", "relay", "onion", "circuit", "bridge", "consensus",
+         "directory", "guard", "stream", "cell", "hidden", "service"]
+
+def html(rand, kb):
+  ''' a page of about kb KB of nested, linked, scripted markup '''
+  parts = ["<html><head><title>bench</title></head><body>"]
+  size = 0
+  while size < kb*1024:
+    words = " ".join([rand.choice(WORDS) for i in xrange(rand.randrange(5, 30))])
+    k = rand.randrange(4)
+    if k == 0:
+      part = '<div class="%s"><p>%s</p></div>' % (rand.choice(WORDS), words)
+    elif k == 1:
+      part = '<a href="/%s/%d" title="%s">%s</a>' % \
+             (rand.choice(WORDS), rand.randrange(1000), rand.choice(WORDS), words)
+    elif k == 2:
+      part = '<ul><li>%s</li><li id="i%d">%s</li></ul>' % \
+             (words, rand.randrange(1000), rand.choice(WORDS))
+    else:
+      part = '<img src="/img/%d.png" alt="%s"><span>%s</span>' % \
+             (rand.randrange(1000), rand.choice(WORDS), words)
+    parts.append(part)
+    size += len(part)
+  parts.append("</body></html>")
+  return "\n".join(parts)
+
+def html_changes(rand, s, n):
+  ''' n pages, each changed from s the way a dynamic site or a tampering
+      exit might '''
+  changed = []
+  for i in xrange(n):
+    k = i % 3
+    if k == 0:
+      c = s.replace(rand.choice(WORDS), rand.choice(WORDS))
+    elif k == 1:
+      c = s.replace("</body>", page("var x = 1;")+"</body>")
+    else:
+      c = s.replace('href="/', 'href="http://evil.example/', 1)
+    changed.append(c)
+  return changed
+
+# The HTTP test's comparisons, without the rest of the test
+class Comparer:
+  load_parsed_baseline = soat.BaseHTTPTest.load_parsed_baseline.im_func
+  compare_html = soat.BaseHTTPTest.compare_html.im_func
+  compare_js = soat.BaseHTTPTest.compare_js.im_func
+
+# compare_html and compare_js before ParsedBaseline
+def old_compare_html(new_content, old_content):
+  old_soup = FullyStrainedSoup(old_content.decode('ascii', 'ignore'))
+  new_soup = FullyStrainedSoup(new_content.decode('ascii', 'ignore'))
+  if not SoupDiffer(old_soup, new_soup).content_changed:
+    return soat.COMPARE_EQUAL
+  return soat.COMPARE_NOEQUAL
+
+def old_compare_js(new_content, old_content):
+  if not JSDiffer(old_content).contains_differences(new_content):
+    return soat.COMPARE_EQUAL
+  return soat.COMPARE_NOEQUAL
+
+def bench(filetype, baseline, changed, work):
+  context = os.path.join(work, filetype)
+  soat.baselines.dump(ParsedBaseline(baseline, filetype), context+".parsed")
+  comparer = Comparer()
+  new = getattr(comparer, "compare_"+filetype)
+  old = globals()["old_compare_"+filetype]
+  t_old = t_new = 0
+  for c in changed:
+    t0 = time.time()
+    a = old(c, baseline)
+    t1 = time.time()
+    b = new(c, baseline, context)
+    t2 = time.time()
+    assert a == b, (filetype, a, b)
+    t_old += t1-t0
+    t_new += t2-t1
+  n = len(changed)
+  print "%-4s %5.1f KB, %d exits: before %7.1f ms, after %7.1f ms " \
+        "per comparison (%.1fx)" % (filetype, len(baseline)/1024.0, n,
+                                    t_old/n*1e3, t_new/n*1e3, t_old/t_new)
+
+def main(argv):
+  exits = 10
+  kb = 38
+  statements = 300
+  if len(argv) > 1: exits = int(argv[1])
+  if len(argv) > 2: kb = int(argv[2])
+  if len(argv) > 3: statements = int(argv[3])
+  TorUtil.loglevel = "ERROR"
+  rand = random.Random(12)
+  work = tempfile.mkdtemp()
+  try:
+    soat.baselines = libsoat.BaselineStore(os.path.join(work, "store"))
+    s = html(rand, kb)
+    bench("html", s, html_changes(rand, s, exits), work)
+    s = script(rand, statements)
+    # Unchanged content never gets this far, and broken scripts make the
+    # lexer report each error on stderr
+    js = [m for (kind, m) in mutations(rand, s)
+          if kind not in ("same", "truncate", "garbage")]
+    bench("js", s, (js*exits)[:exits], work)
+  finally:
+    shutil.rmtree(work)
+
+if __name__ == '__main__':
+  main(sys.argv)
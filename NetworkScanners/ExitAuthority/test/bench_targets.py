@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Scaling benchmark of the Targets and Test result indexes against the
+# list scans of test_targets: N targets with up to 4 keys each, 10% of
+# them added again and then 10% removed, and R inconclusive results, of
+# which 1% of the sites are dropped with remove_target. Both ways must
+# end with the same targets, keys and results.
+#
+# Usage: bench_targets.py [N ...]
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from test_targets import OldTargets, old_remove_results, contents, site_keys
+from test_checkpoint import ScratchTest
+import soat
+import libsoat
+from TorCtl import TorUtil
+
+def old_remove_target(t, target):
+  ''' remove_target with the list scans, minus its result files '''
+  t.banned_targets.add(target)
+  t.targets.remove(target)
+  for stat in (t.dynamic_fails, t.successes, t.exit_fails, t.connect_fails,
+               t.dns_fails, t.timeout_fails):
+    if target in stat:
+      del stat[target]
+  old_remove_results(t.results, target)
+
+def run(t, n, r, remove_target):
+  ''' times (add+readd, remove 10%, remove_target 1%) on t '''
+  rand = random.Random(15)
+  sites = ["site%d.example" % i for i in xrange(n)]
+  t0 = time.time()
+  for site in sites:
+    t.targets.add(site, site_keys(rand))
+  for site in rand.sample(sites, n/10):
+    t.targets.add(site, site_keys(rand))
+  t1 = time.time()
+  removed = rand.sample(sites, n/10)
+  for site in removed:
+    t.targets.remove(site)
+  t2 = time.time()
+  left = [s for s in sites if s not in set(removed)]
+  for i in xrange(r):
+    t.add_result(libsoat.TestResult(None, rand.choice(left),
+                                    soat.TEST_INCONCLUSIVE))
+  t3 = time.time()
+  for site in rand.sample(left, n/100):
+    remove_target(t, site)
+  t4 = time.time()
+  return (t1-t0, t2-t1, t4-t3)
+
+def main(argv):
+  sizes = [1000, 5000]
+  if len(argv) > 1: sizes = map(int, argv[1:])
+  TorUtil.loglevel = "ERROR"
+  work = tempfile.mkdtemp()+os.sep
+  saved = soat.datahandler
+  try:
+    soat.datahandler = libsoat.DataHandler(work)
+    print "                       add+readd         remove 10%       " \
+          "remove_target 1%"
+    for n in sizes:
+      r = min(10*n, 100000)
+      old = ScratchTest(None)
+      old.targets = OldTargets()
+      old.add_result = old.results.append
+      new = ScratchTest(None)
+      new.get_targets = lambda: []
+      t_old = run(old, n, r, old_remove_target)
+      t_new = run(new, n, r, lambda t, site: t.remove_target(site, "x"))
+      assert contents(old.targets) == contents(new.targets)
+      assert sorted([x.site for x in old.results]) == \
+             sorted([x.site for x in new.results])
+      print "N=%-6d R=%-7d %s" % (n, r, "   ".join(
+            ["%7.1f -> %5.1fms" % (o*1e3, w*1e3)
+             for (o, w) in zip(t_old, t_new)]))
+  finally:
+    soat.datahandler = saved
+    shutil.rmtree(work)
+
+if __name__ == '__main__':
+  main(sys.argv)
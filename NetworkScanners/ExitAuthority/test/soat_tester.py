@@ -1,6 +1,14 @@
+import os
+import sys
+import time
+import shutil
 import socket
+import random
+import struct
+import tempfile
+import StringIO
+import threading
 import SocketServer
-import time
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from OpenSSL import SSL, crypto
 
@@ -34,14 +42,40 @@ class SSLServer(HTTPServer):
     now = time.strftime("%Y%m%d%H%M%S")
     x509.set_notBefore(now + "-1200")
     x509.set_notAfter(now + "+1200")
+    x509.set_issuer(x509.get_subject())
+    x509.sign(pkey, "sha256")
     ctx = SSL.Context(SSL.SSLv23_METHOD)
     ctx.use_privatekey(pkey)
     ctx.use_certificate(x509)
     self.socket = SSL.Connection(ctx, self.socket)
 
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+class ThreadingSSLServer(SocketServer.ThreadingMixIn, SSLServer):
+  daemon_threads = True
+
+class ConnectStallServer(HTTPServer):
+  """ Never accepts connections. Once its backlog is full, connects to it
+      stall, as they would to a firewalled host. """
+  request_queue_size = 0
+  def serve_forever(self):
+    fill = []
+    for i in range(4):
+      s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      s.setblocking(0)
+      try:
+        s.connect(("127.0.0.1", self.server_address[1]))
+      except socket.error:
+        pass
+      fill.append(s)
+    while True:
+      time.sleep(60)
+
 class Tester:
   direct_ip = "127.0.0.1"
   exit_ip = None # By default 
+  stall = 300 # Seconds the Stall testers hang for
 
 class HTTPTester(BaseHTTPRequestHandler, Tester):
   server=HTTPServer
@@ -87,14 +121,324 @@ class HTTPSTester(HTTPTester):
     self.rfile = socket._fileobject(self.connection, "rb", self.rbufsize)
     self.wfile = socket._fileobject(self.connection, "wb", self.wbufsize)
 
+# The Stall testers hang the Tor fetch at one stage, to check that soat's
+# read_timeout deadline catches it there. Each should come out as a
+# timeout after read_timeout seconds, not after --stall seconds.
+class HTTPConnectStallTester(HTTPTester):
+  server=ConnectStallServer
+
+class HTTPHeadersStallTester(HTTPTester):
+  server=ThreadingHTTPServer
+  def tor_GET(self):
+    time.sleep(self.stall)
+    HTTPTester.tor_GET(self)
+
+class HTTPBodyStallTester(HTTPTester):
+  server=ThreadingHTTPServer
+  def tor_GET(self):
+    self.send_response(200)
+    self.send_header("Content-type", "text/html")
+    self.send_header("Content-Length", str(len(TOR_RESP)))
+    self.end_headers()
+    self.wfile.write(TOR_RESP[:len(TOR_RESP)/2])
+    self.wfile.flush()
+    time.sleep(self.stall)
+    self.wfile.write(TOR_RESP[len(TOR_RESP)/2:])
+
+class HTTPSHandshakeStallTester(HTTPSTester):
+  server=ThreadingSSLServer
+  def setup(self):
+    # The handshake happens on our first read. Put it off.
+    if self.client_address[0] != self.direct_ip:
+      time.sleep(self.stall)
+    HTTPSTester.setup(self)
+
+# --compare=<n> runs a small soat scan against local stand-ins, once
+# serially and once with exit_concurrency=n, and checks that every exit
+# gets the same verdicts both ways. The stand-in Tor is a SOCKS server
+# that attaches each stream to the exit set last, as PathBuilder does.
+# One of its exits tampers with HTTP, one swaps the SSL certificate
+# and a few are slow. (The serial loop gives up on a random test's
+# unusable exit, so there are none of those here.)
+class PageTester(HTTPTester):
+  def do_GET(self):
+    self.direct_GET()
+  def log_message(self, *args):
+    pass
+
+class QuietSSLServer(ThreadingSSLServer):
+  # soat's SSL test hangs up after the handshake
+  def handle_error(self, request, client_address):
+    pass
+  def shutdown_request(self, request):
+    self.close_request(request)
+
+class FakeRouter:
+  def __init__(self, i):
+    self.idhex = "%040X" % i
+    self.nickname = "r%d" % i
+    self.ip = i
+    self.contact = ""
+
+class FakeSelectionManager:
+  bad_restrictions = False
+
+class FakeConnection:
+  def get_address_mappings(self, type):
+    return []
+
+class FakeScanHandler:
+  def __init__(self, routers):
+    self.routers = routers
+    self.selmgr = FakeSelectionManager()
+    self.c = FakeConnection()
+    self.exit = None
+  def set_exit_node(self, node):
+    self.exit = node[1:]
+  def new_exit(self):
+    pass
+  def get_exit_node(self):
+    return self.routers.get(self.exit)
+  def has_new_nodes(self):
+    return False
+  def get_nodes_for_port(self, port):
+    return self.routers.values()
+  def _sanity_check(self, routers):
+    pass
+
+def relay(src, dst, mangle=None):
+  try:
+    while True:
+      data = src.recv(4096)
+      if not data: break
+      if mangle: data = mangle(data)
+      dst.sendall(data)
+  except socket.error:
+    pass
+  try:
+    dst.shutdown(socket.SHUT_WR)
+  except socket.error:
+    pass
+
+class FakeTorHandler(SocketServer.BaseRequestHandler):
+  def handle(self):
+    server = self.server
+    c = self.request
+    c.recv(3)
+    c.sendall("\x05\x00")
+    req = c.recv(4)
+    if ord(req[3]) == 3:
+      host = c.recv(ord(c.recv(1)))
+    else:
+      host = socket.inet_ntoa(c.recv(4))
+    port = struct.unpack(">H", c.recv(2))[0]
+    exit = server.scanhdlr.exit
+    if exit in server.bad_ssl and port == server.ssl_port:
+      port = server.mitm_port
+    mangle = None
+    if exit in server.slow:
+      mangle = lambda data: (time.sleep(0.3), data)[1]
+    if exit in server.bad_http:
+      mangle = lambda data: data.replace("It works!", "Tampered!")
+    u = socket._socketobject(socket.AF_INET, socket.SOCK_STREAM)
+    u.connect((host, port))
+    c.sendall("\x05\x00\x00\x01"+socket.inet_aton("127.0.0.1")+"\x00\x00")
+    t = threading.Thread(target=relay, args=(u, c, mangle))
+    t.start()
+    relay(c, u)
+    t.join()
+    u.close()
+
+class FakeTor(SocketServer.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+def serve(server):
+  t = threading.Thread(target=server.serve_forever)
+  t.setDaemon(True)
+  t.start()
+  return server.server_address[1]
+
+def soat_scan(soat, libsoat, tor, urls, ssl_targets, concurrency, seed,
+              work=None):
+  ''' run soat's scan loop to the end, as a freshly started soat would,
+      and return its verdicts. With work, the scan runs in that dir and
+      leaves its data there for the next one. '''
+  keep = work is not None
+  if not keep:
+    work = tempfile.mkdtemp(prefix="soat-compare-")
+  os.chdir(work)
+  dirs = ["http/content", "ssl/certs"]
+  for proto in ["http", "ssl"]:
+    for r in ["confirmed", "falsepositive", "rescan", "successful",
+              "inconclusive", "failed"]:
+      dirs.append(os.path.join(proto, r))
+  for d in dirs:
+    if not os.path.isdir(os.path.join(soat.soat_dir, d)):
+      os.makedirs(os.path.join(soat.soat_dir, d))
+  random.seed(seed)
+  soat.scanhdlr = tor.scanhdlr
+  soat.datahandler = libsoat.DataHandler()
+  soat.baselines = libsoat.BaselineStore(soat.baseline_dir)
+  soat.BaseSSLTest.ssl_domains.clear()
+  soat.num_tests_per_node = 2
+  soat.exit_concurrency = concurrency
+  soat.rescan_at_finish = False
+  soat.restart_at_finish = False
+  tests = {"SSL": soat.FixedTargetSSLTest(ssl_targets)}
+  if urls:
+    tests["HTTP"] = soat.FixedTargetHTTPTest(urls)
+  for test in tests.itervalues():
+    test.rewind()
+  t0 = time.time()
+  stdout = sys.stdout
+  sys.stdout = StringIO.StringIO() # The serial loop prints its exits
+  try:
+    if concurrency > 1:
+      soat.run_exit_workers(tests, [], False)
+    else:
+      soat.run_exit_serially(tests, [], False)
+  finally:
+    sys.stdout = stdout
+  elapsed = time.time()-t0
+  verdicts = {}
+  for (proto, test) in tests.iteritems():
+    for (idhex, results) in test.node_results.iteritems():
+      verdicts[(proto, idhex)] = results
+  results = [(r.__class__.__name__, r.exit_node, r.status, r.reason)
+             for test in tests.itervalues() for r in test.results]
+  results.sort()
+  os.chdir(soat_dir)
+  if not keep:
+    shutil.rmtree(work)
+  return (verdicts, results, elapsed)
+
+def load_soat():
+  global soat_dir
+  soat_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+  os.chdir(soat_dir)
+  sys.path.insert(0, soat_dir)
+  import soat, libsoat
+  return (soat, libsoat)
+
+def fake_tor(soat, routers):
+  ''' start the stand-in Tor, and the SSL server and its MITM, for
+      routers. No exit misbehaves until put in tor.bad_http,
+      tor.bad_ssl or tor.slow. '''
+  from TorCtl import TorUtil
+  tor = FakeTor(("127.0.0.1", 0), FakeTorHandler)
+  tor.scanhdlr = FakeScanHandler(routers)
+  tor.bad_http = set([])
+  tor.bad_ssl = set([])
+  tor.slow = set([])
+  tor.ssl_port = serve(QuietSSLServer(("127.0.0.1", 0), HTTPSTester))
+  tor.mitm_port = serve(QuietSSLServer(("127.0.0.1", 0), HTTPSTester))
+  TorUtil.tor_host = "127.0.0.1"
+  TorUtil.tor_port = serve(tor)
+  FakeScanHandler.select_exit_from_set = \
+      soat.ExitScanHandler.select_exit_from_set.im_func
+  return tor
+
+def compare_concurrency(concurrency, seed=1):
+  (soat, libsoat) = load_soat()
+
+  # Few enough bad exits that remove_false_positives() keeps their results
+  routers = dict([(r.idhex, r) for r in map(FakeRouter, range(1, 25))])
+  ids = sorted(routers)
+  tor = fake_tor(soat, routers)
+  tor.bad_http = set(ids[0:1])
+  tor.bad_ssl = set(ids[1:2])
+  tor.slow = set(ids[2:6])
+  http_port = serve(ThreadingHTTPServer(("127.0.0.1", 0), PageTester))
+  urls = ["http://127.0.0.1:%d/%s.html" % (http_port, p) for p in "ab"]
+  ssl_targets = ["127.0.0.1:%d" % tor.ssl_port]
+
+  (serial, serial_results, serial_time) = soat_scan(soat, libsoat, tor,
+      urls, ssl_targets, 1, seed)
+  (conc, conc_results, conc_time) = soat_scan(soat, libsoat, tor,
+      urls, ssl_targets, concurrency, seed)
+  print "Serial scan: %.2fs, exit_concurrency=%d: %.2fs" % \
+      (serial_time, concurrency, conc_time)
+  same = True
+  for key in sorted(set(serial) | set(conc)):
+    mark = ""
+    if serial.get(key) != conc.get(key):
+      mark = " <-- differs"
+      same = False
+    print "%s %s: %s %s%s" % (key[0], routers[key[1]].nickname,
+        serial.get(key), conc.get(key), mark)
+  if serial_results != conc_results:
+    print "Result files differ:\n  %s\n  %s" % (serial_results, conc_results)
+    same = False
+  # Only the tampering exits should have failed, once per target and run
+  failed = [(r[0], r[1]) for r in serial_results]
+  expected = [("HttpTestResult", idhex) for idhex in tor.bad_http]*4 + \
+             [("SSLTestResult", idhex) for idhex in tor.bad_ssl]*2
+  if sorted(failed) != sorted(expected):
+    print "Unexpected failures:", failed
+    same = False
+  return same
+
+# --ssl-cache=<n> counts the certs soat's SSL test fetches directly
+# (not through Tor) in scans of 24 exits, one of which swaps the
+# certificate: first with ssl_cache_ttl=0, which fetches them for every
+# check as soat did before it cached them, then with the configured TTL,
+# then after a restart within it. Each check through the swapping exit
+# forces a refresh before the exit is blamed, so the restart scans the
+# other exits. (With more swapping exits, remove_false_positives() would
+# drop their results and the cert file with them.)
+def ssl_cache_fetches(concurrency, seed=1):
+  ''' returns (label, direct fetches, SSL checks, verdicts) for each scan '''
+  (soat, libsoat) = load_soat()
+  routers = dict([(r.idhex, r) for r in map(FakeRouter, range(1, 25))])
+  tor = fake_tor(soat, routers)
+  tor.bad_ssl = set(sorted(routers)[0:1])
+  ssl_targets = ["127.0.0.1:%d" % tor.ssl_port]
+
+  fetches = []
+  checks = []
+  ssl_request = soat.ssl_request
+  def counting_ssl_request(address):
+    if issubclass(soat._thread_state.socket, soat.socks.socksocket):
+      checks.append(address)
+    else:
+      fetches.append(address)
+    return ssl_request(address)
+  soat.ssl_request = counting_ssl_request
+  ttl = soat.ssl_cache_ttl
+  uncached = tempfile.mkdtemp(prefix="soat-ssl-cache-")
+  cached = tempfile.mkdtemp(prefix="soat-ssl-cache-")
+  runs = []
+  try:
+    for (label, soat.ssl_cache_ttl, work, honest_only) in \
+        [("ssl_cache_ttl=0", 0, uncached, False),
+         ("ssl_cache_ttl=%d" % ttl, ttl, cached, False),
+         ("restarted within the TTL", ttl, cached, True)]:
+      if honest_only:
+        for idhex in tor.bad_ssl:
+          del tor.scanhdlr.routers[idhex]
+      del fetches[:]
+      del checks[:]
+      (verdicts, results, elapsed) = soat_scan(soat, libsoat, tor, [],
+          ssl_targets, concurrency, seed, work)
+      runs.append((label, len(fetches), len(checks), verdicts))
+  finally:
+    soat.ssl_request = ssl_request
+    soat.ssl_cache_ttl = ttl
+    shutil.rmtree(uncached)
+    shutil.rmtree(cached)
+  return runs
+
 def usage(argv):
   print "Usage: %s --exit=<exit ip> [options]" % argv[0]
+  print "       %s --compare=<exit_concurrency>" % argv[0]
+  print "       %s --ssl-cache=<exit_concurrency>" % argv[0]
 
 if __name__ == '__main__':
   import sys
   import getopt
   try:
-    flags,rest = getopt.getopt(sys.argv[1:], "", ["exit=", "direct=", "test="])
+    flags,rest = getopt.getopt(sys.argv[1:], "", ["exit=", "direct=", "test=", "stall=", "compare=", "ssl-cache="])
   except getopt.GetoptError,err:
     print err
     usage(sys.argv)
@@ -107,6 +451,26 @@ if __name__ == '__main__':
       Tester.direct_ip = val
     elif flag == "--test":
       test = val
+    elif flag == "--stall":
+      Tester.stall = float(val)
+    elif flag == "--compare":
+      if compare_concurrency(int(val)):
+        print "Verdicts match"
+        sys.exit(0)
+      print "Verdicts differ"
+      sys.exit(1)
+    elif flag == "--ssl-cache":
+      runs = ssl_cache_fetches(int(val))
+      for (label, fetches, checks, verdicts) in runs:
+        print "%s: %d SSL checks, %d direct cert fetches" % \
+            (label, checks, fetches)
+      restarted = runs[2][3]
+      if runs[0][3] != runs[1][3] or restarted != \
+         dict([(k, runs[0][3].get(k)) for k in restarted]):
+        print "Verdicts differ"
+        sys.exit(1)
+      print "Verdicts match"
+      sys.exit(0)
 
   tester = globals().get(test+"Tester")
   if not tester:
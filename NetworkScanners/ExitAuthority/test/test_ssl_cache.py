@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# The SSL cert cache against the local TLS stand-in of soat_tester: 24
+# exits, one of which swaps the certificate, checked twice each. Without
+# the cache every check fetches the certs directly. With it, only the
+# first check and the ones that see an unknown cert do, and a restart
+# within ssl_cache_ttl fetches nothing. The verdicts are the same.
+
+import os
+import sys
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+import soat_tester
+from TorCtl import TorUtil
+
+class SSLCacheTest(unittest.TestCase):
+  def setUp(self):
+    TorUtil.loglevel = "ERROR"
+
+  def check(self, concurrency):
+    runs = soat_tester.ssl_cache_fetches(concurrency)
+    # (direct fetches, checks) with no cache, with it, and after a
+    # restart: the 3 are the first check and the swapping exit's two
+    self.assertEqual([r[1:3] for r in runs], [(48, 48), (3, 48), (0, 46)])
+    (uncached, cached, restarted) = [r[3] for r in runs]
+    self.assertEqual(cached, uncached)
+    self.assertEqual(len(restarted), 23)
+    for (key, verdict) in restarted.iteritems():
+      self.assertEqual(verdict, uncached[key])
+
+  def test_serial(self):
+    self.check(1)
+
+  def test_concurrent(self):
+    self.check(4)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# http_request and ssl_request against the Stall testers of soat_tester,
+# each of which hangs a fetch at one stage: the connect, the TLS
+# handshake, the reply headers or the body. Every fetch must come out
+# as E_TIMEOUT once read_timeout has passed, not when the server gives
+# up stalling.
+
+import os
+import sys
+import time
+import socket
+import threading
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+# soat finds its libraries relative to the working directory
+os.chdir(os.path.join(here, ".."))
+sys.path.insert(0, os.getcwd())
+sys.path.append(os.path.join(here, "../../.."))
+import soat
+import soat_tester
+from soat_tester import Tester
+from TorCtl import TorUtil
+
+read_timeout = 1.0
+
+class StallTest(unittest.TestCase):
+  def setUp(self):
+    TorUtil.loglevel = "ERROR"
+    self.saved = (soat.read_timeout, Tester.direct_ip, Tester.stall)
+    soat.read_timeout = read_timeout
+    # Every client gets the stalled (Tor) reply
+    Tester.direct_ip = "0.0.0.0"
+    Tester.stall = 5
+    self.servers = []
+
+  def tearDown(self):
+    for server in self.servers:
+      # ConnectStallServer never serves, so there's no loop to stop
+      if not isinstance(server, soat_tester.ConnectStallServer):
+        server.shutdown()
+      server.server_close()
+    (soat.read_timeout, Tester.direct_ip, Tester.stall) = self.saved
+
+  def serve(self, tester):
+    server = tester.server(("127.0.0.1", 0), tester)
+    self.servers.append(server)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return "127.0.0.1:%d" % server.server_address[1]
+
+  def timed(self, func, address):
+    t0 = time.time()
+    rval = func(address)
+    return (rval, time.time()-t0)
+
+  def check_http(self, tester):
+    address = "http://%s/" % self.serve(tester)
+    (reply, elapsed) = self.timed(soat.http_request, address)
+    self.assertEqual(reply.code, soat.E_TIMEOUT, reply.content)
+    self.assertTrue(read_timeout-0.1 < elapsed < read_timeout+1, elapsed)
+    self.assertEqual(soat._thread_state.deadline, None)
+
+  def check_ssl(self, tester):
+    (rval, elapsed) = self.timed(soat.ssl_request, self.serve(tester))
+    self.assertEqual(rval[0], soat.E_TIMEOUT, rval[2])
+    self.assertTrue(read_timeout-0.1 < elapsed < read_timeout+1, elapsed)
+
+  def test_http_connect(self):
+    self.check_http(soat_tester.HTTPConnectStallTester)
+
+  def test_http_headers(self):
+    self.check_http(soat_tester.HTTPHeadersStallTester)
+
+  def test_http_body(self):
+    self.check_http(soat_tester.HTTPBodyStallTester)
+
+  def test_ssl_connect(self):
+    self.check_ssl(soat_tester.HTTPConnectStallTester)
+
+  def test_ssl_handshake(self):
+    self.check_ssl(soat_tester.HTTPSHandshakeStallTester)
+
+  def test_oversized(self):
+    # A reply turned down by its Content-Length does not leave the
+    # deadline behind for the next request on this thread
+    saved = soat.max_content_size
+    soat.max_content_size = 10
+    try:
+      address = "http://%s/" % self.serve(soat_tester.PageTester)
+      reply = soat.http_request(address)
+    finally:
+      soat.max_content_size = saved
+    self.assertEqual(reply.code, 200)
+    self.assertEqual(reply.content, "")
+    self.assertEqual(soat._thread_state.deadline, None)
+
+if __name__ == '__main__':
+  unittest.main()
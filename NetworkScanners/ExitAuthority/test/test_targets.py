@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# The Targets and Test result indexes: random adds and removals must
+# leave the same targets, keys and results as the list scans they
+# replaced, and a Test pickled before the indexes (revision 8) must
+# come back with them rebuilt, and keep them through removals and a
+# second round trip.
+
+import os
+import sys
+import pickle
+import random
+import shutil
+import tempfile
+import unittest
+
+from test_checkpoint import ScratchTest, differences
+import soat
+import libsoat
+from libsoat import SnakePickler
+from TorCtl import TorUtil
+
+KEYS = ["html", "js", "css", "png"]
+
+# Targets before the index
+class OldTargets:
+  def __init__(self):
+    self.list = []
+    self.lookup = {}
+  def add(self, target, keys=[]):
+    if not target:
+      return
+    for pos,entry in enumerate(self.list):
+      if entry[0] == target:
+        newkeys = set.difference(set(keys),self.list[pos][1])
+        self.list[pos][1].update(newkeys)
+        break
+    else:
+      newkeys = set(keys)
+      self.list.append((target,newkeys))
+    for key in newkeys:
+      try:
+        self.lookup[key].append(target)
+      except KeyError:
+        self.lookup[key] = [target]
+  def remove(self,target):
+    retval = False
+    for pos,entry in enumerate(self.list):
+      if entry[0] == target:
+        for key in self.list[pos][1]:
+          self.lookup[key].remove(target)
+        self.list.pop(pos)
+        retval = True
+        break
+    return retval
+  def bykey(self,key):
+    return self.lookup.get(key,[])
+
+def old_remove_results(results, target):
+  ''' what remove_target did with a site's results before site_results '''
+  kill_results = []
+  for r in results:
+    if r.site == target:
+      kill_results.append(r)
+  for r in kill_results:
+    results.remove(r)
+
+def contents(targets):
+  ''' the targets with their keys, and each key's targets, unordered '''
+  entries = sorted([(t, sorted(keys)) for (t, keys) in targets.list])
+  lookup = sorted([(k, sorted(v)) for (k, v) in targets.lookup.iteritems()])
+  return (entries, lookup)
+
+def check_index(testcase, targets):
+  testcase.assertEqual(sorted(targets.positions.items()),
+                       sorted([(e[0], i) for (i, e) in enumerate(targets.list)]))
+  for (key, lookup) in targets.lookup.iteritems():
+    testcase.assertEqual(sorted(targets.key_positions[key].items()),
+                         sorted([(t, i) for (i, t) in enumerate(lookup)]))
+
+def site_keys(rand):
+  return rand.sample(KEYS, rand.randrange(1, 3))
+
+class TargetsTest(unittest.TestCase):
+  def setUp(self):
+    TorUtil.loglevel = "ERROR"
+    self.saved = (soat.datahandler,)
+    self.work = tempfile.mkdtemp()+os.sep
+    dh = libsoat.DataHandler(self.work)
+    dh.saveResult = lambda result: None
+    soat.datahandler = dh
+
+  def tearDown(self):
+    (soat.datahandler,) = self.saved
+    shutil.rmtree(self.work)
+
+  def test_random_ops(self):
+    rand = random.Random(15)
+    old = OldTargets()
+    new = soat.Targets()
+    sites = ["site%d" % i for i in xrange(300)]
+    for i in xrange(5000):
+      site = rand.choice(sites)
+      if rand.random() < 0.6:
+        keys = site_keys(rand)
+        old.add(site, keys)
+        new.add(site, keys)
+      else:
+        self.assertEqual(new.remove(site), old.remove(site))
+      if i % 500 == 0:
+        check_index(self, new)
+    self.assertEqual(contents(new), contents(old))
+    check_index(self, new)
+    for key in KEYS:
+      self.assertEqual(sorted(new.bykey(key)), sorted(old.bykey(key)))
+
+  def new_test(self, seed, results):
+    rand = random.Random(seed)
+    t = ScratchTest(rand)
+    for i in xrange(200):
+      t.targets.add("site%d" % i, site_keys(rand))
+    for i in xrange(results):
+      r = libsoat.TestResult(None, "site%d" % rand.randrange(200),
+                             rand.choice([0, 1]))
+      t.add_result(r)
+    return t
+
+  def test_remove_target(self):
+    t = self.new_test(15, 2000)
+    old = list(t.results)
+    # Nothing new to refill with, so the targets are only removed
+    t.get_targets = lambda: []
+    for i in xrange(0, 200, 3):
+      site = "site%d" % i
+      t.remove_target(site, "x")
+      old_remove_results(old, site)
+      self.assertEqual(sorted(map(id, t.results)), sorted(map(id, old)))
+      self.assertFalse(site in t.targets.positions)
+    t2 = ScratchTest(None)
+    t2.results = t.results
+    t2.rebuild_derived_state()
+    self.assertEqual(t.result_positions, t2.result_positions)
+    self.assertEqual(sorted(t.site_results), sorted(t2.site_results))
+
+  def test_depickle_upgrade(self):
+    t = self.new_test(16, 1000)
+    fresh = pickle.loads(pickle.dumps(t))
+    fresh.rand = t.rand
+    # As a revision 8 test was pickled: no indexes
+    del t.targets.positions
+    del t.targets.key_positions
+    del t.site_results
+    del t.result_positions
+    t._pickle_revision = 8
+    name = os.path.join(self.work, "test.8")
+    f = file(name, "w")
+    pickle.dump(t, f)
+    f.close()
+    t = SnakePickler.load(name)
+    self.assertEqual(t._pickle_revision, 9)
+    check_index(self, t.targets)
+    self.assertEqual(differences(t, fresh), [])
+    # The indexes stay right through removals
+    t.get_targets = fresh.get_targets = lambda: []
+    for i in xrange(0, 200, 7):
+      t.remove_target("site%d" % i, "x")
+      fresh.remove_target("site%d" % i, "x")
+    check_index(self, t.targets)
+    self.assertEqual(differences(t, fresh), [])
+    # and through a second round trip, which has nothing to upgrade
+    del t.get_targets
+    name = os.path.join(self.work, "test.9")
+    SnakePickler.dump(t, name)
+    t2 = SnakePickler.load(name)
+    self.assertEqual(differences(t2, t), [])
+    self.assertEqual(t2.targets.positions, t.targets.positions)
+    self.assertEqual(t2.targets.key_positions, t.targets.key_positions)
+    site = t2.results[0].site
+    t2.get_targets = lambda: []
+    t2.remove_target(site, "x")
+    check_index(self, t2.targets)
+    self.assertFalse([r for r in t2.results if r.site == site])
+    self.assertEqual(sorted(t2.result_positions.values()),
+                     range(len(t2.results)))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -15,8 +15,11 @@
 
 import re
 import sys
+import math
+import array
 import sched
 import time
+import collections
 import socket
 import atexit
 import threading
@@ -26,6 +29,7 @@ sys.path.append("../")
 from TorCtl import *
 from TorCtl.TorUtil import control_port, control_host
 from TorCtl.TorUtil import *
+import nstable
 
 # Set the version here
 VERSION = "0.0-alpha"
@@ -45,6 +49,18 @@ alpha = .9999
 # to show up on the document
 available_min = 0
 
+# List the maximum and a percentile of each link's per-second
+# throughput over the last 'window' seconds as two more columns
+# on the document. Keeping the samples costs 4 bytes per second of
+# window and 1KB of histogram for every link that has had traffic:
+# about 15KB per link for an hour, over 150MB for 10000 links.
+window_columns = False
+# Window of per-second samples kept for every link (seconds)
+window = 60*60
+# Percentile of the per-second throughput over the window
+# that is listed next to its maximum on the document
+window_percentile = 95
+
 # Global variable marks the start of an interval
 start = time.time()
 # Overall start time
@@ -56,9 +72,102 @@ bw_status = "no status document available yet :(\r\n"
 # Dictionary that contains all stats 
 stats = {}
 stats_lock = threading.Lock()
+# Byte counts from the event handlers, waiting to be added to the stats.
+# The handlers only append and do_work only pops, which are atomic on a
+# deque, so event delivery never waits for the document to be written.
+pending = collections.deque()
 # Dicts that contain mappings
 key_to_name = {}
 name_to_key = {}
+# Network status of each router in the consensus, by idhex
+ns_table = nstable.ConsensusTable()
+
+# Histogram buckets per doubling of a per-second total
+hist_steps = 8
+hist_buckets = 32*hist_steps+1 # Bucket 0 counts the idle seconds
+
+# The bucket a per-second total is counted in. These are called for
+# every second of every link, so they are plain functions.
+def hist_bucket(total):
+  if total <= 0: return 0
+  e = total.bit_length()
+  return min((e-1)*hist_steps + (total*hist_steps >> e-1) - hist_steps + 1,
+             hist_buckets-1)
+
+# The lowest total counted in bucket b
+def hist_bucket_floor(b):
+  if b == 0: return 0
+  (e, k) = divmod(b-1, hist_steps)
+  return (1<<e)*(1.0 + float(k)/hist_steps)
+
+# Per-second totals of the bytes a link read and wrote over the last
+# 'window' seconds. The array is allocated once and reused as a ring.
+# The totals of the closed seconds are also counted in a histogram, so
+# windowed maxima and percentiles cost a walk over its buckets rather
+# than over the whole window.
+class SampleRing:
+  def __init__(self, window, now):
+    self.window = window
+    self.totals = array.array('i', [0])*window
+    self.counts = array.array('i', [0])*hist_buckets
+    self.samples = 0 # closed seconds in the histogram
+    self.peak = 0 # their highest total, or None if it has to be found
+    self.first = self.last = int(now) # the second that is open
+
+  # Close the open second and any idle ones up to sec, which is opened
+  def advance(self, sec):
+    w = self.window
+    totals = self.totals
+    counts = self.counts
+    total = totals[self.last % w]
+    counts[hist_bucket(total)] += 1
+    self.samples += 1
+    if self.peak is not None and total > self.peak: self.peak = total
+    if sec - self.last >= w:
+      # Idle for the whole window: every sample in it is zero
+      self.totals[:] = array.array('i', [0])*w
+      self.counts[:] = array.array('i', [0])*hist_buckets
+      counts[0] = self.samples = w-1
+      self.peak = 0
+    else:
+      # The seconds in between were idle
+      counts[0] += sec-self.last-1
+      self.samples += sec-self.last-1
+      for t in xrange(self.last+1, sec+1):
+        i = t % w
+        # The slot still holds second t-w, which leaves the window
+        if t-w >= self.first:
+          total = totals[i]
+          if total:
+            counts[hist_bucket(total)] -= 1
+            if total == self.peak: self.peak = None
+            totals[i] = 0
+          else:
+            counts[0] -= 1
+          self.samples -= 1
+    self.last = sec
+
+  # The highest per-second total over the window
+  def maximum(self, now):
+    if int(now) > self.last: self.advance(int(now))
+    if self.peak is None:
+      totals = self.totals.tolist()
+      totals[self.last % self.window] = 0 # still open
+      self.peak = max(totals)
+    return self.peak
+
+  # The per-second total that pct percent of the window's seconds are
+  # at or below, to within a bucket (1/steps of its value)
+  def percentile(self, now, pct):
+    peak = self.maximum(now)
+    if not self.samples: return 0
+    above = self.samples - max(int(math.ceil(self.samples*pct/100.0)), 1)
+    b = hist_bucket(peak)
+    while b > 0:
+      above -= self.counts[b]
+      if above < 0: break
+      b -= 1
+    return min(hist_bucket_floor(b), peak)
 
 # We use the same class for recording global stats and link stats
 class LinkBandwidthStats(TorCtl.Router):
@@ -81,6 +190,9 @@ class LinkBandwidthStats(TorCtl.Router):
     self.curr_throughput = 0.0	# avg throughput for the last interval 
     self.max_throughput = 0.0	# throughput max-value
     self.available = 0.0	# max - avg
+    # Per-second samples, allocated on the first traffic if
+    # window_columns is set
+    self.history = None
 
   def read(self, bytes_read):
     self.tot_read += bytes_read
@@ -90,6 +202,28 @@ class LinkBandwidthStats(TorCtl.Router):
     self.tot_written += bytes_written
     self.int_written += bytes_written
 
+  # Count the bytes of an event and add them to the samples of its
+  # second, or of the open second if that one is closed already
+  def record(self, now, bytes_read, bytes_written):
+    self.tot_read += bytes_read
+    self.int_read += bytes_read
+    self.tot_written += bytes_written
+    self.int_written += bytes_written
+    if not window_columns: return
+    h = self.history
+    if h is None:
+      h = self.history = SampleRing(window, now)
+    # Events queued while create_document closed their second are
+    # counted in the open one, since the closed ones are in the histogram
+    if int(now) > h.last: h.advance(int(now))
+    h.totals[h.last % h.window] += bytes_read+bytes_written
+
+  # Max and percentile of the per-second throughput over the window
+  def window_stats(self, now):
+    if self.history is None: return (0, 0)
+    return (self.history.maximum(now),
+            self.history.percentile(now, window_percentile))
+
   # Reset all of the interval counters
   def reset_interval_counters(self):
     self.int_read = 0
@@ -140,8 +274,7 @@ class LinkHandler(TorCtl.EventHandler):
   # Method to handle BW-events for recording total bw
   def bandwidth_event(self, event):
     #plog("NOTICE", "BW-Event: " + str(event.read) + " bytes read, " + str(event.written) + " bytes written")  
-    if event.read: global_stats.read(event.read)
-    if event.written: global_stats.written(event.written)
+    pending.append((global_stats.record, (time.time(), event.read, event.written)))
 
   # Method to handle ORCONN-events
   def or_conn_status_event(self, o): 
@@ -163,36 +296,17 @@ class LinkHandler(TorCtl.EventHandler):
     # If status is READ or WRITE
     elif o.status == "READ" or o.status == "WRITE":
       #plog("DEBUG", o.endpoint + ", read: " + str(o.read_bytes) + " wrote: " + str(o.wrote_bytes))      
-      stats_lock.acquire()
-      # If not in stats: add!
-      if o.endpoint not in stats:
-        stats[o.endpoint] = LinkBandwidthStats()
-        stats[o.endpoint].nickname = o.endpoint
-        plog("NOTICE", "+ Added " + o.endpoint + " to the stats")
-      # Add number of bytes to total and interval
-      if o.read_bytes: stats[o.endpoint].read(o.read_bytes)
-      if o.wrote_bytes: stats[o.endpoint].written(o.wrote_bytes)
-      stats_lock.release()
+      pending.append((count_bytes,
+         (o.endpoint, time.time(), o.read_bytes, o.wrote_bytes)))
       
     # If CLOSED or FAILED  
     elif o.status == "CLOSED" or o.status == "FAILED": 
       # Don't record reasons!
-      stats_lock.acquire()      
-      if o.endpoint not in stats:
-	# Add .. if there will be no traffic it will be removed in the next round
-        stats[o.endpoint] = LinkBandwidthStats()
-        stats[o.endpoint].nickname = o.endpoint
-        plog("NOTICE", "+ Added " + o.endpoint + " to the stats")
+      pending.append((count_closed, (o.endpoint, o.ncircs, o.age)))
       # Add 'running' to status
-      if o.status == "FAILED" and not stats[o.endpoint].down:
+      l = stats.get(o.endpoint)
+      if o.status == "FAILED" and not (l and l.down):
         o.status = o.status + "(Running)"
-      # 'Total' stats	
-      stats[o.endpoint].tot_ncircs += o.ncircs
-      stats[o.endpoint].tot_count += 1
-      if o.age: stats[o.endpoint].tot_age += o.age
-      #if o.read_bytes: stats[o.endpoint].tot_read += o.read_bytes
-      #if o.wrote_bytes: stats[o.endpoint].tot_wrote += o.wrote_bytes      
-      stats_lock.release()
 
       # This is only for constructing debug output
       if o.age: age = "AGE="+str(o.age)
@@ -209,16 +323,42 @@ class LinkHandler(TorCtl.EventHandler):
 
   # NS-EventHandler methods
   def ns_event(self, n):
+    ns_table.update(n.nslist)
     read_routers(self.c, n.nslist)
- 
+
+  def new_consensus_event(self, n):
+    ns_table.set_consensus(n.nslist)
+
   def new_desc_event(self, d):
-    for i in d.idlist: # Is this too slow?
-      read_routers(self.c, self.c.get_network_status("id/"+i))
+    read_routers(self.c, ns_table.get_statuses(self.c, d.idlist))
 
-# Sort a list by a specified key
-def sort_list(list, key):
-  list.sort(lambda x,y: cmp(key(y), key(x))) # Python < 2.4 hack
-  return list
+# Get the stats of a link, add it if not there
+# (Requires stats_lock.acquire())
+def get_link(endpoint):
+  if endpoint not in stats:
+    stats[endpoint] = LinkBandwidthStats()
+    stats[endpoint].nickname = endpoint
+    plog("NOTICE", "+ Added " + endpoint + " to the stats")
+  return stats[endpoint]
+
+# Add number of bytes to total, interval and samples
+def count_bytes(endpoint, now, bytes_read, bytes_written):
+  get_link(endpoint).record(now, bytes_read, bytes_written)
+
+# 'Total' stats of a closed connection
+# Add .. if there will be no traffic it will be removed in the next round
+def count_closed(endpoint, ncircs, age):
+  l = get_link(endpoint)
+  l.tot_ncircs += ncircs
+  l.tot_count += 1
+  if age: l.tot_age += age
+
+# Apply what the handlers queued so far
+# (Requires stats_lock.acquire())
+def apply_pending():
+  for i in xrange(len(pending)):
+    (func, args) = pending.popleft()
+    func(*args)
 
 # Write document to file f
 def write_file(f):
@@ -239,6 +379,8 @@ def read_routers(c, nslist):
         if stats[ns.nickname].idhex != r.idhex:
           plog("NOTICE", "Router "+r.nickname+" has multiple keys: "
              +stats[ns.nickname].idhex+" and "+r.idhex)
+        # Keep the samples across descriptor updates
+        r.history = stats[ns.nickname].history
       stats[r.nickname] = r # XXX: We get names only from ORCONN :(
     except TorCtl.ErrorReply:
       bad_key += 1
@@ -270,22 +412,29 @@ def update_stats(elapsed):
 #      - No, avail==0 means new max, but not nothing available!
 #  - clustering/classification?
 def create_document():
-  new_status = ""
+  now = time.time()
+  lines = []
   # Fill in global_stats
-  new_status += str(global_stats.available) + " "
-  new_status += str(global_stats.max_throughput) + " "
-  new_status += str(global_stats.curr_throughput) + "\r\n"    
+  line = "%s %s %s" % (global_stats.available, global_stats.max_throughput,
+     global_stats.curr_throughput)
+  if window_columns:
+    line += " %s %s" % global_stats.window_stats(now)
+  lines.append(line+"\r\n")
   # Sort the document for available
-  key = lambda x: x.available
-  links_sorted = sort_list(stats.values(), key)  
+  links_sorted = stats.values()
+  links_sorted.sort(key=lambda x: x.available, reverse=True)
   for l in links_sorted:
     # Cutoff at available_min
-    if key(l) >= available_min and l.nickname != "AllClients:HASH":
-      new_status += l.nickname + " " + str(key(l)) + " "      
-      new_status += str(l.max_throughput) + " " + str(l.curr_throughput) + "\r\n"      
+    if l.available < available_min: break
+    if l.nickname != "AllClients:HASH":
+      line = "%s %s %s %s" % (l.nickname, l.available, l.max_throughput,
+         l.curr_throughput)
+      if window_columns:
+        line += " %s %s" % l.window_stats(now)
+      lines.append(line+"\r\n")
   # Critical: Exchange global bw_status document
   global bw_status
-  bw_status = new_status
+  bw_status = "".join(lines)
 
 # This is the method where the main work is done
 # Schedule the call every 'interval' seconds
@@ -297,6 +446,8 @@ def do_work(s):
 
   # Acquire lock
   stats_lock.acquire()
+  # Count the events since the last interval
+  apply_pending()
   # Update stats
   update_stats(elapsed)
   # Create the document
@@ -316,6 +467,7 @@ def do_work(s):
 def start_sched(c):
   # Ge the network status
   nslist = c.get_network_status()
+  ns_table.set_consensus(nslist)
   read_routers(c, nslist)  
   # Setup scheduler
   s = sched.scheduler(time.time, time.sleep)
@@ -372,6 +524,7 @@ def main(argv):
   c.set_events([TorCtl.EVENT_TYPE.ORCONN, 
                 TorCtl.EVENT_TYPE.BW, 
                 TorCtl.EVENT_TYPE.NS, 
+                TorCtl.EVENT_TYPE.NEWCONSENSUS, 
                 TorCtl.EVENT_TYPE.NEWDESC], True)
   # TODO: Set extra-info for descriptor here
   # Start server thread
@@ -5,6 +5,7 @@
 Nodemon - Tor node monitor
 """
 
+import os
 import sys
 sys.path.append("../")
 from TorCtl import *
@@ -13,8 +14,11 @@ import traceback
 import re
 from TorCtl.TorUtil import control_port, control_host
 from TorCtl.TorUtil import *
+import nstable
 import sched, time
 import thread
+import bisect
+import collections
 
 class Reason:
   def __init__(self, reason): self.reason = reason
@@ -40,8 +44,15 @@ class RouterStats(TorCtl.Router):
 
 errors = {}
 errors_lock = thread.allocate_lock()
+# ORCONN counts queued by NodeHandler for save_stats to apply. Appending
+# and popping a deque are atomic, so the handler takes no lock.
+pending = collections.deque()
+# Nicknames of the routers whose stats changed since the last save_stats
+changed = set()
 key_to_name = {}
 name_to_key = {}
+# Network status of each router in the consensus, by idhex
+ns_table = nstable.ConsensusTable()
 
 # TODO: Move these to config file
 max_detach = 3
@@ -59,6 +70,7 @@ def read_routers(c, nslist):
           plog("NOTICE", "Router "+r.nickname+" has multiple keys: "
              +errors[ns.nickname].idhex+" and "+r.idhex)
       errors[r.nickname] = r # XXX: We get names only from ORCONN :(
+      changed.add(r.nickname)
     except TorCtl.ErrorReply:
       bad_key += 1
       if "Running" in ns.flags:
@@ -89,35 +101,16 @@ class NodeHandler(TorCtl.EventHandler):
 
     if o.status == "READ" or o.status == "WRITE":
       #plog("DEBUG", "Read: " + str(read) + " wrote: " + str(wrote))
-      errors_lock.acquire()
-      if o.endpoint not in errors:
-        plog("NOTICE", "Buh?? No "+o.endpoint)
-        errors[o.endpoint] = RouterStats()
-        errors[o.endpoint].nickname = o.endpoint
-      errors[o.endpoint].running_read += o.read_bytes
-      errors[o.endpoint].running_wrote += o.wrote_bytes
-      errors_lock.release()
+      pending.append((count_bytes, (o.endpoint, o.read_bytes, o.wrote_bytes)))
 
       
     if o.status == "CLOSED" or o.status == "FAILED":
-      errors_lock.acquire()
-      if o.endpoint not in errors:
-        plog("NOTICE", "Buh?? No "+o.endpoint)
-        errors[o.endpoint] = RouterStats()
-        errors[o.endpoint].nickname = o.endpoint
-      if o.status == "FAILED" and not errors[o.endpoint].down:
+      r = errors.get(o.endpoint)
+      if o.status == "FAILED" and not (r and r.down):
         o.status = o.status + "(Running)"
       o.reason = o.status+":"+o.reason
-      if o.reason not in errors[o.endpoint].reasons:
-        errors[o.endpoint].reasons[o.reason] = Reason(o.reason)
-      errors[o.endpoint].reasons[o.reason].ncircs += o.ncircs
-      errors[o.endpoint].reasons[o.reason].count += 1
-      errors[o.endpoint].tot_ncircs += o.ncircs
-      errors[o.endpoint].tot_count += 1
-      if o.age: errors[o.endpoint].tot_age += o.age
-      if o.read_bytes: errors[o.endpoint].tot_read += o.read_bytes
-      if o.wrote_bytes: errors[o.endpoint].tot_wrote += o.wrote_bytes
-      errors_lock.release()
+      pending.append((count_closed, (o.endpoint, o.reason, o.ncircs, o.age,
+                                     o.read_bytes, o.wrote_bytes)))
     else: return
 
     if o.age: age = "AGE="+str(o.age)
@@ -135,73 +128,138 @@ class NodeHandler(TorCtl.EventHandler):
                reason, ncircs)))
 
   def ns_event(self, n):
+    ns_table.update(n.nslist)
     read_routers(self.c, n.nslist)
- 
+
+  def new_consensus_event(self, n):
+    ns_table.set_consensus(n.nslist)
+
   def new_desc_event(self, d):
-    for i in d.idlist: # Is this too slow?
-      read_routers(self.c, self.c.get_network_status("id/"+i))
+    read_routers(self.c, ns_table.get_statuses(self.c, d.idlist))
 
-def bw_stats(key, f):
-  routers = errors.values()
-  routers.sort(lambda x,y: cmp(key(y), key(x))) # Python < 2.4 hack
+# Requires errors_lock.acquire()
+def get_router(endpoint):
+  if endpoint not in errors:
+    plog("NOTICE", "Buh?? No "+endpoint)
+    errors[endpoint] = RouterStats()
+    errors[endpoint].nickname = endpoint
+  changed.add(endpoint)
+  return errors[endpoint]
 
-  for r in routers:
-    f.write(r.nickname+"="+str(key(r))+"\n")
-  
-  f.close()
-  
-    
-def save_stats(s):
-  errors_lock.acquire()
-  # Yes yes, adding + 0.005 to age is bloody.. but who cares,
+def count_bytes(endpoint, read_bytes, wrote_bytes):
+  r = get_router(endpoint)
+  r.running_read += read_bytes
+  r.running_wrote += wrote_bytes
+
+def count_closed(endpoint, reason, ncircs, age, read_bytes, wrote_bytes):
+  r = get_router(endpoint)
+  if reason not in r.reasons:
+    r.reasons[reason] = Reason(reason)
+  r.reasons[reason].ncircs += ncircs
+  r.reasons[reason].count += 1
+  r.tot_ncircs += ncircs
+  r.tot_count += 1
+  if age: r.tot_age += age
+  if read_bytes: r.tot_read += read_bytes
+  if wrote_bytes: r.tot_wrote += wrote_bytes
+
+# Apply the counts NodeHandler queued since the last call
+# Requires errors_lock.acquire()
+def apply_pending():
+  for i in xrange(len(pending)):
+    (func, args) = pending.popleft()
+    func(*args)
+
+# A stats file with one entry per router. The entries are kept sorted
+# as routers change, and the file is only rewritten if one of them did.
+class StatsFile:
+  def __init__(self, fname, key):
+    self.fname = fname
+    self.key = key
+    self.entries = [] # (sort key, nickname, text), sorted
+    self.by_name = {}
+    self.dirty = True
+
+  # Routers sorted by key, highest first
+  def entry(self, r):
+    k = self.key(r)
+    return (-k, r.nickname, r.nickname+"="+str(k)+"\n")
+
+  def update(self, r):
+    e = self.entry(r)
+    old = self.by_name.get(r.nickname)
+    if e == old: return
+    if old is not None:
+      del self.entries[bisect.bisect_left(self.entries, old)]
+    bisect.insort(self.entries, e)
+    self.by_name[r.nickname] = e
+    self.dirty = True
+
+  # Replace the file in one rename, so readers never see half of it
+  def write(self):
+    if not self.dirty: return
+    f = file(self.fname+".tmp", "w")
+    f.write("".join([e[2] for e in self.entries]))
+    f.close()
+    os.rename(self.fname+".tmp", self.fname)
+    self.dirty = False
+
+class ReasonsFile(StatsFile):
+  def __init__(self, fname):
+    StatsFile.__init__(self, fname, None)
+
+  # Routers by circuits closed, or by connections closed if neither had any
+  def entry(self, r):
+    if r.tot_ncircs: k = (-r.tot_ncircs, 0)
+    else: k = (0, -r.tot_count)
+    text = [r.nickname+" " +str(r.tot_ncircs)+"/"+str(r.tot_count)+"\n"]
+    for reason in r.reasons.itervalues():
+      text.append("\t"+reason.reason+" "+str(reason.ncircs)+
+           "/"+str(reason.count)+"\n")
+    return (k, r.nickname, "".join(text))
+
+# Yes yes, adding + 0.005 to age is bloody.. but who cares,
+stats_files = [
   #  1. Routers sorted by bytes read
-  bw_stats(lambda x: x.tot_read, file("./data/nodemon/r_by_rbytes", "w"))
+  StatsFile("./data/nodemon/r_by_rbytes", lambda x: x.tot_read),
   #  2. Routers sorted by bytes written
-  bw_stats(lambda x: x.tot_wrote, file("./data/nodemon/r_by_wbytes", "w"))
+  StatsFile("./data/nodemon/r_by_wbytes", lambda x: x.tot_wrote),
   #  3. Routers sorted by tot bytes
-  bw_stats(lambda x: x.tot_read+x.tot_wrote,
-     file("./data/nodemon/r_by_tbytes", "w"))
+  StatsFile("./data/nodemon/r_by_tbytes", lambda x: x.tot_read+x.tot_wrote),
   #  4. Routers sorted by downstream bw
-  bw_stats(lambda x: x.tot_read/(x.tot_age+0.005),
-     file("./data/nodemon/r_by_rbw", "w"))
+  StatsFile("./data/nodemon/r_by_rbw",
+     lambda x: x.tot_read/(x.tot_age+0.005)),
   #  5. Routers sorted by upstream bw
-  bw_stats(lambda x: x.tot_wrote/(x.tot_age+0.005),
-      file("./data/nodemon/r_by_wbw", "w"))
+  StatsFile("./data/nodemon/r_by_wbw",
+     lambda x: x.tot_wrote/(x.tot_age+0.005)),
   #  6. Routers sorted by total bw
-  bw_stats(lambda x: (x.tot_read+x.tot_wrote)/(x.tot_age+0.005),
-      file("./data/nodemon/r_by_tbw", "w"))
-
-  bw_stats(lambda x: x.running_read,
-      file("./data/nodemon/r_by_rrunbytes", "w"))
-  bw_stats(lambda x: x.running_wrote,
-      file("./data/nodemon/r_by_wrunbytes", "w"))
-  bw_stats(lambda x: x.running_read+x.running_wrote,
-      file("./data/nodemon/r_by_trunbytes", "w"))
-  
-  
-  f = file("./data/nodemon/reasons", "w")
-  routers = errors.values()
-  def notlambda(x, y):
-    if y.tot_ncircs or x.tot_ncircs:
-      return cmp(y.tot_ncircs, x.tot_ncircs)
-    else:
-      return cmp(y.tot_count, x.tot_count)
-  routers.sort(notlambda)
+  StatsFile("./data/nodemon/r_by_tbw",
+     lambda x: (x.tot_read+x.tot_wrote)/(x.tot_age+0.005)),
 
-  for r in routers:
-    f.write(r.nickname+" " +str(r.tot_ncircs)+"/"+str(r.tot_count)+"\n")
-    for reason in r.reasons.itervalues():
-      f.write("\t"+reason.reason+" "+str(reason.ncircs)+
-           "/"+str(reason.count)+"\n")
+  StatsFile("./data/nodemon/r_by_rrunbytes", lambda x: x.running_read),
+  StatsFile("./data/nodemon/r_by_wrunbytes", lambda x: x.running_wrote),
+  StatsFile("./data/nodemon/r_by_trunbytes",
+     lambda x: x.running_read+x.running_wrote),
 
+  ReasonsFile("./data/nodemon/reasons")]
+
+def save_stats(s):
+  errors_lock.acquire()
+  apply_pending()
+  for name in changed:
+    r = errors[name]
+    for sf in stats_files: sf.update(r)
+  changed.clear()
   errors_lock.release()
-  f.close()
+  # The files are only touched from here, so no need to hold the lock
+  for sf in stats_files: sf.write()
   s.enter(60, 1, save_stats, (s,))
 
 
 def startmon(c):
   global key_to_name, name_to_key
   nslist = c.get_network_status()
+  ns_table.set_consensus(nslist)
   read_routers(c, nslist)
   
   s=sched.scheduler(time.time, time.sleep)
@@ -219,6 +277,7 @@ def main(argv):
   c.authenticate()
   c.set_events([TorCtl.EVENT_TYPE.ORCONN,
           TorCtl.EVENT_TYPE.NS,
+          TorCtl.EVENT_TYPE.NEWCONSENSUS,
           TorCtl.EVENT_TYPE.NEWDESC], True)
   startmon(c)
 
@@ -0,0 +1,45 @@
+"""
+Network statuses of the routers in the consensus, for looking up the
+ids of NEWDESC events without asking Tor for each one
+"""
+
+from TorCtl import TorCtl
+from TorCtl.TorUtil import plog
+
+class ConsensusTable:
+  def __init__(self):
+    self.statuses = {} # by idhex
+
+  # Replace the table with the statuses of a new consensus
+  def set_consensus(self, nslist):
+    self.statuses = dict([(ns.idhex, ns) for ns in nslist])
+
+  # Statuses from NS events replace the ones we have
+  def update(self, nslist):
+    for ns in nslist:
+      self.statuses[ns.idhex] = ns
+
+  # The statuses of ids (from a NEWDESC event). The ones not in the
+  # table are asked for in one GETINFO. Tor refuses all of it if one
+  # id has no status, so ask for them one by one in that case.
+  def get_statuses(self, c, ids):
+    nslist = []
+    unknown = []
+    for i in ids:
+      i = i.lstrip("$")[:40]
+      if i in self.statuses: nslist.append(self.statuses[i])
+      else: unknown.append(i)
+    if not unknown: return nslist
+    found = []
+    try:
+      info = c.get_info(" ".join(["ns/id/"+i for i in unknown]))
+      for body in info.itervalues():
+        found.extend(TorCtl.parse_ns_body(body))
+    except TorCtl.ErrorReply:
+      for i in unknown:
+        try:
+          found.extend(c.get_network_status("id/"+i))
+        except TorCtl.ErrorReply, e:
+          plog("INFO", "No network status for "+i+": "+str(e))
+    self.update(found)
+    return nslist+found
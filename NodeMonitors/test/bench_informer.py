@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Benchmark of bw-informer's event counting and document build: BW and
+# ORCONN READ/WRITE events for a few thousand busy links on a simulated
+# clock, with and without the windowed max and percentile columns.
+# Events are timed from the handler call through apply_pending.
+#
+# Usage: bench_informer.py [links [seconds [events_per_link_sec [window]]]]
+
+import gc
+import sys
+import time
+import random
+
+import fixtures
+from fixtures import FakeConnection, FakeScheduler, FakeStatus, Event
+
+class Clock:
+  now = 1.0e9
+  def time(self):
+    return Clock.now
+
+def rss_mb():
+  return int(open("/proc/self/statm").read().split()[1])*4/1024
+
+def run(links, seconds, per_link, window, columns):
+  bw = fixtures.load("bw-informer")
+  bw.time = Clock()
+  bw.window = window
+  bw.window_columns = columns
+  Clock.now = 1.0e9
+  bw.read_routers(FakeConnection(), [FakeStatus(i) for i in xrange(links)])
+  handler = bw.LinkHandler(FakeConnection())
+  rand = random.Random(22)
+  # Traffic is heavily skewed towards a few links
+  names = ["r%d" % int(rand.random()**2*links) for i in xrange(100000)]
+  events = []
+  for name in names:
+    o = Event()
+    o.endpoint = name
+    o.event_name = "ORCONN"
+    o.status = rand.choice(("READ", "WRITE"))
+    o.read_bytes = o.status == "READ" and rand.randrange(20000) or 0
+    o.wrote_bytes = o.status == "WRITE" and rand.randrange(20000) or 0
+    events.append(o)
+  b = Event()
+  b.read = 500000
+  b.written = 400000
+  per_sec = int(links*per_link)
+  gc.collect()
+  rss = rss_mb()
+  event_time = 0.0
+  nevents = 0
+  docs = []
+  k = 0
+  for sec in xrange(seconds):
+    t0 = time.time()
+    Clock.now = 1.0e9 + sec
+    handler.bandwidth_event(b)
+    for j in xrange(per_sec):
+      Clock.now = 1.0e9 + sec + float(j)/per_sec
+      handler.or_conn_status_event(events[k])
+      k = (k+1) % len(events)
+    bw.stats_lock.acquire()
+    bw.apply_pending()
+    bw.stats_lock.release()
+    event_time += time.time()-t0
+    nevents += per_sec+1
+    if (sec+1) % bw.interval == 0:
+      t0 = time.time()
+      bw.start = Clock.now - bw.interval
+      bw.do_work(FakeScheduler())
+      docs.append(time.time()-t0)
+  gc.collect()
+  print "%-7s %5d links %5ds: %5.2f us/event, do_work %4.0f ms mean " \
+        "%4.0f ms max, rss +%d MB, %d byte document" % \
+        (columns and "columns" or "plain", links, seconds,
+         event_time/nevents*1e6, sum(docs)/len(docs)*1e3, max(docs)*1e3,
+         rss_mb()-rss, len(bw.bw_status))
+
+def main(argv):
+  links = 10000
+  seconds = 200
+  per_link = 2
+  window = 60*60
+  if len(argv) > 1: links = int(argv[1])
+  if len(argv) > 2: seconds = int(argv[2])
+  if len(argv) > 3: per_link = float(argv[3])
+  if len(argv) > 4: window = int(argv[4])
+  tmp = fixtures.scratch_dir()
+  try:
+    for columns in (False, True):
+      run(links, seconds, per_link, window, columns)
+  finally:
+    fixtures.remove_scratch(tmp)
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Benchmark of nodemon's save_stats with a large consensus: a busy
+# first pass, then passes with only a few routers touched in between,
+# then a pass with none. Each pass is timed against a full re-sort and
+# rewrite of every file, the way save_stats used to do it. Both must
+# write the same lines, in order of their keys.
+#
+# Usage: bench_stats.py [routers [passes [touched]]]
+
+import os
+import sys
+import time
+import random
+
+import fixtures
+from fixtures import FakeConnection, FakeScheduler, FakeStatus
+
+# save_stats before StatsFile: every router is sorted and written to
+# every file, here to fname+".old"
+def resort_stats(m):
+  m.errors_lock.acquire()
+  m.apply_pending()
+  for sf in m.stats_files:
+    f = file(sf.fname+".old", "w")
+    routers = m.errors.values()
+    if isinstance(sf, m.ReasonsFile):
+      def notlambda(x, y):
+        if y.tot_ncircs or x.tot_ncircs:
+          return cmp(y.tot_ncircs, x.tot_ncircs)
+        else:
+          return cmp(y.tot_count, x.tot_count)
+      routers.sort(notlambda)
+      for r in routers:
+        f.write(r.nickname+" " +str(r.tot_ncircs)+"/"+str(r.tot_count)+"\n")
+        for reason in r.reasons.itervalues():
+          f.write("\t"+reason.reason+" "+str(reason.ncircs)+
+               "/"+str(reason.count)+"\n")
+    else:
+      key = sf.key
+      routers.sort(lambda x,y: cmp(key(y), key(x)))
+      for r in routers:
+        f.write(r.nickname+"="+str(key(r))+"\n")
+    f.close()
+  m.errors_lock.release()
+
+# The entries of a stats file with the key each is sorted by, in file
+# order. A reasons file entry runs on to its reason lines.
+def entries(fname, reasons):
+  text = file(fname).read()
+  if reasons:
+    blocks = text.replace("\n\t", "\0\t").split("\n")[:-1]
+    result = []
+    for b in blocks:
+      (ncircs, count) = map(int, b.split("\0")[0].split(" ")[1].split("/"))
+      result.append((ncircs and (-ncircs, 0) or (0, -count), b))
+    return result
+  return [(-float(l.split("=")[1]), l) for l in text.split("\n")[:-1]]
+
+def check(m):
+  for sf in m.stats_files:
+    reasons = isinstance(sf, m.ReasonsFile)
+    new = entries(sf.fname, reasons)
+    old = entries(sf.fname+".old", reasons)
+    # Ties are in nickname order now, and were in dict order
+    assert sorted(new) == sorted(old), sf.fname
+    keys = [k for (k, e) in new]
+    assert keys == sorted(keys), sf.fname
+
+def main(argv):
+  n = 10000
+  passes = 20
+  touched = 50
+  if len(argv) > 1: n = int(argv[1])
+  if len(argv) > 2: passes = int(argv[2])
+  if len(argv) > 3: touched = int(argv[3])
+  tmp = fixtures.scratch_dir()
+  try:
+    m = fixtures.load("nodemon")
+    m.read_routers(FakeConnection(), [FakeStatus(i) for i in xrange(n)])
+    handler = m.NodeHandler(FakeConnection())
+    rand = random.Random(24)
+    times = {"save_stats":[], "resort":[]}
+    def run(events):
+      for fields in fixtures.orconn_fields(rand, n, events):
+        handler.or_conn_status_event(fixtures.orconn_event(fields))
+      t0 = time.time()
+      resort_stats(m)
+      t1 = time.time()
+      m.save_stats(FakeScheduler())
+      t2 = time.time()
+      times["resort"].append(t1-t0)
+      times["save_stats"].append(t2-t1)
+    run(3*n)
+    for i in xrange(passes):
+      run(touched)
+    run(0)
+    check(m)
+    print "%d routers, %d events, then %d passes with %d events:" % \
+          (n, 3*n, passes, touched)
+    for name in ("resort", "save_stats"):
+      t = times[name]
+      sparse = t[1:-1]
+      print "  %-10s first %5.0f ms, sparse %5.1f ms mean %5.1f ms max, " \
+            "idle %5.1f ms" % (name, t[0]*1e3, sum(sparse)/len(sparse)*1e3,
+                               max(sparse)*1e3, t[-1]*1e3)
+  finally:
+    fixtures.remove_scratch(tmp)
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,88 @@
+# Helpers for the monitor tests: fresh copies of bw-informer and
+# nodemon run from a scratch dir (both write their documents relative
+# to the working directory), and stand-ins for the routers, network
+# statuses and control connection they read them from.
+
+import os
+import imp
+import sys
+import random
+import shutil
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+sys.path.append(os.path.join(here, "../.."))
+
+loaded = 0
+
+# A copy of the monitor in NodeMonitors/name.py with its own stats
+def load(name):
+  global loaded
+  loaded += 1
+  m = imp.load_source("%s_%d" % (name.replace("-", "_"), loaded),
+                      os.path.join(here, "..", name+".py"))
+  m.plog = lambda *args: None
+  return m
+
+# Make a scratch dir with the data dirs the monitors write to the
+# working directory, and return it
+def scratch_dir():
+  tmp = tempfile.mkdtemp()
+  os.makedirs(os.path.join(tmp, "data", "bw-informer"))
+  os.makedirs(os.path.join(tmp, "data", "nodemon"))
+  os.chdir(tmp)
+  return tmp
+
+def remove_scratch(tmp):
+  os.chdir(here)
+  shutil.rmtree(tmp)
+
+class FakeRouter:
+  def __init__(self, ns):
+    self.idhex = ns.idhex
+    self.nickname = ns.nickname
+    self.down = 0
+
+class FakeStatus:
+  def __init__(self, i):
+    self.idhex = "%040X" % i
+    self.nickname = "r%d" % i
+    self.flags = ["Running"]
+
+class FakeConnection:
+  def get_router(self, ns):
+    return FakeRouter(ns)
+
+class FakeScheduler:
+  def enter(self, *args):
+    pass
+
+class Event:
+  pass
+
+# Fields of n random ORCONN events, mostly READ and WRITE, for links
+# to the first few of routers, some unknown ids and some client IPs
+def orconn_fields(rand, routers, n):
+  fields = []
+  for i in xrange(n):
+    k = rand.random()
+    if k < .02: endpoint = "$%040X" % (routers+rand.randrange(50))
+    elif k < .04: endpoint = "10.0.0.%d:443" % rand.randrange(50)
+    elif k < .3: endpoint = "$%040X" % int(rand.random()**3*routers)
+    else: endpoint = "r%d" % int(rand.random()**3*routers)
+    fields.append((endpoint,
+                   rand.choice(("READ", "WRITE")*20+("CLOSED", "FAILED")),
+                   rand.randrange(5000), rand.randrange(5000),
+                   rand.randrange(4), rand.randrange(100),
+                   rand.choice(("DONE", "IOERROR", "TIMEOUT"))))
+  return fields
+
+# An ORCONN event from orconn_fields. The handlers change the events
+# they get, so every replay needs its own.
+def orconn_event(fields):
+  o = Event()
+  (o.endpoint, o.status, o.read_bytes, o.wrote_bytes, o.ncircs, o.age,
+   o.reason) = fields
+  o.event_name = "ORCONN"
+  return o
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# The windowed max and percentile columns of bw-informer, against a
+# brute-force window over random traffic: maxima and sample counts must
+# be exact, percentiles at most one histogram bucket below the value.
+
+import math
+import random
+import unittest
+
+import fixtures
+
+bw = fixtures.load("bw-informer")
+
+class SampleRingTest(unittest.TestCase):
+  def setUp(self):
+    self.rand = random.Random(22)
+    self.saved = (bw.window_columns, bw.window)
+    bw.window_columns = True
+
+  def tearDown(self):
+    (bw.window_columns, bw.window) = self.saved
+
+  def check(self, l, now, log, start):
+    sec = int(now)
+    vals = [log.get(s, 0) for s in xrange(max(sec-bw.window+1, start), sec)]
+    (wmax, wpct) = l.window_stats(now)
+    self.assertEqual(wmax, vals and max(vals) or 0)
+    self.assertEqual(l.history.samples, len(vals))
+    vals.sort()
+    for pct in (0, 50, bw.window_percentile, 99, 100):
+      p = l.history.percentile(now, pct)
+      if not vals:
+        self.assertEqual(p, 0)
+        continue
+      exact = vals[max(int(math.ceil(len(vals)*pct/100.0))-1, 0)]
+      self.assertTrue(p <= exact, (pct, p, exact))
+      self.assertTrue(p >= exact/(1+1.0/bw.hist_steps)-1e-9, (pct, p, exact))
+
+  def test_random_traffic(self):
+    checks = 0
+    for trial in xrange(200):
+      bw.window = self.rand.choice([2, 3, 5, 17, 60])
+      start = 1000000 + self.rand.randrange(100)
+      now = start + self.rand.random()
+      l = bw.LinkBandwidthStats()
+      l.record(now, 0, 0)
+      log = {}
+      for step in xrange(self.rand.randrange(1, 300)):
+        # Bursts, pauses and idle gaps longer than the window
+        now += self.rand.choice([0, 0.1, 0.3, 1, 2,
+                                 self.rand.randrange(3*bw.window)]) * \
+               self.rand.random() * 2
+        if self.rand.random() < .8:
+          r = self.rand.choice([0, 1, 5, 100, self.rand.randrange(10**7)])
+          w = self.rand.randrange(1000)
+          l.record(now, r, w)
+          log[int(now)] = log.get(int(now), 0) + r + w
+        if self.rand.random() < .3:
+          self.check(l, now, log, start)
+          checks += 1
+    self.assertTrue(checks > 1000)
+
+  def test_late_event(self):
+    # An event stamped before the second create_document closed
+    bw.window = 10
+    l = bw.LinkBandwidthStats()
+    l.record(100.2, 1000, 0)
+    l.window_stats(101.5)
+    l.record(100.9, 50000, 0)
+    for t in xrange(102, 125):
+      l.record(t+0.5, 10, 0)
+    self.assertEqual(l.window_stats(125.5), (10, 10))
+    self.assertEqual(min(l.history.counts), 0)
+    self.assertEqual(l.history.samples, bw.window-1)
+
+  def test_bucket(self):
+    for total in range(1, 5000)+[self.rand.getrandbits(31)
+                                 for i in xrange(5000)]:
+      b = bw.hist_bucket(total)
+      self.assertTrue(bw.hist_bucket_floor(b) <= total)
+      self.assertTrue(total < bw.hist_bucket_floor(b+1))
+
+  def test_document(self):
+    l = bw.LinkBandwidthStats()
+    l.nickname = "r1"
+    bw.stats = {"r1": l}
+    for columns in (False, True):
+      bw.window_columns = columns
+      bw.create_document()
+      lines = bw.bw_status.split("\r\n")
+      self.assertEqual([len(line.split()) for line in lines],
+                       [3+2*columns, 4+2*columns, 0])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# The monitors' event handlers queue their counts for the writer to
+# apply. Replaying a busy ORCONN (and BW) log on the handler thread
+# while another thread writes the stats as fast as it can must end in
+# the counters and files of a replay with no writer running, and the
+# handlers must not wait on the writer's lock.
+
+import os
+import time
+import random
+import unittest
+import threading
+
+import fixtures
+from fixtures import FakeConnection, FakeScheduler, FakeStatus, Event
+
+routers = 2000
+
+def replay(handler, log, write, bw_events=False):
+  ''' Replay log on this thread while write runs in a loop on another,
+      with a BW event every 100 events if bw_events is set. Returns the
+      number of writer passes. '''
+  stop = []
+  passes = [0]
+  def writer():
+    while not stop:
+      write()
+      passes[0] += 1
+  if write:
+    t = threading.Thread(target=writer)
+    t.setDaemon(True)
+    t.start()
+  bw = Event()
+  bw.read = 1000
+  bw.written = 2000
+  for (i, fields) in enumerate(log):
+    handler.or_conn_status_event(fixtures.orconn_event(fields))
+    if bw_events and i % 100 == 0:
+      handler.bandwidth_event(bw)
+  if write:
+    stop.append(1)
+    t.join(60)
+  return passes[0]
+
+class PendingTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = fixtures.scratch_dir()
+    self.log = fixtures.orconn_fields(random.Random(23), routers, 60000)
+
+  def tearDown(self):
+    fixtures.remove_scratch(self.tmp)
+
+  def load(self, name):
+    m = fixtures.load(name)
+    m.read_routers(FakeConnection(), [FakeStatus(i) for i in xrange(routers)])
+    return m
+
+  def nodemon(self, concurrent):
+    m = self.load("nodemon")
+    handler = m.NodeHandler(FakeConnection())
+    write = concurrent and (lambda: m.save_stats(FakeScheduler()))
+    passes = replay(handler, self.log, write)
+    m.save_stats(FakeScheduler())
+    files = {}
+    for sf in m.stats_files:
+      files[sf.fname] = file(sf.fname).read()
+    return (m, files, passes)
+
+  def informer(self, concurrent):
+    m = self.load("bw-informer")
+    handler = m.LinkHandler(FakeConnection())
+    def write():
+      m.start = time.time()-m.interval
+      m.do_work(FakeScheduler())
+    passes = replay(handler, self.log, concurrent and write, True)
+    m.stats_lock.acquire()
+    m.apply_pending()
+    m.stats_lock.release()
+    counts = {}
+    for (name, l) in m.stats.items()+[("global", m.global_stats)]:
+      counts[name] = (l.tot_read, l.tot_written, l.tot_count, l.tot_ncircs,
+                      l.tot_age)
+    return (m, counts, passes)
+
+  def test_nodemon(self):
+    (m, expected, passes) = self.nodemon(False)
+    (m, files, passes) = self.nodemon(True)
+    self.assertTrue(passes > 2, passes)
+    self.assertEqual(len(m.pending), 0)
+    self.assertEqual(files, expected)
+
+  def test_informer(self):
+    (m, expected, passes) = self.informer(False)
+    (m, counts, passes) = self.informer(True)
+    self.assertTrue(passes > 2, passes)
+    self.assertEqual(len(m.pending), 0)
+    self.assertEqual(counts, expected)
+
+  def test_lock_not_taken(self):
+    # With the writer holding its lock, the handlers still return
+    nodemon = self.load("nodemon")
+    informer = self.load("bw-informer")
+    handlers = [(nodemon.errors_lock, nodemon.NodeHandler(FakeConnection()),
+                 False),
+                (informer.stats_lock, informer.LinkHandler(FakeConnection()),
+                 True)]
+    for (lock, handler, bw_events) in handlers:
+      lock.acquire()
+      t = threading.Thread(target=replay, args=(handler, self.log[:1000],
+                                                None, bw_events))
+      t.setDaemon(True)
+      t.start()
+      t.join(10)
+      self.assertFalse(t.isAlive())
+      lock.release()
+    self.assertEqual(len(nodemon.pending), 1000)
+
+if __name__ == '__main__':
+  unittest.main()
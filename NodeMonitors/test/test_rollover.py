@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# A consensus rollover replayed through the monitors' NEWCONSENSUS and
+# NEWDESC handlers, against a fake control port that answers GETINFO
+# the way Tor does: multi-key data replies, and a 552 for the whole
+# request if one key has no answer. The monitors must only ask for
+# the statuses of routers that were not in the consensus, and end up
+# with every router Tor has a status for.
+
+import base64
+import random
+import socket
+import binascii
+import unittest
+import threading
+import SocketServer
+
+import fixtures
+from TorCtl import TorCtl
+
+def router_id(i):
+  return "%040X" % (i*7919 + 12345)
+
+OLD = range(0, 3000)
+NEW = range(100, 3100)       # 100 routers leave and 100 join
+LATE = range(5000, 5010)     # statuses Tor has that are not in the consensus
+GONE = range(6000, 6005)     # ids Tor has no status for
+
+# The network status document lines of a router
+def status(idhex, nickname):
+  identity = base64.b64encode(binascii.a2b_hex(idhex)).rstrip("=")
+  return "r %s %s %s 2026-10-17 00:00:00 10.0.0.1 9001 0\r\n" \
+         "s Fast Running Valid\r\n" % (nickname, identity, identity)
+
+class ControlHandler(SocketServer.StreamRequestHandler):
+  def status(self, idhex):
+    return status(idhex, self.server.statuses[idhex])
+
+  def handle(self):
+    tor = self.server
+    while True:
+      line = self.rfile.readline()
+      if not line: return
+      keys = line.split()[1:]
+      tor.lock.acquire()
+      tor.requests.append(keys)
+      tor.lock.release()
+      reply = []
+      for k in keys:
+        if k == "ns/all":
+          reply.append("250+ns/all=\r\n"+
+                       "".join(map(self.status, sorted(tor.statuses)))+
+                       ".\r\n")
+          continue
+        if k.startswith("ns/id/") and k[6:] in tor.statuses:
+          reply.append("250+%s=\r\n%s.\r\n" % (k, self.status(k[6:])))
+        elif k.startswith("desc/id/") and k[8:] in tor.statuses:
+          reply.append("250+%s=\r\nrouter %s\r\n.\r\n" % (k, k[8:]))
+        else:
+          reply = ['552 Unrecognized key "%s"\r\n' % k]
+          break
+      else:
+        reply.append("250 OK\r\n")
+      self.wfile.write("".join(reply))
+
+class FakeControlPort(SocketServer.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  def __init__(self, routers):
+    SocketServer.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0),
+                                             ControlHandler)
+    self.lock = threading.Lock()
+    self.requests = []
+    self.set_routers(routers)
+
+  def set_routers(self, routers):
+    self.statuses = dict([(router_id(i), "r%d" % i) for i in routers])
+
+  # The keys asked for that start with kind
+  def keys(self, kind):
+    return [k for keys in self.requests for k in keys if k.startswith(kind)]
+
+# Descriptors are asked for, but the stand-in routers are built from
+# the statuses
+class Connection(TorCtl.Connection):
+  def get_router(self, ns):
+    self.get_info("desc/id/"+ns.idhex)
+    return fixtures.FakeRouter(ns)
+
+class Event:
+  pass
+
+class RolloverTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = fixtures.scratch_dir()
+    self.tor = FakeControlPort(OLD)
+    t = threading.Thread(target=self.tor.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect(self.tor.server_address)
+    self.c = Connection(s)
+    self.c.launch_thread()
+
+  def tearDown(self):
+    self.c.close()
+    self.tor.shutdown()
+    self.tor.server_close()
+    fixtures.remove_scratch(self.tmp)
+
+  def rollover(self, m, handler, routers):
+    # Startup, as startmon and start_sched do it
+    nslist = self.c.get_network_status()
+    m.ns_table.set_consensus(nslist)
+    m.read_routers(self.c, nslist)
+    self.assertEqual(len(self.tor.keys("desc/id/")), len(OLD))
+    # Tor has the new consensus, and statuses for a few more routers
+    self.tor.set_routers(NEW+LATE)
+    self.tor.requests = []
+    n = Event()
+    n.nslist = TorCtl.parse_ns_body("".join(
+        [status(router_id(i), "r%d" % i) for i in NEW]).replace("\r\n", "\n"))
+    handler.new_consensus_event(n)
+    ids = ["$"+router_id(i) for i in NEW+LATE+GONE]
+    random.Random(25).shuffle(ids)
+    for i in xrange(0, len(ids), 50):
+      d = Event()
+      d.idlist = ids[i:i+50]
+      handler.new_desc_event(d)
+    # Only the routers missing from the consensus were looked up
+    asked = self.tor.keys("ns/")
+    self.assertEqual(set(asked),
+                     set(["ns/id/"+router_id(i) for i in LATE+GONE]))
+    self.assertTrue(len(asked) <= 2*len(LATE+GONE), len(asked))
+    self.assertEqual(len(self.tor.keys("desc/id/")), len(NEW+LATE))
+    # Every router Tor had a status for is known
+    for i in OLD+NEW+LATE:
+      self.assertEqual(routers["r%d" % i].idhex, router_id(i))
+    for i in GONE:
+      self.assertFalse(router_id(i) in m.key_to_name)
+    self.assertEqual(sorted(m.ns_table.statuses),
+                     sorted(map(router_id, NEW+LATE)))
+
+  def test_nodemon(self):
+    m = fixtures.load("nodemon")
+    self.rollover(m, m.NodeHandler(self.c), m.errors)
+
+  def test_informer(self):
+    m = fixtures.load("bw-informer")
+    self.rollover(m, m.LinkHandler(self.c), m.stats)
+
+if __name__ == '__main__':
+  unittest.main()
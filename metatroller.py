@@ -19,6 +19,10 @@ needed.
 """
 
 import atexit
+import errno
+import fcntl
+import os
+import select
 import sys
 import socket
 import traceback
@@ -39,6 +43,8 @@ from TorCtl.TorUtil import meta_port, meta_host, control_port, control_host, con
 
 mt_version = "0.1.0-dev"
 max_detach = 3
+# Clients sending longer lines than this are disconnected
+max_line_len = 4096
 
 # Do NOT modify this object directly after it is handed to PathBuilder
 # Use PathBuilder.schedule_selmgr instead.
@@ -61,228 +67,411 @@ def clear_dns_cache(c):
   lines = c.sendAndRecv("SIGNAL CLEARDNSCACHE\r\n")
   for _,msg,more in lines:
     plog("DEBUG", msg)
- 
-def commandloop(s, c, h):
-  "The main metatroller listener loop"
-  s.write("220 Welcome to the Tor Metatroller "+mt_version+"! Try HELP for Info\r\n\r\n")
-
-  percent_skip=__selmgr.percent_skip
-  percent_fast=__selmgr.percent_fast
-  while 1:
-    buf = s.readline()
-    if not buf: break
-    
-    m = re.search(r"^(\S+)(?:\s(\S+))?", buf)
-    if not m:
-      s.write("500 "+buf+" is not a metatroller command\r\n")
-      continue
-    (command, arg) = m.groups()
-    if command == "GETLASTEXIT":
-      # local assignment avoids need for lock w/ GIL
-      # http://effbot.org/pyfaq/can-t-we-get-rid-of-the-global-interpreter-lock.htm
-      # http://effbot.org/pyfaq/what-kinds-of-global-value-mutation-are-thread-safe.htm
-      le = h.last_exit
-      if le:
-        s.write("250 LASTEXIT=$"+le.idhex+" ("+le.nickname+") OK\r\n")
+
+# Metatroller commands. Each is called from the command loop as
+# command(session, arg, reply) and must eventually call reply() with its
+# one line response. Commands that wait on PathBuilder jobs call it from
+# the job, once the job is done, rather than holding up the loop.
+
+def getlastexit(m, arg, reply):
+  # local assignment avoids need for lock w/ GIL
+  # http://effbot.org/pyfaq/can-t-we-get-rid-of-the-global-interpreter-lock.htm
+  # http://effbot.org/pyfaq/what-kinds-of-global-value-mutation-are-thread-safe.htm
+  le = m.h.last_exit
+  if le:
+    reply("250 LASTEXIT=$"+le.idhex+" ("+le.nickname+") OK")
+  else:
+    reply("250 LASTEXIT=0 (0) OK")
+
+def newnym(m, arg, reply):
+  # XXX: Seperate this
+  def notlambda():
+    try:
+      clear_dns_cache(m.c)
+    except:
+      traceback.print_exc()
+      reply("550 NEWNYM failed")
+      return
+    m.h.new_nym = True # GIL hack
+    plog("DEBUG", "Got new nym")
+    reply("250 NEWNYM OK")
+  # Waiting on the control port here would hold up every client, and
+  # PathBuilder jobs can be stuck behind a long SAVESQL
+  threading.Thread(None, notlambda).start()
+
+def getdnsexit(m, arg, reply):
+  # TODO: Takes a hostname? Or prints most recent?
+  reply("510 GETDNSEXIT is not implemented")
+
+def setting(name, attr, schedule):
+  """ A command that reports an integer PathBuilder setting (or a
+      SelectionManager one, if schedule is "schedule_selmgr"), or
+      schedules a change to it """
+  def command(m, arg, reply):
+    try:
+      if arg:
+        value = int(arg)
+        def notlambda(obj): setattr(obj, attr, value)
+        getattr(m.h, schedule)(notlambda)
+        m.settings[attr] = value
+        reply("250 "+name+"="+str(value)+" OK")
+      elif schedule == "schedule_selmgr":
+        reply("250 "+name+"="+str(getattr(m.h.selmgr, attr))+" OK")
       else:
-        s.write("250 LASTEXIT=0 (0) OK\r\n")
-    elif command == "NEWEXIT" or command == "NEWNYM":
-      # XXX: Seperate this
-      clear_dns_cache(c)
-      h.new_nym = True # GIL hack
-      plog("DEBUG", "Got new nym")
-      s.write("250 NEWNYM OK\r\n")
-    elif command == "GETDNSEXIT":
-      pass # TODO: Takes a hostname? Or prints most recent?
-    elif command == "ORDEREXITS":
-      try:
-        if arg:
-          order_exits = int(arg)
-          def notlambda(sm): sm.order_exits=order_exits
-          h.schedule_selmgr(notlambda)
-          s.write("250 ORDEREXITS="+str(order_exits)+" OK\r\n")
-        else:
-          s.write("250 ORDEREXITS="+str(h.selmgr.order_exits)+" OK\r\n")
-      except ValueError:
-        s.write("510 Integer expected\r\n")
-    elif command == "USEALLEXITS":
-      try:
-        if arg:
-          use_all_exits = int(arg)
-          def notlambda(sm): sm.use_all_exits=use_all_exits
-          h.schedule_selmgr(notlambda)
-          s.write("250 USEALLEXITS="+str(use_all_exits)+" OK\r\n")
-        else:
-          s.write("250 USEALLEXITS="+str(h.selmgr.use_all_exits)+" OK\r\n")
-      except ValueError:
-        s.write("510 Integer expected\r\n")
-    elif command == "PRECIRCUITS": # XXX: Use op-addon code for this..
-      try:
-        if arg:
-          num_circuits = int(arg)
-          def notlambda(pb): pb.num_circuits=num_circuits
-          h.schedule_immediate(notlambda)
-          s.write("250 PRECIRCUITS="+str(num_circuits)+" OK\r\n")
-        else:
-          s.write("250 PRECIRCUITS="+str(h.num_circuits)+" OK\r\n")
-      except ValueError:
-        s.write("510 Integer expected\r\n")
-    elif command == "RESOLVEPORT":
-      try:
-        if arg:
-          resolve_port = int(arg)
-          def notlambda(pb): pb.resolve_port=resolve_port
-          h.schedule_immediate(notlambda)
-          s.write("250 RESOLVEPORT="+str(resolve_port)+" OK\r\n")
-        else:
-          s.write("250 RESOLVEPORT="+str(h.resolve_port)+" OK\r\n")
-      except ValueError:
-        s.write("510 Integer expected\r\n")
-    elif command == "PERCENTFAST":
-      try:
-        if arg:
-          percent_fast = int(arg)
-          def notlambda(sm): sm.percent_fast=percent_fast
-          h.schedule_selmgr(notlambda)
-          s.write("250 PERCENTFAST="+str(percent_fast)+" OK\r\n")
-        else:
-          s.write("250 PERCENTFAST="+str(h.selmgr.percent_fast)+" OK\r\n")
-      except ValueError:
-        s.write("510 Integer expected\r\n")
-    elif command == "PERCENTSKIP":
-      try:
-        if arg:
-          percent_skip = int(arg)
-          def notlambda(sm): sm.percent_skip=percent_skip
-          h.schedule_selmgr(notlambda)
-          s.write("250 PERCENTSKIP="+str(percent_skip)+" OK\r\n")
-        else:
-          s.write("250 PERCENTSKIP="+str(h.selmgr.percent_skip)+" OK\r\n")
-      except ValueError:
-        s.write("510 Integer expected\r\n")
-    elif command == "BWCUTOFF":
-      try:
-        if arg:
-          min_bw = int(arg)
-          def notlambda(sm): sm.min_bw=min_bw
-          h.schedule_selmgr(notlambda)
-          s.write("250 BWCUTOFF="+str(min_bw)+" OK\r\n")
-        else:
-          s.write("250 BWCUTOFF="+str(h.selmgr.min_bw)+" OK\r\n")
-      except ValueError:
-        s.write("510 Integer expected\r\n")
-    elif command == "UNIFORM":
-      try:
-        if arg:
-          uniform = int(arg)
-          def notlambda(sm): sm.uniform=uniform
-          h.schedule_selmgr(notlambda)
-          s.write("250 UNIFORM="+str(uniform)+" OK\r\n")
-        else:
-          s.write("250 UNIFORM="+str(h.selmgr.uniform)+" OK\r\n")
-      except ValueError:
-        s.write("510 Integer expected\r\n")
-    elif command == "PATHLEN":
+        reply("250 "+name+"="+str(getattr(m.h, attr))+" OK")
+    except ValueError:
+      reply("510 Integer expected")
+  return command
+
+def setexit(m, arg, reply):
+  if arg:
+    exit_name = arg
+    plog("DEBUG", "Got Setexit: "+exit_name)
+    def notlambda(sm): 
+      plog("DEBUG", "Job for setexit: "+exit_name)
+      sm.set_exit(exit_name)
+    m.h.schedule_selmgr(notlambda)
+    reply("250 OK")
+  else:
+    reply("510 Argument expected")
+
+def guardnodes(m, arg, reply):
+  try:
+    if arg:
+      use_guards = bool(int(arg))
+      plog("DEBUG", "Got Setexit: "+str(use_guards))
+      def notlambda(sm): 
+        plog("DEBUG", "Job for setexit: "+str(use_guards))
+        sm.use_guards = use_guards
+      m.h.schedule_selmgr(notlambda)
+    reply("250 OK")
+  except ValueError:
+    reply("510 Integer expected")
+
+def sqlsupport(m, arg, reply):
+  if not arg:
+    reply("510 database expected")
+    return
+  plog("DEBUG", "Got sqlite: "+arg)
+  use_db = arg
+  def notlambda(this):
+    try:
+      from TorCtl import SQLSupport
+      SQLSupport.setup_db(use_db, echo=False, drop=True)
+      this.add_event_listener(SQLSupport.ConsensusTrackerListener())
+      this.add_event_listener(SQLSupport.StreamListener())
+    except ValueError:
+      reply("510 database expected")
+      return
+    except:
+      traceback.print_exc()
+      reply("550 SQLSUPPORT failed")
+      return
+    plog("DEBUG", "Did sqlite: "+arg)
+    reply("250 OK")
+  m.h.schedule_immediate(notlambda)
+
+def closeallcircs(m, arg, reply):
+  def notlambda(this): this.close_all_circuits()
+  m.h.schedule_immediate(notlambda)
+  reply("250 OK")
+
+def savestats(m, arg, reply):
+  if arg: filename = arg
+  else: filename="./data/stats/stats-"+time.strftime("20%y-%m-%d-%H:%M:%S")
+  def notlambda(this): this.write_stats(filename)
+  m.h.schedule_low_prio(notlambda)
+  reply("250 OK")
+
+def saveratios(m, arg, reply):
+  if arg: rfilename = arg
+  else: rfilename="./data/stats/ratios-"+time.strftime("20%y-%m-%d-%H:%M:%S")
+  def notlambda(this): this.write_ratios(rfilename)
+  m.h.schedule_low_prio(notlambda)
+  reply("250 OK")
+
+def savesql(m, arg, reply):
+  if arg: rfilename = arg
+  else: rfilename="./data/stats/sql-"+time.strftime("20%y-%m-%d-%H:%M:%S")
+  percent_skip = m.settings["percent_skip"]
+  percent_fast = m.settings["percent_fast"]
+  def notlambda(h):
+    try:
+      from TorCtl import SQLSupport
+      SQLSupport.RouterStats.write_stats(file(rfilename, "w"),
+                           percent_skip, percent_fast, 
+                            order_by=SQLSupport.RouterStats.sbw,
+                            recompute=True)
+    except:
+      traceback.print_exc()
+      reply("550 SAVESQL failed")
+      return
+    reply("250 OK")
+  m.h.schedule_low_prio(notlambda)
+
+def resetstats(m, arg, reply):
+  plog("DEBUG", "Got resetstats")
+  def notlambda(this): this.reset()
+  m.h.schedule_low_prio(notlambda)
+  reply("250 OK")
+
+def commit(m, arg, reply):
+  plog("DEBUG", "Got commit")
+  def notlambda(this): this.run_all_jobs = True
+  m.h.schedule_immediate(notlambda)
+  reply("250 OK")
+
+def help(m, arg, reply):
+  reply("250 OK")
+
+commands = {
+  "GETLASTEXIT": getlastexit,
+  "NEWEXIT": newnym,
+  "NEWNYM": newnym,
+  "GETDNSEXIT": getdnsexit,
+  "ORDEREXITS": setting("ORDEREXITS", "order_exits", "schedule_selmgr"),
+  "USEALLEXITS": setting("USEALLEXITS", "use_all_exits", "schedule_selmgr"),
+  # XXX: Use op-addon code for this..
+  "PRECIRCUITS": setting("PRECIRCUITS", "num_circuits", "schedule_immediate"),
+  "RESOLVEPORT": setting("RESOLVEPORT", "resolve_port", "schedule_immediate"),
+  "PERCENTFAST": setting("PERCENTFAST", "percent_fast", "schedule_selmgr"),
+  "PERCENTSKIP": setting("PERCENTSKIP", "percent_skip", "schedule_selmgr"),
+  "BWCUTOFF": setting("BWCUTOFF", "min_bw", "schedule_selmgr"),
+  "UNIFORM": setting("UNIFORM", "uniform", "schedule_selmgr"),
+  # Technically this doesn't need a full selmgr update.. But
+  # the user shouldn't be changing it very often..
+  "PATHLEN": setting("PATHLEN", "pathlen", "schedule_selmgr"),
+  "SETEXIT": setexit,
+  "GUARDNODES": guardnodes,
+  "SQLSUPPORT": sqlsupport,
+  "CLOSEALLCIRCS": closeallcircs,
+  "SAVESTATS": savestats,
+  "SAVERATIOS": saveratios,
+  "SAVESQL": savesql,
+  "RESETSTATS": resetstats,
+  "COMMIT": commit,
+  "HELP": help,
+}
+
+# An optional @tag, then the command and its argument
+command_re = re.compile(r"^(?:@(\S+)\s+)?(\S+)(?:\s(\S+))?")
+
+class MetaSession:
+  """ One metatroller client. Commands are run in the order they arrive,
+      and an untagged command is answered before the next one is run,
+      as with a blocking server. A command prefixed with a tag, as in
+      "@7 SAVESQL file", doesn't hold up the ones after it, and its reply
+      comes back with the same prefix whenever it completes. """
+  def __init__(self, sock, server):
+    sock.setblocking(0)
+    self.sock = sock
+    self.server = server
+    self.c = server.c
+    self.h = server.h
+    # The selection settings this client last saw, for SAVESQL
+    self.settings = {"percent_skip": self.h.selmgr.percent_skip,
+                     "percent_fast": self.h.selmgr.percent_fast}
+    self.ibuf = ""
+    self.obuf = ""
+    self.lines = []
+    self.waiting = False
+    self.reading = False
+    self.writing = False
+    self.closed = False
+    server.register(self)
+    self.write("220 Welcome to the Tor Metatroller "+mt_version+"! Try HELP for Info\r\n\r\n")
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def handle_read(self):
+    try:
+      data = self.sock.recv(4096)
+    except socket.error, e:
+      if e.args[0] in (errno.EAGAIN, errno.EINTR): return
+      data = ""
+    if not data:
+      self.close()
+      return
+    lines = (self.ibuf+data).split("\n")
+    self.ibuf = lines.pop()
+    if len(self.ibuf) > max_line_len:
+      plog("NOTICE", "Metatroller client sent a line over "+str(max_line_len)+" bytes. Closing.")
+      self.write("500 Line too long\r\n")
+      self.close()
+      return
+    for line in lines:
+      self.lines.append(line.rstrip("\r"))
+    # Send the replies to pipelined commands together
+    self.reading = True
+    self.run_commands()
+    self.reading = False
+    if self.obuf and not self.closed:
+      self.handle_write()
+
+  def run_commands(self):
+    while self.lines and not self.waiting and not self.closed:
+      line = self.lines.pop(0)
+      m = command_re.search(line)
+      if not m or m.group(2) not in commands:
+        self.write("500 "+line+" is not a metatroller command\r\n")
+        continue
+      (tag, command, arg) = m.groups()
+      if not tag:
+        self.waiting = True
       try:
-        if arg:
-          pathlen = int(arg)
-          # Technically this doesn't need a full selmgr update.. But
-          # the user shouldn't be changing it very often..
-          def notlambda(sm): sm.pathlen=pathlen
-          h.schedule_selmgr(notlambda)
-          s.write("250 PATHLEN="+str(pathlen)+" OK\r\n")
-        else:
-          s.write("250 PATHLEN="+str(h.selmgr.pathlen)+" OK\r\n")
-      except ValueError:
-        s.write("510 Integer expected\r\n")
-    elif command == "SETEXIT":
-      if arg:
-        exit_name = arg
-        plog("DEBUG", "Got Setexit: "+exit_name)
-        def notlambda(sm): 
-          plog("DEBUG", "Job for setexit: "+exit_name)
-          sm.set_exit(exit_name)
-        h.schedule_selmgr(notlambda)
-        s.write("250 OK\r\n")
+        commands[command](self, arg, self.replier(tag))
+      except:
+        traceback.print_exc()
+        self.replier(tag)("550 "+command+" failed")
+
+  def replier(self, tag):
+    "The reply function for a command, callable from any thread"
+    def reply(line):
+      if tag:
+        line = "@"+tag+" "+line
+      if threading.currentThread() is self.server.loop_thread:
+        self.finish(tag, line)
       else:
-        s.write("510 Argument expected\r\n")
-    elif command == "GUARDNODES":
+        self.server.call_in_loop(lambda: self.finish(tag, line))
+    return reply
+
+  def finish(self, tag, line):
+    self.write(line+"\r\n")
+    if not tag:
+      self.waiting = False
+      self.run_commands()
+
+  def write(self, data):
+    if self.closed: return
+    self.obuf += data
+    if not self.reading:
+      self.handle_write()
+
+  def handle_write(self):
+    try:
+      sent = self.sock.send(self.obuf)
+    except socket.error, e:
+      if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+        self.close()
+        return
+      sent = 0
+    self.obuf = self.obuf[sent:]
+    if self.writing != (self.obuf != ""):
+      self.writing = not self.writing
+      self.server.want_write(self, self.writing)
+
+  def close(self):
+    if self.closed: return
+    self.closed = True
+    self.server.unregister(self)
+    self.sock.close()
+
+class Waker:
+  "Wakes the command loop up to run functions other threads queue for it"
+  def __init__(self):
+    (self.r, self.w) = os.pipe()
+    for fd in (self.r, self.w):
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self.queue = []
+    self.queue_lock = threading.Lock()
+
+  def fileno(self):
+    return self.r
+
+  def call(self, func):
+    self.queue_lock.acquire()
+    self.queue.append(func)
+    self.queue_lock.release()
+    try:
+      os.write(self.w, "x")
+    except OSError:
+      pass # The pipe is full, so the loop will wake anyway
+
+  def handle_read(self):
+    try:
+      os.read(self.r, 4096)
+    except OSError:
+      pass
+    self.queue_lock.acquire()
+    queue = self.queue
+    self.queue = []
+    self.queue_lock.release()
+    for func in queue:
       try:
-        if arg:
-          use_guards = bool(int(arg))
-          plog("DEBUG", "Got Setexit: "+str(use_guards))
-          def notlambda(sm): 
-            plog("DEBUG", "Job for setexit: "+str(use_guards))
-            sm.use_guards = use_guards
-          h.schedule_selmgr(notlambda)
-        s.write("250 OK\r\n")
-      except ValueError:
-        s.write("510 Integer expected\r\n")
-    elif command == "SQLSUPPORT":
-     try:
-        if arg:
-          plog("DEBUG", "Got sqlite: "+arg)
-          use_db = arg
-          from TorCtl import SQLSupport
-          SQLSupport.setup_db(use_db, echo=False, drop=True)
-          h.add_event_listener(SQLSupport.ConsensusTrackerListener())
-          h.add_event_listener(SQLSupport.StreamListener())
-          plog("DEBUG", "Did sqlite: "+arg)
-          s.write("250 OK\r\n")
-     except ValueError:
-       s.write("510 database expected\r\n")
-    elif command == "CLOSEALLCIRCS":
-      def notlambda(this): this.close_all_circuits()
-      h.schedule_immediate(notlambda)
-      s.write("250 OK\r\n")
-    elif command == "SAVESTATS":
-      if arg: filename = arg
-      else: filename="./data/stats/stats-"+time.strftime("20%y-%m-%d-%H:%M:%S")
-      def notlambda(this): this.write_stats(filename)
-      h.schedule_low_prio(notlambda)
-      s.write("250 OK\r\n")
-    elif command == "SAVERATIOS":
-      if arg: rfilename = arg
-      else: rfilename="./data/stats/ratios-"+time.strftime("20%y-%m-%d-%H:%M:%S")
-      def notlambda(this): this.write_ratios(rfilename)
-      h.schedule_low_prio(notlambda)
-      s.write("250 OK\r\n")
-    elif command == "SAVESQL":
-      # TODO: Use threading conditions more. Maybe even get some
-      # better status reporting than always blindly printing OK.
-
-      if arg: rfilename = arg
-      else: rfilename="./data/stats/sql-"+time.strftime("20%y-%m-%d-%H:%M:%S")
-      cond = threading.Condition() 
-      def notlambda(h):
-        cond.acquire()
-        SQLSupport.RouterStats.write_stats(file(rfilename, "w"),
-                             percent_skip, percent_fast, 
-                              order_by=SQLSupport.RouterStats.sbw,
-                              recompute=True)
-        cond.notify()
-        cond.release()
-      cond.acquire()
-      h.schedule_low_prio(notlambda)
-      cond.wait()
-      cond.release()
-      s.write("250 OK\r\n")
-    elif command == "RESETSTATS":
-      plog("DEBUG", "Got resetstats")
-      def notlambda(this): this.reset()
-      h.schedule_low_prio(notlambda)
-      s.write("250 OK\r\n")
-    elif command == "COMMIT":
-      plog("DEBUG", "Got commit")
-      def notlambda(this): this.run_all_jobs = True
-      h.schedule_immediate(notlambda)
-      s.write("250 OK\r\n")
-    elif command == "HELP":
-      s.write("250 OK\r\n")
-       
+        func()
+      except:
+        traceback.print_exc()
+
+class MetaServer:
+  """ The metatroller listener. Every client is run from the one poll()
+      loop in serve_forever(), so no command may block; commands that
+      have to wait finish from other threads through call_in_loop(). """
+  def __init__(self, c, h, host, port):
+    self.c = c
+    self.h = h
+    self.loop_thread = None
+    self.handlers = {}
+    self.poller = select.poll()
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind((host, port))
+    self.sock.listen(128)
+    self.sock.setblocking(0)
+    self.register(self)
+    self.waker = Waker()
+    self.register(self.waker)
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def register(self, handler):
+    self.handlers[handler.fileno()] = handler
+    self.poller.register(handler.fileno(), select.POLLIN)
+
+  def unregister(self, handler):
+    del self.handlers[handler.fileno()]
+    self.poller.unregister(handler.fileno())
+
+  def want_write(self, handler, writing):
+    if writing:
+      self.poller.modify(handler.fileno(), select.POLLIN|select.POLLOUT)
     else:
-      s.write("500 "+buf+" is not a metatroller command\r\n")
-  s.close()
+      self.poller.modify(handler.fileno(), select.POLLIN)
+
+  def call_in_loop(self, func):
+    self.waker.call(func)
+
+  def handle_read(self):
+    try:
+      (client, addr) = self.sock.accept()
+    except socket.error, e:
+      if e.args[0] in (errno.EAGAIN, errno.EINTR): return
+      raise
+    MetaSession(client, self)
+
+  def serve_forever(self):
+    self.loop_thread = threading.currentThread()
+    while 1:
+      try:
+        events = self.poller.poll()
+      except select.error, e:
+        if e.args[0] == errno.EINTR: continue
+        raise
+      for (fd, flags) in events:
+        handler = self.handlers.get(fd)
+        try:
+          if handler and flags & (select.POLLIN|select.POLLHUP|select.POLLERR):
+            handler.handle_read()
+          if handler and flags & select.POLLOUT and fd in self.handlers:
+            handler.handle_write()
+        except:
+          traceback.print_exc()
+          if isinstance(handler, MetaSession):
+            handler.close()
+
+  def close(self):
+    self.sock.close()
 
 def cleanup(c, s, f):
   plog("INFO", "Resetting __LeaveStreamsUnattached=0 and FetchUselessDescriptors="+f)
@@ -295,13 +484,9 @@ def cleanup(c, s, f):
 
 def listenloop(c, h, f):
   """Loop that handles metatroller commands"""
-  srv = ListenSocket(meta_host, meta_port)
+  srv = MetaServer(c, h, meta_host, meta_port)
   atexit.register(cleanup, *(c, srv, f))
-  while 1:
-    client = srv.accept()
-    if not client: break
-    thr = threading.Thread(None, lambda: commandloop(BufSock(client), c, h))
-    thr.start()
+  srv.serve_forever()
   srv.close()
 
 def startup():
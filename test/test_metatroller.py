@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# The metatroller's command loop under load, against a stand-in
+# PathBuilder that runs its jobs on its own thread the way the real one
+# does between events. Hundreds of clients pipeline commands and tag
+# slow SAVESQLs, and every one of them must get its replies, in order.
+# test_load reports each command's p50/p95/p99 latency, send to reply.
+
+import os
+import sys
+import time
+import Queue
+import shutil
+import socket
+import tempfile
+import unittest
+import threading
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+import metatroller
+import TorCtl
+from TorCtl import TorUtil
+
+class FakeExit:
+  idhex = "AB"*20
+  nickname = "exit1"
+
+class FakeSelectionManager:
+  def __init__(self):
+    self.percent_fast = 80
+    self.percent_skip = 0
+    self.order_exits = 1
+    self.use_all_exits = 1
+    self.min_bw = 1024
+    self.uniform = 1
+    self.pathlen = 3
+    self.exit = None
+  def set_exit(self, exit_name):
+    self.exit = exit_name
+
+class FakeConnection:
+  def __init__(self, delay):
+    self.delay = delay
+  def sendAndRecv(self, line):
+    time.sleep(self.delay)
+    return [("250", "OK", None)]
+
+class FakeSQLSupport:
+  ''' Stands in for TorCtl.SQLSupport. write_stats takes a while, and
+      records the selection settings it was handed. '''
+  delay = 0.005
+  written = {}
+  class RouterStats:
+    sbw = None
+    def write_stats(f, percent_skip, percent_fast, **kwargs):
+      time.sleep(FakeSQLSupport.delay)
+      FakeSQLSupport.written[f.name] = (percent_skip, percent_fast)
+      f.close()
+    write_stats = staticmethod(write_stats)
+  def setup_db(*args, **kwargs):
+    pass
+  setup_db = staticmethod(setup_db)
+  class ConsensusTrackerListener:
+    pass
+  class StreamListener:
+    pass
+
+class FakePathBuilder:
+  ''' Runs immediate and selmgr jobs first, then one low priority job at
+      a time, each costing a little like an event would. '''
+  def __init__(self):
+    self.selmgr = FakeSelectionManager()
+    self.last_exit = FakeExit()
+    self.num_circuits = 1
+    self.resolve_port = 0
+    self.jobs = Queue.PriorityQueue()
+    self.scheduled = 0
+    t = threading.Thread(target=self.run)
+    t.setDaemon(True)
+    t.start()
+
+  def run(self):
+    while True:
+      (prio, n, job, arg) = self.jobs.get()
+      time.sleep(0.0005)
+      job(arg)
+
+  def schedule(self, prio, job, arg):
+    self.scheduled += 1
+    self.jobs.put((prio, self.scheduled, job, arg))
+
+  def add_event_listener(self, listener):
+    pass
+  def schedule_immediate(self, job):
+    self.schedule(0, job, self)
+  def schedule_selmgr(self, job):
+    self.schedule(0, job, self.selmgr)
+  def schedule_low_prio(self, job):
+    self.schedule(1, job, self)
+
+class Client:
+  def __init__(self, port):
+    self.sock = socket.create_connection(("127.0.0.1", port))
+    self.sock.settimeout(30)
+    self.f = self.sock.makefile("rb")
+    assert self.f.readline().startswith("220")
+    self.f.readline()
+
+  def send(self, *lines):
+    self.sock.sendall("".join([l+"\r\n" for l in lines]))
+
+  def readline(self):
+    return self.f.readline().rstrip("\r\n")
+
+  def close(self):
+    self.f.close()
+    self.sock.close()
+
+server = None
+
+def start_server():
+  global server
+  if not server:
+    TorUtil.loglevel = "ERROR"
+    TorCtl.SQLSupport = FakeSQLSupport
+    sys.modules["TorCtl.SQLSupport"] = FakeSQLSupport
+    server = metatroller.MetaServer(FakeConnection(0.002), FakePathBuilder(),
+                                    "127.0.0.1", 0)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+  return server.sock.getsockname()[1]
+
+def percentile(times, p):
+  ''' the p-th percentile of the sorted list times, nearest rank '''
+  return times[min(len(times)-1, int(len(times)*p/100.0))]
+
+class MetatrollerTest(unittest.TestCase):
+  def setUp(self):
+    self.port = start_server()
+    self.dir = tempfile.mkdtemp(prefix="metatroller-test-")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_load(self):
+    clients = 200
+    rounds = 5
+    errors = []
+    # (command, seconds from its send to its reply)
+    latencies = []
+    def run(i):
+      try:
+        c = Client(self.port)
+        for r in xrange(rounds):
+          sql = os.path.join(self.dir, "sql-%d-%d" % (i, r))
+          fast = 70 + (i+r) % 20
+          commands = [("GETLASTEXIT", "250 LASTEXIT=$"+"AB"*20+" (exit1) OK"),
+                      ("PERCENTFAST %d" % fast, "250 PERCENTFAST=%d OK" % fast),
+                      ("@%d.%d SAVESQL %s" % (i, r, sql), None),
+                      ("ORDEREXITS 1", "250 ORDEREXITS=1 OK"),
+                      ("NEWNYM", "250 NEWNYM OK"),
+                      ("BOGUS", "500 BOGUS is not a metatroller command"),
+                      ("HELP", "250 OK")]
+          if i % 2:
+            # Pipelined
+            c.send(*[command for (command, reply) in commands])
+            sent = time.time()
+          tagged = None
+          for (command, want) in commands:
+            if not i % 2:
+              c.send(command)
+              sent = time.time()
+            if not want:
+              saved = sent
+              continue
+            line = c.readline()
+            if line.startswith("@"):
+              tagged = line
+              latencies.append(("SAVESQL", time.time()-saved))
+              line = c.readline()
+            latencies.append((command.split()[0], time.time()-sent))
+            if line != want:
+              errors.append((command, line))
+          if not tagged:
+            tagged = c.readline()
+            latencies.append(("SAVESQL", time.time()-saved))
+          if tagged != "@%d.%d 250 OK" % (i, r):
+            errors.append(("SAVESQL", tagged))
+          # SAVESQL saw the PERCENTFAST this client sent before it
+          elif FakeSQLSupport.written.get(sql) != (0, fast):
+            errors.append(("SAVESQL settings", FakeSQLSupport.written.get(sql)))
+        c.close()
+      except Exception, e:
+        errors.append(repr(e))
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in xrange(clients)]
+    t0 = time.time()
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join(60)
+    self.assertEqual(errors, [])
+    self.assertTrue(len(FakeSQLSupport.written) >= clients*rounds)
+    # The 1000 SAVESQLs take 5s on the PathBuilder thread, but nothing
+    # waits behind them except the tagged replies
+    self.assertTrue(time.time()-t0 < 15)
+    by_command = {}
+    for (command, latency) in latencies:
+      by_command.setdefault(command, []).append(latency)
+    sys.stderr.write("\n%-12s %6s %8s %8s %8s\n" %
+                     ("command", "count", "p50 ms", "p95 ms", "p99 ms"))
+    for command in sorted(by_command):
+      times = sorted(by_command[command])
+      sys.stderr.write("%-12s %6d %8.1f %8.1f %8.1f\n" %
+                       ((command, len(times)) +
+                        tuple([percentile(times, p)*1e3 for p in (50, 95, 99)])))
+    # and no untagged command waited behind a SAVESQL
+    slow = percentile(sorted(by_command["SAVESQL"]), 50)
+    for command in by_command:
+      if command != "SAVESQL":
+        self.assertTrue(percentile(sorted(by_command[command]), 99) < slow,
+                        command)
+
+  def test_untagged_order(self):
+    c = Client(self.port)
+    sql = os.path.join(self.dir, "sql-untagged")
+    c.send("SAVESQL "+sql, "GETLASTEXIT", "PERCENTSKIP 5", "PERCENTSKIP")
+    self.assertEqual(c.readline(), "250 OK")
+    self.assertTrue(os.path.exists(sql))
+    self.assertTrue(c.readline().startswith("250 LASTEXIT="))
+    self.assertEqual(c.readline(), "250 PERCENTSKIP=5 OK")
+    c.close()
+
+  def test_client_leaves(self):
+    c = Client(self.port)
+    c.send("SAVESQL "+os.path.join(self.dir, "sql-gone"), "NEWNYM")
+    c.close()
+    time.sleep(0.2)
+    c = Client(self.port)
+    c.send("", "GETDNSEXIT", "SQLSUPPORT", "PRECIRCUITS x", "@b RESOLVEPORT 9",
+           "HELP")
+    self.assertEqual([c.readline() for i in xrange(6)],
+                     ["500  is not a metatroller command",
+                      "510 GETDNSEXIT is not implemented",
+                      "510 database expected", "510 Integer expected",
+                      "@b 250 RESOLVEPORT=9 OK", "250 OK"])
+    c.close()
+
+  def test_long_line(self):
+    c = Client(self.port)
+    c.sock.sendall("HELP\r\n"+"x"*(metatroller.max_line_len+10))
+    self.assertEqual(c.readline(), "250 OK")
+    self.assertEqual(c.readline(), "500 Line too long")
+    self.assertEqual(c.readline(), "")
+    c.close()
+    # A line right at the limit is fine
+    c = Client(self.port)
+    c.send("SETEXIT "+"x"*(metatroller.max_line_len-10))
+    self.assertEqual(c.readline(), "250 OK")
+    c.close()
+
+if __name__ == '__main__':
+  unittest.main()